@@ -0,0 +1,242 @@
+"""Deterministic stand-in for the OSRM and TomTom HTTP APIs.
+
+Routes follow straight lines between waypoints, with distances from
+haversine times a detour factor, and traffic speeds are hashed from the
+location, so results are stable across runs. Every response can be delayed
+to mimic a remote server: set FAKE_UPSTREAM_LATENCY_MS and
+FAKE_UPSTREAM_JITTER_MS, or call configure(), which can also make a share
+of requests stall or fail to mimic a misbehaving one. Use it in-process through
+httpx.ASGITransport, or serve it with
+    uvicorn routing.benchmarks.fake_upstream:app --port 5000
+and point OSRM_URL and TOMTOM_API_URL at it.
+"""
+from collections import Counter
+from fastapi import FastAPI, Request, Response
+from urllib.parse import urlsplit
+import asyncio
+import itertools
+import os
+import random
+import zlib
+import numpy as np
+from .instances import AVERAGE_SPEED, DETOUR_FACTOR
+from ..geometry import haversine
+
+app = FastAPI()
+
+# Seconds added to every response: a fixed base plus uniform jitter
+latency = float(os.getenv("FAKE_UPSTREAM_LATENCY_MS", "0")) / 1000
+jitter = float(os.getenv("FAKE_UPSTREAM_JITTER_MS", "0")) / 1000
+_rng = random.Random(0)
+# Share of requests delayed by a further `tail` seconds, and share answered with a 503
+tail_share = 0.0
+tail = 0.0
+error_share = 0.0
+# Requests served per endpoint, for checking how many upstream calls a run made
+calls: Counter = Counter()
+# Asynchronous matrix jobs and routing batches: id -> [polls left, result]
+jobs: dict = {}
+_job_ids = itertools.count()
+# Status polls an asynchronous job answers "in progress" to before it is done
+JOB_POLLS = 1
+
+def configure(latency_ms: float = 0, jitter_ms: float = 0, seed: int = 0,
+              tail_rate: float = 0, tail_ms: float = 0, error_rate: float = 0):
+    """Set the simulated network delay and faults and reset the request counters"""
+    global latency, jitter, _rng, tail_share, tail, error_share
+    latency = latency_ms / 1000
+    jitter = jitter_ms / 1000
+    _rng = random.Random(seed)
+    tail_share = tail_rate
+    tail = tail_ms / 1000
+    error_share = error_rate
+    calls.clear()
+
+@app.middleware("http")
+async def simulate_latency(request: Request, call_next):
+    calls[request.url.path.split("/")[1]] += 1
+    delay = latency + (_rng.uniform(0, jitter) if jitter else 0)
+    if tail_share and _rng.random() < tail_share:
+        delay += tail
+    if delay:
+        await asyncio.sleep(delay)
+    if error_share and _rng.random() < error_share:
+        return Response(status_code=503)
+    return await call_next(request)
+
+def parse_coordinates(coordinates: str) -> np.ndarray:
+    return np.array([list(map(float, pair.split(","))) for pair in coordinates.split(";")])
+
+def straight_line(lon_lat: np.ndarray, points_per_leg: int = 20) -> np.ndarray:
+    t = np.linspace(0, 1, points_per_leg, endpoint=False)[:, None]
+    legs = [a + t * (b - a) for a, b in zip(lon_lat[:-1], lon_lat[1:])]
+    return np.vstack(legs + [lon_lat[-1:]])
+
+def leg_distances(lon_lat: np.ndarray) -> np.ndarray:
+    return haversine(lon_lat[:-1, 1], lon_lat[:-1, 0], lon_lat[1:, 1], lon_lat[1:, 0]) * DETOUR_FACTOR
+
+def speed_at(lat: float, lon: float) -> int:
+    """Current speed in km/h, 8-45 like the fake traffic provider"""
+    return 8 + zlib.crc32(f"{lat:.3f},{lon:.3f}".encode()) % 38
+
+@app.get("/route/v1/{profile}/{coordinates}")
+async def route(profile: str, coordinates: str, alternatives: str = "false"):
+    lon_lat = parse_coordinates(coordinates)
+    legs = leg_distances(lon_lat)
+    distance = float(legs.sum())
+    routes = [{
+        'geometry': {'type': 'LineString', 'coordinates': straight_line(lon_lat).tolist()},
+        'distance': distance,
+        'duration': distance / AVERAGE_SPEED,
+        'legs': [{'distance': float(d), 'duration': float(d) / AVERAGE_SPEED, 'steps': []} for d in legs]
+    }]
+    if alternatives != "false":
+        # A detour bowed out to one side, 15% longer, sharing both ends
+        geometry = straight_line(lon_lat)
+        bow = np.sin(np.linspace(0, np.pi, len(geometry)))[:, None] * 0.01
+        routes.append({
+            'geometry': {'type': 'LineString', 'coordinates': (geometry + bow).tolist()},
+            'distance': distance * 1.15,
+            'duration': distance * 1.15 / AVERAGE_SPEED,
+            'legs': [{'distance': float(d) * 1.15, 'duration': float(d) * 1.15 / AVERAGE_SPEED, 'steps': []}
+                     for d in legs]
+        })
+    return {'code': 'Ok', 'routes': routes}
+
+@app.get("/table/v1/{profile}/{coordinates}")
+async def table(profile: str, coordinates: str, request: Request):
+    lon_lat = parse_coordinates(coordinates)
+    all_indices = ";".join(map(str, range(len(lon_lat))))
+    sources = list(map(int, request.query_params.get('sources', all_indices).split(";")))
+    destinations = list(map(int, request.query_params.get('destinations', all_indices).split(";")))
+    src, dst = lon_lat[sources], lon_lat[destinations]
+    distances = haversine(src[:, None, 1], src[:, None, 0], dst[None, :, 1], dst[None, :, 0]) * DETOUR_FACTOR
+    return {
+        'code': 'Ok',
+        'distances': distances.tolist(),
+        'durations': (distances / AVERAGE_SPEED).tolist()
+    }
+
+@app.get("/nearest/v1/{profile}/{coordinates}")
+async def nearest(profile: str, coordinates: str):
+    lon, lat = parse_coordinates(coordinates)[0]
+    return {'code': 'Ok', 'waypoints': [{'location': [lon, lat], 'distance': 0.0}]}
+
+@app.get("/traffic/services/4/flowSegmentData/{style}/{zoom}/json")
+async def flow_segment(style: str, zoom: int, point: str):
+    lat, lon = map(float, point.split(","))
+    return {
+        'flowSegmentData': {
+            'currentSpeed': speed_at(lat, lon),
+            'freeFlowSpeed': 50,
+            'currentTravelTime': 60,
+            'freeFlowTravelTime': 30,
+            'confidence': 1.0
+        }
+    }
+
+@app.get("/search/2/search")
+async def search(query: str, limit: int = 10):
+    """A few addresses along a street named after the query, at a location hashed from it"""
+    seed = zlib.crc32(query.lower().encode())
+    lat, lon = 52.4 + (seed % 2000) / 10000, 13.3 + (seed // 2000 % 2000) / 10000
+    return {'results': [{
+        'id': f"{seed}-{k}",
+        'address': {'freeformAddress': f"{k * 2 + 1} {query.title()} Street, Berlin"},
+        'position': {'lat': lat + k * 1e-4, 'lon': lon}
+    } for k in range(min(limit, 5))]}
+
+@app.get("/routing/1/calculateRoute/{locations}/json")
+async def calculate_route(locations: str):
+    return route_summary(locations)
+
+def route_summary(locations: str) -> dict:
+    lon_lat = np.array([list(map(float, pair.split(",")))[::-1] for pair in locations.split(":")])
+    legs = leg_distances(lon_lat)
+
+    def summary(distance: float) -> dict:
+        return {
+            'lengthInMeters': int(distance),
+            'travelTimeInSeconds': int(distance / AVERAGE_SPEED),
+            'trafficDelayInSeconds': 0
+        }
+
+    return {
+        'routes': [{
+            'summary': summary(float(legs.sum())),
+            'legs': [{
+                'summary': summary(float(d)),
+                'points': [{'latitude': lat, 'longitude': lon}
+                           for lon, lat in straight_line(lon_lat[i:i + 2]).tolist()]
+            } for i, d in enumerate(legs)]
+        }]
+    }
+
+@app.post("/routing/matrix/2")
+async def matrix(request: Request):
+    return matrix_result(await request.json())
+
+def matrix_result(body: dict) -> dict:
+    def lon_lat(entries) -> np.ndarray:
+        return np.array([[e['point']['longitude'], e['point']['latitude']] for e in entries])
+
+    src, dst = lon_lat(body['origins']), lon_lat(body['destinations'])
+    distances = haversine(src[:, None, 1], src[:, None, 0], dst[None, :, 1], dst[None, :, 0]) * DETOUR_FACTOR
+    return {
+        'data': [{
+            'originIndex': i,
+            'destinationIndex': j,
+            'routeSummary': {
+                'lengthInMeters': int(distances[i, j]),
+                'travelTimeInSeconds': int(distances[i, j] / AVERAGE_SPEED)
+            }
+        } for i in range(len(src)) for j in range(len(dst))]
+    }
+
+@app.post("/routing/matrix/2/async")
+async def matrix_async(request: Request):
+    job_id = str(next(_job_ids))
+    jobs[job_id] = [JOB_POLLS, matrix_result(await request.json())]
+    return Response(content=f'{{"jobId": "{job_id}", "state": "Submitted"}}',
+                    status_code=202, media_type="application/json")
+
+@app.get("/routing/matrix/2/async/{job_id}")
+async def matrix_status(job_id: str):
+    job = jobs[job_id]
+    job[0] -= 1
+    return {'jobId': job_id, 'state': 'InProgress' if job[0] >= 0 else 'Completed'}
+
+@app.get("/routing/matrix/2/async/{job_id}/result")
+async def matrix_download(job_id: str):
+    return jobs.pop(job_id)[1]
+
+def batch_items(body: dict) -> dict:
+    items = []
+    for item in body['batchItems']:
+        path = urlsplit(item['query']).path
+        items.append({'statusCode': 200, 'response': route_summary(path.split("/")[2])})
+    return {'formatVersion': '0.0.12', 'batchItems': items,
+            'summary': {'successfulRequests': len(items), 'totalRequests': len(items)}}
+
+@app.post("/routing/1/batch/sync/json")
+async def batch_sync(request: Request):
+    return batch_items(await request.json())
+
+@app.post("/routing/1/batch/json")
+async def batch_async(request: Request):
+    batch_id = str(next(_job_ids))
+    jobs[batch_id] = [JOB_POLLS, batch_items(await request.json())]
+    return Response(status_code=202, headers={'Location': f"/routing/1/batch/{batch_id}?key=fake"})
+
+@app.get("/routing/1/batch/{batch_id}")
+async def batch_status(batch_id: str):
+    job = jobs[batch_id]
+    job[0] -= 1
+    if job[0] >= 0:
+        return Response(status_code=202)
+    # Like redirectMode=manual: send the client on to the download
+    return Response(status_code=303, headers={'Location': f"/routing/1/batch/download/{batch_id}"})
+
+@app.get("/routing/1/batch/download/{batch_id}")
+async def batch_download(batch_id: str):
+    return jobs.pop(batch_id)[1]
@@ -0,0 +1,93 @@
+from typing import Dict, List, Tuple
+import numpy as np
+
+# Rough urban driving: road distance ~1.3x straight line at ~30 km/h
+DETOUR_FACTOR = 1.3
+AVERAGE_SPEED = 30 / 3.6
+
+def generate_points(n: int, seed: int, clustered: bool = False,
+                    center: Tuple[float, float] = (52.52, 13.40),
+                    radius_km: float = 15) -> List[Dict]:
+    """Seeded stop locations around a city centre, uniform or in a few dense clusters"""
+    rng = np.random.default_rng(seed)
+    spread = radius_km / 111
+    if clustered:
+        n_clusters = max(1, n // 25)
+        centers = rng.uniform(-spread, spread, size=(n_clusters, 2))
+        offsets = centers[rng.integers(0, n_clusters, n)] + rng.normal(0, spread / 15, size=(n, 2))
+    else:
+        offsets = rng.uniform(-spread, spread, size=(n, 2))
+    return [
+        {'lat': float(center[0] + dlat), 'lon': float(center[1] + dlon), 'name': f'Stop {i + 1}'}
+        for i, (dlat, dlon) in enumerate(offsets)
+    ]
+
+def synthetic_matrix(points: List[Dict]) -> Tuple[np.ndarray, np.ndarray]:
+    """Durations and distances from straight-line distance scaled by a detour factor"""
+    lat = np.radians([p['lat'] for p in points])
+    lon = np.radians([p['lon'] for p in points])
+    dlat = lat[:, None] - lat[None, :]
+    dlon = lon[:, None] - lon[None, :]
+    h = np.sin(dlat / 2) ** 2 + np.cos(lat)[:, None] * np.cos(lat)[None, :] * np.sin(dlon / 2) ** 2
+    distances = 2 * 6371000 * np.arcsin(np.sqrt(h)) * DETOUR_FACTOR
+    return distances / AVERAGE_SPEED, distances
+
+def generate_vrp_instance(n_orders: int, n_vehicles: int, seed: int,
+                          clustered: bool = False, n_depots: int = 3) -> Dict:
+    """Seeded fleet instance with capacities, 8-hour shifts and 2-hour delivery windows"""
+    rng = np.random.default_rng(seed)
+    depots = generate_points(n_depots, seed + 1, radius_km=5)
+    stops = generate_points(n_orders, seed, clustered)
+    durations, distances = synthetic_matrix(depots + stops)
+
+    total_demand = 0
+    orders = []
+    for k in range(n_orders):
+        window_start = 8 * 3600 + int(rng.integers(0, 7)) * 3600
+        demand = int(rng.integers(1, 4))
+        total_demand += demand
+        orders.append({
+            'node': n_depots + k,
+            'demand': demand,
+            'service_time': 300,
+            'tw_start': window_start,
+            'tw_end': window_start + 2 * 3600
+        })
+
+    # Enough capacity overall, but not so much that vehicles never fill up
+    capacity = max(10, int(np.ceil(1.3 * total_demand / n_vehicles)))
+    vehicles = [{
+        'start': v % n_depots,
+        'end': v % n_depots,
+        'capacity': capacity,
+        'shift_start': 8 * 3600,
+        'shift_end': 18 * 3600
+    } for v in range(n_vehicles)]
+
+    return {
+        'durations': durations,
+        'distances': distances,
+        'vehicles': vehicles,
+        'orders': orders
+    }
+
+def generate_route_request(n_stops: int, seed: int, clustered: bool = False) -> Dict:
+    """Body for /route-update and the batch endpoint: a depot and n_stops destinations"""
+    depot = generate_points(1, seed + 1, radius_km=5)[0]
+    return {
+        'depot': {'lat': depot['lat'], 'lon': depot['lon']},
+        'destinations': generate_points(n_stops, seed, clustered)
+    }
+
+def generate_multi_point_request(n_stops: int, seed: int, clustered: bool = False) -> Dict:
+    """Body for /optimize-multi-point: n_stops stored routes sharing one start point"""
+    depot = generate_points(1, seed + 1, radius_km=5)[0]
+    return {
+        'user_id': f'benchmark-{seed}',
+        'routes': [{
+            'id': f'route-{i}',
+            'name': stop['name'],
+            'startPoint': f"{depot['lat']} {depot['lon']}",
+            'endPoint': f"{stop['lat']} {stop['lon']}"
+        } for i, stop in enumerate(generate_points(n_stops, seed, clustered))]
+    }
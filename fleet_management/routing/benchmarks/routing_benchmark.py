@@ -0,0 +1,732 @@
+"""Benchmark the routing service against the fake OSRM/TomTom upstream.
+
+Run from fleet_management/:
+    python -m routing.benchmarks.routing_benchmark --output results.json
+    python -m routing.benchmarks.routing_benchmark --compare baseline.json
+    python -m routing.benchmarks.routing_benchmark --compare baseline.json results.json
+
+Nine sections, each over seeded uniform and clustered instances:
+  solver     TSP solve time, tour cost and peak memory per quality setting
+  parallel   best tour cost over time of iterated local search on one process
+             and on --workers processes, against single-run local search
+  eta        time-dependent ETA evaluation of route geometries and of many
+             candidate tours over a matrix, for 1 and many departure times
+  geocoding  build time and prefix lookup time of the local place index
+  matrix     distance matrix build time and upstream requests, from OSRM
+             tables and from TomTom synchronous blocks or asynchronous jobs
+  sparse     memory, upstream requests, solve time and tour cost of the
+             k-nearest-neighbour matrix and solver against the dense ones
+  edits      latency and upstream requests of inserting and removing a stop
+             on an optimized route, and the distance each insertion adds
+  endpoints  throughput and p50/p99 latency of the API under concurrent load
+  resilience p50/p99 route latency and share of estimated results while the
+             upstream is healthy, has a slow tail or is down, with and
+             without hedged requests
+
+Upstream responses are deterministic and delayed by --latency-ms, so runs are
+comparable between versions. With --compare, every metric that got worse
+than the baseline by more than --threshold is reported and the exit status
+is 1.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+import numpy as np
+from ..geocoding import PlaceIndex
+from ..eta import RouteTimeline, SpeedProfiles, tour_arrival_times
+from ..parallel_solver import parallel_ils
+from ..tsp_solver import QUALITY_SETTINGS, Deadline, nearest_neighbor, solve_tsp, tour_cost
+from . import fake_upstream
+from .instances import (generate_multi_point_request, generate_points, generate_route_request,
+                        synthetic_matrix)
+
+SOLVER_SIZES = [5, 10, 25, 50, 100, 200, 500]
+PARALLEL_SIZES = [200, 500]
+# Share of the --budget at which the parallel section samples the best cost
+CHECKPOINTS = [0.1, 0.25, 0.5, 1.0]
+ETA_VERTICES = [1000, 20000]
+ETA_DEPARTURES = [1, 1000]
+# Candidate tours evaluated at once in the eta section, each over ETA_TOUR_STOPS stops
+ETA_TOURS = 1000
+ETA_TOUR_STOPS = 100
+ETA_TOUR_DEPARTURES = [1, 10]
+GEOCODING_SIZES = [1000, 100000]
+# Prefix lookups timed per index size
+GEOCODING_LOOKUPS = 1000
+MATRIX_SIZES = [10, 50, 100, 200, 500]
+SPARSE_SIZES = [1000, 2000]
+SPARSE_NEIGHBORS = 12
+EDIT_SIZES = [100, 1000]
+ENDPOINT_SIZES = [5, 25, 100]
+# Upstream faults injected by the resilience section, as fake_upstream.configure arguments
+RESILIENCE_SCENARIOS = {
+    'healthy': {},
+    'slow-tail': {'tail_rate': 0.05, 'tail_ms': 2000},
+    'outage': {'error_rate': 1.0}
+}
+# Requests sent before the faults start, so hedging has latencies to go on
+RESILIENCE_WARMUP = 50
+RESILIENCE_STOPS = 5
+# Seconds each route request may spend on upstream calls
+RESILIENCE_DEADLINE = 1.0
+
+# Metrics where a larger value is an improvement; everything else should go down
+HIGHER_IS_BETTER = {'throughput', 'improvement_over_nn', 'improvement_over_local_search'}
+
+FAKE_UPSTREAM_URL = "http://fake-upstream"
+
+def summarize(samples: List[float]) -> Dict:
+    """Mean, p50 and p99 of latencies in seconds, reported in milliseconds"""
+    samples = np.asarray(samples) * 1000
+    return {
+        'mean_ms': float(samples.mean()),
+        'p50_ms': float(np.percentile(samples, 50)),
+        'p99_ms': float(np.percentile(samples, 99))
+    }
+
+def median_time(fn: Callable, repeat: int):
+    """Return (fn's last result, median wall time in seconds over repeat runs)"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return result, float(np.median(times))
+
+async def median_time_async(fn: Callable, repeat: int):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = await fn()
+        times.append(time.perf_counter() - start)
+    return result, float(np.median(times))
+
+def peak_memory(fn: Callable):
+    """Run fn under tracemalloc and return (its result, peak bytes allocated)"""
+    tracemalloc.start()
+    try:
+        result = fn()
+        return result, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def max_rss_mb() -> float:
+    # ru_maxrss is kilobytes on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+def fake_http_client():
+    import httpx
+    from ..http_client import HTTPClient
+    return HTTPClient(transport=httpx.ASGITransport(app=fake_upstream.app))
+
+def bench_solver(sizes: List[int], seeds: range, repeat: int) -> List[Dict]:
+    results = []
+    for n in sizes:
+        for clustered in (False, True):
+            for seed in seeds:
+                points = generate_points(1, seed + 1, radius_km=5) + generate_points(n, seed, clustered)
+                distances = synthetic_matrix(points)[1]
+                baseline = tour_cost(distances, nearest_neighbor(distances))
+
+                runs = {}
+                # Iterated settings run to their time budget; the parallel section covers them
+                for quality in (q for q, settings in QUALITY_SETTINGS.items() if not settings.get('iterated')):
+                    solution, wall_time = median_time(lambda: solve_tsp(distances, quality=quality), repeat)
+                    runs[quality] = (wall_time, solution)
+                best = min(solution['objective'] for _, solution in runs.values())
+
+                for quality, (wall_time, solution) in runs.items():
+                    # Memory is measured on a separate run; tracemalloc slows allocation down
+                    _, peak = peak_memory(lambda: solve_tsp(distances, quality=quality))
+                    results.append({
+                        'benchmark': 'solver',
+                        'params': {'stops': n, 'clustered': clustered, 'seed': seed, 'quality': quality},
+                        'metrics': {
+                            'time_ms': 1000 * wall_time,
+                            'objective': solution['objective'],
+                            'improvement_over_nn': 1 - solution['objective'] / baseline,
+                            'gap_to_best': solution['objective'] / best - 1,
+                            'peak_memory_mb': peak / 2 ** 20
+                        },
+                        'solver': solution['solver']
+                    })
+                    print(json.dumps(results[-1]))
+    return results
+
+def bench_parallel(sizes: List[int], seeds: range, budget: float, workers: int) -> List[Dict]:
+    results = []
+    for count in sorted({1, workers}):
+        # Start the pool and load the solver in each worker before timing anything
+        if count > 1:
+            parallel_ils(np.ones((20, 20)) - np.eye(20), Deadline(1.0),
+                         {**QUALITY_SETTINGS['thorough'], 'seed': 0}, workers=count)
+    for n in sizes:
+        for clustered in (False, True):
+            for seed in seeds:
+                points = generate_points(1, seed + 1, radius_km=5) + generate_points(n, seed, clustered)
+                distances = synthetic_matrix(points)[1]
+                local = solve_tsp(distances, quality='quality')['objective']
+
+                for count in sorted({1, workers}):
+                    curve = []
+                    start = time.perf_counter()
+                    parallel_ils(
+                        distances, Deadline(budget), {**QUALITY_SETTINGS['thorough'], 'seed': seed},
+                        on_improvement=lambda order, cost: curve.append((time.perf_counter() - start, cost)),
+                        workers=count
+                    )
+                    metrics = {}
+                    for share in CHECKPOINTS:
+                        found = [cost for elapsed, cost in curve if elapsed <= share * budget]
+                        if found:
+                            metrics[f'objective_at_{share * budget:g}s'] = found[-1]
+                    metrics['improvement_over_local_search'] = 1 - curve[-1][1] / local
+                    metrics['time_to_best_ms'] = 1000 * curve[-1][0]
+                    results.append({
+                        'benchmark': 'parallel',
+                        'params': {'stops': n, 'clustered': clustered, 'seed': seed,
+                                   'workers': count, 'budget': budget},
+                        'metrics': metrics
+                    })
+                    print(json.dumps(results[-1]))
+    return results
+
+def synthetic_route(vertices: int, stops: int, seed: int, clustered: bool = False) -> Dict:
+    """A route-shaped geometry visiting stops in order, with legs timed like the matrix"""
+    points = generate_points(stops + 1, seed, clustered)
+    lon_lat = np.array([[p['lon'], p['lat']] for p in points])
+    # Spread the vertices over the legs, with a little noise so cells change mid-leg
+    legs = np.repeat(np.arange(stops), vertices // stops)
+    share = np.concatenate([np.linspace(0, 1, vertices // stops, endpoint=False)] * stops)
+    coordinates = lon_lat[legs] + share[:, None] * (lon_lat[legs + 1] - lon_lat[legs])
+    coordinates += np.random.default_rng(seed).normal(0, 1e-4, coordinates.shape)
+    coordinates = np.vstack([coordinates, lon_lat[-1:]])
+    durations, distances = synthetic_matrix(points)
+    leg_list = [{'distance': float(distances[k, k + 1]), 'duration': float(durations[k, k + 1])}
+                for k in range(stops)]
+    return {
+        'geometry': {'type': 'LineString', 'coordinates': coordinates.tolist()},
+        'distance': sum(leg['distance'] for leg in leg_list),
+        'duration': sum(leg['duration'] for leg in leg_list),
+        'legs': leg_list
+    }
+
+def bench_eta(vertices: List[int], departures: List[int], seeds: range, repeat: int) -> List[Dict]:
+    results = []
+    # A Monday morning, so departures run through the rush hour
+    start = datetime(2024, 3, 4, 7).timestamp()
+    for clustered in (False, True):
+        for seed in seeds:
+            # Observed profiles for every cell the instances touch
+            rng = np.random.default_rng(seed)
+            points = generate_points(5000, seed + 2)
+            epochs = start + rng.uniform(0, 7 * 24 * 3600, len(points) * 10)
+            lat = np.repeat([p['lat'] for p in points], 10)
+            lon = np.repeat([p['lon'] for p in points], 10)
+            profiles = SpeedProfiles.from_observations(lat, lon, epochs, rng.uniform(0.4, 1.0, len(epochs)),
+                                                       min_samples=1)
+
+            for n in vertices:
+                route = synthetic_route(n, 20, seed, clustered)
+                timeline, build_time = median_time(lambda: RouteTimeline(route, profiles), repeat)
+                for count in departures:
+                    times = start + np.arange(count) * 60.0
+                    _, wall_time = median_time(lambda: timeline.stop_arrivals(times), repeat)
+                    results.append({
+                        'benchmark': 'eta',
+                        'params': {'vertices': n, 'departures': count, 'clustered': clustered, 'seed': seed},
+                        'metrics': {
+                            'build_ms': 1000 * build_time,
+                            'time_ms': 1000 * wall_time,
+                            'spans': len(timeline.span_seconds)
+                        }
+                    })
+                    print(json.dumps(results[-1]))
+
+            tour_points = generate_points(ETA_TOUR_STOPS, seed, clustered)
+            durations = synthetic_matrix(tour_points)[0]
+            tours = np.array([rng.permutation(ETA_TOUR_STOPS) for _ in range(ETA_TOURS)])
+            for count in ETA_TOUR_DEPARTURES:
+                times = start + np.arange(count) * 60.0
+                _, wall_time = median_time(lambda: tour_arrival_times(durations, tours, times, profiles), repeat)
+                results.append({
+                    'benchmark': 'eta',
+                    'params': {'tours': ETA_TOURS, 'stops': ETA_TOUR_STOPS, 'departures': count,
+                               'clustered': clustered, 'seed': seed},
+                    'metrics': {'time_ms': 1000 * wall_time}
+                })
+                print(json.dumps(results[-1]))
+    return results
+
+def synthetic_places(n: int, seed: int) -> List[Dict]:
+    """Seeded addresses like "128 Linden Street, Berlin" from a small street vocabulary"""
+    rng = np.random.default_rng(seed)
+    roots = ['Linden', 'Oranien', 'Kastanien', 'Schiller', 'Goethe', 'Baker', 'Market', 'Mill',
+             'Station', 'Church', 'Park', 'Garden', 'Bridge', 'River', 'Forest', 'King']
+    suffixes = ['Street', 'Road', 'Avenue', 'Lane', 'Way', 'Allee', 'strasse', 'Platz']
+    points = generate_points(n, seed)
+    return [{
+        'id': f"{seed}-{i}",
+        'name': f"Customer {i}",
+        'address': f"{rng.integers(1, 300)} {roots[rng.integers(len(roots))]}{rng.integers(1, 40)} "
+                   f"{suffixes[rng.integers(len(suffixes))]}, Berlin",
+        'position': {'lat': point['lat'], 'lon': point['lon']}
+    } for i, point in enumerate(points)]
+
+def bench_geocoding(sizes: List[int], seeds: range, repeat: int) -> List[Dict]:
+    results = []
+    for n in sizes:
+        for seed in seeds:
+            places = synthetic_places(n, seed)
+
+            def build():
+                index = PlaceIndex()
+                index.add_many(places, own=True)
+                return index
+
+            index, build_time = median_time(build, repeat)
+            rng = np.random.default_rng(seed)
+            addresses = [places[i]['address'] for i in rng.integers(0, n, GEOCODING_LOOKUPS)]
+            prefixes = [address[:rng.integers(3, 15)] for address in addresses]
+            _, lookup_time = median_time(lambda: [index.search(prefix) for prefix in prefixes], repeat)
+            results.append({
+                'benchmark': 'geocoding',
+                'params': {'places': n, 'seed': seed},
+                'metrics': {
+                    'build_ms': 1000 * build_time,
+                    'lookup_us': 1e6 * lookup_time / GEOCODING_LOOKUPS
+                }
+            })
+            print(json.dumps(results[-1]))
+    return results
+
+async def bench_matrix(sizes: List[int], seeds: range, repeat: int) -> List[Dict]:
+    from ..routing_backend import OSRMRoutingBackend
+    from ..tomtom_service import TomTomService
+
+    os.environ['TOMTOM_API_URL'] = FAKE_UPSTREAM_URL
+    http_client = fake_http_client()
+    # Both fake APIs are counted by the first path segment of their URLs
+    backends = {
+        'osrm': (OSRMRoutingBackend(FAKE_UPSTREAM_URL, http_client=http_client), 'table'),
+        'tomtom': (TomTomService("benchmark", http_client, vehicle={'vehicleWeight': 18000}), 'routing')
+    }
+    results = []
+    try:
+        for name, (backend, endpoint) in backends.items():
+            for n in sizes:
+                for clustered in (False, True):
+                    for seed in seeds:
+                        points = generate_points(n, seed, clustered)
+                        fake_upstream.calls.clear()
+                        _, wall_time = await median_time_async(lambda: backend.get_matrix(points), repeat)
+                        results.append({
+                            'benchmark': 'matrix',
+                            'params': {'backend': name, 'points': n, 'clustered': clustered, 'seed': seed},
+                            'metrics': {
+                                'time_ms': 1000 * wall_time,
+                                'upstream_requests': fake_upstream.calls[endpoint] / repeat
+                            }
+                        })
+                        print(json.dumps(results[-1]))
+    finally:
+        await http_client.aclose()
+    return results
+
+async def bench_sparse(sizes: List[int], seeds: range, neighbors: int) -> List[Dict]:
+    from ..candidate_solver import solve_candidate_tsp
+    from ..distance_matrix import get_sparse_matrix
+    from ..routing_backend import OSRMRoutingBackend
+
+    http_client = fake_http_client()
+    backend = OSRMRoutingBackend(FAKE_UPSTREAM_URL, http_client=http_client)
+    results = []
+    try:
+        for n in sizes:
+            for clustered in (False, True):
+                for seed in seeds:
+                    points = generate_points(n, seed, clustered)
+                    fake_upstream.calls.clear()
+                    dense, dense_time = await median_time_async(lambda: backend.get_matrix(points), 1)
+                    dense_calls = fake_upstream.calls['table']
+                    fake_upstream.calls.clear()
+                    sparse, sparse_time = await median_time_async(
+                        lambda: get_sparse_matrix(backend, points, neighbors), 1)
+                    sparse_calls = fake_upstream.calls['table']
+
+                    dense_solution = solve_tsp(dense.distances, seed=seed)
+                    sparse_solution = solve_candidate_tsp(sparse, seed=seed)
+                    # Both tours priced on the full road matrix
+                    dense_cost = tour_cost(dense.distances, dense_solution['order'])
+                    sparse_cost = tour_cost(dense.distances, sparse_solution['order'])
+                    for mode, matrix_time, nbytes, calls, solution, cost in (
+                            ('dense', dense_time, dense.durations.nbytes + dense.distances.nbytes, dense_calls,
+                             dense_solution, dense_cost),
+                            ('sparse', sparse_time, sparse.nbytes, sparse_calls, sparse_solution, sparse_cost)):
+                        results.append({
+                            'benchmark': 'sparse',
+                            'params': {'mode': mode, 'points': n, 'neighbors': neighbors,
+                                       'clustered': clustered, 'seed': seed},
+                            'metrics': {
+                                'matrix_ms': 1000 * matrix_time,
+                                'matrix_bytes': nbytes,
+                                'upstream_requests': calls,
+                                'solve_ms': 1000 * solution['solve_time'],
+                                'tour_cost': cost,
+                                'cost_over_dense': cost / dense_cost - 1
+                            }
+                        })
+                        print(json.dumps(results[-1]))
+    finally:
+        await http_client.aclose()
+    return results
+
+async def bench_edits(sizes: List[int], seeds: range, repeat: int) -> List[Dict]:
+    from ..distance_matrix import estimate_matrix
+    from ..route_cache import RouteCache
+    from ..route_optimizer import RouteOptimizer
+    from ..stop_edits import StopEditor
+
+    os.environ.setdefault("TOMTOM_API_KEY", "benchmark")
+    os.environ.update({
+        'OSRM_URL': FAKE_UPSTREAM_URL,
+        'TOMTOM_API_URL': FAKE_UPSTREAM_URL,
+        'ROUTING_BACKEND': 'osrm',
+        'TRAFFIC_PROVIDER': 'tomtom'
+    })
+    http_client = fake_http_client()
+    results = []
+    try:
+        for n in sizes:
+            for clustered in (False, True):
+                for seed in seeds:
+                    # A fresh cache, so every edit fetches the matrix rows it needs
+                    optimizer = RouteOptimizer(http_client, RouteCache())
+                    editor = StopEditor(optimizer, store=None)
+                    points = generate_points(n + 1 + repeat, seed, clustered)
+                    depot, new_stops = points[0], points[n + 1:]
+                    order = nearest_neighbor(estimate_matrix(points[:n + 1]).distances)
+                    route = await optimizer.optimize_route(depot, [points[i] for i in order[1:]])
+
+                    insert_times, remove_times, added, calls = [], [], [], 0
+                    for stop in new_stops:
+                        fake_upstream.calls.clear()
+                        start = time.perf_counter()
+                        edited = await editor.insert(route, depot, stop)
+                        insert_times.append(time.perf_counter() - start)
+                        calls += fake_upstream.calls['table']
+                        added.append(edited['distance'] - route['distance'])
+
+                        number = edited['stops'][len(edited['stops']) // 2]['number']
+                        fake_upstream.calls.clear()
+                        start = time.perf_counter()
+                        await editor.remove(edited, depot, number)
+                        remove_times.append(time.perf_counter() - start)
+                        calls += fake_upstream.calls['table']
+                    results.append({
+                        'benchmark': 'edits',
+                        'params': {'stops': n, 'clustered': clustered, 'seed': seed},
+                        'metrics': {
+                            'insert_ms': 1000 * float(np.median(insert_times)),
+                            'remove_ms': 1000 * float(np.median(remove_times)),
+                            'upstream_requests': calls / (2 * repeat),
+                            'added_distance': float(np.median(added))
+                        }
+                    })
+                    print(json.dumps(results[-1]))
+    finally:
+        await http_client.aclose()
+    return results
+
+async def load_test(client, requests: List[Dict], concurrency: int) -> Dict:
+    """Send {method, url, body} requests from `concurrency` workers and time each one"""
+    queue = list(reversed(requests))
+    latencies = []
+    errors = 0
+
+    async def worker():
+        nonlocal errors
+        while queue:
+            request = queue.pop()
+            start = time.perf_counter()
+            response = await client.request(request['method'], request['url'], json=request['body'])
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    wall_time = time.perf_counter() - start
+    return {
+        'throughput': len(latencies) / wall_time,
+        **summarize(latencies),
+        'errors': errors
+    }
+
+async def bench_endpoints(sizes: List[int], seeds: range, concurrency: int, count: int) -> List[Dict]:
+    import httpx
+    from ..http_client import set_http_client
+    from ..main import app
+
+    store_dir = tempfile.TemporaryDirectory()
+    os.environ.setdefault("TOMTOM_API_KEY", "benchmark")
+    os.environ.update({
+        'OSRM_URL': FAKE_UPSTREAM_URL,
+        'TOMTOM_API_URL': FAKE_UPSTREAM_URL,
+        'ROUTING_BACKEND': 'osrm',
+        'TRAFFIC_PROVIDER': 'tomtom',
+        'ROUTE_STORE_PATH': os.path.join(store_dir.name, 'routes.db'),
+        'LIVE_UPDATE_INTERVAL': '3600',
+        'WARMUP_DEPOTS': '',
+        # Worker processes could not reach the in-process fake, so jobs run inline
+        'JOB_WORKERS': '0'
+    })
+    set_http_client(fake_http_client())
+
+    # Each request gets its own instance so the route cache doesn't answer for us
+    endpoints = {
+        'route-update': lambda n, seed: {
+            'method': 'POST', 'url': f'/route-update/{seed}',
+            'body': generate_route_request(n, seed)
+        },
+        'optimize-multi-point': lambda n, seed: {
+            'method': 'POST', 'url': '/optimize-multi-point',
+            'body': generate_multi_point_request(n, seed)
+        }
+    }
+
+    results = []
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://app", timeout=None) as client:
+            for name, make_request in endpoints.items():
+                for n in sizes:
+                    for seed in seeds:
+                        requests = [make_request(n, 1000 * seed + i) for i in range(count)]
+                        fake_upstream.calls.clear()
+                        rss_before = max_rss_mb()
+                        metrics = await load_test(client, requests, concurrency)
+                        metrics['upstream_requests'] = sum(fake_upstream.calls.values()) / count
+                        metrics['rss_growth_mb'] = max_rss_mb() - rss_before
+                        results.append({
+                            'benchmark': 'endpoint',
+                            'params': {'endpoint': name, 'stops': n, 'seed': seed, 'concurrency': concurrency},
+                            'metrics': metrics
+                        })
+                        print(json.dumps(results[-1]))
+    store_dir.cleanup()
+    return results
+
+async def bench_resilience(seeds: range, concurrency: int, count: int,
+                           latency_ms: float, jitter_ms: float) -> List[Dict]:
+    import httpx
+    from ..http_client import HTTPClient
+    from ..resilience import deadline
+    from ..route_cache import RouteCache
+    from ..route_optimizer import RouteOptimizer
+
+    os.environ.setdefault("TOMTOM_API_KEY", "benchmark")
+    os.environ.update({
+        'OSRM_URL': FAKE_UPSTREAM_URL,
+        'TOMTOM_API_URL': FAKE_UPSTREAM_URL,
+        'ROUTING_BACKEND': 'osrm',
+        'TRAFFIC_PROVIDER': 'tomtom'
+    })
+
+    async def route_all(optimizer: RouteOptimizer, requests: List[Dict]) -> Dict:
+        queue = list(reversed(requests))
+        latencies = []
+        estimated = errors = 0
+
+        async def worker():
+            nonlocal estimated, errors
+            while queue:
+                request = queue.pop()
+                start = time.perf_counter()
+                try:
+                    with deadline(RESILIENCE_DEADLINE):
+                        route = await optimizer.optimize_route(request['depot'], request['destinations'])
+                    estimated += 'estimates' in route
+                except Exception:
+                    errors += 1
+                latencies.append(time.perf_counter() - start)
+
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        return {**summarize(latencies), 'estimated_share': estimated / len(requests), 'errors': errors}
+
+    # Every failed upstream call is logged as an error; they are expected here
+    logging.disable(logging.ERROR)
+    results = []
+    for scenario, faults in RESILIENCE_SCENARIOS.items():
+        for hedge in (False, True):
+            for seed in seeds:
+                # A fresh client and cache: no latency history, breaker state or cached routes
+                http_client = HTTPClient(transport=httpx.ASGITransport(app=fake_upstream.app),
+                                         hedge_percentile=95 if hedge else 0)
+                optimizer = RouteOptimizer(http_client, RouteCache())
+                requests = [generate_route_request(RESILIENCE_STOPS, 1000 * seed + i)
+                            for i in range(RESILIENCE_WARMUP + count)]
+                fake_upstream.configure(latency_ms, jitter_ms, seed)
+                await route_all(optimizer, requests[:RESILIENCE_WARMUP])
+                fake_upstream.configure(latency_ms, jitter_ms, seed, **faults)
+                metrics = await route_all(optimizer, requests[RESILIENCE_WARMUP:])
+                metrics['upstream_requests'] = sum(fake_upstream.calls.values()) / count
+                await http_client.aclose()
+                results.append({
+                    'benchmark': 'resilience',
+                    'params': {'scenario': scenario, 'hedge': hedge, 'seed': seed, 'concurrency': concurrency},
+                    'metrics': metrics
+                })
+                print(json.dumps(results[-1]))
+    fake_upstream.configure(latency_ms, jitter_ms)
+    logging.disable(logging.INFO)
+    return results
+
+def git_revision() -> Optional[str]:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                             capture_output=True, text=True, check=True)
+        return out.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def result_key(result: Dict) -> str:
+    return f"{result['benchmark']} " + json.dumps(result['params'], sort_keys=True)
+
+def compare(baseline: Dict, current: Dict, threshold: float) -> List[Dict]:
+    """Relative change of every metric present in both runs, worst regressions first"""
+    previous = {result_key(r): r['metrics'] for r in baseline['results']}
+    changes = []
+    for result in current['results']:
+        old_metrics = previous.get(result_key(result))
+        if old_metrics is None:
+            continue
+        for metric, new in result['metrics'].items():
+            old = old_metrics.get(metric)
+            if old is None:
+                continue
+            # Regression is positive whichever direction is better for the metric
+            if old == new:
+                change = 0.0
+            else:
+                change = (new - old) / abs(old) if old else float('inf')
+            regression = -change if metric in HIGHER_IS_BETTER else change
+            changes.append({
+                'key': result_key(result),
+                'metric': metric,
+                'baseline': old,
+                'current': new,
+                'regression': regression,
+                'regressed': regression > threshold
+            })
+    changes.sort(key=lambda c: -c['regression'])
+    return changes
+
+def print_comparison(changes: List[Dict], threshold: float) -> bool:
+    regressed = [c for c in changes if c['regressed']]
+    for c in regressed:
+        print(f"REGRESSION {c['key']} {c['metric']}: "
+              f"{c['baseline']:.4g} -> {c['current']:.4g} ({100 * c['regression']:+.1f}%)")
+    improved = sum(1 for c in changes if c['regression'] < -threshold)
+    print(f"{len(changes)} metrics compared: {len(regressed)} regressed, "
+          f"{improved} improved by more than {100 * threshold:.0f}%")
+    return bool(regressed)
+
+def parse_sizes(value: str) -> List[int]:
+    return [int(size) for size in value.split(",")]
+
+def run(args) -> Dict:
+    fake_upstream.configure(args.latency_ms, args.jitter_ms, seed=0)
+    seeds = range(args.seeds)
+    results = []
+    if 'solver' in args.sections:
+        results += bench_solver(args.solver_sizes, seeds, args.repeat)
+    if 'parallel' in args.sections:
+        results += bench_parallel(args.parallel_sizes, seeds, args.budget, args.workers)
+    if 'eta' in args.sections:
+        results += bench_eta(args.eta_vertices, args.eta_departures, seeds, args.repeat)
+    if 'geocoding' in args.sections:
+        results += bench_geocoding(args.geocoding_sizes, seeds, args.repeat)
+    if 'matrix' in args.sections:
+        results += asyncio.run(bench_matrix(args.matrix_sizes, seeds, args.repeat))
+    if 'sparse' in args.sections:
+        results += asyncio.run(bench_sparse(args.sparse_sizes, seeds, args.sparse_neighbors))
+    if 'edits' in args.sections:
+        results += asyncio.run(bench_edits(args.edit_sizes, seeds, args.repeat))
+    if 'endpoints' in args.sections:
+        results += asyncio.run(bench_endpoints(args.endpoint_sizes, seeds, args.concurrency, args.requests))
+    if 'resilience' in args.sections:
+        results += asyncio.run(bench_resilience(seeds, args.concurrency, args.requests,
+                                                args.latency_ms, args.jitter_ms))
+    return {
+        'meta': {
+            'timestamp': datetime.now().isoformat(),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'latency_ms': args.latency_ms,
+            'jitter_ms': args.jitter_ms,
+            'max_rss_mb': max_rss_mb()
+        },
+        'results': results
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sections", default="solver,parallel,eta,geocoding,matrix,sparse,edits,endpoints,resilience",
+                        type=lambda value: value.split(","))
+    parser.add_argument("--solver-sizes", type=parse_sizes, default=SOLVER_SIZES)
+    parser.add_argument("--parallel-sizes", type=parse_sizes, default=PARALLEL_SIZES)
+    parser.add_argument("--budget", type=float, default=10, help="seconds per parallel-section solve")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="processes for the parallel section, compared with one")
+    parser.add_argument("--eta-vertices", type=parse_sizes, default=ETA_VERTICES)
+    parser.add_argument("--eta-departures", type=parse_sizes, default=ETA_DEPARTURES)
+    parser.add_argument("--geocoding-sizes", type=parse_sizes, default=GEOCODING_SIZES)
+    parser.add_argument("--matrix-sizes", type=parse_sizes, default=MATRIX_SIZES)
+    parser.add_argument("--sparse-sizes", type=parse_sizes, default=SPARSE_SIZES)
+    parser.add_argument("--sparse-neighbors", type=int, default=SPARSE_NEIGHBORS)
+    parser.add_argument("--edit-sizes", type=parse_sizes, default=EDIT_SIZES)
+    parser.add_argument("--endpoint-sizes", type=parse_sizes, default=ENDPOINT_SIZES)
+    parser.add_argument("--seeds", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=5, help="runs per solver/matrix timing and edits per route (median kept)")
+    parser.add_argument("--latency-ms", type=float, default=20, help="simulated upstream latency")
+    parser.add_argument("--jitter-ms", type=float, default=10)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=100, help="requests per endpoint and size")
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--compare", nargs="+", metavar="FILE",
+                        help="baseline results, and optionally current results instead of running")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="relative change that counts as a regression")
+    args = parser.parse_args()
+
+    # The app logs every request at INFO, which would dominate the timings
+    logging.disable(logging.INFO)
+
+    if args.compare and len(args.compare) == 2:
+        with open(args.compare[1]) as f:
+            current = json.load(f)
+    else:
+        current = run(args)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(current, f, indent=2)
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            baseline = json.load(f)
+        sys.exit(1 if print_comparison(compare(baseline, current, args.threshold), args.threshold) else 0)
@@ -0,0 +1,67 @@
+"""Measure import/startup time and per-request overhead of the routing app.
+
+Run from fleet_management/:  python -m routing.benchmarks.startup_benchmark
+Upstream calls go to the in-process fake, so only our own overhead is timed.
+"""
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+IMPORT_SNIPPET = (
+    "import time; t = time.perf_counter(); import routing.main; "
+    "print(time.perf_counter() - t)"
+)
+
+def measure_import(runs: int) -> float:
+    """Median wall time to import routing.main in a fresh interpreter"""
+    env = dict(os.environ, TOMTOM_API_KEY=os.getenv("TOMTOM_API_KEY", "benchmark"))
+    samples = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-c", IMPORT_SNIPPET],
+                             capture_output=True, text=True, check=True, env=env)
+        samples.append(float(out.stdout.strip().splitlines()[-1]))
+    return statistics.median(samples)
+
+async def measure_requests(requests: int) -> dict:
+    import httpx
+    from ..http_client import HTTPClient, set_http_client
+    from ..main import app
+    from .fake_upstream import app as fake_osrm
+
+    os.environ.setdefault("TOMTOM_API_KEY", "benchmark")
+    os.environ["OSRM_URL"] = "http://fake-osrm"
+    set_http_client(HTTPClient(transport=httpx.ASGITransport(app=fake_osrm)))
+
+    start = time.perf_counter()
+    async with app.router.lifespan_context(app):
+        startup = time.perf_counter() - start
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://app") as client:
+            body = {
+                'depot': {'lat': 52.52, 'lon': 13.40},
+                'destinations': [{'lat': 52.50, 'lon': 13.45}, {'lat': 52.48, 'lon': 13.38}]
+            }
+            # The first call fills the route cache; the rest measure our own overhead
+            await client.post("/route-update/0", json=body)
+            latencies = []
+            for _ in range(requests):
+                t = time.perf_counter()
+                response = await client.post("/route-update/0", json=body)
+                latencies.append(time.perf_counter() - t)
+                response.raise_for_status()
+
+    latencies.sort()
+    return {
+        'startup_seconds': startup,
+        'request_p50_ms': 1000 * latencies[len(latencies) // 2],
+        'request_p99_ms': 1000 * latencies[int(len(latencies) * 0.99)]
+    }
+
+if __name__ == "__main__":
+    results = {'import_seconds': measure_import(5)}
+    results.update(asyncio.run(measure_requests(500)))
+    print(json.dumps(results, indent=2))
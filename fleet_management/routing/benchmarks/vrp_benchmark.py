@@ -0,0 +1,50 @@
+"""Benchmark the fleet solver on generated instances.
+
+Run from fleet_management/:  python -m routing.benchmarks.vrp_benchmark
+"""
+import argparse
+import json
+import time
+from ..vrp_solver import solve_vrp
+from .instances import generate_vrp_instance
+
+# (orders, vehicles) pairs sized like our depots
+SIZES = [(50, 5), (200, 30), (400, 60), (600, 80)]
+
+def run(sizes, seeds, time_budget):
+    results = []
+    for n_orders, n_vehicles in sizes:
+        for clustered in (False, True):
+            for seed in seeds:
+                instance = generate_vrp_instance(n_orders, n_vehicles, seed, clustered)
+                start = time.perf_counter()
+                solution = solve_vrp(
+                    instance['durations'], instance['distances'],
+                    instance['vehicles'], instance['orders'],
+                    time_budget=time_budget
+                )
+                results.append({
+                    'orders': n_orders,
+                    'vehicles': n_vehicles,
+                    'clustered': clustered,
+                    'seed': seed,
+                    'wall_time': time.perf_counter() - start,
+                    'total_duration': solution['total_duration'],
+                    'total_distance': solution['total_distance'],
+                    'vehicles_used': sum(1 for route in solution['routes'] if route['orders']),
+                    'unassigned': len(solution['unassigned'])
+                })
+                print(json.dumps(results[-1]))
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--seeds", type=int, default=3)
+    parser.add_argument("--time-budget", type=float, default=None)
+    parser.add_argument("--output", help="write all results to this JSON file")
+    args = parser.parse_args()
+
+    results = run(SIZES, range(args.seeds), args.time_budget)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,329 @@
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Tuple
+import logging
+import secrets
+import time
+import numpy as np
+from .distance_matrix import SparseDistanceMatrix
+from .geometry import haversine
+from .parallel_solver import double_bridge
+from .tsp_solver import (ITERATED_TIME_BUDGET, QUALITY_SETTINGS, UNREACHABLE_COST, Deadline,
+                         ImprovementCallback)
+
+logger = logging.getLogger(__name__)
+
+# Iterated local search stops after this many perturbations in a row found nothing better
+PATIENCE = 50
+
+# Cost of driving between each (row, col) pair of point indices
+Costs = Callable[[np.ndarray, np.ndarray], np.ndarray]
+
+def candidate_costs(matrix: SparseDistanceMatrix, field: str) -> Costs:
+    def costs(rows, cols) -> np.ndarray:
+        return np.minimum(matrix.lookup(field, rows, cols), UNREACHABLE_COST)
+    return costs
+
+def tour_cost(costs: Costs, order) -> float:
+    """Cost of a closed tour that returns to its first point"""
+    order = np.asarray(order)
+    return float(costs(order, np.roll(order, -1)).sum())
+
+class Intervals:
+    """Disjoint closed ranges of tour positions, for picking moves that don't interfere"""
+
+    def __init__(self):
+        self._starts: List[int] = []
+        self._ends: List[int] = []
+
+    def free(self, start: int, end: int) -> bool:
+        i = bisect_left(self._starts, start)
+        if i < len(self._starts) and self._starts[i] <= end:
+            return False
+        return i == 0 or self._ends[i - 1] < start
+
+    def add(self, start: int, end: int):
+        i = bisect_left(self._starts, start)
+        self._starts.insert(i, start)
+        self._ends.insert(i, end)
+
+def nearest_candidate_tour(matrix: SparseDistanceMatrix, values: np.ndarray) -> List[int]:
+    """Greedy tour that drives to the closest unvisited candidate, or the closest unvisited point if none is left"""
+    n = len(matrix)
+    visited = np.zeros(n, dtype=bool)
+    visited[0] = True
+    order = [0]
+    current = 0
+    for _ in range(n - 1):
+        candidates = matrix.neighbors[current]
+        free = ~visited[candidates]
+        if free.any():
+            current = int(candidates[free][np.argmin(values[current][free])])
+        else:
+            rest = np.flatnonzero(~visited)
+            straight = haversine(matrix.lat[current], matrix.lon[current], matrix.lat[rest], matrix.lon[rest])
+            current = int(rest[np.argmin(straight)])
+        visited[current] = True
+        order.append(current)
+    return order
+
+def changed_stops(before: List[int], after: List[int]) -> np.ndarray:
+    """Mask of the stops whose predecessor or successor differs between two tours"""
+    def links(order):
+        order = np.asarray(order)
+        succ = np.empty(len(order), dtype=np.intp)
+        pred = np.empty(len(order), dtype=np.intp)
+        succ[order] = np.roll(order, -1)
+        pred[order] = np.roll(order, 1)
+        return succ, pred
+    (succ, pred), (new_succ, new_pred) = links(before), links(after)
+    return (succ != new_succ) | (pred != new_pred)
+
+def two_opt(costs: Costs, neighbors: np.ndarray, values: np.ndarray, order: List[int],
+            deadline: Deadline, active: Optional[np.ndarray] = None) -> Tuple[List[int], np.ndarray]:
+    """Segment reversals that create an edge between candidate neighbours.
+
+    Each pass prices every such move from the `active` stops (all by
+    default) at once and then applies the best improving moves whose
+    positions don't overlap, so long tours need few passes. Later passes
+    only look at the stops at the ends of applied moves. Handles asymmetric
+    costs like tsp_solver.two_opt. `values` are the costs to each
+    candidate, so only the move's other new edge is looked up.
+
+    Returns the tour and a mask of the stops any applied move touched.
+    """
+    n = len(order)
+    tour = np.asarray(order)
+    position = np.empty(n, dtype=np.intp)
+    look = np.ones(n, dtype=bool) if active is None else active.copy()
+    touched = np.zeros(n, dtype=bool)
+    while look.any() and not deadline.expired():
+        position[tour] = np.arange(n)
+        ext = np.append(tour, tour[0])
+        fwd = costs(ext[:-1], ext[1:])
+        rev = costs(ext[1:], ext[:-1])
+        fwd_sum = np.concatenate(([0.0], np.cumsum(fwd)))
+        rev_sum = np.concatenate(([0.0], np.cumsum(rev)))
+
+        # New edge between tour[lo] and tour[hi], the candidate pair's positions, as the first
+        # (i = lo) or second (i = lo - 1) edge of the move; the other new edge is
+        # tour[i + shift] -> tour[j + shift]
+        rows = np.flatnonzero(look[tour])
+        x = np.repeat(rows, neighbors.shape[1])
+        y = position[neighbors[tour[rows]].ravel()]
+        lo, hi = np.minimum(x, y), np.maximum(x, y)
+        i = np.concatenate((lo, lo - 1))
+        j = np.concatenate((hi, hi - 1))
+        shift = np.repeat((1, 0), len(x))
+        known = np.tile(x < y, 2)
+        candidate = np.tile(values[tour[rows]].ravel(), 2)
+        valid = (i >= 0) & (j >= i + 2)
+        i, j, shift, known, candidate = i[valid], j[valid], shift[valid], known[valid], candidate[valid]
+        # The new edge runs tour[lo] -> tour[hi], which is the candidate's own direction only when x < y
+        back = np.flatnonzero(~known)
+        candidate[back] = costs(ext[i[back] + 1 - shift[back]], ext[j[back] + 1 - shift[back]])
+        delta = (candidate + costs(ext[i + shift], ext[j + shift])
+                 - fwd[i] - fwd[j]
+                 + (rev_sum[j] - rev_sum[i + 1])
+                 - (fwd_sum[j] - fwd_sum[i + 1]))
+        improving = np.flatnonzero(delta < -1e-9)
+
+        taken = Intervals()
+        look[:] = False
+        for move in improving[np.argsort(delta[improving], kind='stable')]:
+            a, b = int(i[move]), int(j[move])
+            # Reversing a segment turns its stops around, which changes their moves too; moves
+            # that lost out to an overlapping one are priced again next pass
+            look[ext[a:b + 2]] = True
+            if taken.free(a, b + 1):
+                taken.add(a, b + 1)
+                touched[ext[a:b + 2]] = True
+                tour[a + 1:b + 1] = tour[a + 1:b + 1][::-1]
+    return tour.tolist(), touched
+
+def or_opt(costs: Costs, neighbors: np.ndarray, order: List[int], deadline: Deadline,
+           max_segment: int = 3, active: Optional[np.ndarray] = None) -> Tuple[List[int], np.ndarray]:
+    """Move chains of 1..max_segment stops next to one of their candidate neighbours.
+
+    Either end of the chain can be joined to the neighbour, so chains are
+    tried both ways round. Like two_opt, chains that start or end at an
+    `active` stop are priced at once, the best improving moves that touch
+    disjoint positions are applied together, and later passes only look at
+    the stops those moves touched, which are also returned.
+    """
+    n = len(order)
+    tour = list(order)
+    position = np.empty(n, dtype=np.intp)
+    k = neighbors.shape[1]
+    look = np.ones(n, dtype=bool) if active is None else active.copy()
+    touched = np.zeros(n, dtype=bool)
+    while look.any() and not deadline.expired():
+        ext = np.append(tour, tour[0])
+        position[ext[:-1]] = np.arange(n)
+        moves = []
+        for length in range(1, min(max_segment, n - 2) + 1):
+            start = np.arange(1, n - length + 1)
+            start = start[look[ext[start]] | look[ext[start + length - 1]]]
+            first, last = ext[start], ext[start + length - 1]
+            prev, nxt = ext[start - 1], ext[start + length]
+            removal_gain = costs(prev, first) + costs(last, nxt) - costs(prev, nxt)
+            inner = np.stack([start + t for t in range(length - 1)]) if length > 1 else np.empty((0, len(start)), int)
+            # Extra cost of driving the chain backwards
+            turn = (costs(ext[inner + 1], ext[inner]) - costs(ext[inner], ext[inner + 1])).sum(axis=0)
+
+            for reverse in ((False, True) if length > 1 else (False,)):
+                # Insert so the chain's entry stop follows one of its neighbours, or its exit
+                # stop precedes one
+                head, tail = (last, first) if reverse else (first, last)
+                s = np.repeat(start, 2 * k)
+                p = np.concatenate((position[neighbors[head]], (position[neighbors[tail]] - 1) % n), axis=1).ravel()
+                gain = np.repeat(removal_gain - (turn if reverse else 0), 2 * k)
+                valid = (p < s - 1) | (p > s + length - 1)
+                s, p, gain = s[valid], p[valid], gain[valid]
+                offset = (0, length - 1)[reverse]
+                delta = (costs(ext[p], ext[s + offset]) + costs(ext[s + length - 1 - offset], ext[p + 1])
+                         - costs(ext[p], ext[p + 1]) - gain)
+                improving = delta < -1e-9
+                count = int(improving.sum())
+                moves.append((delta[improving], s[improving], p[improving],
+                              np.full(count, length), np.full(count, reverse)))
+
+        delta, s, p, lengths, reversed_ = (np.concatenate(parts) for parts in zip(*moves))
+        taken = Intervals()
+        look[:] = False
+        removed = np.zeros(n, dtype=bool)
+        inserted: Dict[int, List[int]] = {}
+        for move in np.argsort(delta, kind='stable'):
+            a, length, after = int(s[move]), int(lengths[move]), int(p[move])
+            spans = [(a - 1, a + length), (after, after + 1)]
+            if after <= a + length and a - 1 <= after + 1:
+                # Moving a chain by one position touches a single stretch
+                spans = [(min(a - 1, after), max(a + length, after + 1))]
+            ends = np.append(ext[a - 1:a + length + 1], ext[[after, after + 1]])
+            # Moves that lost out to an overlapping one are priced again next pass
+            look[ends] = True
+            if all(taken.free(lo, hi) for lo, hi in spans):
+                for lo, hi in spans:
+                    taken.add(lo, hi)
+                touched[ends] = True
+                removed[a:a + length] = True
+                chain = tour[a:a + length]
+                inserted[after] = chain[::-1] if reversed_[move] else chain
+        new_tour = []
+        for index, stop in enumerate(tour):
+            if not removed[index]:
+                new_tour.append(stop)
+            new_tour.extend(inserted.get(index, ()))
+        tour = new_tour
+    return tour, touched
+
+def improve(costs: Costs, matrix: SparseDistanceMatrix, values: np.ndarray, order: List[int],
+            deadline: Deadline, settings: Dict, active: Optional[np.ndarray] = None,
+            on_improvement: Optional[ImprovementCallback] = None) -> Tuple[List[int], float]:
+    """Alternate candidate 2-opt and Or-opt until neither finds a move.
+
+    Each only looks at the stops the other has touched since it last ran,
+    starting from `active` (all stops by default).
+    """
+    n = len(order)
+    pending_two_opt = np.ones(n, dtype=bool) if active is None else active.copy()
+    pending_or_opt = pending_two_opt.copy()
+    best_cost = tour_cost(costs, order)
+    while (pending_two_opt.any() or pending_or_opt.any()) and not deadline.expired():
+        order, touched = two_opt(costs, matrix.neighbors, values, order, deadline, pending_two_opt)
+        pending_or_opt |= touched
+        order, touched = or_opt(costs, matrix.neighbors, order, deadline, settings['or_opt_max_segment'],
+                                pending_or_opt)
+        pending_two_opt = touched
+        pending_or_opt[:] = False
+        cost = tour_cost(costs, order)
+        if cost < best_cost - 1e-9:
+            best_cost = cost
+            if on_improvement is not None:
+                on_improvement(order, best_cost)
+    return order, best_cost
+
+def candidate_local_search(matrix: SparseDistanceMatrix, field: str, deadline: Deadline, settings: Dict,
+                           on_improvement: Optional[ImprovementCallback] = None) -> Tuple[List[int], float]:
+    """Nearest-candidate construction improved by candidate 2-opt and Or-opt until no move helps"""
+    costs = candidate_costs(matrix, field)
+    values = np.minimum(getattr(matrix, field), UNREACHABLE_COST)
+    order = nearest_candidate_tour(matrix, values)
+    if on_improvement is not None:
+        on_improvement(order, tour_cost(costs, order))
+    return improve(costs, matrix, values, order, deadline, settings, on_improvement=on_improvement)
+
+def candidate_iterated_local_search(matrix: SparseDistanceMatrix, field: str, deadline: Deadline,
+                                    settings: Dict,
+                                    on_improvement: Optional[ImprovementCallback] = None) -> Tuple[List[int], float]:
+    """Perturb the best tour with a double bridge and repair it, keeping improvements.
+
+    Only the stops next to the bridge's cuts are looked at again, so a kick
+    and its repair cost far less than a full local search.
+    """
+    costs = candidate_costs(matrix, field)
+    values = np.minimum(getattr(matrix, field), UNREACHABLE_COST)
+    order, cost = candidate_local_search(matrix, field, deadline, settings, on_improvement)
+    rng = np.random.default_rng(settings['seed'])
+    stale = 0
+    while stale < PATIENCE and not deadline.expired():
+        kicked = double_bridge(order, rng)
+        candidate, candidate_cost = improve(costs, matrix, values, kicked, deadline, settings,
+                                            changed_stops(order, kicked))
+        if candidate_cost < cost - 1e-9:
+            order, cost = candidate, candidate_cost
+            stale = 0
+            if on_improvement is not None:
+                on_improvement(order, cost)
+        else:
+            stale += 1
+    return order, cost
+
+def solve_candidate_tsp(matrix: SparseDistanceMatrix,
+                        field: str = 'distances',
+                        time_budget: Optional[float] = None,
+                        quality: str = 'balanced',
+                        on_improvement: Optional[ImprovementCallback] = None,
+                        cancelled: Optional[Callable[[], bool]] = None,
+                        seed: Optional[int] = None) -> Dict:
+    """Find a short closed tour starting and ending at point 0 over a sparse matrix.
+
+    Like solve_tsp, but moves only ever create edges between candidate
+    neighbours, so each pass costs n * k rather than n * n. 'thorough'
+    adds iterated local search on this process; the other settings only
+    differ in how long a chain Or-opt moves.
+    """
+    if quality not in QUALITY_SETTINGS:
+        raise ValueError(f"Unknown quality setting: {quality}")
+
+    start = time.perf_counter()
+    settings = QUALITY_SETTINGS[quality]
+    n = len(matrix)
+    if n <= 3:
+        solver = 'candidate_local_search'
+        order = list(range(n))
+    elif settings.get('iterated'):
+        solver = 'candidate_iterated_local_search'
+        if seed is None:
+            seed = secrets.randbits(32)
+        settings = {**settings, 'seed': seed}
+        time_budget = ITERATED_TIME_BUDGET if time_budget is None else min(time_budget, ITERATED_TIME_BUDGET)
+        order, _ = candidate_iterated_local_search(matrix, field, Deadline(time_budget, cancelled),
+                                                   settings, on_improvement)
+    else:
+        solver = 'candidate_local_search'
+        order, _ = candidate_local_search(matrix, field, Deadline(time_budget, cancelled),
+                                          settings, on_improvement)
+
+    solve_time = time.perf_counter() - start
+    logger.info(f"Solved {n}-point tour with {solver} over {matrix.neighbors.shape[1]} "
+                f"candidates per point in {solve_time:.3f}s")
+    order = np.asarray(order)
+    solution = {
+        'order': [int(i) for i in order],
+        'objective': float(matrix.lookup(field, order, np.roll(order, -1)).sum()),
+        'solver': solver,
+        'solve_time': solve_time
+    }
+    if 'seed' in settings:
+        solution['seed'] = seed
+    return solution
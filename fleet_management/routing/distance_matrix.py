@@ -0,0 +1,237 @@
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+import asyncio
+import logging
+import numpy as np
+from .geometry import haversine, quadrant_neighbors, spatial_order
+from .http_client import HTTPClient, get_http_client
+from .metrics import UPSTREAM_FALLBACKS
+from .resilience import upstream_failed
+
+logger = logging.getLogger(__name__)
+
+# Road distance over straight-line distance, and the speed assumed for estimates
+DETOUR_FACTOR = 1.3
+ESTIMATE_SPEED = 30 / 3.6  # m/s
+
+class DistanceMatrix(NamedTuple):
+    durations: np.ndarray  # seconds, shape (n, n)
+    distances: np.ndarray  # metres, shape (n, n)
+    estimated: bool = False  # from straight-line distances rather than a routing engine
+
+def estimate_od_matrix(origins: List[Dict], destinations: List[Dict]) -> DistanceMatrix:
+    """Haversine distances times DETOUR_FACTOR, driven at ESTIMATE_SPEED, for when no engine answers"""
+    lat = np.array([point['lat'] for point in origins], dtype=float)[:, None]
+    lon = np.array([point['lon'] for point in origins], dtype=float)[:, None]
+    distances = haversine(
+        lat, lon,
+        np.array([point['lat'] for point in destinations], dtype=float)[None, :],
+        np.array([point['lon'] for point in destinations], dtype=float)[None, :]
+    ) * DETOUR_FACTOR
+    return DistanceMatrix(distances / ESTIMATE_SPEED, distances, estimated=True)
+
+def estimate_matrix(points: List[Dict]) -> DistanceMatrix:
+    return estimate_od_matrix(points, points)
+
+class SparseDistanceMatrix:
+    """Road durations and distances from each point to its k nearest neighbours only.
+
+    Memory grows as n * k rather than n * n. Any other pair is estimated
+    from its straight-line distance, scaled by the median detour and pace
+    of the candidate pairs, so every pair still has a cost.
+    """
+
+    def __init__(self, lat: np.ndarray, lon: np.ndarray, neighbors: np.ndarray,
+                 durations: np.ndarray, distances: np.ndarray, estimated: bool = False):
+        self.lat = lat
+        self.lon = lon
+        self.neighbors = neighbors  # (n, k) point indices, nearest first
+        self.durations = durations  # (n, k) seconds to each neighbour
+        self.distances = distances  # (n, k) metres to each neighbour
+        self.estimated = estimated
+
+        straight = haversine(lat[:, None], lon[:, None], lat[neighbors], lon[neighbors])
+        known = np.isfinite(distances) & np.isfinite(durations) & (straight > 0)
+        # Metres of road and seconds of driving per straight-line metre
+        self._scale = {
+            'distances': float(np.median(distances[known] / straight[known])) if known.any() else DETOUR_FACTOR,
+            'durations': float(np.median(durations[known] / straight[known])) if known.any()
+            else DETOUR_FACTOR / ESTIMATE_SPEED
+        }
+
+    def __len__(self) -> int:
+        return len(self.neighbors)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(array.nbytes for array in (self.neighbors, self.durations, self.distances, self.lat, self.lon))
+
+    def lookup(self, field: str, rows, cols) -> np.ndarray:
+        """Durations or distances for (row, col) pairs: from the road where known, else estimated"""
+        rows, cols = np.broadcast_arrays(np.asarray(rows, dtype=np.intp), np.asarray(cols, dtype=np.intp))
+        # Comparing against k neighbours per row beats a search over all n * k pairs
+        match = self.neighbors[rows] == cols[..., None]
+        slot = match.argmax(axis=-1)
+        found = match[..., 0] | (slot > 0)
+        values = getattr(self, field)[rows, slot]
+        missing = ~found
+        if missing.any():
+            r, c = rows[missing], cols[missing]
+            values[missing] = haversine(self.lat[r], self.lon[r], self.lat[c], self.lon[c]) * self._scale[field]
+        return values
+
+def iter_blocks(n: int, block_size: int, n_cols: Optional[int] = None) -> Iterator[Tuple[range, range]]:
+    """Yield (rows, cols) index ranges that tile an n x n (or n x n_cols) matrix"""
+    n_cols = n if n_cols is None else n_cols
+    for row_start in range(0, n, block_size):
+        rows = range(row_start, min(row_start + block_size, n))
+        for col_start in range(0, n_cols, block_size):
+            yield rows, range(col_start, min(col_start + block_size, n_cols))
+
+class MatrixBackend:
+    """Interface for services that return a full duration/distance matrix"""
+
+    async def get_matrix(self, points: List[Dict]) -> DistanceMatrix:
+        raise NotImplementedError
+
+    async def get_od_matrix(self, origins: List[Dict], destinations: List[Dict]) -> DistanceMatrix:
+        """Durations and distances from every origin to every destination"""
+        matrix = await self.get_matrix(origins + destinations)
+        n = len(origins)
+        return DistanceMatrix(matrix.durations[:n, n:], matrix.distances[:n, n:], matrix.estimated)
+
+class OSRMMatrixBackend(MatrixBackend):
+    def __init__(self, base_url: str = "http://router.project-osrm.org",
+                 profile: str = "driving",
+                 max_table_size: int = 100,
+                 http_client: Optional[HTTPClient] = None):
+        self.http_client = http_client or get_http_client()
+        self.table_url = f"{base_url}/table/v1/{profile}"
+        # OSRM rejects tables with more coordinates than --max-table-size
+        # (100 on the public demo server), so a block holds half of that
+        # for sources and half for destinations.
+        self.block_size = max(1, max_table_size // 2)
+
+    async def get_matrix(self, points: List[Dict]) -> DistanceMatrix:
+        """Get durations and distances between all points using the OSRM table service"""
+        try:
+            n = len(points)
+            durations = np.zeros((n, n))
+            distances = np.zeros((n, n))
+            if n < 2:
+                return DistanceMatrix(durations, distances)
+
+            blocks = list(iter_blocks(n, self.block_size))
+            results = await asyncio.gather(*[
+                self._get_block(points, rows, cols) for rows, cols in blocks
+            ])
+
+            for (rows, cols), (block_durations, block_distances) in zip(blocks, results):
+                durations[rows.start:rows.stop, cols.start:cols.stop] = block_durations
+                distances[rows.start:rows.stop, cols.start:cols.stop] = block_distances
+
+            np.fill_diagonal(durations, 0)
+            np.fill_diagonal(distances, 0)
+            return DistanceMatrix(durations, distances)
+
+        except Exception as e:
+            logger.error(f"OSRM matrix calculation failed: {str(e)}")
+            raise
+
+    async def get_od_matrix(self, origins: List[Dict], destinations: List[Dict]) -> DistanceMatrix:
+        """Durations and distances from every origin to every destination, in table blocks"""
+        try:
+            n_rows, n_cols = len(origins), len(destinations)
+            durations = np.zeros((n_rows, n_cols))
+            distances = np.zeros((n_rows, n_cols))
+            if not n_rows or not n_cols:
+                return DistanceMatrix(durations, distances)
+
+            # Destinations follow the origins in the point list the blocks index into
+            points = origins + destinations
+            blocks = list(iter_blocks(n_rows, self.block_size, n_cols))
+            results = await asyncio.gather(*[
+                self._get_block(points, rows, range(n_rows + cols.start, n_rows + cols.stop))
+                for rows, cols in blocks
+            ])
+
+            for (rows, cols), (block_durations, block_distances) in zip(blocks, results):
+                durations[rows.start:rows.stop, cols.start:cols.stop] = block_durations
+                distances[rows.start:rows.stop, cols.start:cols.stop] = block_distances
+            return DistanceMatrix(durations, distances)
+
+        except Exception as e:
+            logger.error(f"OSRM matrix calculation failed: {str(e)}")
+            raise
+
+    async def _get_block(self, points: List[Dict], rows: range, cols: range) -> Tuple[np.ndarray, np.ndarray]:
+        # Diagonal blocks share their coordinates between sources and destinations
+        if rows == cols:
+            block_points = [points[i] for i in rows]
+            sources = destinations = range(len(rows))
+        else:
+            block_points = [points[i] for i in rows] + [points[j] for j in cols]
+            sources = range(len(rows))
+            destinations = range(len(rows), len(rows) + len(cols))
+
+        coordinates = ";".join([f"{point['lon']},{point['lat']}" for point in block_points])
+        url = f"{self.table_url}/{coordinates}"
+        params = {
+            'annotations': 'duration,distance',
+            'sources': ";".join(map(str, sources)),
+            'destinations': ";".join(map(str, destinations))
+        }
+
+        logger.debug(f"Requesting {len(rows)}x{len(cols)} table block from OSRM")
+        response = await self.http_client.get(url, params=params)
+        response.raise_for_status()
+
+        table = response.json()
+        if table.get('code') != 'Ok':
+            raise ValueError(f"OSRM table request failed: {table.get('message', table.get('code'))}")
+
+        # Unreachable pairs come back as null
+        block_durations = np.array(table['durations'], dtype=float)
+        block_distances = np.array(table['distances'], dtype=float)
+        block_durations[np.isnan(block_durations)] = np.inf
+        block_distances[np.isnan(block_distances)] = np.inf
+        return block_durations, block_distances
+
+async def get_sparse_matrix(backend: MatrixBackend, points: List[Dict], k: int,
+                            group_size: int = 16) -> SparseDistanceMatrix:
+    """Road durations and distances from every point to its k nearest neighbours.
+
+    Points are taken in groups of `group_size` that lie close together, and
+    each group is asked for the origin-destination matrix to the union of
+    its neighbours, which is not much larger than group_size + k. Upstream
+    cells and calls grow as n * k instead of n * n. Groups the upstream
+    fails to answer are estimated from straight-line distances.
+    """
+    lat = np.array([point['lat'] for point in points], dtype=float)
+    lon = np.array([point['lon'] for point in points], dtype=float)
+    neighbors = quadrant_neighbors(lat, lon, k)
+    order = spatial_order(lat, lon)
+    groups = [order[start:start + group_size] for start in range(0, len(points), group_size)]
+
+    async def fetch(group: np.ndarray) -> Tuple[np.ndarray, DistanceMatrix]:
+        targets = np.unique(neighbors[group])
+        origins = [points[i] for i in group]
+        destinations = [points[j] for j in targets]
+        try:
+            return targets, await backend.get_od_matrix(origins, destinations)
+        except Exception as e:
+            if not upstream_failed(e):
+                raise
+            logger.warning(f"Estimating {len(group)}x{len(targets)} matrix block: {str(e)}")
+            UPSTREAM_FALLBACKS.inc('matrix', 'haversine')
+            return targets, estimate_od_matrix(origins, destinations)
+
+    results = await asyncio.gather(*[fetch(group) for group in groups])
+    durations = np.empty(neighbors.shape)
+    distances = np.empty(neighbors.shape)
+    for group, (targets, matrix) in zip(groups, results):
+        rows = np.arange(len(group))[:, None]
+        cols = np.searchsorted(targets, neighbors[group])
+        durations[group] = matrix.durations[rows, cols]
+        distances[group] = matrix.distances[rows, cols]
+    return SparseDistanceMatrix(lat, lon, neighbors, durations, distances,
+                                estimated=any(matrix.estimated for _, matrix in results))
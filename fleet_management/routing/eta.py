@@ -0,0 +1,261 @@
+from datetime import datetime
+from typing import Dict, List, Optional, Sequence
+import logging
+import os
+import numpy as np
+from .geometry import as_lon_lat, cumulative_distances
+
+logger = logging.getLogger(__name__)
+
+DAY = 24 * 3600
+WEEK = 7 * DAY
+# Speed profiles hold one factor per hour of the week, Monday 00:00 first
+SLOTS = 7 * 24
+SLOT_SECONDS = WEEK // SLOTS
+# Profile cells are rounded to this many decimal degrees (~1 km at 2)
+CELL_PRECISION = 2
+# Factors are stored as uint8 in steps of 1/200, so up to 1.275x free flow
+FACTOR_SCALE = 200
+# Live traffic counts fully now and fades into the profile with this time constant
+LIVE_TRAFFIC_HORIZON = 1800.0
+# Fixed-point passes: each re-reads the profile at the span times the previous pass found
+ETA_PASSES = 3
+# Spans are also cut after this much free-flow driving, so long legs in one
+# cell still see the profile change along the way
+MAX_SPAN_SECONDS = 300.0
+# Live speeds below this share of free flow are treated as this share
+MIN_SPEED_FACTOR = 0.05
+
+def default_profile() -> np.ndarray:
+    """Generic urban speed factors per hour of the week: weekday rush hours, quieter weekends"""
+    hours = np.arange(24) + 0.5
+    weekday = 1 - 0.35 * np.exp(-((hours - 8) / 1.2) ** 2) - 0.4 * np.exp(-((hours - 17.5) / 1.5) ** 2)
+    weekend = 1 - 0.15 * np.exp(-((hours - 13) / 3) ** 2)
+    return np.concatenate([np.tile(weekday, 5), np.tile(weekend, 2)]).astype(np.float32)
+
+def cell_keys(lat, lon) -> np.ndarray:
+    """int64 key of the profile cell containing each point"""
+    scale = 10 ** CELL_PRECISION
+    rows = np.round(np.asarray(lat, dtype=float) * scale).astype(np.int64) + 90 * scale
+    cols = np.round(np.asarray(lon, dtype=float) * scale).astype(np.int64) + 180 * scale
+    return rows * (360 * scale + 1) + cols
+
+def week_seconds(epoch, utc_offset: float = 0.0) -> np.ndarray:
+    """Local seconds since Monday 00:00 for Unix timestamps"""
+    # 1970-01-01 was a Thursday, three days after a Monday
+    return (np.asarray(epoch, dtype=float) + utc_offset + 3 * DAY) % WEEK
+
+def parse_departure_time(value: Optional[str] = None) -> datetime:
+    """Timezone-aware departure; naive times are server local time, None is now"""
+    departure = datetime.fromisoformat(value) if value else datetime.now()
+    return departure if departure.tzinfo else departure.astimezone()
+
+class SpeedProfiles:
+    """Speed factors (share of free-flow speed) by road cell and hour of the week.
+
+    The table is compact: sorted int64 cell keys and one uint8 row of
+    SLOTS factors per cell. Cells without a row use the default profile.
+    Factors are interpolated linearly between hourly slots.
+    """
+
+    def __init__(self, cells: Optional[np.ndarray] = None, factors: Optional[np.ndarray] = None,
+                 default: Optional[np.ndarray] = None):
+        self.cells = np.asarray(cells if cells is not None else [], dtype=np.int64)
+        factors = np.asarray(factors if factors is not None else np.zeros((0, SLOTS)), dtype=np.uint8)
+        self.default = np.asarray(default if default is not None else default_profile(), dtype=np.float32)
+        # Row 0 is the default profile, so a lookup miss is just index 0
+        self.table = np.vstack([self.default[None, :], factors.astype(np.float32) / FACTOR_SCALE])
+        # Flat factors and the change to the next slot, for one gather per lookup
+        self._flat = self.table.ravel().astype(np.float64)
+        self._slope = (np.roll(self.table, -1, axis=1) - self.table).ravel().astype(np.float64)
+
+    def __len__(self) -> int:
+        return len(self.cells)
+
+    def rows(self, lat, lon) -> np.ndarray:
+        """Table row for each point"""
+        keys = cell_keys(lat, lon)
+        if not len(self.cells):
+            return np.zeros(keys.shape, dtype=np.intp)
+        index = np.minimum(np.searchsorted(self.cells, keys), len(self.cells) - 1)
+        return np.where(self.cells[index] == keys, index + 1, 0)
+
+    def factors(self, rows: np.ndarray, seconds: np.ndarray) -> np.ndarray:
+        """Speed factor for table rows at week seconds; both broadcast like NumPy"""
+        position = np.asarray(seconds, dtype=float) / SLOT_SECONDS - 0.5
+        first = np.floor(position)
+        weight = position - first
+        index = np.asarray(rows, dtype=np.intp) * SLOTS + first.astype(np.intp) % SLOTS
+        return self._flat[index] + weight * self._slope[index]
+
+    @classmethod
+    def from_observations(cls, lat, lon, epoch, factor, utc_offset: float = 0.0,
+                          min_samples: int = 3) -> "SpeedProfiles":
+        """Average observed speed factors per cell and hour of the week.
+
+        Slots with fewer than min_samples observations keep the default
+        profile's factor.
+        """
+        keys = cell_keys(lat, lon)
+        slots = (week_seconds(epoch, utc_offset) // SLOT_SECONDS).astype(np.intp)
+        cells, cell_index = np.unique(keys, return_inverse=True)
+        sums = np.zeros((len(cells), SLOTS))
+        counts = np.zeros((len(cells), SLOTS))
+        np.add.at(sums, (cell_index, slots), np.asarray(factor, dtype=float))
+        np.add.at(counts, (cell_index, slots), 1)
+
+        default = default_profile()
+        means = np.where(counts >= min_samples, sums / np.maximum(counts, 1), default[None, :])
+        factors = np.clip(np.round(means * FACTOR_SCALE), 1, 255).astype(np.uint8)
+        return cls(cells, factors, default)
+
+    @classmethod
+    def load(cls, path: str) -> "SpeedProfiles":
+        with np.load(path) as data:
+            profiles = cls(data['cells'], data['factors'], data['default'])
+        logger.info(f"Loaded speed profiles for {len(profiles)} cells from {path}")
+        return profiles
+
+    def save(self, path: str):
+        factors = np.round(self.table[1:] * FACTOR_SCALE).astype(np.uint8)
+        np.savez_compressed(path, cells=self.cells, factors=factors, default=self.default)
+
+_shared_profiles: Optional[SpeedProfiles] = None
+
+def get_speed_profiles() -> SpeedProfiles:
+    """Profiles from SPEED_PROFILE_PATH, or the default profile everywhere"""
+    global _shared_profiles
+    if _shared_profiles is None:
+        path = os.getenv("SPEED_PROFILE_PATH")
+        _shared_profiles = SpeedProfiles.load(path) if path else SpeedProfiles()
+    return _shared_profiles
+
+class RouteTimeline:
+    """Free-flow timing of a route geometry, ready for any number of departure times.
+
+    The geometry is cut into spans that each lie in one profile cell, end at
+    stops and take at most MAX_SPAN_SECONDS at free flow; each span's
+    free-flow time comes from its leg's duration spread over the leg by
+    distance. Evaluating departures then only touches (departures x spans)
+    arrays.
+    """
+
+    def __init__(self, route: Dict, profiles: SpeedProfiles):
+        lon_lat = as_lon_lat(route['geometry']['coordinates'])
+        cumulative = cumulative_distances(lon_lat)
+        # Distance along the geometry at every vertex
+        self.cumulative = cumulative
+        length = float(cumulative[-1]) if len(cumulative) else 0.0
+        n_segments = max(len(lon_lat) - 1, 0)
+
+        legs = route.get('legs') or [{'distance': route['distance'], 'duration': route['duration']}]
+        leg_distances = np.array([leg['distance'] for leg in legs], dtype=float)
+        leg_durations = np.array([leg['duration'] for leg in legs], dtype=float)
+        # Leg ends along the geometry; the router's distances may differ slightly from ours
+        leg_ends = np.cumsum(leg_distances) * (length / leg_distances.sum() if leg_distances.sum() else 0.0)
+        self.stop_vertices = np.clip(np.searchsorted(cumulative, leg_ends - 1e-6), 0, max(n_segments, 0))
+        self.stop_vertices[-1] = n_segments
+
+        if n_segments == 0:
+            self.boundaries = np.array([0])
+            self.span_seconds = np.zeros(0)
+            self.span_rows = np.zeros(0, dtype=np.intp)
+            self.span_speeds = np.zeros(0)
+            self.span_starts = np.zeros(0)
+            self.stop_boundaries = np.zeros(len(legs), dtype=np.intp)
+            self.profiles = profiles
+            return
+
+        segment_lengths = np.diff(cumulative)
+        leg_of_segment = np.searchsorted(self.stop_vertices, np.arange(n_segments), side='right')
+        leg_of_segment = np.minimum(leg_of_segment, len(legs) - 1)
+        starts = np.concatenate(([0], self.stop_vertices[:-1]))
+        leg_lengths = cumulative[self.stop_vertices] - cumulative[starts]
+        share = np.divide(segment_lengths, leg_lengths[leg_of_segment],
+                          out=np.zeros(n_segments), where=leg_lengths[leg_of_segment] > 0)
+        segment_seconds = share * leg_durations[leg_of_segment]
+
+        midpoints = (lon_lat[:-1] + lon_lat[1:]) / 2
+        segment_rows = profiles.rows(midpoints[:, 1], midpoints[:, 0])
+        cell_changes = np.flatnonzero(np.diff(segment_rows)) + 1
+        time_steps = np.flatnonzero(np.diff(np.cumsum(segment_seconds) // MAX_SPAN_SECONDS)) + 1
+        self.boundaries = np.unique(np.concatenate((
+            [0], cell_changes, time_steps, self.stop_vertices, [n_segments]
+        )))
+        starts = self.boundaries[:-1]
+        self.span_seconds = np.add.reduceat(segment_seconds, starts)
+        self.span_rows = segment_rows[starts]
+        span_lengths = np.add.reduceat(segment_lengths, starts)
+        self.span_speeds = np.divide(span_lengths, self.span_seconds,
+                                     out=np.zeros(len(starts)), where=self.span_seconds > 0) * 3.6
+        self.span_starts = cumulative[starts]
+        # Position of each stop among the span boundaries
+        self.stop_boundaries = np.searchsorted(self.boundaries, self.stop_vertices)
+        self.profiles = profiles
+
+    @property
+    def free_flow_duration(self) -> float:
+        return float(self.span_seconds.sum())
+
+    def live_factors(self, sample_offsets: Sequence[float], flows: List[Dict]) -> np.ndarray:
+        """Per-span share of free-flow speed from live traffic at points along the route.
+
+        Each span takes the last sample at or before its start. Without a
+        free-flow speed from the provider, the router's speed is the reference.
+        """
+        if not len(self.span_seconds) or not flows:
+            return np.ones(len(self.span_seconds))
+        offsets = np.asarray(sample_offsets, dtype=float)
+        order = np.argsort(offsets)
+        current = np.array([flow['current_speed'] for flow in flows], dtype=float)[order]
+        free_flow = np.array([flow.get('free_flow_speed') or np.nan for flow in flows], dtype=float)[order]
+        sample = np.maximum(np.searchsorted(offsets[order], self.span_starts, side='right') - 1, 0)
+        reference = np.where(np.isnan(free_flow[sample]), self.span_speeds, free_flow[sample])
+        ratio = np.divide(current[sample], reference, out=np.ones(len(sample)), where=reference > 0)
+        return np.clip(ratio, MIN_SPEED_FACTOR, 1.0)
+
+    def times(self, departures, utc_offset: float = 0.0, live: Optional[np.ndarray] = None,
+              now: Optional[float] = None) -> np.ndarray:
+        """Seconds after departure at every span boundary, shape (departures, spans + 1).
+
+        departures are Unix timestamps. Each pass looks up every span's speed
+        factor at the middle of the span as the previous pass timed it,
+        starting from free flow; live factors, if given, dominate near `now`
+        and fade out over LIVE_TRAFFIC_HORIZON.
+        """
+        departures = np.atleast_1d(np.asarray(departures, dtype=float))[:, None]
+        base = self.span_seconds[None, :]
+        durations = np.broadcast_to(base, (departures.shape[0], base.shape[1]))
+        elapsed = np.concatenate((np.zeros((departures.shape[0], 1)), np.cumsum(durations, axis=1)), axis=1)
+        for _ in range(ETA_PASSES):
+            middle = departures + elapsed[:, :-1] + durations / 2
+            factors = self.profiles.factors(self.span_rows[None, :], week_seconds(middle, utc_offset))
+            if live is not None:
+                weight = np.exp(-np.maximum(middle - (now if now is not None else 0.0), 0) / LIVE_TRAFFIC_HORIZON)
+                factors = weight * live[None, :] + (1 - weight) * factors
+            durations = base / np.maximum(factors, MIN_SPEED_FACTOR)
+            elapsed = np.concatenate((np.zeros((departures.shape[0], 1)), np.cumsum(durations, axis=1)), axis=1)
+        return elapsed
+
+    def stop_arrivals(self, departures, utc_offset: float = 0.0, live: Optional[np.ndarray] = None,
+                      now: Optional[float] = None) -> np.ndarray:
+        """Seconds after departure at which each stop is reached, shape (departures, stops)"""
+        return self.times(departures, utc_offset, live, now)[:, self.stop_boundaries]
+
+def tour_arrival_times(durations: np.ndarray, tours: np.ndarray, departures,
+                       profiles: SpeedProfiles, row: int = 0, utc_offset: float = 0.0) -> np.ndarray:
+    """Seconds after departure at each position of many tours over a duration matrix.
+
+    tours is (tours, positions) of matrix indices and every tour leaves at
+    each of `departures`; the result is (departures, tours, positions). One
+    profile row (the region's) scales every leg by the factor at the time
+    the leg starts, vectorised over tours and departures.
+    """
+    tours = np.atleast_2d(np.asarray(tours, dtype=np.intp))
+    departures = np.atleast_1d(np.asarray(departures, dtype=float))[:, None]
+    elapsed = np.zeros((departures.shape[0], tours.shape[0], tours.shape[1]))
+    legs = durations[tours[:, :-1], tours[:, 1:]]
+    for k in range(tours.shape[1] - 1):
+        factor = profiles.factors(row, week_seconds(departures + elapsed[:, :, k], utc_offset))
+        elapsed[:, :, k + 1] = elapsed[:, :, k] + legs[None, :, k] / np.maximum(factor, MIN_SPEED_FACTOR)
+    return elapsed
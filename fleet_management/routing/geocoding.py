@@ -0,0 +1,299 @@
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import os
+import re
+import unicodedata
+from .http_client import HTTPClient
+from .route_cache import RouteCache
+from .tomtom_service import TomTomService
+
+logger = logging.getLogger(__name__)
+
+# Shorter queries are answered from the local index only
+MIN_UPSTREAM_QUERY = 3
+# Index entries a prefix lookup ranks at most; very short prefixes match many more
+MAX_CANDIDATES = 500
+# Places learned from upstream searches kept in the index; the oldest go first
+MAX_LEARNED_PLACES = 100_000
+# Index entries added one place at a time that are sorted into the main keys together
+MERGE_SIZE = 10_000
+
+def normalize_query(text: str) -> str:
+    """Case- and accent-folded words separated by single spaces"""
+    decomposed = unicodedata.normalize('NFKD', text)
+    folded = "".join(c for c in decomposed if not unicodedata.combining(c)).casefold()
+    return " ".join(re.findall(r"\w+", folded))
+
+def word_suffixes(text: str) -> List[str]:
+    """The normalized text from each word on, so a prefix can start at any word"""
+    words = normalize_query(text).split(" ")
+    return [" ".join(words[i:]) for i in range(len(words)) if words[i]]
+
+def own_place(place: Dict) -> Dict:
+    """One of our depots or customers in the shape search_place returns"""
+    return {
+        'id': str(place.get('id') or f"own:{place['lat']:.6f},{place['lon']:.6f}:{place.get('name', '')}"),
+        'name': place.get('name') or place.get('address'),
+        'address': place.get('address') or place.get('name'),
+        'position': {'lat': place['lat'], 'lon': place['lon']},
+        'type': place.get('type', 'Address')
+    }
+
+def _window(keys: List[str], ids: List[str], prefix: str) -> List[str]:
+    """IDs under keys starting with prefix, from at most MAX_CANDIDATES keys"""
+    start = bisect_left(keys, prefix)
+    end = bisect_left(keys, prefix + "\U0010ffff", start, min(len(keys), start + MAX_CANDIDATES))
+    return ids[start:end]
+
+class KeyArray:
+    """Sorted (key, place ID) pairs for prefix lookups.
+
+    Entries added one place at a time go into a small sorted array of recent
+    ones, merged into the main array once it holds MERGE_SIZE entries, so an
+    insert moves at most that many entries. Entries of places that `live` no
+    longer accepts are dropped at the merge; until then lookups can still
+    return their IDs.
+    """
+
+    def __init__(self, live: Callable[[str], bool]):
+        self.live = live
+        self.keys: List[str] = []
+        self.ids: List[str] = []
+        self.recent_keys: List[str] = []
+        self.recent_ids: List[str] = []
+
+    def add(self, entries: Iterable[Tuple[str, str]]):
+        for key, place_id in entries:
+            # After equal keys, so ties keep the order places were added in
+            position = bisect_right(self.recent_keys, key)
+            self.recent_keys.insert(position, key)
+            self.recent_ids.insert(position, place_id)
+        if len(self.recent_keys) >= MERGE_SIZE:
+            self.merge()
+
+    def merge(self, entries: Iterable[Tuple[str, str]] = ()):
+        """Fold the recent entries, and any others given, into the main array with one sort"""
+        merged = [
+            entry for entry in zip(self.keys + self.recent_keys, self.ids + self.recent_ids)
+            if self.live(entry[1])
+        ]
+        merged.extend(entries)
+        merged.sort()
+        self.keys = [key for key, _ in merged]
+        self.ids = [place_id for _, place_id in merged]
+        self.recent_keys, self.recent_ids = [], []
+
+    def matching(self, prefix: str) -> List[str]:
+        if not self.recent_keys:
+            return _window(self.keys, self.ids, prefix)
+        return _window(self.keys, self.ids, prefix) + _window(self.recent_keys, self.recent_ids, prefix)
+
+class PlaceIndex:
+    """Prefix index over place names and addresses.
+
+    Each place is indexed under every word-start suffix of its normalized
+    name and address, so "baker st" finds "221B Baker Street". A lookup is a
+    binary search plus a scan of the matching keys. Our own places have
+    their own KeyArray and rank first, so places learned from upstream
+    searches never crowd them out. Beyond max_learned learned places the
+    oldest is forgotten.
+    """
+
+    def __init__(self, max_learned: int = MAX_LEARNED_PLACES):
+        self.max_learned = max_learned
+        self.places: Dict[str, Dict] = {}
+        # Sort key per place: own places first, then shorter names
+        self._rank: Dict[str, Tuple[bool, int]] = {}
+        # Learned place IDs, oldest first
+        self._learned: "OrderedDict[str, None]" = OrderedDict()
+        self._own_keys = KeyArray(self.places.__contains__)
+        self._learned_keys = KeyArray(self._learned.__contains__)
+
+    def __len__(self) -> int:
+        return len(self.places)
+
+    def _entries(self, place: Dict) -> List[Tuple[str, str]]:
+        keys = set()
+        for text in (place.get('name'), place.get('address')):
+            if text:
+                keys.update(word_suffixes(text))
+        return [(key, place['id']) for key in sorted(keys)]
+
+    def _register(self, place: Dict, own: bool) -> bool:
+        """Record the place and its rank; False if it was already indexed"""
+        place_id = place['id']
+        if place_id in self.places:
+            # An upstream result can turn out to be one of ours, never the other way round
+            if not own or place_id not in self._learned:
+                return False
+            del self._learned[place_id]
+        elif not own:
+            self._learned[place_id] = None
+            while len(self._learned) > self.max_learned:
+                oldest, _ = self._learned.popitem(last=False)
+                del self.places[oldest]
+                del self._rank[oldest]
+        self.places[place_id] = place
+        self._rank[place_id] = (not own, len(place.get('name') or ""))
+        return True
+
+    def add(self, place: Dict, own: bool = False):
+        if self._register(place, own):
+            (self._own_keys if own else self._learned_keys).add(self._entries(place))
+
+    def add_many(self, places: Iterable[Dict], own: bool = False):
+        """Add places with one sort at the end"""
+        (self._own_keys if own else self._learned_keys).merge([
+            entry for place in places if self._register(place, own) for entry in self._entries(place)
+        ])
+
+    def search(self, query: str, limit: int = 10) -> List[Dict]:
+        """Places with a name or address word sequence starting with the normalized query"""
+        prefix = normalize_query(query)
+        if not prefix:
+            return []
+        # Forgotten places can linger in the keys until their next merge
+        matches = {
+            place_id: None
+            for place_id in itertools.chain(self._own_keys.matching(prefix), self._learned_keys.matching(prefix))
+            if place_id in self._rank
+        }
+        ranked = heapq.nsmallest(limit, matches, key=self._rank.__getitem__)
+        return [self.places[place_id] for place_id in ranked]
+
+def merge_results(first: List[Dict], second: List[Dict], limit: int) -> List[Dict]:
+    seen = set()
+    merged = []
+    for place in itertools.chain(first, second):
+        if place['id'] not in seen:
+            seen.add(place['id'])
+            merged.append(place)
+    return merged[:limit]
+
+class GeocodingService:
+    """Geocoding and autocomplete in front of TomTomService.search_place.
+
+    Upstream results are cached by normalized query for `ttl` seconds, and
+    the last `max_learned` places seen are kept in a local prefix index
+    along with our own depots and customers. Autocomplete answers from the index when it has
+    `min_local` matches or more. Otherwise it waits `debounce` seconds and
+    only goes upstream if the same session has not typed again. Concurrent
+    misses for one query share a single request, and at most
+    `max_concurrency` search requests are in flight at once.
+    """
+
+    def __init__(self, tomtom: TomTomService, ttl: float = 86400, debounce: float = 0.25,
+                 min_local: int = 3, max_concurrency: int = 4, max_bytes: int = 32 * 1024 * 1024,
+                 max_learned: int = MAX_LEARNED_PLACES):
+        self.tomtom = tomtom
+        self.debounce = debounce
+        self.min_local = min_local
+        self.index = PlaceIndex(max_learned)
+        self.cache = RouteCache(max_bytes=max_bytes, ttl=ttl)
+        self._upstream = asyncio.Semaphore(max_concurrency)
+        # Latest keystroke per session; an older one that wakes up after its debounce gives way
+        self._latest: Dict[str, int] = {}
+        self._keystrokes = itertools.count()
+        self.local_hits = 0
+        self.cache_hits = 0
+        self.upstream = 0
+        self.superseded = 0
+
+    def add_places(self, places: List[Dict]) -> int:
+        """Index our own depots or customers: dicts with lat, lon and a name and/or address"""
+        places = [own_place(place) for place in places]
+        self.index.add_many(places, own=True)
+        return len(places)
+
+    def _cache_key(self, kind: str, query: str, country: Optional[str]) -> str:
+        return f"{kind}|{country or ''}|{normalize_query(query)}"
+
+    async def _fetch(self, query: str, country: Optional[str], typeahead: bool) -> List[Dict]:
+        self.upstream += 1
+        async with self._upstream:
+            results = await self.tomtom.search_place(query, country, typeahead=typeahead)
+        for place in results:
+            self.index.add(place)
+        return results
+
+    async def search(self, query: str, country: str = None) -> List[Dict]:
+        """Full search, cached by normalized query"""
+        key = self._cache_key('search', query, country)
+        cached = await self.cache.get_async(key)
+        if cached is not None:
+            self.cache_hits += 1
+            return cached
+        return await self.cache.get_or_fetch(key, lambda: self._fetch(query, country, typeahead=False))
+
+    async def autocomplete(self, query: str, country: str = None, limit: int = 10,
+                           session: Optional[str] = None) -> Tuple[List[Dict], str]:
+        """Places for a partly typed query, and where they came from: local, cache or upstream"""
+        normalized = normalize_query(query)
+        local = self.index.search(normalized, limit)
+        if len(local) >= min(limit, self.min_local) or len(normalized) < MIN_UPSTREAM_QUERY:
+            self.local_hits += 1
+            return local, 'local'
+
+        key = self._cache_key('autocomplete', normalized, country)
+        cached = await self.cache.get_async(key)
+        if cached is not None:
+            self.cache_hits += 1
+            return merge_results(local, cached, limit), 'cache'
+
+        if session is not None and self.debounce > 0:
+            keystroke = next(self._keystrokes)
+            self._latest[session] = keystroke
+            await asyncio.sleep(self.debounce)
+            if self._latest.get(session) != keystroke:
+                # The session's next keystroke makes the upstream call instead
+                self.superseded += 1
+                return local, 'local'
+            del self._latest[session]
+
+        try:
+            results = await self.cache.get_or_fetch(key, lambda: self._fetch(query, country, typeahead=True))
+        except Exception as e:
+            logger.error(f"Autocomplete for {normalized!r} failed upstream: {str(e)}")
+            return local, 'local'
+        return merge_results(local, results, limit), 'upstream'
+
+    def stats(self) -> Dict:
+        lookups = self.local_hits + self.cache_hits + self.upstream
+        cache = self.cache.stats()
+        return {
+            'hits': self.local_hits + self.cache_hits,
+            'misses': self.upstream,
+            'hit_ratio': (self.local_hits + self.cache_hits) / lookups if lookups else 0.0,
+            'entries': cache['entries'],
+            'bytes': cache['bytes'],
+            'inflight': cache['inflight'],
+            'places': len(self.index),
+            'superseded': self.superseded
+        }
+
+def load_places(path: str) -> List[Dict]:
+    """Own places from a JSON list of {id, name, address, lat, lon, type}"""
+    with open(path) as f:
+        return json.load(f)
+
+def create_geocoder(api_key: Optional[str] = None, http_client: Optional[HTTPClient] = None) -> GeocodingService:
+    """Geocoder configured from GEOCODING_* variables, with GEOCODING_PLACES_PATH indexed up front"""
+    geocoder = GeocodingService(
+        TomTomService(api_key or os.getenv("TOMTOM_API_KEY"), http_client),
+        ttl=float(os.getenv("GEOCODING_TTL", "86400")),
+        debounce=float(os.getenv("GEOCODING_DEBOUNCE", "0.25")),
+        min_local=int(os.getenv("GEOCODING_MIN_LOCAL", "3")),
+        max_concurrency=int(os.getenv("GEOCODING_MAX_CONCURRENCY", "4")),
+        max_learned=int(os.getenv("GEOCODING_MAX_LEARNED", str(MAX_LEARNED_PLACES)))
+    )
+    path = os.getenv("GEOCODING_PLACES_PATH")
+    if path:
+        count = geocoder.add_places(load_places(path))
+        logger.info(f"Indexed {count} own places from {path}")
+    return geocoder
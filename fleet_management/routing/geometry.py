@@ -0,0 +1,404 @@
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Union
+import base64
+import numpy as np
+
+EARTH_RADIUS = 6371000.0  # metres
+
+# Grid keys pack three signed cell indices into one int64, 21 bits each
+_KEY_BITS = 21
+_KEY_OFFSET = 1 << (_KEY_BITS - 1)
+
+Points = Union[np.ndarray, Sequence[Dict], Sequence[Sequence[float]]]
+
+def haversine(lat1, lon1, lat2, lon2) -> np.ndarray:
+    """Great-circle distance in metres; arguments in degrees, broadcast like NumPy"""
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    h = (np.sin((lat2 - lat1) / 2) ** 2
+         + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(h, 0, 1)))
+
+def haversine_matrix(lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+    """All-pairs great-circle distances in metres between points given in degrees"""
+    lat, lon = np.asarray(lat, dtype=float), np.asarray(lon, dtype=float)
+    return haversine(lat[:, None], lon[:, None], lat[None, :], lon[None, :])
+
+def as_lon_lat(points: Points) -> np.ndarray:
+    """(n, 2) array of [lon, lat] from GeoJSON coordinates or {'lat', 'lon'} dicts"""
+    if len(points) and isinstance(points[0], dict):
+        return np.array([[p['lon'], p['lat']] for p in points], dtype=float)
+    return np.asarray(points, dtype=float).reshape(-1, 2)
+
+def route_coordinates(coordinates: Points) -> np.ndarray:
+    """Read-only (n, 2) float array of [lon, lat] for a route geometry.
+
+    Routes are cached and shared between requests, so their coordinates are
+    frozen rather than copied by every reader.
+    """
+    lon_lat = np.array(as_lon_lat(coordinates))
+    lon_lat.flags.writeable = False
+    return lon_lat
+
+def to_unit_vectors(lon_lat: np.ndarray) -> np.ndarray:
+    """Project [lon, lat] degrees onto 3D unit vectors"""
+    lon, lat = np.radians(lon_lat[:, 0]), np.radians(lon_lat[:, 1])
+    cos_lat = np.cos(lat)
+    return np.column_stack((cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)))
+
+def cumulative_distances(lon_lat: np.ndarray) -> np.ndarray:
+    """Distance in metres from the first vertex to every vertex of a polyline"""
+    if len(lon_lat) == 0:
+        return np.zeros(0)
+    steps = haversine(lon_lat[:-1, 1], lon_lat[:-1, 0], lon_lat[1:, 1], lon_lat[1:, 0])
+    return np.concatenate(([0.0], np.cumsum(steps)))
+
+class RouteSpatialIndex:
+    """Grid index over the segments of a route polyline for fast proximity queries.
+
+    Vertices are projected to Earth-centred coordinates in metres, so distances
+    are metric everywhere (chord length, which matches the great-circle distance
+    to well under a metre at the scales we query). Each segment is registered in
+    every grid cell it passes through; queries look at the cells around each
+    point and then measure exact point-to-segment distances.
+    """
+
+    def __init__(self, coordinates: Points, cell_size: float = 500.0):
+        self.lon_lat = as_lon_lat(coordinates)
+        self.cell_size = cell_size
+        self.xyz = to_unit_vectors(self.lon_lat) * EARTH_RADIUS
+        self.cumulative = cumulative_distances(self.lon_lat)
+        self.segment_lengths = np.diff(self.cumulative)
+
+        n_segments = max(len(self.xyz) - 1, 0)
+        if n_segments == 0:
+            # A single point behaves like a zero-length segment
+            self.starts = self.xyz[:1]
+            self.ends = self.xyz[:1]
+            n_segments = len(self.starts)
+        else:
+            self.starts = self.xyz[:-1]
+            self.ends = self.xyz[1:]
+
+        # Sample every segment at most one cell apart so it lands in each cell it crosses
+        lengths = np.linalg.norm(self.ends - self.starts, axis=1)
+        samples = np.ceil(lengths / cell_size).astype(int) + 1
+        segment_ids = np.repeat(np.arange(n_segments), samples)
+        first_sample = np.repeat(np.cumsum(samples) - samples, samples)
+        t = (np.arange(len(segment_ids)) - first_sample) / np.maximum(samples[segment_ids] - 1, 1)
+        points = self.starts[segment_ids] + t[:, None] * (self.ends[segment_ids] - self.starts[segment_ids])
+
+        keys = self._keys(np.floor(points / cell_size).astype(np.int64))
+        # Consecutive samples of one segment usually share a cell; keep one entry each
+        keep = np.ones(len(keys), dtype=bool)
+        keep[1:] = (keys[1:] != keys[:-1]) | (segment_ids[1:] != segment_ids[:-1])
+        keys, segment_ids = keys[keep], segment_ids[keep]
+        order = np.argsort(keys, kind='stable')
+        self._keys_sorted = keys[order]
+        self._segments = segment_ids[order]
+
+    @staticmethod
+    def _keys(cells: np.ndarray) -> np.ndarray:
+        cells = cells + _KEY_OFFSET
+        return (cells[:, 0] << (2 * _KEY_BITS)) | (cells[:, 1] << _KEY_BITS) | cells[:, 2]
+
+    def _candidates(self, xyz: np.ndarray, radius: float):
+        """(point, segment) index pairs whose grid cells could be within radius"""
+        reach = int(np.ceil((radius + self.cell_size / 2) / self.cell_size))
+        steps = np.arange(-reach, reach + 1)
+        offsets = np.stack(np.meshgrid(steps, steps, steps, indexing='ij'), axis=-1).reshape(-1, 3)
+
+        cells = np.floor(xyz / self.cell_size).astype(np.int64)
+        keys = self._keys((cells[:, None, :] + offsets[None, :, :]).reshape(-1, 3))
+        lo = np.searchsorted(self._keys_sorted, keys, side='left')
+        hi = np.searchsorted(self._keys_sorted, keys, side='right')
+        counts = hi - lo
+        if counts.sum() == 0:
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+
+        # Expand each [lo, hi) range into the matching entry positions
+        entry = np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        point_ids = np.repeat(np.arange(len(keys)) // len(offsets), counts)
+        n_segments = len(self.starts)
+        pairs = np.unique(point_ids * n_segments + self._segments[entry])
+        return pairs // n_segments, pairs % n_segments
+
+    def _segment_distances(self, xyz: np.ndarray, point_ids: np.ndarray, segment_ids: np.ndarray):
+        a = self.starts[segment_ids]
+        ab = self.ends[segment_ids] - a
+        ap = xyz[point_ids] - a
+        denom = np.einsum('ij,ij->i', ab, ab)
+        t = np.clip(np.einsum('ij,ij->i', ap, ab) / np.where(denom > 0, denom, 1), 0, 1)
+        return np.linalg.norm(ap - t[:, None] * ab, axis=1), t
+
+    def segments_near(self, points: Points, radius: float) -> np.ndarray:
+        """Boolean mask of route segments that pass within radius metres of any point"""
+        mask = np.zeros(len(self.starts), dtype=bool)
+        if len(points) == 0:
+            return mask
+        xyz = to_unit_vectors(as_lon_lat(points)) * EARTH_RADIUS
+        point_ids, segment_ids = self._candidates(xyz, radius)
+        if len(segment_ids):
+            distances, _ = self._segment_distances(xyz, point_ids, segment_ids)
+            mask[segment_ids[distances <= radius]] = True
+        return mask
+
+    def snap(self, point: Sequence[float], radius: float, min_along: float = 0.0):
+        """Closest (segment, t, distance, along) for a [lon, lat] point within radius metres.
+
+        Only positions at least min_along metres along the route are considered,
+        and among those the earliest pass within 2 * radius wins, so a route
+        that doubles back on itself snaps to the stretch the vehicle is on.
+        Returns None when no segment is close enough.
+        """
+        xyz = to_unit_vectors(as_lon_lat([point])) * EARTH_RADIUS
+        _, segment_ids = self._candidates(xyz, radius)
+        if len(segment_ids) == 0 or len(self.segment_lengths) == 0:
+            return None
+        distances, t = self._segment_distances(xyz, np.zeros(len(segment_ids), dtype=int), segment_ids)
+        along = self.cumulative[segment_ids] + t * self.segment_lengths[segment_ids]
+        ok = (distances <= radius) & (along >= min_along)
+        if not ok.any():
+            return None
+        ok &= along <= along[ok].min() + 2 * radius
+        best = np.flatnonzero(ok)[np.argmin(distances[ok])]
+        return int(segment_ids[best]), float(t[best]), float(distances[best]), float(along[best])
+
+    def length_near(self, points: Points, radius: float) -> float:
+        """Metres of route made up of segments within radius of any point"""
+        if len(self.segment_lengths) == 0:
+            return 0.0
+        return float(self.segment_lengths[self.segments_near(points, radius)].sum())
+
+def encode_polyline(coordinates: Points, precision: int = 5) -> str:
+    """Encode [lon, lat] coordinates with the Google/OSRM polyline algorithm"""
+    lon_lat = as_lon_lat(coordinates)
+    if len(lon_lat) == 0:
+        return ""
+    # Polylines store (lat, lon) deltas as zigzag-encoded integers in 5-bit chunks
+    scaled = np.round(lon_lat[:, ::-1] * 10 ** precision).astype(np.int64)
+    deltas = np.diff(scaled, axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).ravel()
+    values = (deltas << 1) ^ (deltas >> 63)
+
+    n_chunks = np.ones(len(values), dtype=np.int64)
+    for k in range(1, 13):
+        n_chunks += values >= (1 << (5 * k))
+    first = np.cumsum(n_chunks) - n_chunks
+    owner = np.repeat(np.arange(len(values)), n_chunks)
+    position = np.arange(n_chunks.sum()) - first[owner]
+
+    chunks = (values[owner] >> (5 * position)) & 0x1F
+    chunks |= np.where(position < n_chunks[owner] - 1, 0x20, 0)
+    return (chunks + 63).astype(np.uint8).tobytes().decode('ascii')
+
+def decode_polyline(encoded: str, precision: int = 5) -> np.ndarray:
+    """Decode a polyline string into an (n, 2) array of [lon, lat]"""
+    if not encoded:
+        return np.zeros((0, 2))
+    chunks = np.frombuffer(encoded.encode('ascii'), dtype=np.uint8).astype(np.int64) - 63
+    is_last = chunks < 0x20
+    ends = np.flatnonzero(is_last)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    owner = np.repeat(np.arange(len(starts)), ends - starts + 1)
+    position = np.arange(len(chunks)) - starts[owner]
+
+    values = np.add.reduceat((chunks & 0x1F) << (5 * position), starts)
+    deltas = (values >> 1) ^ -(values & 1)
+    lat_lon = np.cumsum(deltas.reshape(-1, 2), axis=0) / 10 ** precision
+    return lat_lon[:, ::-1]
+
+def simplify(coordinates: Points, tolerance: float) -> np.ndarray:
+    """Indices of the vertices Douglas-Peucker keeps at a tolerance in metres"""
+    lon_lat = as_lon_lat(coordinates)
+    n = len(lon_lat)
+    if n <= 2 or tolerance <= 0:
+        return np.arange(n)
+    # Equirectangular projection around the route; metre-accurate at route scale
+    scale = np.radians(1) * EARTH_RADIUS
+    x = lon_lat[:, 0] * scale * np.cos(np.radians(lon_lat[:, 1].mean()))
+    y = lon_lat[:, 1] * scale
+
+    # Split every open segment at once per pass rather than one segment per step,
+    # so a pass costs a few array operations whatever the number of segments
+    keep = np.zeros(n, dtype=bool)
+    keep[[0, -1]] = True
+    candidates = np.arange(1, n - 1)
+    while len(candidates):
+        kept = np.flatnonzero(keep)
+        segment = np.searchsorted(kept, candidates) - 1
+        first, last = kept[segment], kept[segment + 1]
+        dx, dy = x[last] - x[first], y[last] - y[first]
+        px, py = x[candidates] - x[first], y[candidates] - y[first]
+        length_sq = dx * dx + dy * dy
+        # Distance to the segment, not the infinite line, so hairpins survive
+        t = np.clip((px * dx + py * dy) / np.where(length_sq > 0, length_sq, 1), 0, 1)
+        distances = np.hypot(px - t * dx, py - t * dy)
+
+        # Farthest candidate of each segment (candidates are sorted, so segments are runs)
+        starts = np.flatnonzero(np.r_[True, segment[1:] != segment[:-1]])
+        sizes = np.diff(np.r_[starts, len(candidates)])
+        group_max = np.maximum.reduceat(distances, starts)
+        at_max = np.flatnonzero(distances == np.repeat(group_max, sizes))
+        _, first_at_max = np.unique(segment[at_max], return_index=True)
+        farthest = candidates[at_max[first_at_max]]
+
+        split = group_max > tolerance
+        keep[farthest[split]] = True
+        # Segments within tolerance are final; the rest are re-examined as two halves
+        candidates = candidates[np.repeat(split, sizes) & ~keep[candidates]]
+    return np.flatnonzero(keep)
+
+def zoom_tolerance(zoom: float, lat: float) -> float:
+    """Metres covered by one pixel of a 256px web map tile at this zoom and latitude"""
+    return 156543.03392 * np.cos(np.radians(lat)) / 2 ** zoom
+
+GEOMETRY_FORMATS = ('geojson', 'polyline5', 'polyline6', 'float32')
+
+class GeometryOptions(NamedTuple):
+    """How route geometries are written into responses"""
+    format: str = 'geojson'
+    tolerance: Optional[float] = None  # metres; vertices closer to the line are dropped
+    zoom: Optional[float] = None  # simplify to one pixel at this web map zoom level
+
+    @property
+    def is_default(self) -> bool:
+        return self.format == 'geojson' and not self.tolerance and self.zoom is None
+
+def format_geometry(geometry: Dict, options: GeometryOptions) -> Any:
+    """A GeoJSON LineString, simplified and encoded as the options ask.
+
+    polyline5/6 give an encoded polyline string (as OSRM's geometries=polyline)
+    and float32 gives base64 of little-endian float32 [lon, lat] pairs.
+    """
+    lon_lat = as_lon_lat(geometry['coordinates'])
+    tolerance = options.tolerance or 0.0
+    if options.zoom is not None and len(lon_lat):
+        tolerance = max(tolerance, zoom_tolerance(options.zoom, float(lon_lat[:, 1].mean())))
+    if tolerance:
+        lon_lat = lon_lat[simplify(lon_lat, tolerance)]
+
+    if options.format == 'geojson':
+        return {'type': geometry.get('type', 'LineString'), 'coordinates': lon_lat}
+    if options.format in ('polyline5', 'polyline6'):
+        return encode_polyline(lon_lat, int(options.format[-1]))
+    if options.format == 'float32':
+        return base64.b64encode(lon_lat.astype('<f4').tobytes()).decode('ascii')
+    raise ValueError(f"Unknown geometry format: {options.format}")
+
+def format_routes(value: Any, options: GeometryOptions) -> Any:
+    """Copy of a response with every route geometry in it formatted, however deeply nested"""
+    if options.is_default:
+        return value
+    if isinstance(value, dict):
+        formatted = {}
+        for key, item in value.items():
+            if key == 'geometry' and isinstance(item, dict) and 'coordinates' in item:
+                formatted[key] = format_geometry(item, options)
+                formatted['geometry_format'] = options.format
+            else:
+                formatted[key] = format_routes(item, options)
+        return formatted
+    # Lists of dicts (stops, routes) may hold routes; coordinate lists and arrays don't
+    if isinstance(value, list) and value and isinstance(value[0], (dict, list)):
+        return [format_routes(item, options) for item in value]
+    return value
+
+# SciPy's k-d tree answers nearest-neighbour queries in n log n; without it
+# they fall back to blocked brute force, which gives the same answers
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+# Rows per block of the brute-force nearest-neighbour search
+_NEIGHBOR_BLOCK = 256
+
+def nearest_neighbors(lat: np.ndarray, lon: np.ndarray, k: int) -> np.ndarray:
+    """(n, k) indices of each point's k nearest other points, nearest first"""
+    xyz = to_unit_vectors(np.column_stack((lon, lat)))
+    n = len(xyz)
+    k = min(k, n - 1)
+    if k <= 0:
+        return np.zeros((n, 0), dtype=np.intp)
+    if cKDTree is not None:
+        _, found = cKDTree(xyz).query(xyz, k + 1)
+        found = np.asarray(found, dtype=np.intp).reshape(n, k + 1)
+    else:
+        found = np.empty((n, k + 1), dtype=np.intp)
+        for start in range(0, n, _NEIGHBOR_BLOCK):
+            # Closer points have larger dot products between unit vectors
+            closeness = xyz[start:start + _NEIGHBOR_BLOCK] @ xyz.T
+            nearest = np.argpartition(-closeness, k, axis=1)[:, :k + 1]
+            rows = np.arange(len(nearest))[:, None]
+            found[start:start + len(nearest)] = nearest[rows, np.argsort(-closeness[rows, nearest], axis=1)]
+    # Drop each point itself; a duplicate location can come back ahead of it
+    is_self = found == np.arange(n)[:, None]
+    is_self[~is_self.any(axis=1), -1] = True
+    return found[~is_self].reshape(n, k)
+
+def quadrant_neighbors(lat: np.ndarray, lon: np.ndarray, k: int, reach: int = 5) -> np.ndarray:
+    """(n, k) candidate neighbours per point: the nearest in each compass quadrant, then the nearest overall.
+
+    Quadrants are picked from the reach * k nearest points, up to k // 4
+    each, so points on the edge of a dense cluster also get candidates in
+    the clusters next to it, which plain nearest neighbours rarely reach.
+    """
+    wide = nearest_neighbors(lat, lon, reach * k)
+    n, width = wide.shape
+    k = min(k, width)
+    if k < 4:
+        return wide[:, :k]
+    lat, lon = np.asarray(lat, dtype=float), np.asarray(lon, dtype=float)
+    north = lat[wide] >= lat[:, None]
+    east = np.sin(np.radians(lon[wide] - lon[:, None])) >= 0
+    quadrant = 2 * north + east
+    # Rank of each point among the nearer ones in its quadrant
+    rank = np.zeros(wide.shape, dtype=np.intp)
+    for q in range(4):
+        in_quadrant = quadrant == q
+        rank[in_quadrant] = (np.cumsum(in_quadrant, axis=1) - 1)[in_quadrant]
+    columns = np.arange(width)
+    preference = np.where(rank < k // 4, columns, columns + width)
+    # Back in order of distance, nearest first
+    chosen = np.sort(np.argsort(preference, axis=1, kind='stable')[:, :k], axis=1)
+    return wide[np.arange(n)[:, None], chosen]
+
+def spatial_order(lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+    """Indices that sort points along a Z-order curve, so runs of them lie close together"""
+    lat, lon = np.asarray(lat, dtype=float), np.asarray(lon, dtype=float)
+    if len(lat) == 0:
+        return np.zeros(0, dtype=np.intp)
+
+    def spread(values: np.ndarray, low: float, high: float) -> np.ndarray:
+        # 16 bits per axis, moved to the even bit positions
+        x = ((values - low) / max(high - low, 1e-12) * 65535).astype(np.uint64)
+        for shift, mask in ((8, 0x00FF00FF), (4, 0x0F0F0F0F), (2, 0x33333333), (1, 0x55555555)):
+            x = (x | (x << np.uint64(shift))) & np.uint64(mask)
+        return x
+
+    codes = spread(lon, lon.min(), lon.max()) | (spread(lat, lat.min(), lat.max()) << np.uint64(1))
+    return np.argsort(codes, kind='stable')
+
+_GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+def geohash(lat: float, lon: float, precision: int = 7) -> str:
+    """Geohash cell of a point; 7 characters is roughly 150m x 150m"""
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars = []
+    bits = 0
+    value = 0
+    even = True
+    while len(chars) < precision:
+        # Bits alternate between longitude and latitude, starting with longitude
+        bounds, x = (lon_range, lon) if even else (lat_range, lat)
+        mid = (bounds[0] + bounds[1]) / 2
+        value <<= 1
+        if x >= mid:
+            value |= 1
+            bounds[0] = mid
+        else:
+            bounds[1] = mid
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(_GEOHASH_ALPHABET[value])
+            bits = value = 0
+    return "".join(chars)
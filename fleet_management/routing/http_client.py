@@ -0,0 +1,186 @@
+from typing import Dict, Optional, Tuple
+import asyncio
+import logging
+import os
+import time
+import httpx
+from .metrics import (UPSTREAM_HEDGES, UPSTREAM_IN_FLIGHT, UPSTREAM_REQUESTS, UPSTREAM_SECONDS,
+                      add_timing, upstream_endpoint)
+from .resilience import (CircuitBreaker, CircuitOpen, LatencyTracker, UpstreamTimeout, create_circuit_breaker,
+                         first_success, time_left)
+
+logger = logging.getLogger(__name__)
+
+class HTTPClient:
+    """Shared async HTTP client with keep-alive pooling and per-host connection limits.
+
+    Every call is bounded by `timeout` in total and by the deadline of the
+    request being handled, if any. A GET still unanswered after the
+    `hedge_percentile` latency of its endpoint gets a duplicate, and the
+    first answer wins. Each host has a circuit breaker that refuses calls
+    while the host keeps failing.
+    """
+
+    def __init__(self,
+                 max_connections: Optional[int] = None,
+                 max_connections_per_host: Optional[int] = None,
+                 timeout: Optional[float] = None,
+                 connect_timeout: Optional[float] = None,
+                 transport: Optional[httpx.AsyncBaseTransport] = None,
+                 hedge_percentile: Optional[float] = None):
+        # Read the environment here rather than at import so a .env loaded at startup applies
+        max_connections = max_connections or int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+        max_connections_per_host = max_connections_per_host or int(os.getenv("HTTP_MAX_CONNECTIONS_PER_HOST", "20"))
+        timeout = timeout or float(os.getenv("HTTP_TIMEOUT", "10"))
+        connect_timeout = connect_timeout or float(os.getenv("HTTP_CONNECT_TIMEOUT", "3"))
+        # 0 turns hedging off
+        if hedge_percentile is None:
+            hedge_percentile = float(os.getenv("HTTP_HEDGE_PERCENTILE", "95"))
+
+        # HTTP/2 needs the optional h2 package; fall back to HTTP/1.1 keep-alive without it
+        try:
+            import h2  # noqa: F401
+            http2 = True
+        except ImportError:
+            http2 = False
+
+        self.max_connections_per_host = max_connections_per_host
+        self.timeout = timeout
+        self.hedge_percentile = hedge_percentile
+        self._host_limits: Dict[str, asyncio.Semaphore] = {}
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._latencies: Dict[Tuple[str, str], LatencyTracker] = {}
+        self._client = httpx.AsyncClient(
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+                keepalive_expiry=30
+            ),
+            timeout=httpx.Timeout(timeout, connect=connect_timeout),
+            transport=transport
+        )
+
+    def _host_limit(self, host: str) -> asyncio.Semaphore:
+        if host not in self._host_limits:
+            self._host_limits[host] = asyncio.Semaphore(self.max_connections_per_host)
+        return self._host_limits[host]
+
+    def breaker(self, host: str) -> CircuitBreaker:
+        if host not in self._breakers:
+            self._breakers[host] = create_circuit_breaker()
+        return self._breakers[host]
+
+    def breaker_states(self) -> Dict[str, str]:
+        return {host: breaker.state for host, breaker in self._breakers.items()}
+
+    async def request(self, method: str, url: str, hedge: Optional[bool] = None, **kwargs) -> httpx.Response:
+        """Send a request within the current deadline; hedge defaults to on for GETs only"""
+        # Drop unset query parameters like requests does instead of sending "key="
+        if kwargs.get('params'):
+            kwargs['params'] = {k: v for k, v in kwargs['params'].items() if v is not None}
+        parsed = httpx.URL(url)
+        host = parsed.host
+        endpoint = upstream_endpoint(parsed.path)
+
+        budget = self.timeout
+        left = time_left()
+        if left is not None:
+            if left <= 0:
+                raise UpstreamTimeout(f"No time left in the request deadline for {host}")
+            budget = min(budget, left)
+        breaker = self.breaker(host)
+        if not breaker.allow():
+            raise CircuitOpen(f"Circuit open for {host}")
+
+        latencies = self._latencies.setdefault((host, endpoint), LatencyTracker())
+        hedge_after = None
+        if (method == "GET" if hedge is None else hedge) and self.hedge_percentile:
+            hedge_after = latencies.percentile(self.hedge_percentile)
+
+        try:
+            response = await asyncio.wait_for(
+                self._send_hedged(method, url, parsed, endpoint, hedge_after, latencies, kwargs), budget
+            )
+        except asyncio.TimeoutError:
+            # Running out of a short request deadline says nothing about the host
+            if budget >= self.timeout:
+                breaker.record(False)
+            else:
+                breaker.abandon()
+            raise UpstreamTimeout(f"{method} {host}/{endpoint} took longer than {budget:.2f}s")
+        except asyncio.CancelledError:
+            breaker.abandon()
+            raise
+        except Exception:
+            breaker.record(False)
+            raise
+        breaker.record(response.status_code < 500 and response.status_code != 429)
+        return response
+
+    async def _send_hedged(self, method: str, url: str, parsed: httpx.URL, endpoint: str,
+                           hedge_after: Optional[float], latencies: LatencyTracker,
+                           kwargs: Dict) -> httpx.Response:
+        if hedge_after is None:
+            return await self._send(method, url, parsed, endpoint, latencies, kwargs)
+        tasks = [asyncio.ensure_future(self._send(method, url, parsed, endpoint, latencies, kwargs))]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+            if done:
+                return tasks[0].result()
+            # Slower than almost every recent call: race a duplicate against it
+            UPSTREAM_HEDGES.inc(parsed.host, endpoint)
+            tasks.append(asyncio.ensure_future(self._send(method, url, parsed, endpoint, latencies, kwargs)))
+            return await first_success(tasks)
+        finally:
+            # Cancelled by the deadline, or the loser of the race
+            for task in tasks:
+                task.cancel()
+
+    async def _send(self, method: str, url: str, parsed: httpx.URL, endpoint: str,
+                    latencies: LatencyTracker, kwargs: Dict) -> httpx.Response:
+        host = parsed.host
+        async with self._host_limit(host):
+            UPSTREAM_IN_FLIGHT.inc(host)
+            start = time.perf_counter()
+            status = "error"
+            try:
+                response = await self._client.request(method, url, **kwargs)
+                status = str(response.status_code)
+                latencies.observe(time.perf_counter() - start)
+                return response
+            finally:
+                elapsed = time.perf_counter() - start
+                UPSTREAM_IN_FLIGHT.dec(host)
+                UPSTREAM_SECONDS.observe(elapsed, host, endpoint)
+                UPSTREAM_REQUESTS.inc(host, endpoint, status)
+                add_timing("upstream", elapsed)
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("POST", url, **kwargs)
+
+    async def aclose(self):
+        await self._client.aclose()
+
+_shared_client: Optional[HTTPClient] = None
+
+def get_http_client() -> HTTPClient:
+    """Return the application-wide client, creating it on first use"""
+    global _shared_client
+    if _shared_client is None:
+        _shared_client = HTTPClient()
+    return _shared_client
+
+def set_http_client(client: HTTPClient):
+    """Replace the application-wide client, e.g. with one pointed at a fake upstream"""
+    global _shared_client
+    _shared_client = client
+
+async def close_http_client():
+    global _shared_client
+    if _shared_client is not None:
+        await _shared_client.aclose()
+        _shared_client = None
@@ -0,0 +1,418 @@
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+import asyncio
+import atexit
+import hashlib
+import heapq
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from .metrics import REGISTRY, recording_timings
+from .parallel_solver import close_solver_pool, share_cores
+from .route_optimizer import RouteOptimizer, SolverRunner, run_solver_inline
+from .resilience import error_status
+
+logger = logging.getLogger(__name__)
+
+JOB_KINDS = ('multi_point', 'fleet')
+TERMINAL_STATES = ('completed', 'failed', 'cancelled')
+# Solver improvements are forwarded at most this often per job
+PROGRESS_INTERVAL = 0.2
+# Progress-queue stage for a better tour found in a worker; the parent turns it into progress
+IMPROVEMENT = 'improvement'
+
+class QueueFull(Exception):
+    """Raised when too many jobs are already waiting"""
+
+class JobCancelled(Exception):
+    pass
+
+async def execute(optimizer: RouteOptimizer, kind: str, payload: Dict,
+                  report: Callable[[str, Dict], None],
+                  cancelled: Callable[[], bool],
+                  run_solver: SolverRunner = run_solver_inline) -> Dict:
+    """Run one job's matrix build, solve and routing on the app's optimizer"""
+    def on_progress(stage: str, detail: Dict):
+        # Between stages a cancelled job stops at once; inside a solve the
+        # solver stops early and the next stage boundary ends the job
+        if cancelled():
+            raise JobCancelled("Job was cancelled")
+        report(stage, detail)
+
+    if kind == 'multi_point':
+        return await optimizer.optimize_multi_point_delivery(
+            payload['user_id'], payload['routes'],
+            time_budget=payload.get('time_budget'),
+            quality=payload.get('quality', 'balanced'),
+            seed=payload.get('seed'),
+            departure_time=payload.get('departure_time'),
+            on_progress=on_progress, cancelled=cancelled, run_solver=run_solver
+        )
+    if kind == 'fleet':
+        return await optimizer.optimize_fleet(
+            payload['vehicles'], payload['orders'],
+            time_budget=payload.get('time_budget'),
+            on_progress=on_progress, cancelled=cancelled, run_solver=run_solver
+        )
+    raise ValueError(f"Unknown job kind: {kind}")
+
+# Worker process state, set up once per process by _init_worker
+_worker: Dict = {}
+
+def _init_worker(progress_queue, cancel_flags):
+    from dotenv import load_dotenv
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    _worker['progress'] = progress_queue
+    _worker['cancel_flags'] = cancel_flags
+    # Every job worker may solve at once, so each gets its share of the cores
+    share_cores(len(cancel_flags))
+    atexit.register(close_solver_pool)
+
+def run_solve(job_id: str, slot: int, solve: Callable[..., Dict], improvements: bool) -> Tuple[Dict, Dict]:
+    """Entry point in a worker process: one solve, and the metrics it recorded.
+
+    Better tours go back over the shared queue for the job's on_improvement.
+    """
+    flags = _worker['cancel_flags']
+    progress_queue = _worker['progress']
+    last_sent = {'at': 0.0}
+
+    def on_improvement(order: List[int], cost: float):
+        now = time.monotonic()
+        if now - last_sent['at'] < PROGRESS_INTERVAL:
+            return
+        last_sent['at'] = now
+        progress_queue.put((job_id, IMPROVEMENT, {'order': list(order), 'cost': float(cost)}))
+
+    def cancelled() -> bool:
+        return flags[slot] != 0
+
+    before = REGISTRY.snapshot()
+    callbacks = {'on_improvement': on_improvement} if improvements else {}
+    result = solve(cancelled=cancelled, **callbacks)
+    return result, REGISTRY.changes_since(before)
+
+def job_key(kind: str, payload: Dict) -> str:
+    """Jobs with the same kind and inputs get the same ID"""
+    data = json.dumps({'kind': kind, 'payload': payload}, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(data.encode()).hexdigest()[:32]
+
+class Job:
+    def __init__(self, job_id: str, kind: str, payload: Dict, priority: int):
+        self.id = job_id
+        self.kind = kind
+        self.payload = payload
+        self.priority = priority
+        self.status = 'queued'
+        self.submitted_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.progress: Optional[Dict] = None
+        # Seconds per stage (matrix, solve, route...), for the Server-Timing of requests waiting on it
+        self.timings: Dict[str, float] = {}
+        self.result: Optional[Dict] = None
+        self.error: Optional[str] = None
+        # HTTP status the synchronous endpoints report the error with
+        self.error_status: Optional[int] = None
+        self.cancel_requested = False
+        self.slot: Optional[int] = None
+        # Bumped on every change; watchers wait on the event for the next version
+        self.version = 0
+        self._changed = asyncio.Event()
+
+    @property
+    def done(self) -> bool:
+        return self.status in TERMINAL_STATES
+
+    def touch(self):
+        self.version += 1
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def wait_for_change(self, version: int, timeout: Optional[float] = None) -> bool:
+        """Wait until the job moves past `version`; False on timeout"""
+        if self.version != version:
+            return True
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def wait(self) -> 'Job':
+        while not self.done:
+            await self.wait_for_change(self.version)
+        return self
+
+    def snapshot(self) -> Dict:
+        return {
+            'job_id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'priority': self.priority,
+            'submitted_at': self.submitted_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'progress': self.progress,
+            'result': self.result,
+            'error': self.error
+        }
+
+class JobQueue:
+    """Optimization jobs run in priority order on a pool of worker processes.
+
+    Submitting returns at once with a job ID derived from the inputs, so
+    identical requests share one job while it is queued or running. Matrix
+    builds and routing run on the event loop with the app's optimizer, so
+    they share its route cache, single-flight and metrics. Only the CPU-bound solve goes to a worker
+    process; its better tours come back over a multiprocessing queue, and
+    the metrics it recorded come back with its result. Queued jobs beyond
+    max_queued are refused with QueueFull. Cancelling a running job sets its
+    slot's shared flag, which the solver checks between moves.
+
+    With workers=0 solves run on the event loop too, up to
+    inline_concurrency jobs at a time, which suits development and tests.
+    """
+
+    def __init__(self, optimizer: RouteOptimizer, workers: int = 2, max_queued: int = 100,
+                 result_ttl: float = 3600, inline_concurrency: int = 4,
+                 on_result: Optional[Callable[[Job, Dict], Dict]] = None):
+        self.optimizer = optimizer
+        self.workers = workers
+        self.max_queued = max_queued
+        self.result_ttl = result_ttl
+        self.on_result = on_result
+        self.slots = workers or inline_concurrency
+        self._jobs: Dict[str, Job] = {}
+        self._heap: List[tuple] = []
+        self._seq = itertools.count()
+        self._free_slots = list(range(self.slots))
+        self._slot_freed = asyncio.Event()
+        self._work = asyncio.Event()
+        self._tasks: set = set()
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._progress_queue = None
+        self._progress_reader: Optional[threading.Thread] = None
+        self._cancel_flags = None
+        # on_improvement of each job whose solve is running in a worker
+        self._improvement_callbacks: Dict[str, Callable[[List[int], float], None]] = {}
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        if self.workers:
+            # spawn, not fork: the parent runs an event loop and threads
+            context = multiprocessing.get_context('spawn')
+            self._progress_queue = context.Queue()
+            self._cancel_flags = context.Array('b', self.workers, lock=False)
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=context,
+                initializer=_init_worker, initargs=(self._progress_queue, self._cancel_flags)
+            )
+            self._progress_reader = threading.Thread(
+                target=self._read_progress, args=(loop,), name='job-progress', daemon=True
+            )
+            self._progress_reader.start()
+        else:
+            self._cancel_flags = [0] * self.slots
+        self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def stop(self):
+        if self._dispatcher is None:
+            return
+        self._dispatcher.cancel()
+        for job in self._jobs.values():
+            if not job.done:
+                self._cancel(job)
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(self._dispatcher, *self._tasks, return_exceptions=True)
+        if self._executor:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._progress_queue.put(None)
+            self._progress_reader.join(timeout=5)
+        # Inline solves keep their pool in this process
+        close_solver_pool()
+
+    def submit(self, kind: str, payload: Dict, priority: int = 0) -> tuple:
+        """Queue a job, or join an identical queued or running one; returns (job, deduplicated)"""
+        if kind not in JOB_KINDS:
+            raise ValueError(f"Unknown job kind: {kind}")
+        self._expire()
+        job_id = job_key(kind, payload)
+        existing = self._jobs.get(job_id)
+        # Only unfinished jobs are joined. A finished one is replaced by a new run:
+        # its ETAs and traffic were for a departure that may have passed.
+        if existing is not None and not existing.done:
+            if existing.status == 'queued' and priority > existing.priority:
+                existing.priority = priority
+                heapq.heappush(self._heap, (-priority, next(self._seq), job_id))
+            return existing, True
+
+        queued = sum(1 for job in self._jobs.values() if job.status == 'queued')
+        if queued >= self.max_queued:
+            raise QueueFull(f"{queued} jobs already queued")
+        job = Job(job_id, kind, payload, priority)
+        self._jobs[job_id] = job
+        heapq.heappush(self._heap, (-priority, next(self._seq), job_id))
+        self._work.set()
+        logger.info(f"Queued {kind} job {job_id} with priority {priority}")
+        return job, False
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> Optional[Job]:
+        job = self._jobs.get(job_id)
+        if job is not None and not job.done:
+            self._cancel(job)
+        return job
+
+    def _cancel(self, job: Job):
+        job.cancel_requested = True
+        if job.status == 'queued':
+            # Its heap entry is skipped when popped
+            self._finish(job, 'cancelled')
+        elif job.slot is not None:
+            self._cancel_flags[job.slot] = 1
+
+    def stats(self) -> Dict[str, int]:
+        counts = {status: 0 for status in ('queued', 'running') + TERMINAL_STATES}
+        for job in self._jobs.values():
+            counts[job.status] += 1
+        return counts
+
+    def _expire(self):
+        cutoff = time.time() - self.result_ttl
+        for job_id in [job.id for job in self._jobs.values() if job.done and job.finished_at < cutoff]:
+            del self._jobs[job_id]
+
+    def _next_job(self) -> Optional[Job]:
+        while self._heap:
+            _, _, job_id = heapq.heappop(self._heap)
+            job = self._jobs.get(job_id)
+            # Stale entries: cancelled while queued, or re-pushed at a higher priority
+            if job is not None and job.status == 'queued':
+                return job
+        return None
+
+    async def _dispatch(self):
+        while True:
+            if not self._free_slots:
+                self._slot_freed.clear()
+                await self._slot_freed.wait()
+                continue
+            job = self._next_job()
+            if job is None:
+                self._work.clear()
+                await self._work.wait()
+                continue
+            slot = self._free_slots.pop()
+            self._cancel_flags[slot] = 0
+            job.slot = slot
+            job.status = 'running'
+            job.started_at = time.time()
+            job.touch()
+            task = asyncio.create_task(self._run(job, slot))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    def _solver_runner(self, job: Job, slot: int) -> SolverRunner:
+        async def run_in_worker(solve: Callable[..., Dict],
+                                on_improvement: Optional[Callable[[List[int], float], None]] = None,
+                                cancelled: Optional[Callable[[], bool]] = None) -> Dict:
+            # The worker checks the slot's shared flag in place of cancelled
+            if on_improvement is not None:
+                self._improvement_callbacks[job.id] = on_improvement
+            try:
+                result, metrics = await asyncio.get_running_loop().run_in_executor(
+                    self._executor, run_solve, job.id, slot, solve, on_improvement is not None
+                )
+            finally:
+                self._improvement_callbacks.pop(job.id, None)
+            REGISTRY.merge(metrics)
+            return result
+
+        return run_in_worker
+
+    async def _run(self, job: Job, slot: int):
+        try:
+            flags = self._cancel_flags
+            with recording_timings(job.timings):
+                result = await execute(
+                    self.optimizer, job.kind, job.payload,
+                    lambda stage, detail: self._on_progress(job.id, stage, detail),
+                    lambda: flags[slot] != 0,
+                    self._solver_runner(job, slot) if self._executor else run_solver_inline
+                )
+            if job.cancel_requested:
+                raise JobCancelled()
+            if self.on_result:
+                result = self.on_result(job, result)
+            job.result = result
+            self._finish(job, 'completed')
+        except (JobCancelled, asyncio.CancelledError):
+            self._finish(job, 'cancelled')
+        except Exception as e:
+            logger.error(f"Job {job.id} failed: {str(e)}")
+            job.error = str(e)
+            job.error_status = error_status(e)
+            self._finish(job, 'failed')
+        finally:
+            job.slot = None
+            self._free_slots.append(slot)
+            self._slot_freed.set()
+
+    def _finish(self, job: Job, status: str):
+        job.status = status
+        job.finished_at = time.time()
+        job.touch()
+        logger.info(f"Job {job.id} {status}")
+
+    def _on_progress(self, job_id: str, stage: str, detail: Dict):
+        if stage == IMPROVEMENT:
+            callback = self._improvement_callbacks.get(job_id)
+            if callback is not None:
+                try:
+                    callback(detail['order'], detail['cost'])
+                except JobCancelled:
+                    # The worker sees the cancel flag and ends the solve itself
+                    pass
+            return
+        job = self._jobs.get(job_id)
+        if job is None or job.done:
+            return
+        job.progress = {'stage': stage, **detail}
+        job.touch()
+
+    def _read_progress(self, loop: asyncio.AbstractEventLoop):
+        # Blocking reads happen on this thread; updates are applied on the loop
+        while True:
+            try:
+                message = self._progress_queue.get()
+            except (EOFError, OSError):
+                return
+            if message is None:
+                return
+            try:
+                loop.call_soon_threadsafe(self._on_progress, *message)
+            except RuntimeError:
+                # Loop already closed during shutdown
+                return
+
+def create_job_queue(optimizer: RouteOptimizer,
+                     on_result: Optional[Callable[[Job, Dict], Dict]] = None) -> JobQueue:
+    """JobQueue configured from JOB_WORKERS, JOB_MAX_QUEUED and JOB_RESULT_TTL"""
+    return JobQueue(
+        optimizer,
+        workers=int(os.getenv("JOB_WORKERS", str(min(4, os.cpu_count() or 1)))),
+        max_queued=int(os.getenv("JOB_MAX_QUEUED", "100")),
+        result_ttl=float(os.getenv("JOB_RESULT_TTL", "3600")),
+        inline_concurrency=int(os.getenv("JOB_INLINE_CONCURRENCY", "4")),
+        on_result=on_result
+    )
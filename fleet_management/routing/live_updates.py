@@ -0,0 +1,272 @@
+from typing import Dict, List, Optional, Set, Tuple
+import asyncio
+import logging
+from datetime import datetime
+from .geometry import GeometryOptions, format_routes
+from .metrics import UPSTREAM_FALLBACKS
+from .progress import RouteProgress
+from .resilience import upstream_failed
+from .route_optimizer import RouteOptimizer, traffic_alert
+from .serialization import dumps_text
+
+logger = logging.getLogger(__name__)
+
+# Sample points are snapped to a grid of this many decimal degrees (~110m at 3)
+# so routes that share roads share one traffic lookup per check
+CELL_PRECISION = 3
+
+Cell = Tuple[float, float]
+
+class Subscription:
+    """One connected vehicle; holds only the latest unsent message"""
+
+    def __init__(self, route_id: int, geometry: GeometryOptions = GeometryOptions()):
+        self.route_id = route_id
+        self.geometry = geometry
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=1)
+
+    def push(self, message: str):
+        # Messages are full snapshots, so a slow client only needs the newest one
+        if self._queue.full():
+            self._queue.get_nowait()
+        self._queue.put_nowait(message)
+
+    async def next_message(self) -> str:
+        return await self._queue.get()
+
+class RouteState:
+    def __init__(self, route: Dict):
+        self.route = route
+        self.progress = RouteProgress(route)
+        # (last offset along the route, cell) in driving order; a cell stays
+        # active until the vehicle has passed the last sample in it
+        last_offset: Dict[Cell, float] = {}
+        for offset, lat, lon in self.progress.samples:
+            last_offset[(round(lat, CELL_PRECISION), round(lon, CELL_PRECISION))] = offset
+        self.cells: List[Tuple[float, Cell]] = sorted((offset, cell) for cell, offset in last_offset.items())
+        self.first_active = 0
+        self.subscribers: Set[Subscription] = set()
+        self.position: Optional[Dict] = None
+        self.alerts: List[Dict] = []
+        self.needs_rerouting = False
+        self.signature: Optional[tuple] = None
+        self.alternative_sent = False
+        self.completed_stops = 0
+        self.last_payload: Optional[Dict] = None
+        # Latest payload serialised once per geometry format subscribers asked for
+        self.messages: Dict[GeometryOptions, str] = {}
+
+    def active_cells(self) -> List[Cell]:
+        return [cell for _, cell in self.cells[self.first_active:]]
+
+    def message_for(self, geometry: GeometryOptions) -> str:
+        message = self.messages.get(geometry)
+        if message is None:
+            message = self.messages[geometry] = dumps_text(format_routes(self.last_payload, geometry))
+        return message
+
+class LiveUpdateHub:
+    """Pushes traffic alerts for subscribed routes when their conditions change.
+
+    Every route's sample points are snapped to grid cells. One background loop
+    checks traffic for each distinct cell once per interval, however many
+    routes pass through it, then recomputes alerts per route and notifies
+    subscribers only if the alerts (or the rerouting decision) changed.
+    Reported positions advance each route's RouteProgress, and cells the
+    vehicle has passed drop out of the checks.
+    """
+
+    def __init__(self, optimizer: RouteOptimizer, interval: float = 15.0):
+        self.optimizer = optimizer
+        self.interval = interval
+        self._routes: Dict[int, RouteState] = {}
+        self._cell_refs: Dict[Cell, int] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def subscribe(self, route_id: int, route: Dict,
+                        geometry: GeometryOptions = GeometryOptions()) -> Subscription:
+        subscription = Subscription(route_id, geometry)
+        state = self._routes.get(route_id)
+        if state is not None:
+            state.subscribers.add(subscription)
+            if state.last_payload is not None:
+                subscription.push(state.message_for(geometry))
+            return subscription
+
+        state = self._routes[route_id] = RouteState(route)
+        for cell in state.active_cells():
+            self._cell_refs[cell] = self._cell_refs.get(cell, 0) + 1
+        state.subscribers.add(subscription)
+        # Give a new route its first snapshot now rather than at the next scheduled check
+        try:
+            await self.check_all([route_id])
+        except BaseException:
+            # Failed or cancelled: the caller never gets the subscription to unsubscribe
+            self.unsubscribe(subscription)
+            raise
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        state = self._routes.get(subscription.route_id)
+        if state is None:
+            return
+        state.subscribers.discard(subscription)
+        if not state.subscribers:
+            del self._routes[subscription.route_id]
+            for cell in state.active_cells():
+                self._release(cell)
+
+    async def replace_route(self, route_id: int, route: Dict):
+        """Follow a changed route (e.g. after stops were edited), keeping its subscribers and position"""
+        old = self._routes.get(route_id)
+        if old is None:
+            return
+        for cell in old.active_cells():
+            self._release(cell)
+        state = self._routes[route_id] = RouteState(route)
+        for cell in state.active_cells():
+            self._cell_refs[cell] = self._cell_refs.get(cell, 0) + 1
+        state.subscribers = old.subscribers
+        if old.position is not None:
+            await self.update_position(route_id, old.position)
+        # Alerts along the new geometry go out even if they match the old ones
+        state.signature = None
+        await self.check_all([route_id])
+
+    def _release(self, cell: Cell):
+        self._cell_refs[cell] -= 1
+        if not self._cell_refs[cell]:
+            del self._cell_refs[cell]
+
+    async def update_position(self, route_id: int, position: Dict):
+        state = self._routes.get(route_id)
+        if state is None:
+            return
+        state.position = position
+        state.progress.update(position)
+        # Stop checking traffic in cells the vehicle has left behind
+        while (state.first_active < len(state.cells)
+               and state.cells[state.first_active][0] < state.progress.travelled):
+            self._release(state.cells[state.first_active][1])
+            state.first_active += 1
+
+        if state.progress.completed_stops != state.completed_stops:
+            state.completed_stops = state.progress.completed_stops
+            # Alerts behind the vehicle no longer matter; the next check settles the rest
+            state.signature = None
+            await self.check_all([route_id])
+        elif state.needs_rerouting and not state.alternative_sent:
+            # A vehicle that reports in after rerouting was flagged still needs its alternative
+            state.alternative_sent = True  # don't start a second one on the next position
+            await self._publish(route_id, state)
+
+    def stats(self) -> Dict:
+        return {
+            'routes': len(self._routes),
+            'subscribers': sum(len(state.subscribers) for state in self._routes.values()),
+            'cells': len(self._cell_refs)
+        }
+
+    async def _run(self):
+        while True:
+            try:
+                await self.check_all()
+            except Exception as e:
+                logger.error(f"Live update check failed: {str(e)}")
+            await asyncio.sleep(self.interval)
+
+    async def check_all(self, route_ids: Optional[List[int]] = None):
+        """Look up traffic once per distinct cell and push changes to affected routes"""
+        if route_ids is None:
+            route_ids = list(self._routes)
+            cells = list(self._cell_refs)
+        else:
+            route_ids = [route_id for route_id in route_ids if route_id in self._routes]
+            cells = list(dict.fromkeys(
+                cell for route_id in route_ids for cell in self._routes[route_id].active_cells()
+            ))
+        if not route_ids:
+            return
+        try:
+            traffic = dict(zip(cells, await self.optimizer.get_traffic_batch(cells)))
+            alerts_by_cell = {cell: traffic_alert(*cell, traffic[cell]) for cell in cells}
+        except Exception as e:
+            if not upstream_failed(e):
+                raise
+            # Subscribers keep the alerts they last got; routes without a first snapshot get one with none
+            UPSTREAM_FALLBACKS.inc('traffic', 'none')
+            logger.warning(f"Traffic unavailable for live updates: {str(e)}")
+            route_ids = [route_id for route_id in route_ids if self._routes[route_id].last_payload is None]
+            alerts_by_cell = {}
+
+        changed = []
+        for route_id in route_ids:
+            state = self._routes.get(route_id)
+            if state is None:
+                continue
+            alerts = [alerts_by_cell[cell] for cell in state.active_cells() if alerts_by_cell.get(cell)]
+            # Speeds jitter between checks; only a change in where and how bad counts
+            signature = tuple(
+                (a['coordinates']['lat'], a['coordinates']['lon'], a['severity']) for a in alerts
+            )
+            if signature == state.signature:
+                continue
+            state.signature = signature
+            state.alerts = alerts
+            state.needs_rerouting = (
+                any(a['severity'] == 'High' for a in alerts)
+                and bool(state.progress.remaining_stops())
+            )
+            state.alternative_sent = False
+            changed.append(self._publish(route_id, state))
+        await asyncio.gather(*changed)
+
+        logger.info(
+            f"Checked {len(cells)} traffic cells for {len(route_ids)} routes, "
+            f"{len(changed)} changed"
+        )
+
+    async def _publish(self, route_id: int, state: RouteState):
+        message = {
+            'route_id': str(route_id),
+            'current_position': state.position,
+            'traffic_alerts': state.alerts,
+            'needs_rerouting': state.needs_rerouting,
+            'progress': state.progress.summary(),
+            'timestamp': datetime.now().isoformat()
+        }
+        if state.needs_rerouting and state.position is not None:
+            remaining_stops = state.progress.remaining_stops()
+            try:
+                message['alternative_route'] = await self.optimizer.calculate_alternative_route(
+                    state.route,
+                    state.position,
+                    remaining_stops[-1]['coordinates'],
+                    traffic_alerts=state.alerts,
+                    via=[
+                        {**stop['coordinates'], 'name': stop.get('name')}
+                        for stop in remaining_stops[:-1]
+                    ]
+                )
+                state.alternative_sent = True
+            except Exception as e:
+                logger.error(f"Alternative route for live update failed: {str(e)}")
+
+        # Serialise once per geometry format and share the text between subscribers
+        state.last_payload = message
+        state.messages = {}
+        for subscription in state.subscribers:
+            subscription.push(state.message_for(subscription.geometry))
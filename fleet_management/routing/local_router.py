@@ -0,0 +1,598 @@
+"""In-process routing over a preprocessed road graph.
+
+Build a graph once from an OSM XML extract:
+
+    python -m routing.local_router extract.osm graph_dir
+
+and serve it with ROUTING_BACKEND=local LOCAL_GRAPH_PATH=graph_dir. The graph
+is a directory of .npy arrays (CSR adjacency in both directions plus ALT
+landmark distances) that is memory-mapped on load, so several workers share
+one copy through the page cache.
+"""
+from typing import Dict, List, Optional, Tuple
+import argparse
+import asyncio
+import heapq
+import json
+import logging
+import os
+import re
+import time
+import xml.etree.ElementTree as ET
+import numpy as np
+from .distance_matrix import DistanceMatrix
+from .geometry import haversine, route_coordinates
+from .routing_backend import RoutingBackend
+
+# SciPy's compiled Dijkstra makes graph builds and matrices much faster; the
+# pure-Python searches below give the same answers without it
+try:
+    from scipy.sparse import csr_matrix
+    from scipy.sparse.csgraph import dijkstra as csgraph_dijkstra
+except ImportError:
+    csgraph_dijkstra = None
+
+logger = logging.getLogger(__name__)
+
+# Default car speeds in km/h for OSM highway types we route on
+HIGHWAY_SPEEDS = {
+    'motorway': 100, 'motorway_link': 60,
+    'trunk': 80, 'trunk_link': 50,
+    'primary': 60, 'primary_link': 40,
+    'secondary': 50, 'secondary_link': 40,
+    'tertiary': 40, 'tertiary_link': 30,
+    'unclassified': 30, 'residential': 30,
+    'living_street': 10, 'service': 15,
+}
+ONEWAY_HIGHWAYS = {'motorway', 'motorway_link'}
+NO_ACCESS = {'no', 'private'}
+
+# Landmarks for the A* lower bounds; more tighten the bound but cost memory
+DEFAULT_LANDMARKS = 8
+# Nearest-node lookup grid, in degrees (~500m)
+GRID_CELL = 0.005
+# Alternatives: penalise the best route's edges, accept if different enough
+ALTERNATIVE_PENALTY = 1.4
+MAX_ALTERNATIVE_SHARED = 0.8
+MAX_ALTERNATIVE_SLOWDOWN = 1.5
+# Matrix searches run a few sources at a time; each needs a time and a
+# predecessor (12 bytes) per graph node, so this bounds that working memory
+MATRIX_CHUNK_BYTES = 64 * 1024 * 1024
+
+_ARRAYS = (
+    'lat', 'lon', 'indptr', 'targets', 'length', 'duration',
+    'rev_indptr', 'rev_sources', 'rev_duration', 'landmark_from', 'landmark_to'
+)
+
+def parse_maxspeed(value: Optional[str]) -> Optional[float]:
+    """km/h from an OSM maxspeed tag like "50", "50 km/h" or "30 mph" """
+    if not value:
+        return None
+    match = re.match(r'\s*(\d+(?:\.\d+)?)\s*(mph)?', value)
+    if not match:
+        return None
+    speed = float(match.group(1))
+    return speed * 1.609 if match.group(2) else speed
+
+def _csr(n: int, sources: np.ndarray, order_keys: Tuple[np.ndarray, ...]):
+    order = np.lexsort(order_keys)
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=n), out=indptr[1:])
+    return indptr, order
+
+class RoadGraph:
+    """Directed road graph in CSR form, weighted by travel time.
+
+    Node i has outgoing edges indptr[i]:indptr[i + 1] into targets/length/
+    duration, and incoming edges rev_indptr[i]:rev_indptr[i + 1] into
+    rev_sources/rev_duration. landmark_from[v] and landmark_to[v] hold travel
+    times from and to each landmark, which give A* its lower bounds (ALT).
+    """
+
+    def __init__(self, arrays: Dict[str, np.ndarray]):
+        # Plain ndarray views over the memory maps; slicing np.memmap is several times slower
+        for name in _ARRAYS:
+            setattr(self, name, np.asarray(arrays[name]))
+        self.n_nodes = len(self.lat)
+        self._build_grid()
+        self._csr = None
+        self._edge_keys = None
+
+    @classmethod
+    def from_edges(cls, lat: np.ndarray, lon: np.ndarray, sources: np.ndarray, targets: np.ndarray,
+                   duration: np.ndarray, n_landmarks: int = DEFAULT_LANDMARKS) -> "RoadGraph":
+        """Build the graph from an edge list, keeping the largest strongly connected part"""
+        lat, lon = np.asarray(lat, dtype=float), np.asarray(lon, dtype=float)
+        sources, targets = np.asarray(sources, dtype=np.int64), np.asarray(targets, dtype=np.int64)
+        duration = np.asarray(duration, dtype=float)
+        length = haversine(lat[sources], lon[sources], lat[targets], lon[targets])
+
+        # Keep only the fastest of parallel edges and drop self-loops
+        keep = sources != targets
+        sources, targets, length, duration = sources[keep], targets[keep], length[keep], duration[keep]
+        order = np.lexsort((duration, targets, sources))
+        sources, targets, length, duration = sources[order], targets[order], length[order], duration[order]
+        first = np.ones(len(sources), dtype=bool)
+        first[1:] = (sources[1:] != sources[:-1]) | (targets[1:] != targets[:-1])
+        sources, targets, length, duration = sources[first], targets[first], length[first], duration[first]
+
+        # Restrict to the largest strongly connected component so every pair is routable
+        component = _largest_scc(len(lat), sources, targets)
+        index = np.full(len(lat), -1, dtype=np.int64)
+        index[component] = np.arange(len(component))
+        keep = (index[sources] >= 0) & (index[targets] >= 0)
+        sources, targets = index[sources[keep]], index[targets[keep]]
+        length, duration = length[keep], duration[keep]
+        lat, lon = lat[component], lon[component]
+        n = len(component)
+
+        indptr, order = _csr(n, sources, (targets, sources))
+        rev_indptr, rev_order = _csr(n, targets, (sources, targets))
+        arrays = {
+            'lat': lat.astype(np.float32),
+            'lon': lon.astype(np.float32),
+            'indptr': indptr,
+            'targets': targets[order].astype(np.int32),
+            'length': length[order].astype(np.float32),
+            'duration': duration[order].astype(np.float32),
+            'rev_indptr': rev_indptr,
+            'rev_sources': sources[rev_order].astype(np.int32),
+            'rev_duration': duration[rev_order].astype(np.float32),
+            'landmark_from': np.zeros((n, 0), dtype=np.float32),
+            'landmark_to': np.zeros((n, 0), dtype=np.float32),
+        }
+        graph = cls(arrays)
+        graph._select_landmarks(n_landmarks)
+        return graph
+
+    @classmethod
+    def load(cls, path: str) -> "RoadGraph":
+        arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r') for name in _ARRAYS}
+        graph = cls(arrays)
+        logger.info(f"Loaded road graph with {graph.n_nodes} nodes and {len(graph.targets)} edges from {path}")
+        return graph
+
+    def save(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        for name in _ARRAYS:
+            np.save(os.path.join(path, f"{name}.npy"), np.asarray(getattr(self, name)))
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump({
+                'nodes': self.n_nodes,
+                'edges': len(self.targets),
+                'landmarks': self.landmark_from.shape[1]
+            }, f)
+
+    def _build_grid(self):
+        cells = self._cells(np.asarray(self.lat), np.asarray(self.lon))
+        self._grid_order = np.argsort(cells, kind='stable')
+        self._grid_keys = cells[self._grid_order]
+
+    @staticmethod
+    def _cells(lat, lon):
+        row = np.floor(np.asarray(lat, dtype=float) / GRID_CELL).astype(np.int64)
+        col = np.floor(np.asarray(lon, dtype=float) / GRID_CELL).astype(np.int64)
+        return (row << 32) + col
+
+    def _nodes_within(self, row: int, col: int, reach: int) -> np.ndarray:
+        """Nodes in the square of grid cells reach cells around (row, col)"""
+        steps = np.arange(-reach, reach + 1, dtype=np.int64)
+        keys = (((row + steps) << 32)[:, None] + (col + steps)[None, :]).ravel()
+        lo = np.searchsorted(self._grid_keys, keys, side='left')
+        hi = np.searchsorted(self._grid_keys, keys, side='right')
+        counts = hi - lo
+        entries = np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        return self._grid_order[entries]
+
+    def nearest_node(self, lat: float, lon: float) -> int:
+        """Graph node closest to a point"""
+        if self.n_nodes == 0:
+            raise ValueError("Road graph has no nodes")
+        row, col = int(np.floor(lat / GRID_CELL)), int(np.floor(lon / GRID_CELL))
+        # Metres covered by one cell in its narrower (east-west) direction
+        cell_metres = GRID_CELL * np.pi / 180 * 6371000 * max(np.cos(np.radians(lat)), 0.01)
+        reach = 1
+        while True:
+            if (2 * reach + 1) ** 2 >= self.n_nodes:
+                # Far from the network: scanning every node is cheaper than the grid
+                return int(np.argmin(haversine(lat, lon, self.lat, self.lon)))
+            candidates = self._nodes_within(row, col, reach)
+            if len(candidates):
+                distances = haversine(lat, lon, self.lat[candidates], self.lon[candidates])
+                best = int(np.argmin(distances))
+                # Anything outside the searched square is at least this far away
+                if distances[best] <= reach * cell_metres:
+                    return int(candidates[best])
+                reach = int(np.ceil(distances[best] / cell_metres)) + 1
+            else:
+                reach *= 4
+
+    def _select_landmarks(self, count: int):
+        """Pick landmarks far apart (farthest-point heuristic) and store travel times to and from them"""
+        if count <= 0 or self.n_nodes == 0:
+            return
+        start = time.perf_counter()
+        landmarks, from_rows, to_rows = [], [], []
+        # Start from the node farthest from an arbitrary one, so landmarks sit at the edges
+        nearest = self.dijkstra(0)
+        for _ in range(min(count, self.n_nodes)):
+            landmark = int(np.argmax(np.where(np.isfinite(nearest), nearest, -1)))
+            landmarks.append(landmark)
+            from_rows.append(self.dijkstra(landmark))
+            to_rows.append(self.dijkstra(landmark, reverse=True))
+            nearest = from_rows[-1] if len(from_rows) == 1 else np.minimum(nearest, from_rows[-1])
+        self.landmark_from = np.stack(from_rows, axis=1).astype(np.float32)
+        self.landmark_to = np.stack(to_rows, axis=1).astype(np.float32)
+        logger.info(f"Selected {len(landmarks)} landmarks in {time.perf_counter() - start:.1f}s")
+
+    def _duration_matrix(self):
+        if self._csr is None:
+            self._csr = csr_matrix(
+                (self.duration, self.targets, self.indptr), shape=(self.n_nodes, self.n_nodes)
+            )
+        return self._csr
+
+    def dijkstra(self, source: int, reverse: bool = False) -> np.ndarray:
+        """Travel time from source to every node (or to source from every node if reverse)"""
+        if csgraph_dijkstra is not None:
+            graph = self._duration_matrix().T if reverse else self._duration_matrix()
+            return csgraph_dijkstra(graph, indices=source)
+        indptr, heads, weights = (
+            (self.rev_indptr, self.rev_sources, self.rev_duration) if reverse
+            else (self.indptr, self.targets, self.duration)
+        )
+        indptr, heads, weights = indptr.tolist(), heads.tolist(), weights.tolist()
+        dist = [float('inf')] * self.n_nodes
+        dist[source] = 0.0
+        heap = [(0.0, source)]
+        while heap:
+            d, u = heapq.heappop(heap)
+            if d > dist[u]:
+                continue
+            for e in range(indptr[u], indptr[u + 1]):
+                nd = d + weights[e]
+                v = heads[e]
+                if nd < dist[v]:
+                    dist[v] = nd
+                    heapq.heappush(heap, (nd, v))
+        return np.array(dist)
+
+    def many_to_many(self, nodes: List[int]) -> DistanceMatrix:
+        """Travel times between all nodes, and the distances along those fastest paths"""
+        k = len(nodes)
+        durations = np.zeros((k, k))
+        distances = np.zeros((k, k))
+        # Points snapped to the same node share a search
+        unique, inverse = np.unique(nodes, return_inverse=True)
+        if csgraph_dijkstra is not None:
+            targets = unique.tolist()
+            chunk = max(1, MATRIX_CHUNK_BYTES // (12 * self.n_nodes))
+            for start in range(0, len(unique), chunk):
+                sources = unique[start:start + chunk]
+                times, predecessors = csgraph_dijkstra(
+                    self._duration_matrix(), indices=sources, return_predecessors=True
+                )
+                # Keep only the target columns; the full rows go with the next chunk
+                for offset, source in enumerate(sources.tolist()):
+                    row = start + offset
+                    lengths = self._path_lengths(source, predecessors[offset], targets)
+                    durations[inverse == row] = times[offset, nodes]
+                    distances[inverse == row] = [lengths[node] for node in nodes]
+                del times, predecessors
+        else:
+            for row, source in enumerate(unique.tolist()):
+                durations[inverse == row], distances[inverse == row] = self._one_to_many(source, nodes)
+        return DistanceMatrix(durations, distances)
+
+    def _edge_ids(self, tails: np.ndarray, heads: np.ndarray) -> np.ndarray:
+        """CSR positions of the edges tail -> head"""
+        if self._edge_keys is None:
+            # Edges are stored sorted by (tail, head), so their keys are already sorted
+            tails_all = np.repeat(np.arange(self.n_nodes, dtype=np.int64), np.diff(self.indptr))
+            self._edge_keys = tails_all * self.n_nodes + self.targets
+        return np.searchsorted(self._edge_keys, tails.astype(np.int64) * self.n_nodes + heads)
+
+    def _path_lengths(self, source: int, predecessors: np.ndarray, targets: List[int]) -> Dict[int, float]:
+        """Length of the tree path from source to each target, sharing common prefixes"""
+        lengths = {source: 0.0}
+        for target in targets:
+            chain = []
+            v = target
+            while v not in lengths and v >= 0:
+                chain.append(v)
+                v = int(predecessors[v])
+            if v < 0:
+                lengths[target] = float('inf')
+                continue
+            if not chain:
+                continue
+            chain = np.array(chain[::-1], dtype=np.int64)
+            steps = self.length[self._edge_ids(predecessors[chain], chain)].astype(float)
+            for node, total in zip(chain.tolist(), (lengths[v] + np.cumsum(steps)).tolist()):
+                lengths[node] = total
+        return lengths
+
+    def _one_to_many(self, source: int, targets: List[int]) -> Tuple[List[float], List[float]]:
+        indptr, heads, weights, lengths = self.indptr, self.targets, self.duration, self.length
+        remaining = set(targets)
+        dist = {source: 0.0}
+        length = {source: 0.0}
+        settled = set()
+        heap = [(0.0, source)]
+        while heap and remaining:
+            d, u = heapq.heappop(heap)
+            if u in settled:
+                continue
+            settled.add(u)
+            remaining.discard(u)
+            a, b = int(indptr[u]), int(indptr[u + 1])
+            for v, w, l in zip(heads[a:b].tolist(), weights[a:b].tolist(), lengths[a:b].tolist()):
+                nd = d + w
+                if nd < dist.get(v, float('inf')):
+                    dist[v] = nd
+                    length[v] = length[u] + l
+                    heapq.heappush(heap, (nd, v))
+        inf = float('inf')
+        return [dist.get(t, inf) for t in targets], [length.get(t, inf) for t in targets]
+
+    def shortest_path(self, source: int, target: int,
+                      penalties: Optional[Dict[int, float]] = None) -> Optional[List[int]]:
+        """Fastest path as a list of edge indices, using A* with landmark lower bounds.
+
+        penalties multiplies the travel time of the given edges; it only ever
+        raises weights, so the landmark bounds stay valid.
+        """
+        if source == target:
+            return []
+        landmark_from, landmark_to = self.landmark_from, self.landmark_to
+        from_t = landmark_from[target].tolist()
+        to_t = landmark_to[target].tolist()
+
+        def bound(v: int) -> float:
+            # Lower bound on the time from v to the target, via every landmark.
+            # Plain floats: a handful of NumPy calls per node costs more than the loop
+            lower = 0.0
+            for a, b in zip(from_t, landmark_from[v].tolist()):
+                if a - b > lower:
+                    lower = a - b
+            for a, b in zip(landmark_to[v].tolist(), to_t):
+                if a - b > lower:
+                    lower = a - b
+            return lower
+
+        indptr, heads, weights = self.indptr, self.targets, self.duration
+        dist = {source: 0.0}
+        parent_edge: Dict[int, int] = {}
+        closed = set()
+        heap = [(bound(source), source)]
+        while heap:
+            _, u = heapq.heappop(heap)
+            if u in closed:
+                continue
+            if u == target:
+                break
+            closed.add(u)
+            d = dist[u]
+            a, b = int(indptr[u]), int(indptr[u + 1])
+            for e, v, w in zip(range(a, b), heads[a:b].tolist(), weights[a:b].tolist()):
+                if penalties and e in penalties:
+                    w *= penalties[e]
+                nd = d + w
+                if nd < dist.get(v, float('inf')):
+                    dist[v] = nd
+                    parent_edge[v] = e
+                    heapq.heappush(heap, (nd + bound(v), v))
+        if target not in parent_edge:
+            return None
+
+        # Walk back from the target; the edge's tail is found from its CSR position
+        edges = []
+        v = target
+        while v != source:
+            e = parent_edge[v]
+            edges.append(e)
+            v = int(np.searchsorted(indptr, e, side='right') - 1)
+        return edges[::-1]
+
+    def path_nodes(self, source: int, edges: List[int]) -> List[int]:
+        return [source] + [int(self.targets[e]) for e in edges]
+
+class LocalRoutingBackend(RoutingBackend):
+    """Routes and matrices computed in-process from a RoadGraph, with no network"""
+
+    name = "local"
+
+    def __init__(self, graph: RoadGraph):
+        self.graph = graph
+
+    async def get_routes(self, waypoints: List[Dict], alternatives: bool = False) -> List[Dict]:
+        try:
+            # Searches are CPU-bound; keep them off the event loop
+            return await asyncio.to_thread(self._routes, waypoints, alternatives)
+        except Exception as e:
+            logger.error(f"Local route calculation failed: {str(e)}")
+            raise
+
+    async def get_matrix(self, points: List[Dict]) -> DistanceMatrix:
+        try:
+            return await asyncio.to_thread(self._matrix, points)
+        except Exception as e:
+            logger.error(f"Local matrix calculation failed: {str(e)}")
+            raise
+
+    async def warm_up(self, points: List[Dict]):
+        # Touch the pages around the depots so the first searches don't fault them in
+        await self.get_matrix(points)
+
+    def _routes(self, waypoints: List[Dict], alternatives: bool) -> List[Dict]:
+        graph = self.graph
+        nodes = [graph.nearest_node(point['lat'], point['lon']) for point in waypoints]
+        legs = []
+        for source, target in zip(nodes, nodes[1:]):
+            edges = graph.shortest_path(source, target)
+            if edges is None:
+                raise ValueError("No route found between waypoints")
+            legs.append((source, edges))
+        routes = [self._route(legs)]
+
+        # Like OSRM, alternatives are only offered between two waypoints
+        if alternatives and len(nodes) == 2 and legs[0][1]:
+            source, best = legs[0]
+            penalties = {e: ALTERNATIVE_PENALTY for e in best}
+            edges = graph.shortest_path(source, nodes[1], penalties)
+            if edges is not None:
+                alternative = self._route([(source, edges)])
+                shared = float(graph.length[sorted(set(best) & set(edges))].sum())
+                if (shared < MAX_ALTERNATIVE_SHARED * routes[0]['distance']
+                        and alternative['duration'] <= MAX_ALTERNATIVE_SLOWDOWN * routes[0]['duration']):
+                    routes.append(alternative)
+        return routes
+
+    def _route(self, legs: List[Tuple[int, List[int]]]) -> Dict:
+        graph = self.graph
+        path = []
+        leg_summaries = []
+        for source, edges in legs:
+            nodes = graph.path_nodes(source, edges)
+            # Consecutive legs share their joining node
+            path.extend(nodes[1:] if path else nodes)
+            leg_summaries.append({
+                'distance': float(graph.length[edges].sum()) if edges else 0.0,
+                'duration': float(graph.duration[edges].sum()) if edges else 0.0,
+                'summary': '',
+                'steps': []
+            })
+        distance = sum(leg['distance'] for leg in leg_summaries)
+        duration = sum(leg['duration'] for leg in leg_summaries)
+        return {
+            'geometry': {
+                'type': 'LineString',
+                'coordinates': route_coordinates(np.column_stack((graph.lon[path], graph.lat[path])))
+            },
+            'distance': distance,
+            'duration': duration,
+            'weight': duration,
+            'weight_name': 'duration',
+            'legs': leg_summaries
+        }
+
+    def _matrix(self, points: List[Dict]) -> DistanceMatrix:
+        nodes = [self.graph.nearest_node(point['lat'], point['lon']) for point in points]
+        matrix = self.graph.many_to_many(nodes)
+        np.fill_diagonal(matrix.durations, 0)
+        np.fill_diagonal(matrix.distances, 0)
+        return matrix
+
+def _reachable(n: int, indptr: np.ndarray, heads: np.ndarray, source: int) -> np.ndarray:
+    seen = np.zeros(n, dtype=bool)
+    seen[source] = True
+    frontier = np.array([source])
+    while len(frontier):
+        starts, ends = indptr[frontier], indptr[frontier + 1]
+        counts = ends - starts
+        edge_ids = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        nxt = np.unique(heads[edge_ids])
+        frontier = nxt[~seen[nxt]]
+        seen[frontier] = True
+    return seen
+
+def _largest_scc(n: int, sources: np.ndarray, targets: np.ndarray, attempts: int = 5) -> np.ndarray:
+    """Nodes of the largest strongly connected component found from a few well-connected seeds.
+
+    Road networks have one giant component plus fragments (e.g. oneway
+    dead-ends at the extract border), so a seed inside the giant component
+    finds it with two breadth-first searches.
+    """
+    order = np.argsort(sources, kind='stable')
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=n), out=indptr[1:])
+    forward = targets[order]
+    rev_order = np.argsort(targets, kind='stable')
+    rev_indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(targets, minlength=n), out=rev_indptr[1:])
+    backward = sources[rev_order]
+
+    degree = np.diff(indptr) + np.diff(rev_indptr)
+    best = np.zeros(0, dtype=np.int64)
+    for seed in np.argsort(-degree)[:attempts]:
+        if len(best) and seed in set(best.tolist()):
+            continue
+        component = np.flatnonzero(
+            _reachable(n, indptr, forward, seed) & _reachable(n, rev_indptr, backward, seed)
+        )
+        if len(component) > len(best):
+            best = component
+        if len(best) > n // 2:
+            break
+    return best
+
+def read_osm(path: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Car-routable edges from an OSM XML extract: (lat, lon, sources, targets, durations)"""
+    # Pass 1: ways (which nodes are used, and how); pass 2: coordinates of those nodes
+    way_sources, way_targets, way_speeds = [], [], []
+    for _, element in ET.iterparse(path, events=('end',)):
+        if element.tag == 'way':
+            tags = {tag.get('k'): tag.get('v') for tag in element.iter('tag')}
+            highway = tags.get('highway')
+            if highway in HIGHWAY_SPEEDS and tags.get('access') not in NO_ACCESS \
+                    and tags.get('motor_vehicle') not in NO_ACCESS:
+                refs = [int(nd.get('ref')) for nd in element.iter('nd')]
+                speed = parse_maxspeed(tags.get('maxspeed')) or HIGHWAY_SPEEDS[highway]
+                oneway = tags.get('oneway')
+                if oneway == '-1':
+                    refs = refs[::-1]
+                forward_only = oneway in ('yes', '1', '-1', 'true') or (
+                    oneway is None and (highway in ONEWAY_HIGHWAYS or tags.get('junction') == 'roundabout')
+                )
+                pairs = list(zip(refs, refs[1:]))
+                if not forward_only:
+                    pairs += [(b, a) for a, b in pairs]
+                for a, b in pairs:
+                    way_sources.append(a)
+                    way_targets.append(b)
+                    way_speeds.append(speed)
+            element.clear()
+        elif element.tag == 'relation':
+            element.clear()
+
+    osm_ids = np.unique(np.array(way_sources + way_targets, dtype=np.int64))
+    lat = np.full(len(osm_ids), np.nan)
+    lon = np.full(len(osm_ids), np.nan)
+    for _, element in ET.iterparse(path, events=('end',)):
+        if element.tag == 'node':
+            osm_id = int(element.get('id'))
+            i = np.searchsorted(osm_ids, osm_id)
+            if i < len(osm_ids) and osm_ids[i] == osm_id:
+                lat[i], lon[i] = float(element.get('lat')), float(element.get('lon'))
+            element.clear()
+        elif element.tag in ('way', 'relation'):
+            element.clear()
+
+    sources = np.searchsorted(osm_ids, np.array(way_sources, dtype=np.int64))
+    targets = np.searchsorted(osm_ids, np.array(way_targets, dtype=np.int64))
+    # Ways can reference nodes cut off by the extract boundary
+    known = ~np.isnan(lat[sources]) & ~np.isnan(lat[targets])
+    sources, targets = sources[known], targets[known]
+    speeds = np.array(way_speeds)[known] / 3.6
+    durations = haversine(lat[sources], lon[sources], lat[targets], lon[targets]) / speeds
+    return lat, lon, sources, targets, durations
+
+def build_graph(osm_path: str, out_path: str, n_landmarks: int = DEFAULT_LANDMARKS) -> RoadGraph:
+    start = time.perf_counter()
+    lat, lon, sources, targets, durations = read_osm(osm_path)
+    graph = RoadGraph.from_edges(lat, lon, sources, targets, durations, n_landmarks)
+    graph.save(out_path)
+    logger.info(
+        f"Built road graph with {graph.n_nodes} nodes and {len(graph.targets)} edges "
+        f"in {time.perf_counter() - start:.1f}s"
+    )
+    return graph
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Build a local routing graph from an OSM XML extract")
+    parser.add_argument("osm_path")
+    parser.add_argument("out_path")
+    parser.add_argument("--landmarks", type=int, default=DEFAULT_LANDMARKS)
+    args = parser.parse_args()
+    build_graph(args.osm_path, args.out_path, args.landmarks)
@@ -1,16 +1,163 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import Depends, FastAPI, HTTPException, Query, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import List, Dict, Optional
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from starlette.requests import HTTPConnection
+from pydantic import BaseModel, Field, NonNegativeFloat, PositiveFloat, model_validator
+from typing import List, Dict, Literal, Optional
+import asyncio
+import json
 import logging
+import os
+from contextlib import asynccontextmanager
 from .route_optimizer import RouteOptimizer
-from datetime import datetime
+from .http_client import close_http_client
+from .route_cache import close_route_cache
+from .route_store import RouteStore, open_route_store
+from .live_updates import LiveUpdateHub
+from .stop_edits import EditConflict, StopEditor, StopNotFound
+from .progress import ProgressRegistry
+from .jobs import Job, JobQueue, QueueFull, create_job_queue
+from .metrics import REGISTRY, MetricsMiddleware, add_timing, cache_samples, monitor_event_loop, render_samples
+from .geometry import GeometryOptions, format_routes
+from .serialization import FastJSONResponse, dumps_text
+from .eta import parse_departure_time
+from .geocoding import GeocodingService, create_geocoder
+from .resilience import DeadlineMiddleware, deadline, error_status
+from datetime import datetime, timedelta
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+def parse_depots(value: str) -> List[Dict]:
+    """Parse WARMUP_DEPOTS, e.g. "52.52,13.40;48.14,11.58" """
+    depots = []
+    for pair in filter(None, value.split(";")):
+        lat, lon = map(float, pair.split(","))
+        depots.append({"lat": lat, "lon": lon})
+    return depots
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    # One optimizer (and its HTTP client and route cache) serves every request
+    app.state.optimizer = RouteOptimizer()
+    app.state.batch_max_concurrency = int(os.getenv("BATCH_MAX_CONCURRENCY", "8"))
+    app.state.route_store = open_route_store()
+    app.state.progress = ProgressRegistry()
+    app.state.live_updates = LiveUpdateHub(
+        app.state.optimizer,
+        interval=float(os.getenv("LIVE_UPDATE_INTERVAL", "15"))
+    )
+
+    app.state.stop_editor = StopEditor(app.state.optimizer, app.state.route_store, app.state.live_updates)
+    route_store = app.state.route_store
+
+    def store_job_result(job: Job, result: Dict) -> Dict:
+        # Multi-point results are saved like /optimize-multi-point always did
+        if job.kind != 'multi_point':
+            return result
+        route_id = route_store.create(request=job.payload, result=result, user_id=job.payload['user_id'])
+        return {"route_id": route_id, "optimized_route": result}
+
+    app.state.jobs = create_job_queue(app.state.optimizer, on_result=store_job_result)
+    app.state.geocoder = create_geocoder(app.state.optimizer.tomtom_api_key)
+
+    warmup_depots = parse_depots(os.getenv("WARMUP_DEPOTS", ""))
+    if warmup_depots:
+        await app.state.optimizer.warm_up(warmup_depots)
+    app.state.live_updates.start()
+    app.state.stop_editor.start()
+    app.state.jobs.start()
+    loop_monitor = asyncio.create_task(monitor_event_loop())
+
+    yield
+    loop_monitor.cancel()
+    await app.state.jobs.stop()
+    await app.state.stop_editor.stop()
+    await app.state.live_updates.stop()
+    # Close pooled upstream connections and the route cache shared by all optimizers
+    await close_http_client()
+    close_route_cache()
+    app.state.route_store.close()
+
+# HTTPConnection rather than Request so the dependencies also work for WebSockets
+async def get_optimizer(connection: HTTPConnection) -> RouteOptimizer:
+    return connection.app.state.optimizer
+
+async def get_route_store(connection: HTTPConnection) -> RouteStore:
+    return connection.app.state.route_store
+
+async def get_live_updates(connection: HTTPConnection) -> LiveUpdateHub:
+    return connection.app.state.live_updates
+
+async def get_progress(connection: HTTPConnection) -> ProgressRegistry:
+    return connection.app.state.progress
+
+async def get_jobs(connection: HTTPConnection) -> JobQueue:
+    return connection.app.state.jobs
+
+async def get_geocoder(connection: HTTPConnection) -> GeocodingService:
+    return connection.app.state.geocoder
+
+async def get_stop_editor(connection: HTTPConnection) -> StopEditor:
+    return connection.app.state.stop_editor
+
+def submit_job(jobs: JobQueue, kind: str, payload: Dict, priority: int = 0) -> tuple:
+    try:
+        return jobs.submit(kind, payload, priority)
+    except QueueFull as e:
+        # Back-pressure: clients retry once running jobs have drained the queue
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+
+def error_response(e: Exception) -> HTTPException:
+    """HTTP error for a failed request: 4xx for bad input, 502-504 when an upstream let us down"""
+    if isinstance(e, HTTPException):
+        return e
+    return HTTPException(status_code=error_status(e), detail=str(e))
+
+def job_outcome(job: Job) -> Dict:
+    """Result of a finished job, or the HTTP error the synchronous endpoints report"""
+    # The job ran outside this request; its stages still belong in the request's Server-Timing
+    for stage, seconds in job.timings.items():
+        add_timing(stage, seconds)
+    if job.status == 'cancelled':
+        raise HTTPException(status_code=409, detail="Job was cancelled")
+    if job.status == 'failed':
+        raise HTTPException(status_code=job.error_status or 500, detail=job.error)
+    return job.result
+
+async def geometry_options(
+    geometry_format: Literal['geojson', 'polyline5', 'polyline6', 'float32'] = 'geojson',
+    tolerance: Optional[float] = Query(None, gt=0),  # metres
+    zoom: Optional[float] = Query(None, ge=0, le=22)  # web map zoom to simplify for
+) -> GeometryOptions:
+    return GeometryOptions(geometry_format, tolerance, zoom)
+
+def route_response(content: Dict, geometry: GeometryOptions) -> FastJSONResponse:
+    """Response with route geometries formatted as asked, skipping jsonable_encoder"""
+    return FastJSONResponse(format_routes(content, geometry))
+
+async def load_optimized_route(route_id: int, optimizer: RouteOptimizer,
+                               store: RouteStore) -> Optional[Dict]:
+    """Stored result for a route, optimizing and saving it first if needed"""
+    record = store.get(route_id)
+    if record is None:
+        return None
+    route = record['result']
+    if route is None:
+        # Stored with /set-route but never optimized yet
+        route = await optimizer.optimize_route(
+            depot=record['request']['depot'],
+            destinations=record['request']['destinations'],
+            departure_time=record['request'].get('departure_time')
+        )
+        store.set_result(route_id, route)
+    return route
+
+app = FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
 
 # Configure CORS
 app.add_middleware(
@@ -19,7 +166,15 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing"],
 )
+# Request latency histograms, plus a Server-Timing breakdown when SERVER_TIMING=true
+app.add_middleware(MetricsMiddleware)
+# Upstream calls made for a request share its deadline (REQUEST_DEADLINE, X-Request-Deadline);
+# streaming endpoints apply it per batch item or subscription instead
+app.add_middleware(DeadlineMiddleware, streaming_paths=[
+    r"/optimize-batch", r"/jobs/[^/]+/events", r"/route-updates/[^/]+/stream"
+])
 
 # Define models
 class Location(BaseModel):
@@ -31,108 +186,483 @@ class RouteRequest(BaseModel):
     depot: Location
     destinations: List[Location]
     departure_time: Optional[str] = None
+    user_id: Optional[str] = None
 
 class MultiPointRequest(BaseModel):
     user_id: str
     routes: List[Dict]
+    time_budget: Optional[PositiveFloat] = None  # seconds the solver may spend
+    quality: Literal['fast', 'balanced', 'quality', 'thorough'] = 'balanced'
+    seed: Optional[int] = None  # repeats a 'thorough' solve exactly
+    departure_time: Optional[str] = None  # ISO 8601, default now
+
+class MultiPointJobRequest(MultiPointRequest):
+    priority: int = 0  # higher runs first
+
+class Place(BaseModel):
+    lat: float
+    lon: float
+    name: Optional[str] = None
+    address: Optional[str] = None
+    id: Optional[str] = None
+    type: str = 'Address'  # e.g. Depot or Customer
+
+class StopInsert(Location):
+    position: Optional[int] = None  # index in the current stop order; default where it costs least
+    route_id: Optional[str] = None  # reference kept on the stop, like multi-point stops have
+
+class BatchRouteRequest(BaseModel):
+    routes: List[RouteRequest]
+    max_concurrency: Optional[int] = None  # capped at BATCH_MAX_CONCURRENCY
+
+class Vehicle(BaseModel):
+    id: str
+    capacity: NonNegativeFloat
+    shift_start: float = 0  # seconds since the start of the planning day
+    shift_end: float = 86400
+    start_depot: Location
+    end_depot: Optional[Location] = None  # defaults to start_depot
+
+    @model_validator(mode='after')
+    def check_shift(self):
+        if self.shift_end <= self.shift_start:
+            raise ValueError("shift_end must be after shift_start")
+        return self
 
-routes_store = []  # Temporary in-memory storage for routes
+class Order(BaseModel):
+    id: str
+    location: Location
+    demand: float = 1
+    service_time: float = 0  # seconds spent at the stop
+    time_window_start: Optional[float] = None
+    time_window_end: Optional[float] = None
+
+class FleetRequest(BaseModel):
+    vehicles: List[Vehicle] = Field(min_length=1)
+    orders: List[Order]
+    time_budget: Optional[PositiveFloat] = None  # seconds the solver may spend
+
+class FleetJobRequest(FleetRequest):
+    priority: int = 0
 
 # POST: Set route
 @app.post("/set-route")
-async def set_route(route_request: RouteRequest):
+async def set_route(route_request: RouteRequest, store: RouteStore = Depends(get_route_store)):
     try:
         logger.info(f"Received route request: {route_request}")
-        route_id = len(routes_store)
-        routes_store.append(route_request)
+        route_id = store.create(request=route_request.model_dump(), user_id=route_request.user_id)
         # Return both route_id and initial route data
         return {
             "route_id": route_id,
             "message": "Route stored successfully",
-            "initial_route": route_request.dict()
+            "initial_route": route_request.model_dump()
         }
     except Exception as e:
         logger.error(f"Failed to store route: {str(e)}")
-        raise HTTPException(status_code=400, detail=str(e))
+        raise error_response(e)
 
 # GET: Calculate and return optimized route
 @app.get("/optimized-route/{route_id}")
-async def get_optimized_route(route_id: int):
+async def get_optimized_route(route_id: int,
+                              refresh: bool = False,  # route the stored stop order again with current traffic
+                              optimizer: RouteOptimizer = Depends(get_optimizer),
+                              store: RouteStore = Depends(get_route_store),
+                              editor: StopEditor = Depends(get_stop_editor),
+                              geometry: GeometryOptions = Depends(geometry_options)):
     try:
-        if route_id >= len(routes_store):
+        optimized_route = None
+        if refresh:
+            optimized_route = await editor.refresh_stored(route_id, stale_only=False)
+        if optimized_route is None:
+            # Routes from /set-route are optimized on first read; multi-point routes are stored optimized
+            optimized_route = await load_optimized_route(route_id, optimizer, store)
+        if optimized_route is None:
             raise HTTPException(status_code=404, detail="Route not found")
-        
-        route_request = routes_store[route_id]
-        optimizer = RouteOptimizer()  
-        optimized_route = await optimizer.optimize_route(
-            depot=route_request.depot.dict(),
-            destinations=[dest.dict() for dest in route_request.destinations]
-        )
-        
-        logger.info(f"Optimized route calculated for route_id {route_id}")
-        return {"route_id": route_id, "optimized_route": optimized_route}
+
+        logger.info(f"Optimized route served for route_id {route_id}")
+        return route_response({"route_id": route_id, "optimized_route": optimized_route}, geometry)
     except Exception as e:
         logger.error(f"Route optimization failed: {str(e)}")
+        raise error_response(e)
+
+# GET: Typical trip duration over a range of departure times, to pick when to leave
+@app.get("/optimized-route/{route_id}/departures")
+async def get_departure_options(route_id: int,
+                                start: Optional[str] = None,  # ISO 8601, default now
+                                hours: float = Query(12, gt=0, le=168),
+                                step_minutes: float = Query(15, ge=1),
+                                optimizer: RouteOptimizer = Depends(get_optimizer),
+                                store: RouteStore = Depends(get_route_store)):
+    route = await load_optimized_route(route_id, optimizer, store)
+    if route is None:
+        raise HTTPException(status_code=404, detail="Route not found")
+    try:
+        first = parse_departure_time(start)
+    except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
-# POST: Optimize multi-point delivery
-@app.post("/optimize-multi-point")
-async def optimize_multi_point(request: MultiPointRequest):
+    count = int(hours * 60 // step_minutes) + 1
+    departures = [first + timedelta(minutes=step_minutes * k) for k in range(count)]
+    options = optimizer.departure_etas(route, departures)
+    return {
+        "route_id": route_id,
+        "departures": options,
+        "best": min(options, key=lambda option: option['duration_in_traffic'])
+    }
+
+async def edit_stops(route_id: int, optimizer: RouteOptimizer, store: RouteStore, edit) -> Dict:
+    """Run a stop edit on a stored route, mapping its failures to HTTP errors"""
     try:
-        logger.info(f"Received multi-point optimization request for user {request.user_id}")
-        optimizer = RouteOptimizer()
-        optimized_route = await optimizer.optimize_multi_point_delivery(
-            request.user_id,
-            request.routes
-        )
-        
-        # Store the optimized route
-        route_id = len(routes_store)
-        routes_store.append(optimized_route)
-        
-        logger.info(f"Multi-point route optimized for user {request.user_id}")
-        return {
-            "route_id": route_id,
-            "optimized_route": optimized_route
-        }
+        if await load_optimized_route(route_id, optimizer, store) is None:
+            raise HTTPException(status_code=404, detail="Route not found")
+        return await edit()
+    except StopNotFound as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except EditConflict as e:
+        # Another edit or optimization saved the route first; retrying works from that
+        raise HTTPException(status_code=409, detail=str(e))
     except Exception as e:
-        logger.error(f"Multi-point optimization failed: {str(e)}")
-        raise HTTPException(status_code=400, detail=str(e))
+        logger.error(f"Editing stops of route {route_id} failed: {str(e)}")
+        raise error_response(e)
+
+# POST: Add a stop to an optimized route without optimizing it again.
+# Order, legs and ETAs come back at once; geometry follows in the background.
+@app.post("/optimized-route/{route_id}/stops")
+async def insert_stop(route_id: int, stop: StopInsert,
+                      optimizer: RouteOptimizer = Depends(get_optimizer),
+                      store: RouteStore = Depends(get_route_store),
+                      editor: StopEditor = Depends(get_stop_editor),
+                      geometry: GeometryOptions = Depends(geometry_options)):
+    route = await edit_stops(route_id, optimizer, store, lambda: editor.insert_stop(
+        route_id, stop.model_dump(exclude={'position'}), stop.position
+    ))
+    logger.info(f"Inserted stop into route {route_id}")
+    return route_response({"route_id": route_id, "optimized_route": route}, geometry)
+
+# DELETE: Remove a stop, by its number, from an optimized route
+@app.delete("/optimized-route/{route_id}/stops/{number}")
+async def remove_stop(route_id: int, number: int,
+                      optimizer: RouteOptimizer = Depends(get_optimizer),
+                      store: RouteStore = Depends(get_route_store),
+                      editor: StopEditor = Depends(get_stop_editor),
+                      geometry: GeometryOptions = Depends(geometry_options)):
+    route = await edit_stops(route_id, optimizer, store, lambda: editor.remove_stop(route_id, number))
+    logger.info(f"Removed stop {number} from route {route_id}")
+    return route_response({"route_id": route_id, "optimized_route": route}, geometry)
+
+# POST: Optimize many routes, streaming results back as NDJSON
+@app.post("/optimize-batch")
+async def optimize_batch(batch: BatchRouteRequest, request: Request,
+                         optimizer: RouteOptimizer = Depends(get_optimizer),
+                         geometry: GeometryOptions = Depends(geometry_options)):
+    logger.info(f"Received batch optimization request with {len(batch.routes)} routes")
+    max_concurrency = request.app.state.batch_max_concurrency
+    concurrency = min(batch.max_concurrency or max_concurrency, max_concurrency)
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    # Identical routes in the batch are optimized once and reported for every index
+    indices_by_key: Dict[str, List[int]] = {}
+    requests_by_key: Dict[str, RouteRequest] = {}
+    for index, route_request in enumerate(batch.routes):
+        key = json.dumps(route_request.model_dump(include={'depot', 'destinations'}), sort_keys=True)
+        indices_by_key.setdefault(key, []).append(index)
+        requests_by_key.setdefault(key, route_request)
+
+    async def optimize_one(key: str):
+        route_request = requests_by_key[key]
+        # Each item gets the whole request deadline from when it starts, however long the batch runs
+        async with semaphore:
+            try:
+                with deadline(getattr(request.state, 'deadline', None)):
+                    optimized_route = await optimizer.optimize_route(
+                        depot=route_request.depot.model_dump(),
+                        destinations=[dest.model_dump() for dest in route_request.destinations],
+                        departure_time=route_request.departure_time
+                    )
+                return key, {"optimized_route": optimized_route}
+            except Exception as e:
+                logger.error(f"Batch item optimization failed: {str(e)}")
+                return key, {"error": str(e)}
+
+    async def stream_results():
+        tasks = [asyncio.create_task(optimize_one(key)) for key in indices_by_key]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                key, result = await next_done
+                for index in indices_by_key[key]:
+                    yield dumps_text(format_routes({"index": index, **result}, geometry)) + "\n"
+        finally:
+            # Stop remaining work if the client goes away mid-stream
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+# POST: Optimize multi-point delivery
+# Runs as a job and waits for it; /jobs/multi-point returns at once instead
+@app.post("/optimize-multi-point")
+async def optimize_multi_point(request: MultiPointRequest,
+                               jobs: JobQueue = Depends(get_jobs),
+                               geometry: GeometryOptions = Depends(geometry_options)):
+    logger.info(f"Received multi-point optimization request for user {request.user_id}")
+    job, _ = submit_job(jobs, 'multi_point', request.model_dump())
+    await job.wait()
+    result = job_outcome(job)
+    logger.info(f"Multi-point route optimized for user {request.user_id}")
+    return route_response(result, geometry)
+
+# POST: Optimize routes for a fleet of vehicles
+@app.post("/optimize-fleet")
+async def optimize_fleet(request: FleetRequest, jobs: JobQueue = Depends(get_jobs)):
+    logger.info(f"Received fleet optimization request for {len(request.vehicles)} vehicles")
+    job, _ = submit_job(jobs, 'fleet', request.model_dump())
+    await job.wait()
+    plan = job_outcome(job)
+    logger.info(f"Fleet plan calculated with {len(plan['unassigned_orders'])} unassigned orders")
+    return plan
+
+# POST: Queue optimizations; the response carries a job ID to poll or follow
+@app.post("/jobs/multi-point", status_code=202)
+async def submit_multi_point_job(request: MultiPointJobRequest, jobs: JobQueue = Depends(get_jobs)):
+    job, deduplicated = submit_job(jobs, 'multi_point', request.model_dump(exclude={'priority'}), request.priority)
+    return {"job_id": job.id, "status": job.status, "deduplicated": deduplicated}
+
+@app.post("/jobs/fleet", status_code=202)
+async def submit_fleet_job(request: FleetJobRequest, jobs: JobQueue = Depends(get_jobs)):
+    job, deduplicated = submit_job(jobs, 'fleet', request.model_dump(exclude={'priority'}), request.priority)
+    return {"job_id": job.id, "status": job.status, "deduplicated": deduplicated}
+
+# GET: Job status, progress (best objective so far) and, once done, the result
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, jobs: JobQueue = Depends(get_jobs),
+                  geometry: GeometryOptions = Depends(geometry_options)):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return route_response(job.snapshot(), geometry)
+
+# GET: Server-sent events with every progress change until the job finishes
+@app.get("/jobs/{job_id}/events")
+async def stream_job_events(job_id: str, request: Request, jobs: JobQueue = Depends(get_jobs),
+                            geometry: GeometryOptions = Depends(geometry_options)):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    async def events():
+        version = None
+        while not await request.is_disconnected():
+            if version is not None and not await job.wait_for_change(version, timeout=15):
+                yield ": keep-alive\n\n"
+                continue
+            version = job.version
+            snapshot = job.snapshot()
+            yield f"data: {dumps_text(format_routes(snapshot, geometry))}\n\n"
+            if job.done:
+                return
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+# DELETE: Cancel a queued or running job
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str, jobs: JobQueue = Depends(get_jobs)):
+    job = jobs.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return {"job_id": job.id, "status": job.status, "cancel_requested": job.cancel_requested}
 
 # GET: Live route updates
 @app.get("/route-updates/{route_id}")
 async def get_route_updates(
     route_id: int,
     current_lat: float,
-    current_lon: float
+    current_lon: float,
+    optimizer: RouteOptimizer = Depends(get_optimizer),
+    store: RouteStore = Depends(get_route_store),
+    trackers: ProgressRegistry = Depends(get_progress),
+    geometry: GeometryOptions = Depends(geometry_options)
 ):
     try:
         logger.info(f"Received update request at {datetime.now().strftime('%H:%M:%S')} for route {route_id}")
         
-        if route_id >= len(routes_store):
+        version = store.updated_at(route_id)
+        if version is None:
             raise HTTPException(status_code=404, detail="Route not found")
         
+        # Reuse the tracker from earlier polls unless the stored route changed
+        progress = trackers.get(route_id, version)
+        if progress is None:
+            route = await load_optimized_route(route_id, optimizer, store)
+            progress = trackers.track(route_id, store.updated_at(route_id), route)
+        
         current_position = {
             "lat": current_lat,
             "lon": current_lon
         }
         
-        optimizer = RouteOptimizer()
         updates = await optimizer.get_live_updates(
             str(route_id),
-            current_position
+            current_position,
+            progress.route,
+            progress
         )
         
         logger.info(f"Route updates retrieved for route_id {route_id}")
-        return updates
+        return route_response(updates, geometry)
         
     except Exception as e:
         logger.error(f"Failed to get route updates: {str(e)}")
-        raise HTTPException(status_code=400, detail=str(e))
+        raise error_response(e)
+
+# WebSocket: Vehicles send {"lat", "lon"} positions and receive alerts when conditions change
+@app.websocket("/ws/route-updates/{route_id}")
+async def route_updates_socket(
+    websocket: WebSocket,
+    route_id: int,
+    optimizer: RouteOptimizer = Depends(get_optimizer),
+    store: RouteStore = Depends(get_route_store),
+    hub: LiveUpdateHub = Depends(get_live_updates),
+    geometry: GeometryOptions = Depends(geometry_options)
+):
+    route = await load_optimized_route(route_id, optimizer, store)
+    if route is None:
+        await websocket.close(code=4404, reason="Route not found")
+        return
+    await websocket.accept()
+    subscription = None
+    sender = None
+
+    async def send_updates():
+        while True:
+            await websocket.send_text(await subscription.next_message())
+
+    try:
+        subscription = await hub.subscribe(route_id, route, geometry)
+        sender = asyncio.create_task(send_updates())
+        while True:
+            position = await websocket.receive_json()
+            await hub.update_position(route_id, {"lat": position["lat"], "lon": position["lon"]})
+    except WebSocketDisconnect:
+        logger.info(f"Live update socket closed for route {route_id}")
+    except Exception as e:
+        logger.error(f"Live update socket failed: {str(e)}")
+        await websocket.close(code=1011)
+    finally:
+        if sender is not None:
+            sender.cancel()
+        if subscription is not None:
+            hub.unsubscribe(subscription)
+
+# GET: Server-sent events for clients that cannot use WebSockets
+@app.get("/route-updates/{route_id}/stream")
+async def stream_route_updates(
+    route_id: int,
+    request: Request,
+    optimizer: RouteOptimizer = Depends(get_optimizer),
+    store: RouteStore = Depends(get_route_store),
+    hub: LiveUpdateHub = Depends(get_live_updates),
+    geometry: GeometryOptions = Depends(geometry_options)
+):
+    # The stream itself has no deadline; setting it up does
+    with deadline(getattr(request.state, 'deadline', None)):
+        route = await load_optimized_route(route_id, optimizer, store)
+        if route is None:
+            raise HTTPException(status_code=404, detail="Route not found")
+        subscription = await hub.subscribe(route_id, route, geometry)
+
+    async def events():
+        try:
+            while not await request.is_disconnected():
+                try:
+                    message = await asyncio.wait_for(subscription.next_message(), timeout=15)
+                except asyncio.TimeoutError:
+                    # Comment line keeps proxies from closing an idle stream
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"data: {message}\n\n"
+        finally:
+            hub.unsubscribe(subscription)
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+# POST: Position report for a route followed over server-sent events
+@app.post("/route-updates/{route_id}/position")
+async def report_position(route_id: int, position: Location,
+                          hub: LiveUpdateHub = Depends(get_live_updates)):
+    await hub.update_position(route_id, {"lat": position.lat, "lon": position.lon})
+    return {"route_id": route_id, "received": True}
+
+# GET: Stored routes, newest first
+@app.get("/routes")
+async def list_routes(
+    user_id: Optional[str] = None,
+    since: Optional[float] = None,  # Unix timestamps
+    until: Optional[float] = None,
+    limit: int = 100,
+    store: RouteStore = Depends(get_route_store)
+):
+    try:
+        return {"routes": store.list_routes(user_id=user_id, since=since, until=until, limit=limit)}
+    except Exception as e:
+        logger.error(f"Failed to list routes: {str(e)}")
+        raise error_response(e)
+
+# GET: Place search, cached by normalized query
+@app.get("/places/search")
+async def search_places(q: str = Query(..., min_length=1), country: Optional[str] = None,
+                        geocoder: GeocodingService = Depends(get_geocoder)):
+    try:
+        return {"results": await geocoder.search(q, country)}
+    except Exception as e:
+        logger.error(f"Place search failed: {str(e)}")
+        raise error_response(e)
+
+# GET: Autocomplete from the local index, going upstream only once typing pauses
+@app.get("/places/autocomplete")
+async def autocomplete_places(
+    request: Request,
+    q: str,
+    country: Optional[str] = None,
+    limit: int = Query(10, ge=1, le=50),
+    session: Optional[str] = None,  # one per search box; defaults to the client address
+    geocoder: GeocodingService = Depends(get_geocoder)
+):
+    results, source = await geocoder.autocomplete(
+        q, country, limit, session or (request.client.host if request.client else None)
+    )
+    return {"results": results, "source": source}
+
+# POST: Index our own depot and customer addresses for autocomplete
+@app.post("/places")
+async def add_places(places: List[Place], geocoder: GeocodingService = Depends(get_geocoder)):
+    count = geocoder.add_places([place.model_dump() for place in places])
+    return {"indexed": count, "places": len(geocoder.index)}
+
+# GET: Prometheus metrics
+@app.get("/metrics")
+async def metrics(optimizer: RouteOptimizer = Depends(get_optimizer),
+                  hub: LiveUpdateHub = Depends(get_live_updates),
+                  jobs: JobQueue = Depends(get_jobs),
+                  geocoder: GeocodingService = Depends(get_geocoder)):
+    caches = {'route': optimizer.route_cache.stats(), 'geocoding': geocoder.stats()}
+    if hasattr(optimizer.traffic, 'stats'):
+        caches['traffic'] = optimizer.traffic.stats()
+    live = hub.stats()
+    body = REGISTRY.render() + cache_samples(caches) + "".join(
+        render_samples(f"routing_live_{name}", "gauge", f"Live update {name} currently tracked", [({}, value)])
+        for name, value in live.items()
+    ) + render_samples("routing_jobs", "gauge", "Optimization jobs held, by status", [
+        ({'status': status}, count) for status, count in jobs.stats().items()
+    ]) + render_samples("routing_upstream_circuit_open", "gauge", "1 while calls to a host are refused", [
+        ({'host': host}, int(state == 'open')) for host, state in optimizer.http_client.breaker_states().items()
+    ])
+    return PlainTextResponse(body, media_type="text/plain; version=0.0.4; charset=utf-8")
 
 # POST: Route update
 @app.post("/route-update/{route_id}")
-async def update_route(route_id: str, current_route: Dict):
+async def update_route(route_id: str, current_route: Dict,
+                       optimizer: RouteOptimizer = Depends(get_optimizer),
+                       geometry: GeometryOptions = Depends(geometry_options)):
     try:
         logger.info(f"Received route update request for route {route_id}")
         
@@ -140,17 +670,17 @@ async def update_route(route_id: str, current_route: Dict):
         if not current_route:
             raise HTTPException(status_code=400, detail="Missing route data")
             
-        optimizer = RouteOptimizer()
         updated_route = await optimizer.optimize_route(
             depot=current_route.get('depot', {}),
-            destinations=current_route.get('destinations', [])
+            destinations=current_route.get('destinations', []),
+            departure_time=current_route.get('departure_time')
         )
         
-        return {
+        return route_response({
             "route_id": route_id,
             "optimized_route": updated_route
-        }
+        }, geometry)
         
     except Exception as e:
         logger.error(f"Route update failed: {str(e)}")
-        raise HTTPException(status_code=400, detail=str(e))
\ No newline at end of file
+        raise error_response(e)
\ No newline at end of file
@@ -0,0 +1,307 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+import asyncio
+import logging
+import os
+import time
+from starlette.datastructures import MutableHeaders
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds, from cache hits up to minute-long fleet solves
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+Sample = Tuple[Dict[str, str], float]
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    pairs = (
+        f'{name}="' + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+        for name, value in labels.items()
+    )
+    return "{" + ",".join(pairs) + "}"
+
+def render_samples(name: str, kind: str, help_text: str, samples: List[Sample]) -> str:
+    """Prometheus text format for one metric family"""
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+    lines += [f"{name}{_format_labels(labels)} {value}" for labels, value in samples]
+    return "\n".join(lines) + "\n"
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+
+    def samples(self) -> List[Sample]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        return render_samples(self.name, self.kind, self.help_text, self.samples())
+
+    # Worker processes send back what they recorded so the app's /metrics includes it
+    def state(self) -> Dict:
+        return {}
+
+    def changes_since(self, state: Dict) -> Dict:
+        return {}
+
+    def merge(self, changes: Dict):
+        pass
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        super().__init__(name, help_text, labels)
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, *label_values: str, amount: float = 1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self) -> List[Sample]:
+        return [(dict(zip(self.labels, key)), value) for key, value in self._values.items()]
+
+    def state(self) -> Dict:
+        return dict(self._values)
+
+    def changes_since(self, state: Dict) -> Dict:
+        return {key: value - state.get(key, 0) for key, value in self._values.items() if value != state.get(key, 0)}
+
+    def merge(self, changes: Dict):
+        for key, amount in changes.items():
+            self.inc(*key, amount=amount)
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    # A level in another process says nothing about this one
+    def changes_since(self, state: Dict) -> Dict:
+        return {}
+
+    def dec(self, *label_values: str, amount: float = 1):
+        self.inc(*label_values, amount=-amount)
+
+    def set(self, value: float, *label_values: str):
+        self._values[label_values] = value
+
+class Histogram(Metric):
+    """Bucketed observations; each observation is one bisect and two additions"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+        # label values -> [per-bucket counts (last is +Inf), sum]
+        self._series: Dict[tuple, list] = {}
+
+    def observe(self, value: float, *label_values: str):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def state(self) -> Dict:
+        return {key: (list(counts), total) for key, (counts, total) in self._series.items()}
+
+    def changes_since(self, state: Dict) -> Dict:
+        changes = {}
+        for key, (counts, total) in self._series.items():
+            before_counts, before_total = state.get(key, ([0] * len(counts), 0.0))
+            if counts != before_counts:
+                changes[key] = ([a - b for a, b in zip(counts, before_counts)], total - before_total)
+        return changes
+
+    def merge(self, changes: Dict):
+        for key, (counts, total) in changes.items():
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0] = [a + b for a, b in zip(series[0], counts)]
+            series[1] += total
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total) in self._series.items():
+            labels = dict(zip(self.labels, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': bound})} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "".join(metric.render() for metric in self._metrics)
+
+    def snapshot(self) -> Dict[str, Dict]:
+        return {metric.name: metric.state() for metric in self._metrics}
+
+    def changes_since(self, snapshot: Dict[str, Dict]) -> Dict[str, Dict]:
+        """What was recorded since `snapshot`, in a picklable form merge() accepts"""
+        changes = {}
+        for metric in self._metrics:
+            metric_changes = metric.changes_since(snapshot.get(metric.name, {}))
+            if metric_changes:
+                changes[metric.name] = metric_changes
+        return changes
+
+    def merge(self, changes: Dict[str, Dict]):
+        for metric in self._metrics:
+            if metric.name in changes:
+                metric.merge(changes[metric.name])
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "routing_stage_duration_seconds", "Time spent in each stage of route optimization", ["stage"]
+))
+UPSTREAM_SECONDS = REGISTRY.register(Histogram(
+    "routing_upstream_request_duration_seconds", "Upstream HTTP request time", ["host", "endpoint"]
+))
+UPSTREAM_REQUESTS = REGISTRY.register(Counter(
+    "routing_upstream_requests_total", "Upstream HTTP requests by response status", ["host", "endpoint", "status"]
+))
+UPSTREAM_HEDGES = REGISTRY.register(Counter(
+    "routing_upstream_hedged_requests_total", "Duplicate requests sent after a slow upstream response",
+    ["host", "endpoint"]
+))
+UPSTREAM_FALLBACKS = REGISTRY.register(Counter(
+    "routing_upstream_fallbacks_total", "Upstream results replaced by estimates", ["kind", "source"]
+))
+UPSTREAM_IN_FLIGHT = REGISTRY.register(Gauge(
+    "routing_upstream_requests_in_flight", "Upstream HTTP requests awaiting a response", ["host"]
+))
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "routing_http_request_duration_seconds", "Time to the start of the response", ["method", "route", "status"]
+))
+EVENT_LOOP_LAG = REGISTRY.register(Histogram(
+    "routing_event_loop_lag_seconds", "How late the event loop runs a scheduled wake-up", buckets=LAG_BUCKETS
+))
+
+# Stage timings of the request being handled; tasks it starts share the dict
+_request_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar("request_timings", default=None)
+
+def add_timing(stage: str, seconds: float):
+    """Add to the current request's breakdown (concurrent stages add up past wall time)"""
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+@contextmanager
+def recording_timings(timings: Dict[str, float]) -> Iterator[None]:
+    """Collect stage timings into `timings` outside a request, e.g. for a job a request waits on"""
+    token = _request_timings.set(timings)
+    try:
+        yield
+    finally:
+        _request_timings.reset(token)
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage)
+        add_timing(stage, elapsed)
+
+def upstream_endpoint(path: str) -> str:
+    """Path up to the first segment with coordinates or a query, e.g. "route/v1/driving" """
+    parts = []
+    for part in path.strip("/").split("/")[:4]:
+        if any(c in part for c in ",;:.%"):
+            break
+        parts.append(part)
+    return "/".join(parts)
+
+def server_timing(timings: Dict[str, float]) -> str:
+    return ", ".join(f"{stage};dur={1000 * seconds:.1f}" for stage, seconds in timings.items())
+
+class MetricsMiddleware:
+    """Times every HTTP request and optionally adds a Server-Timing breakdown.
+
+    Plain ASGI rather than BaseHTTPMiddleware, so the per-request cost is a
+    context variable and one histogram observation.
+    """
+
+    def __init__(self, app, server_timing: Optional[bool] = None):
+        self.app = app
+        self.server_timing = server_timing
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        if self.server_timing is None:
+            # Decided on the first request so a .env loaded at startup applies
+            self.server_timing = os.getenv("SERVER_TIMING", "false").lower() in ("1", "true")
+
+        timings: Dict[str, float] = {}
+        token = _request_timings.set(timings)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if self.server_timing:
+                    timings['total'] = time.perf_counter() - start
+                    MutableHeaders(scope=message).append("Server-Timing", server_timing(timings))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _request_timings.reset(token)
+            # The router records the matched route in the scope; label by its template, not the raw path
+            route = scope.get("route")
+            REQUEST_SECONDS.observe(
+                time.perf_counter() - start,
+                scope["method"], getattr(route, "path", "unmatched"), str(status)
+            )
+
+async def monitor_event_loop(interval: float = 0.5):
+    """Record how late each sleep wakes up; blocking work in handlers shows up as lag"""
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(0.0, time.perf_counter() - start - interval))
+
+def cache_samples(caches: Dict[str, Dict]) -> str:
+    """Metric families for RouteCache-style stats() dicts, keyed by cache name"""
+    families = [
+        ("routing_cache_hits_total", "counter", "Cache lookups answered from memory", 'hits'),
+        ("routing_cache_disk_hits_total", "counter", "Cache lookups answered from disk", 'disk_hits'),
+        ("routing_cache_misses_total", "counter", "Cache lookups that went upstream", 'misses'),
+        ("routing_cache_hit_ratio", "gauge", "Share of lookups answered from cache", 'hit_ratio'),
+        ("routing_cache_entries", "gauge", "Entries held in memory", 'entries'),
+        ("routing_cache_bytes", "gauge", "Approximate memory held by entries", 'bytes'),
+        ("routing_cache_inflight", "gauge", "Fetches other callers are waiting on", 'inflight'),
+    ]
+    return "".join(
+        render_samples(name, kind, help_text, [
+            ({'cache': cache}, stats[field]) for cache, stats in caches.items() if field in stats
+        ])
+        for name, kind, help_text, field in families
+    )
@@ -0,0 +1,177 @@
+from multiprocessing import shared_memory
+from multiprocessing.pool import Pool
+from typing import Dict, List, Optional, Tuple
+import logging
+import multiprocessing
+import os
+import numpy as np
+from .tsp_solver import Deadline, ImprovementCallback, local_search, or_opt, tour_cost, two_opt
+
+logger = logging.getLogger(__name__)
+
+# Perturbations swap two adjacent segments of at most this many stops
+MAX_SEGMENT = 50
+# Local-search work per worker and round, in stops x iterations; rounds
+# last a few tenths of a second whatever the tour size
+ROUND_WORK = 2000
+# Stop once this many rounds in a row found no better tour
+PATIENCE = 8
+# How long past the deadline to wait for a round before giving up on the pool
+ROUND_GRACE = 10.0
+
+def double_bridge(order: List[int], rng: np.random.Generator, max_segment: int = MAX_SEGMENT) -> List[int]:
+    """Swap two adjacent random segments, a move 2-opt and Or-opt cannot undo in one step"""
+    n = len(order)
+    if n < 5:
+        return list(order)
+    length = max(1, min(max_segment, (n - 1) // 3))
+    a = int(rng.integers(1, n - 2))
+    b = min(n - 1, a + int(rng.integers(1, length + 1)))
+    c = min(n, b + int(rng.integers(1, length + 1)))
+    return order[:a] + order[b:c] + order[a:b] + order[c:]
+
+def iterated_local_search(matrix: np.ndarray, order: List[int], cost: float,
+                          rng: np.random.Generator, iterations: int,
+                          deadline: Deadline, settings: Dict) -> Tuple[List[int], float]:
+    """Perturb the tour and repair it with 2-opt and Or-opt, keeping only improvements"""
+    for _ in range(iterations):
+        if deadline.expired():
+            break
+        candidate = double_bridge(order, rng)
+        candidate = two_opt(matrix, candidate, deadline)
+        candidate = or_opt(matrix, candidate, deadline, settings['or_opt_max_segment'])
+        candidate_cost = tour_cost(matrix, candidate)
+        if candidate_cost < cost - 1e-9:
+            order, cost = candidate, candidate_cost
+    return order, cost
+
+# Worker side: the matrix of the current solve, attached once per process
+_attached: Dict[str, Tuple[shared_memory.SharedMemory, np.ndarray]] = {}
+
+def _attach(name: str, n: int) -> np.ndarray:
+    entry = _attached.get(name)
+    if entry is None:
+        while _attached:
+            shm, previous = _attached.popitem()[1]
+            # The view has to go before the block can be closed
+            del previous
+            shm.close()
+        # Workers share the parent's resource tracker, so the parent's unlink
+        # is the only clean-up needed
+        shm = shared_memory.SharedMemory(name=name)
+        entry = _attached[name] = (shm, np.ndarray((n, n), dtype=np.float64, buffer=shm.buf))
+    return entry[1]
+
+def _search_round(name: str, n: int, order: List[int], cost: float, seed: int,
+                  remaining: Optional[float], iterations: int, settings: Dict) -> Tuple[List[int], float]:
+    matrix = _attach(name, n)
+    return iterated_local_search(
+        matrix, order, cost, np.random.default_rng(seed), iterations, Deadline(remaining), settings
+    )
+
+# A multiprocessing Pool rather than a ProcessPoolExecutor: its workers are
+# daemons, so a job worker process that started the pool can still exit
+_pool: Optional[Pool] = None
+_pool_workers = 0
+# Processes that may each run a solve at once, e.g. the job workers; they split the cores
+_solving_processes = 1
+
+def share_cores(processes: int):
+    """Size this process's default pool for `processes` solving side by side"""
+    global _solving_processes
+    _solving_processes = max(1, processes)
+
+def solver_workers() -> int:
+    """Processes used per solve, from TSP_WORKERS (default: this process's share of the cores)"""
+    default = max(1, (os.cpu_count() or 1) // _solving_processes)
+    return max(1, int(os.getenv("TSP_WORKERS", str(default))))
+
+def get_solver_pool(workers: int) -> Pool:
+    """Process pool kept between solves so each solve skips process start-up"""
+    global _pool, _pool_workers
+    if _pool is None or _pool_workers != workers:
+        close_solver_pool()
+        _pool = multiprocessing.get_context('spawn').Pool(workers)
+        _pool_workers = workers
+    return _pool
+
+def close_solver_pool():
+    global _pool
+    if _pool is not None:
+        _pool.terminate()
+        _pool.join()
+        _pool = None
+
+def round_seed(seed: int, round_number: int, worker: int) -> int:
+    return int(np.random.SeedSequence([seed, round_number, worker]).generate_state(1)[0])
+
+def parallel_ils(matrix: np.ndarray, deadline: Deadline, settings: Dict,
+                 on_improvement: Optional[ImprovementCallback] = None,
+                 workers: Optional[int] = None) -> List[int]:
+    """Iterated local search with one search per worker process.
+
+    Runs in synchronous rounds: every worker perturbs and repairs the best
+    tour so far with its own random stream, then the best tour of the round
+    is handed to all workers for the next one. The matrix sits in shared
+    memory, so a round only sends tours. With the same seed and worker count
+    the result is the same unless the time budget cuts a round short.
+    """
+    workers = workers or solver_workers()
+    seed = settings['seed']
+    n = len(matrix)
+    iterations = max(1, ROUND_WORK // n)
+
+    order = local_search(matrix, deadline, settings, on_improvement)
+    cost = tour_cost(matrix, order)
+    if n < 5:
+        return order
+
+    shm = None
+    pool = None
+    if workers > 1:
+        pool = get_solver_pool(workers)
+        shm = shared_memory.SharedMemory(create=True, size=matrix.nbytes)
+        np.ndarray(matrix.shape, dtype=np.float64, buffer=shm.buf)[:] = matrix
+
+    try:
+        round_number = 0
+        stale = 0
+        while stale < PATIENCE and not deadline.expired():
+            seeds = [round_seed(seed, round_number, worker) for worker in range(workers)]
+            if pool is None:
+                results = [iterated_local_search(
+                    matrix, order, cost, np.random.default_rng(seeds[0]), iterations, deadline, settings
+                )]
+            else:
+                remaining = deadline.remaining()
+                pending = [
+                    pool.apply_async(_search_round, (shm.name, n, order, cost, worker_seed,
+                                                     remaining, iterations, settings))
+                    for worker_seed in seeds
+                ]
+                # A worker that died never answers; don't wait on it forever
+                timeout = None if remaining is None else remaining + ROUND_GRACE
+                results = [result.get(timeout) for result in pending]
+
+            # Ties go to the lowest worker so the outcome doesn't depend on timing
+            best_order, best_cost = min(results, key=lambda result: result[1])
+            if best_cost < cost - 1e-9:
+                order, cost = best_order, best_cost
+                stale = 0
+                if on_improvement is not None:
+                    on_improvement(order, cost)
+            else:
+                stale += 1
+            round_number += 1
+
+        logger.info(f"Iterated local search ran {round_number} rounds on {workers} workers")
+        return order
+    except Exception as e:
+        logger.error(f"Parallel solve failed: {str(e)}")
+        # Workers may still be busy with this solve; start a fresh pool next time
+        close_solver_pool()
+        raise
+    finally:
+        if shm is not None:
+            shm.close()
+            shm.unlink()
@@ -0,0 +1,152 @@
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+import logging
+import numpy as np
+from .geometry import RouteSpatialIndex, haversine
+
+logger = logging.getLogger(__name__)
+
+# Positions further than this from the route count as off-route
+OFF_ROUTE_DISTANCE = 100.0
+# GPS jitter can put a vehicle slightly behind where it was; allow this much
+BACKTRACK_TOLERANCE = 50.0
+# A stop counts as done once the vehicle is this close to it along the route
+STOP_REACHED_DISTANCE = 50.0
+# Traffic is sampled at this many evenly spaced points over the full route
+SAMPLE_COUNT = 10
+
+class RouteProgress:
+    """Tracks how far a vehicle has driven along an optimized route.
+
+    Reported positions are snapped onto the route polyline through a spatial
+    index, never moving backwards by more than GPS jitter. Everything that
+    looks ahead (traffic samples, stops, geometry, duration) only covers the
+    part of the route the vehicle has not driven yet, so the work per update
+    shrinks as the trip goes on.
+    """
+
+    def __init__(self, route: Dict):
+        self.route = route
+        self.index = RouteSpatialIndex(route['geometry']['coordinates'])
+        self.length = float(self.index.cumulative[-1]) if len(self.index.cumulative) else 0.0
+        self.stops = route.get('stops', [])
+        self.stop_offsets = self._stop_offsets()
+        self.leg_ends, self.leg_times = self._leg_times()
+
+        # Fixed sample positions, so samples ahead of the vehicle drop out one by one
+        offsets = np.linspace(0, self.length, SAMPLE_COUNT, endpoint=False)
+        lon = np.interp(offsets, self.index.cumulative, self.index.lon_lat[:, 0])
+        lat = np.interp(offsets, self.index.cumulative, self.index.lon_lat[:, 1])
+        self.samples: List[Tuple[float, float, float]] = list(zip(offsets.tolist(), lat.tolist(), lon.tolist()))
+
+        self.travelled = 0.0
+        self.segment = 0
+        self.snapped: Optional[List[float]] = None
+        self.off_route = False
+        self.completed_stops = 0
+
+    def _stop_offsets(self) -> List[float]:
+        """Distance along the route of each stop, in stop order"""
+        lon_lat = self.index.lon_lat
+        offsets = []
+        first = 0
+        for stop in self.stops:
+            point = stop['coordinates']
+            distances = haversine(point['lat'], point['lon'], lon_lat[first:, 1], lon_lat[first:, 0])
+            first += int(np.argmin(distances))
+            offsets.append(float(self.index.cumulative[first]))
+        return offsets
+
+    def _leg_times(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Distance along the route and driving time at each leg end, starting from 0"""
+        legs = self.route.get('legs') or [{'distance': self.route['distance'], 'duration': self.route['duration']}]
+        leg_distances = np.array([leg['distance'] for leg in legs], dtype=float)
+        leg_durations = np.array([leg['duration'] for leg in legs], dtype=float)
+        # The router's distances may differ slightly from the geometry's, as in RouteTimeline
+        total = leg_distances.sum()
+        ends = np.cumsum(leg_distances) * (self.length / total if total else 0.0)
+        return np.concatenate(([0.0], ends)), np.concatenate(([0.0], np.cumsum(leg_durations)))
+
+    @property
+    def remaining_duration(self) -> float:
+        """Driving time left, at each leg's own average speed rather than the route's"""
+        if not self.length:
+            return 0.0
+        return float(self.leg_times[-1] - np.interp(self.travelled, self.leg_ends, self.leg_times))
+
+    def update(self, position: Dict) -> Dict:
+        """Snap a reported {'lat', 'lon'} position onto the route and return the progress"""
+        match = self.index.snap(
+            [position['lon'], position['lat']],
+            OFF_ROUTE_DISTANCE,
+            min_along=self.travelled - BACKTRACK_TOLERANCE
+        )
+        if match is None:
+            # Keep the last known progress; rerouting from here covers the detour
+            self.off_route = True
+        else:
+            segment, t, _, along = match
+            self.off_route = False
+            self.segment = segment
+            self.travelled = max(self.travelled, along)
+            start, end = self.index.lon_lat[segment], self.index.lon_lat[segment + 1]
+            self.snapped = (start + t * (end - start)).tolist()
+            while (self.completed_stops < len(self.stop_offsets)
+                   and self.stop_offsets[self.completed_stops] <= self.travelled + STOP_REACHED_DISTANCE):
+                self.completed_stops += 1
+        return self.summary()
+
+    @property
+    def remaining_fraction(self) -> float:
+        return 1.0 - self.travelled / self.length if self.length else 0.0
+
+    def remaining_stops(self) -> List[Dict]:
+        return self.stops[self.completed_stops:]
+
+    def remaining_samples(self) -> List[Tuple[float, float]]:
+        """(lat, lon) traffic sample points still ahead of the vehicle"""
+        return [(lat, lon) for offset, lat, lon in self.samples if offset >= self.travelled]
+
+    def remaining_coordinates(self) -> List[List[float]]:
+        coordinates = self.index.lon_lat[self.segment + 1:].tolist()
+        return ([self.snapped] if self.snapped else []) + coordinates
+
+    def summary(self) -> Dict:
+        remaining_stops = self.remaining_stops()
+        return {
+            'distance_travelled': self.travelled,
+            'distance_remaining': self.length - self.travelled,
+            'remaining_duration': self.remaining_duration,
+            'snapped_position': (
+                {'lat': self.snapped[1], 'lon': self.snapped[0]} if self.snapped else None
+            ),
+            'off_route': self.off_route,
+            'completed_stops': self.completed_stops,
+            'next_stop': remaining_stops[0] if remaining_stops else None
+        }
+
+class ProgressRegistry:
+    """Progress trackers for the most recently updated routes, bounded in number.
+
+    Trackers are keyed by route ID and the stored route's version (its
+    updated_at), so a re-optimized route starts a fresh tracker.
+    """
+
+    def __init__(self, max_routes: int = 10000):
+        self.max_routes = max_routes
+        self._trackers: "OrderedDict[int, Tuple[float, RouteProgress]]" = OrderedDict()
+
+    def get(self, route_id: int, version: float) -> Optional[RouteProgress]:
+        entry = self._trackers.get(route_id)
+        if entry is None or entry[0] != version:
+            return None
+        self._trackers.move_to_end(route_id)
+        return entry[1]
+
+    def track(self, route_id: int, version: float, route: Dict) -> RouteProgress:
+        tracker = RouteProgress(route)
+        self._trackers[route_id] = (version, tracker)
+        self._trackers.move_to_end(route_id)
+        while len(self._trackers) > self.max_routes:
+            self._trackers.popitem(last=False)
+        return tracker
@@ -0,0 +1,204 @@
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Deque, Iterable, Iterator, List, Optional
+import asyncio
+import logging
+import os
+import re
+import time
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# Latency samples kept per upstream endpoint, and how many are needed before hedging
+LATENCY_WINDOW = 200
+MIN_LATENCY_SAMPLES = 20
+
+class UpstreamTimeout(TimeoutError):
+    """An upstream call ran out of its per-call timeout or the request's deadline"""
+
+class CircuitOpen(Exception):
+    """Calls to an upstream host are being refused after too many recent failures"""
+
+class UpstreamJobFailed(Exception):
+    """An asynchronous upstream job (e.g. a TomTom matrix job) ended without a result"""
+
+# Monotonic time by which the request being handled must be answered; tasks it starts share it
+_deadline: ContextVar[Optional[float]] = ContextVar("request_deadline", default=None)
+
+@contextmanager
+def deadline(seconds: Optional[float]) -> Iterator[None]:
+    """Give upstream calls in the block `seconds` in total; nested deadlines only ever shrink it"""
+    if seconds is None:
+        yield
+        return
+    new = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(new if current is None else min(current, new))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+def time_left() -> Optional[float]:
+    """Seconds until the current deadline, or None without one"""
+    current = _deadline.get()
+    return None if current is None else current - time.monotonic()
+
+def upstream_failed(e: BaseException) -> bool:
+    """Whether an error means the upstream is slow or down, rather than the request being bad"""
+    if isinstance(e, (UpstreamTimeout, CircuitOpen, UpstreamJobFailed, httpx.TransportError)):
+        return True
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code >= 500 or e.response.status_code == 429
+    return False
+
+def error_status(e: BaseException) -> int:
+    """HTTP status to report for an error raised while handling a request"""
+    if isinstance(e, (UpstreamTimeout, httpx.TimeoutException)):
+        return 504
+    if isinstance(e, CircuitOpen):
+        return 503
+    if isinstance(e, (httpx.HTTPError, UpstreamJobFailed)):
+        return 502
+    if isinstance(e, (ValueError, KeyError, IndexError)):
+        return 400
+    return 500
+
+class LatencyTracker:
+    """Recent response times of one upstream endpoint"""
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self._samples: Deque[float] = deque(maxlen=window)
+
+    def observe(self, seconds: float):
+        self._samples.append(seconds)
+
+    def percentile(self, q: float) -> Optional[float]:
+        """The q-th percentile, or None until there are enough samples to trust it"""
+        if len(self._samples) < MIN_LATENCY_SAMPLES:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q / 100))]
+
+class CircuitBreaker:
+    """Fails calls to an upstream fast while its recent error rate is too high.
+
+    Closed, it lets calls through and remembers the outcome of the last
+    `window`. Once at least `min_calls` are known and `error_rate` of them
+    failed it opens and refuses calls for `cooldown` seconds. Then it lets a
+    single trial call through (half-open): success closes it again, failure
+    reopens it.
+    """
+
+    def __init__(self, error_rate: float = 0.5, window: int = 20, min_calls: int = 10,
+                 cooldown: float = 10.0):
+        self.error_rate = error_rate
+        self.min_calls = min_calls
+        self.cooldown = cooldown
+        self._outcomes: Deque[bool] = deque(maxlen=window)
+        self._opened_at: Optional[float] = None
+        self._trial = False
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return 'closed'
+        if time.monotonic() - self._opened_at < self.cooldown:
+            return 'open'
+        return 'half_open'
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == 'closed':
+            return True
+        if state == 'half_open' and not self._trial:
+            self._trial = True
+            return True
+        return False
+
+    def record(self, ok: bool):
+        if self._opened_at is not None:
+            # Only the trial call counts; calls that started before the breaker opened don't
+            if not self._trial:
+                return
+            self._trial = False
+            if ok:
+                self._opened_at = None
+                self._outcomes.clear()
+            else:
+                self._opened_at = time.monotonic()
+            return
+        self._outcomes.append(ok)
+        failures = self._outcomes.count(False)
+        if len(self._outcomes) >= self.min_calls and failures >= self.error_rate * len(self._outcomes):
+            self._opened_at = time.monotonic()
+            logger.warning(f"Circuit opened after {failures} failures in {len(self._outcomes)} calls")
+
+    def abandon(self):
+        """A call ended without telling us anything about the host, e.g. it was cancelled"""
+        if self._opened_at is not None:
+            self._trial = False
+
+def create_circuit_breaker() -> CircuitBreaker:
+    """Breaker configured from BREAKER_ERROR_RATE, BREAKER_WINDOW, BREAKER_MIN_CALLS and BREAKER_COOLDOWN"""
+    return CircuitBreaker(
+        error_rate=float(os.getenv("BREAKER_ERROR_RATE", "0.5")),
+        window=int(os.getenv("BREAKER_WINDOW", "20")),
+        min_calls=int(os.getenv("BREAKER_MIN_CALLS", "10")),
+        cooldown=float(os.getenv("BREAKER_COOLDOWN", "10"))
+    )
+
+class DeadlineMiddleware:
+    """Gives each HTTP request a deadline that bounds its upstream calls.
+
+    REQUEST_DEADLINE seconds (default 10) from the start of the request;
+    clients can ask for less with an X-Request-Deadline header in seconds.
+    Streaming responses (batches, server-sent events) can outlive any one
+    deadline, so paths matching `streaming_paths` get none; the seconds are
+    left in request.state.deadline for them to bound each unit of work.
+    Plain ASGI, like MetricsMiddleware, so the cost is one context variable.
+    """
+
+    def __init__(self, app, seconds: Optional[float] = None, streaming_paths: Iterable[str] = ()):
+        self.app = app
+        self.seconds = seconds
+        self.streaming_paths = [re.compile(pattern) for pattern in streaming_paths]
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        if self.seconds is None:
+            # Decided on the first request so a .env loaded at startup applies
+            self.seconds = float(os.getenv("REQUEST_DEADLINE", "10"))
+
+        seconds = self.seconds
+        for name, value in scope.get("headers", []):
+            if name == b"x-request-deadline":
+                try:
+                    seconds = min(seconds, float(value))
+                except ValueError:
+                    pass
+        seconds = seconds if seconds > 0 else None
+        if any(pattern.fullmatch(scope["path"]) for pattern in self.streaming_paths):
+            scope.setdefault("state", {})["deadline"] = seconds
+            await self.app(scope, receive, send)
+            return
+        with deadline(seconds):
+            await self.app(scope, receive, send)
+
+async def first_success(tasks: List[asyncio.Task]):
+    """Result of the first task to succeed, cancelling the others; if all fail, the first one's error"""
+    pending = set(tasks)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+        raise tasks[0].exception()
+    finally:
+        for task in pending:
+            task.cancel()
@@ -0,0 +1,313 @@
+from collections import OrderedDict
+from itertools import islice
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from .serialization import dumps, loads
+
+logger = logging.getLogger(__name__)
+
+# Longer lists and dicts are sized from this many of their items
+SIZE_SAMPLE = 8
+
+def estimate_size(value: Any) -> int:
+    """Rough JSON size of a value in bytes, sampling long containers rather than encoding it"""
+    if isinstance(value, dict):
+        if not value:
+            return 2
+        items = list(islice(value.items(), SIZE_SAMPLE))
+        per_item = sum(len(str(key)) + 4 + estimate_size(item) for key, item in items) / len(items)
+        return 2 + int(per_item * len(value))
+    if isinstance(value, (list, tuple)):
+        if not value:
+            return 2
+        step = max(1, len(value) // SIZE_SAMPLE)
+        items = value[::step][:SIZE_SAMPLE]
+        per_item = sum(estimate_size(item) + 1 for item in items) / len(items)
+        return 2 + int(per_item * len(value))
+    if isinstance(value, str):
+        return len(value) + 2
+    # Numbers (typically ~10 digits once encoded), booleans and None
+    return 10
+
+class RouteCache:
+    """LRU cache for upstream route responses, bounded by size in bytes, with per-entry TTL.
+
+    Entries can optionally be written to an SQLite file so they survive
+    restarts. A background thread writes them in batches every
+    flush_interval seconds, so the event loop never waits on the disk; it
+    also drops rows that expired more than stale_ttl ago and the soonest to
+    expire beyond max_disk_rows. The async lookups read it from worker
+    threads as well. Concurrent misses for the same key share one upstream
+    fetch. Expired entries stay until evicted, so get_stale can still serve
+    them while the upstream is down. Memory use is counted from the bytes
+    read off disk, or else estimated from a sample of the value.
+    Cached values are shared between callers and must not be mutated.
+    """
+
+    def __init__(self,
+                 max_bytes: int = 64 * 1024 * 1024,
+                 ttl: float = 300,
+                 precision: int = 5,
+                 disk_path: Optional[str] = None,
+                 max_disk_rows: int = 100_000,
+                 stale_ttl: float = 3600,
+                 flush_interval: float = 1.0,
+                 purge_interval: float = 60):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.precision = precision
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self._entries: "OrderedDict[str, Tuple[float, int, Any]]" = OrderedDict()
+        self._bytes = 0
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+        self.max_disk_rows = max_disk_rows
+        self.stale_ttl = stale_ttl
+        self.flush_interval = flush_interval
+        self.purge_interval = purge_interval
+        self._disk = None
+        # Disk reads run in worker threads and share the connection
+        self._disk_lock = threading.Lock()
+        self._writer: Optional[threading.Thread] = None
+        # Rows waiting for the writer thread: key -> (expires_at, value)
+        self._pending: Dict[str, Tuple[float, Any]] = {}
+        self._pending_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closing = False
+        if disk_path:
+            self._disk = sqlite3.connect(disk_path, check_same_thread=False)
+            self._disk.execute("PRAGMA journal_mode=WAL")
+            self._disk.execute(
+                "CREATE TABLE IF NOT EXISTS route_cache ("
+                "key TEXT PRIMARY KEY, expires_at REAL NOT NULL, value BLOB NOT NULL)"
+            )
+            self._disk.execute("CREATE INDEX IF NOT EXISTS route_cache_expires_at ON route_cache (expires_at)")
+            self._disk.commit()
+            self._writer = threading.Thread(
+                target=self._write_behind, args=(disk_path,), name="route-cache-writer", daemon=True
+            )
+            self._writer.start()
+
+    def make_key(self, waypoints: List[Dict], params: Optional[Dict] = None) -> str:
+        """Key on waypoint order with coordinates rounded to the configured precision"""
+        coordinates = ";".join(
+            f"{point['lon']:.{self.precision}f},{point['lat']:.{self.precision}f}"
+            for point in waypoints
+        )
+        return f"{coordinates}|{json.dumps(params or {}, sort_keys=True)}"
+
+    def get(self, key: str) -> Optional[Any]:
+        """The cached value if it has not expired. A memory miss reads the disk
+        tier in the calling thread; on the event loop use get_async."""
+        value = self._get_memory(key)
+        if value is None and self._disk is not None:
+            value = self._from_disk(key, self._read_disk(key))
+        return self._counted(value)
+
+    async def get_async(self, key: str) -> Optional[Any]:
+        """Like get, but the disk tier is read in a worker thread"""
+        value = self._get_memory(key)
+        if value is None and self._disk is not None:
+            value = self._from_disk(key, await asyncio.to_thread(self._read_disk, key))
+        return self._counted(value)
+
+    async def get_stale(self, key: str) -> Optional[Any]:
+        """The last value stored under key, however long ago it expired"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            return entry[2]
+        if self._disk is not None:
+            row = await asyncio.to_thread(self._read_disk, key)
+            if row is not None:
+                return row[1]
+        return None
+
+    def set(self, key: str, value: Any):
+        expires_at = time.time() + self.ttl
+        self._store_in_memory(key, value, expires_at, estimate_size(value))
+        if self._writer is not None:
+            with self._pending_lock:
+                self._pending[key] = (expires_at, value)
+
+    async def get_or_fetch(self, key: str, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        """Return the cached value or fetch it, merging concurrent misses for the same key"""
+        value = self._get_memory(key)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.misses += 1
+            try:
+                return await asyncio.shield(inflight)
+            except asyncio.CancelledError:
+                # Only retry when the fetch we were waiting on was cancelled, not us
+                if not inflight.cancelled():
+                    raise
+                return await self.get_or_fetch(key, fetch)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            # Registered first, so misses arriving while the disk is read wait for this lookup
+            value = None
+            if self._disk is not None:
+                value = self._from_disk(key, await asyncio.to_thread(self._read_disk, key))
+            if self._counted(value) is None:
+                value = await fetch()
+                self.set(key, value)
+            future.set_result(value)
+            return value
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Waiters see the error; don't warn about it going unretrieved otherwise
+            future.exception()
+            raise
+        finally:
+            del self._inflight[key]
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'disk_hits': self.disk_hits,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'entries': len(self._entries),
+            'bytes': self._bytes,
+            'inflight': len(self._inflight)
+        }
+
+    def close(self):
+        if self._writer is not None:
+            # The writer flushes what is still pending before it exits
+            self._closing = True
+            self._wake.set()
+            self._writer.join()
+            self._writer = None
+        with self._disk_lock:
+            if self._disk is not None:
+                self._disk.close()
+                self._disk = None
+
+    def _write_behind(self, disk_path: str):
+        disk = sqlite3.connect(disk_path)
+        last_purge = 0.0
+        try:
+            while True:
+                self._wake.wait(self.flush_interval)
+                closing = self._closing
+                with self._pending_lock:
+                    rows, self._pending = self._pending, {}
+                try:
+                    if rows:
+                        disk.executemany(
+                            "INSERT OR REPLACE INTO route_cache (key, expires_at, value) VALUES (?, ?, ?)",
+                            [(key, expires_at, zlib.compress(dumps(value)))
+                             for key, (expires_at, value) in rows.items()]
+                        )
+                        disk.commit()
+                    if closing or time.time() - last_purge >= self.purge_interval:
+                        self._purge(disk)
+                        last_purge = time.time()
+                except sqlite3.Error as e:
+                    logger.error(f"Route cache disk write failed: {str(e)}")
+                if closing:
+                    return
+        finally:
+            disk.close()
+
+    def _purge(self, disk: sqlite3.Connection):
+        """Drop rows too old to serve even as stale, then the soonest to expire beyond max_disk_rows"""
+        disk.execute("DELETE FROM route_cache WHERE expires_at < ?", (time.time() - self.stale_ttl,))
+        excess = disk.execute("SELECT COUNT(*) FROM route_cache").fetchone()[0] - self.max_disk_rows
+        if excess > 0:
+            disk.execute(
+                "DELETE FROM route_cache WHERE key IN "
+                "(SELECT key FROM route_cache ORDER BY expires_at LIMIT ?)", (excess,)
+            )
+        disk.commit()
+
+    def _get_memory(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.time():
+            return None
+        self._entries.move_to_end(key)
+        return entry[2]
+
+    def _read_disk(self, key: str) -> Optional[Tuple[float, Any, int]]:
+        """(expires_at, value, size) of the disk row for key, expired or not; blocks on SQLite"""
+        with self._disk_lock:
+            if self._disk is None:
+                return None
+            row = self._disk.execute(
+                "SELECT expires_at, value FROM route_cache WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        data = zlib.decompress(row[1])
+        return row[0], loads(data), len(data)
+
+    def _from_disk(self, key: str, row: Optional[Tuple[float, Any, int]]) -> Optional[Any]:
+        if row is None or row[0] <= time.time():
+            return None
+        expires_at, value, size = row
+        self._store_in_memory(key, value, expires_at, size)
+        self.disk_hits += 1
+        return value
+
+    def _counted(self, value: Optional[Any]) -> Optional[Any]:
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def _store_in_memory(self, key: str, value: Any, expires_at: float, size: int):
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._evict(key)
+        self._entries[key] = (expires_at, size, value)
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            self._evict(next(iter(self._entries)))
+
+    def _evict(self, key: str):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+_shared_cache: Optional[RouteCache] = None
+
+def get_route_cache() -> RouteCache:
+    """Return the application-wide route cache, configured from the environment"""
+    global _shared_cache
+    if _shared_cache is None:
+        _shared_cache = RouteCache(
+            max_bytes=int(os.getenv("ROUTE_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+            ttl=float(os.getenv("ROUTE_CACHE_TTL", "300")),
+            precision=int(os.getenv("ROUTE_CACHE_PRECISION", "5")),
+            disk_path=os.getenv("ROUTE_CACHE_PATH") or None,
+            max_disk_rows=int(os.getenv("ROUTE_CACHE_MAX_ROWS", "100000")),
+            stale_ttl=float(os.getenv("ROUTE_CACHE_STALE_TTL", "3600"))
+        )
+    return _shared_cache
+
+def close_route_cache():
+    global _shared_cache
+    if _shared_cache is not None:
+        _shared_cache.close()
+        _shared_cache = None
@@ -1,159 +1,312 @@
-import requests
-import json
 from datetime import datetime, timedelta
-from typing import List, Dict
+from typing import Awaitable, Callable, List, Dict, Optional
 import os
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
+import time
+from functools import partial
 import logging
-from dotenv import load_dotenv
-from itertools import permutations
-import numpy as np
-import random
-# import polyline
+from .candidate_solver import solve_candidate_tsp
+from .distance_matrix import estimate_matrix, get_sparse_matrix
+from .http_client import HTTPClient, get_http_client
+from .metrics import UPSTREAM_FALLBACKS, timed
+from .resilience import upstream_failed
+from .route_cache import RouteCache, get_route_cache
+from .tsp_solver import solve_tsp
+from .vrp_solver import solve_vrp
+# The routing backends, traffic providers and ETA tables are imported where
+# they are used, so only the configured ones are ever loaded.
 
-load_dotenv()
-
-# Set up logging
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# Route segments within this many metres of a congestion alert count as congested
+CONGESTION_RADIUS = 500
+# Alternatives with more than this share of their length congested are rejected
+MAX_CONGESTED_SHARE = 0.1
+
+# Called as on_progress(stage, detail) as a long optimization moves through
+# its stages: "matrix", "solve" (once per better solution) and "route"
+ProgressCallback = Callable[[str, Dict], None]
+
+# Runs a CPU-bound solve, given as a picklable functools.partial of a solver
+# function, with the on_improvement and cancelled callbacks added. Job workers
+# pass one that sends the solve to a process pool.
+SolverRunner = Callable[..., Awaitable[Dict]]
+
+async def run_solver_inline(solve: Callable[..., Dict],
+                            on_improvement: Optional[Callable[[List[int], float], None]] = None,
+                            cancelled: Optional[Callable[[], bool]] = None) -> Dict:
+    callbacks = {'on_improvement': on_improvement} if on_improvement is not None else {}
+    return solve(cancelled=cancelled, **callbacks)
+
+def route_sample_points(coordinates: List[List[float]], count: int = 10) -> List[tuple]:
+    """About count (lat, lon) points spread evenly along a [lon, lat] geometry"""
+    step = max(len(coordinates) // count, 1)
+    return [(float(coord[1]), float(coord[0])) for coord in coordinates[::step]]
+
+def traffic_alert(lat: float, lon: float, traffic: Dict) -> Optional[Dict]:
+    """Alert for a sampled point, or None when traffic there is clear"""
+    if traffic['congestion_level'] == 'High':
+        message = f"Heavy traffic detected: {traffic['current_speed']} km/h"
+    elif traffic['congestion_level'] == 'Medium':
+        message = f"Moderate traffic: {traffic['current_speed']} km/h"
+    else:
+        return None
+    return {
+        'coordinates': {'lat': lat, 'lon': lon},
+        'severity': traffic['congestion_level'],
+        'message': message
+    }
+
 class RouteOptimizer:
-    def __init__(self):
-        self.osrm_url = "http://router.project-osrm.org/route/v1/driving"
+    def __init__(self, http_client: Optional[HTTPClient] = None,
+                 route_cache: Optional[RouteCache] = None,
+                 traffic_provider=None,
+                 routing_backend=None,
+                 speed_profiles=None):
+        self.http_client = http_client or get_http_client()
+        self.route_cache = route_cache or get_route_cache()
         self.tomtom_api_key = os.getenv("TOMTOM_API_KEY")
         if not self.tomtom_api_key:
             raise ValueError("TomTom API key not found in environment variables!")
         
-        self.tomtom_traffic_url = "https://api.tomtom.com/traffic/services/4/flowSegmentData/absolute/10/json"
+        self._routing_backend = routing_backend
+        self._traffic = traffic_provider
+        self._speed_profiles = speed_profiles
+        # Tours with this many points or more only fetch road costs to each point's nearest neighbours
+        self.sparse_threshold = int(os.getenv("SPARSE_MATRIX_THRESHOLD", "1000"))
+        self.sparse_neighbors = int(os.getenv("SPARSE_MATRIX_NEIGHBORS", "12"))
+
+    @property
+    def routing_backend(self):
+        """OSRM or the local graph engine, chosen by ROUTING_BACKEND"""
+        if self._routing_backend is None:
+            from .routing_backend import create_routing_backend
+            self._routing_backend = create_routing_backend(self.http_client)
+        return self._routing_backend
+
+    @property
+    def matrix_backend(self):
+        # Every routing backend also serves duration/distance matrices
+        return self.routing_backend
+
+    @property
+    def traffic(self):
+        if self._traffic is None:
+            from .traffic import create_traffic_provider
+            self._traffic = create_traffic_provider(self.tomtom_api_key, self.http_client)
+        return self._traffic
+
+    @property
+    def speed_profiles(self):
+        """Typical speed by road cell and hour of the week, from SPEED_PROFILE_PATH"""
+        if self._speed_profiles is None:
+            from .eta import get_speed_profiles
+            self._speed_profiles = get_speed_profiles()
+        return self._speed_profiles
+
+    async def warm_up(self, depots: List[Dict]):
+        """Load heavy modules, open upstream connections and cache routes between depots"""
+        import numpy as np
+        from .geometry import RouteSpatialIndex
+
+        # Exercise the NumPy code paths once so the first real request doesn't pay for it
+        solve_tsp(np.ones((4, 4)) - np.eye(4))
+        RouteSpatialIndex([[0.0, 0.0], [0.001, 0.001]]).segments_near([[0.0, 0.0]], 100)
+
+        legs = [[a, b] for a in depots for b in depots if a is not b]
+        results = await asyncio.gather(
+            self.routing_backend.warm_up(depots),
+            *[self.get_osm_route(leg) for leg in legs],
+            return_exceptions=True
+        )
+        failures = [r for r in results if isinstance(r, Exception)]
+        for failure in failures:
+            logger.warning(f"Warm-up request failed: {str(failure)}")
+        logger.info(
+            f"Warm-up finished for {len(depots)} depots "
+            f"({len(results) - len(failures)}/{len(results)} requests succeeded)"
+        )
 
     async def get_osm_route(self, waypoints: List[Dict]) -> Dict:
-        """Get route using OSRM"""
+        """Get route from the routing backend, served from the route cache when possible"""
+        return (await self.get_osm_routes(waypoints))[0]
+
+    async def get_osm_routes(self, waypoints: List[Dict], alternatives: bool = False) -> List[Dict]:
+        """Get the route, plus alternative routes if asked for, best first.
+
+        When the backend is down or out of time, the last cached routes are
+        served however old they are, else a straight-line estimate. Either
+        way the routes carry an 'estimate' key saying which.
+        """
+        params = {'backend': self.routing_backend.name, 'alternatives': alternatives}
+        key = self.route_cache.make_key(waypoints, params)
+        with timed("route"):
+            try:
+                return await self.route_cache.get_or_fetch(
+                    key, lambda: self.routing_backend.get_routes(waypoints, alternatives)
+                )
+            except Exception as e:
+                if not upstream_failed(e):
+                    raise
+                stale = await self.route_cache.get_stale(key)
+                if stale is not None:
+                    logger.warning(f"Serving expired cached route: {str(e)}")
+                    UPSTREAM_FALLBACKS.inc('route', 'cache')
+                    return [{**route, 'estimate': 'cache'} for route in stale]
+                logger.warning(f"Estimating route from straight lines: {str(e)}")
+                UPSTREAM_FALLBACKS.inc('route', 'haversine')
+                from .routing_backend import estimate_route
+                return [estimate_route(waypoints)]
+
+    async def get_matrix(self, points: List[Dict]):
+        """Matrix from the matrix backend, or a haversine estimate when the upstream fails"""
+        with timed("matrix"):
+            try:
+                return await self.matrix_backend.get_matrix(points)
+            except Exception as e:
+                if not upstream_failed(e):
+                    raise
+                logger.warning(f"Estimating matrix from straight lines: {str(e)}")
+                UPSTREAM_FALLBACKS.inc('matrix', 'haversine')
+                return estimate_matrix(points)
+
+    async def get_sparse_matrix(self, points: List[Dict]):
+        """Road costs from each point to its sparse_neighbors nearest, estimating blocks the upstream fails"""
+        with timed("matrix"):
+            return await get_sparse_matrix(self.matrix_backend, points, self.sparse_neighbors)
+
+    async def get_traffic_data(self, lat: float, lon: float) -> Dict:
+        """Get traffic data for a location"""
         try:
-            # Format coordinates for OSRM
-            coordinates = ";".join([f"{point['lon']},{point['lat']}" for point in waypoints])
-            
-            # Make request to OSRM
-            url = f"{self.osrm_url}/{coordinates}"
-            params = {
-                'overview': 'full',
-                'geometries': 'geojson',
-                'steps': 'true'
-            }
-            
-            logger.debug(f"Requesting route from OSRM with URL: {url}")
-            response = requests.get(url, params=params)
-            response.raise_for_status()
-            
-            route_data = response.json()
-            
-            if 'routes' not in route_data or not route_data['routes']:
-                raise ValueError("No route found in OSRM response")
-            
-            return route_data['routes'][0]
-            
+            with timed("traffic"):
+                return await self.traffic.get_flow(lat, lon)
         except Exception as e:
-            logger.error(f"OSRM route calculation failed: {str(e)}")
+            logger.error(f"Failed to get traffic data: {str(e)}")
             raise
 
-    async def get_traffic_data(self, lat: float, lon: float) -> Dict:
-        """Get traffic data for a location"""
+    async def get_traffic_batch(self, points: List[tuple]) -> List[Dict]:
+        """Traffic data for many (lat, lon) points, one upstream lookup per map cell"""
         try:
-            # Simulated traffic data - in real app, this would call a traffic API
-            speed = random.randint(8, 45)  # Speed in km/h
-            
-            # Determine congestion level based on speed
-            if speed < 15:
-                congestion_level = 'High'
-            elif speed < 25:
-                congestion_level = 'Medium'
-            else:
-                congestion_level = 'Low'
-            
-            return {
-                'current_speed': speed,
-                'congestion_level': congestion_level,
-                'timestamp': datetime.now().isoformat()
-            }
+            with timed("traffic"):
+                return await self.traffic.get_flows(points)
         except Exception as e:
             logger.error(f"Failed to get traffic data: {str(e)}")
             raise
 
-    async def optimize_route(self, depot: Dict, destinations: List[Dict]) -> Dict:
+    async def optimize_route(self, depot: Dict, destinations: List[Dict],
+                             route_data: Optional[Dict] = None,
+                             departure_time: Optional[str] = None) -> Dict:
+        """Route through the destinations with traffic-aware arrival times.
+
+        departure_time is an ISO 8601 string (default now); live traffic
+        weighs most for departures close to now and typical speeds for the
+        time of day and week take over for later ones.
+        """
         try:
             logger.info("Starting route optimization")
             
-            waypoints = [depot] + destinations
-            route_data = await self.get_osm_route(waypoints)
+            # Callers that already picked a route (e.g. an alternative) pass it in
+            if route_data is None:
+                waypoints = [depot] + destinations
+                route_data = await self.get_osm_route(waypoints)
             
             # Get traffic data and calculate ETA
             traffic_segments = []
             coordinates = route_data['geometry']['coordinates']
-            total_delay_minutes = 0
             
             # Sample points for traffic analysis
+            import numpy as np
+            from .eta import RouteTimeline, parse_departure_time
             num_samples = 8
             sample_indices = np.linspace(0, len(coordinates)-1, num_samples, dtype=int)
             
-            for idx in sample_indices:
-                coord = coordinates[idx]
-                traffic = await self.get_traffic_data(coord[1], coord[0])
-                
-                # Calculate segment delay based on speed
-                segment_distance = route_data['distance'] / num_samples
-                expected_time = (segment_distance / 1000) / 30 * 60  # Expected time at 30 km/h
-                actual_time = (segment_distance / 1000) / traffic['current_speed'] * 60
-                segment_delay = actual_time - expected_time
-                total_delay_minutes += segment_delay
-                
-                traffic_segments.append({
-                    'timestamp': traffic['timestamp'],
-                    'distance_covered': (route_data['distance'] * idx) / len(coordinates),
-                    'current_speed': traffic['current_speed'],
-                    'congestion_level': traffic['congestion_level']
-                })
-            
-            # Count congestion levels
-            congestion_counts = {
-                'High': len([s for s in traffic_segments if s['congestion_level'] == 'High']),
-                'Medium': len([s for s in traffic_segments if s['congestion_level'] == 'Medium']),
-                'Low': len([s for s in traffic_segments if s['congestion_level'] == 'Low'])
-            }
+            estimates = {'route': route_data['estimate']} if route_data.get('estimate') else {}
+            try:
+                sample_traffic = await self.get_traffic_batch(
+                    [(float(coordinates[idx][1]), float(coordinates[idx][0])) for idx in sample_indices]
+                )
+            except Exception as e:
+                if not upstream_failed(e):
+                    raise
+                # Typical speeds for the time of day still apply
+                UPSTREAM_FALLBACKS.inc('traffic', 'profile')
+                estimates['traffic'] = 'profile'
+                sample_traffic = []
+            # Time-dependent arrival times, congestion summary and the ETA
+            with timed("eta"):
+                departure = parse_departure_time(departure_time)
+                timeline = RouteTimeline(route_data, self.speed_profiles)
+                # Without live traffic the speed profiles alone decide, even right after departure
+                live = (
+                    timeline.live_factors(timeline.cumulative[sample_indices], sample_traffic)
+                    if sample_traffic else None
+                )
+                arrivals = timeline.stop_arrivals(
+                    departure.timestamp(), departure.utcoffset().total_seconds(), live, now=time.time()
+                )[0]
+                travel_seconds = float(arrivals[-1])
+                total_delay_minutes = (travel_seconds - route_data['duration']) / 60
+
+                for idx, traffic in zip(sample_indices, sample_traffic):
+                    traffic_segments.append({
+                        'timestamp': traffic['timestamp'],
+                        'distance_covered': float(timeline.cumulative[idx]),
+                        'current_speed': traffic['current_speed'],
+                        'congestion_level': traffic['congestion_level']
+                    })
             
-            total_segments = len(traffic_segments)
-            traffic_summary = (
-                f"{(congestion_counts['Low']/total_segments*100):.0f}% Clear, "
-                f"{(congestion_counts['Medium']/total_segments*100):.0f}% Moderate, "
-                f"{(congestion_counts['High']/total_segments*100):.0f}% Heavy"
-            )
+                # Count congestion levels
+                congestion_counts = {
+                    'High': len([s for s in traffic_segments if s['congestion_level'] == 'High']),
+                    'Medium': len([s for s in traffic_segments if s['congestion_level'] == 'Medium']),
+                    'Low': len([s for s in traffic_segments if s['congestion_level'] == 'Low'])
+                }
             
-            # Calculate ETA
-            base_duration_minutes = route_data['duration'] / 60
-            total_estimated_minutes = base_duration_minutes + max(0, total_delay_minutes)
-            eta = datetime.now() + timedelta(minutes=int(total_estimated_minutes))
-            
-            optimized_route = {
-                'geometry': route_data['geometry'],
-                'distance': route_data['distance'],
-                'duration': route_data['duration'],
-                'traffic_segments': traffic_segments,
-                'eta': eta.isoformat(),
-                'traffic_conditions': {
-                    'summary': traffic_summary,
-                    'delay_minutes': max(0, int(total_delay_minutes))
-                },
-                'stops': [
-                    {
-                        'number': i + 1,
-                        'name': dest.get('name', f'Stop {i+1}'),
-                        'coordinates': {
-                            'lat': dest['lat'],
-                            'lon': dest['lon']
+                total_segments = len(traffic_segments)
+                traffic_summary = (
+                    f"{(congestion_counts['Low']/total_segments*100):.0f}% Clear, "
+                    f"{(congestion_counts['Medium']/total_segments*100):.0f}% Moderate, "
+                    f"{(congestion_counts['High']/total_segments*100):.0f}% Heavy"
+                ) if total_segments else "No live traffic data"
+            
+                # Per-stop arrivals line up with legs when the router returned one per stop
+                stop_etas = arrivals if len(arrivals) == len(destinations) else [None] * len(destinations)
+                eta = departure + timedelta(seconds=travel_seconds)
+            
+                optimized_route = {
+                    'geometry': route_data['geometry'],
+                    'distance': route_data['distance'],
+                    'duration': route_data['duration'],
+                    'duration_in_traffic': travel_seconds,
+                    'legs': [
+                        {'distance': leg['distance'], 'duration': leg['duration']}
+                        for leg in route_data.get('legs', [])
+                    ],
+                    'traffic_segments': traffic_segments,
+                    'departure_time': departure.isoformat(),
+                    'eta': eta.isoformat(),
+                    'traffic_conditions': {
+                        'summary': traffic_summary,
+                        'delay_minutes': max(0, int(total_delay_minutes))
+                    },
+                    'stops': [
+                        {
+                            'number': i + 1,
+                            'name': dest.get('name', f'Stop {i+1}'),
+                            'coordinates': {
+                                'lat': dest['lat'],
+                                'lon': dest['lon']
+                            },
+                            'eta': (
+                                (departure + timedelta(seconds=float(arrival))).isoformat()
+                                if arrival is not None else None
+                            )
                         }
-                    }
-                    for i, dest in enumerate(destinations)
-                ]
-            }
+                        for i, (dest, arrival) in enumerate(zip(destinations, stop_etas))
+                    ]
+                }
+                if estimates:
+                    optimized_route['estimates'] = estimates
             
             logger.info("Route optimization completed")
             return optimized_route
@@ -162,6 +315,26 @@ class RouteOptimizer:
             logger.error(f"Route optimization failed: {str(e)}")
             raise
 
+    def departure_etas(self, route: Dict, departures: List[datetime]) -> List[Dict]:
+        """Typical trip duration and arrival for each departure, from speed profiles alone.
+
+        Departures should share one UTC offset, e.g. a sweep from one start time.
+        """
+        from .eta import RouteTimeline
+        timeline = RouteTimeline(route, self.speed_profiles)
+        durations = timeline.times(
+            [departure.timestamp() for departure in departures],
+            departures[0].utcoffset().total_seconds()
+        )[:, -1]
+        return [
+            {
+                'departure_time': departure.isoformat(),
+                'eta': (departure + timedelta(seconds=float(duration))).isoformat(),
+                'duration_in_traffic': float(duration)
+            }
+            for departure, duration in zip(departures, durations)
+        ]
+
     async def get_route_update(self, route_id: str, current_route: Dict) -> Dict:
         """Get updated route information with current traffic conditions"""
         try:
@@ -189,30 +362,28 @@ class RouteOptimizer:
             logger.error(f"Route update failed: {str(e)}")
             raise
 
-    async def check_route_conditions(self, current_route: Dict) -> Dict:
+    async def check_route_conditions(self, current_route: Dict,
+                                     sample_points: Optional[List[tuple]] = None) -> Dict:
         """Enhanced check for current route conditions"""
         try:
-            coordinates = current_route['geometry']['coordinates']
             traffic_alerts = []
             needs_rerouting = False
-            
-            # Check traffic conditions for route segments
-            for coord in coordinates[::len(coordinates)//10]:  # Sample 10 points along route
-                traffic = await self.get_traffic_data(coord[1], coord[0])
-                
-                if traffic['congestion_level'] == 'High':
-                    traffic_alerts.append({
-                        'coordinates': {'lat': coord[1], 'lon': coord[0]},
-                        'severity': 'High',
-                        'message': f"Heavy traffic detected: {traffic['current_speed']} km/h"
-                    })
-                    needs_rerouting = True
-                elif traffic['congestion_level'] == 'Medium':
-                    traffic_alerts.append({
-                        'coordinates': {'lat': coord[1], 'lon': coord[0]},
-                        'severity': 'Medium',
-                        'message': f"Moderate traffic: {traffic['current_speed']} km/h"
-                    })
+            if sample_points is None:
+                sample_points = route_sample_points(current_route['geometry']['coordinates'])
+            
+            # Check traffic conditions for route segments; no alerts while traffic is unavailable
+            try:
+                sample_traffic = await self.get_traffic_batch(sample_points)
+            except Exception as e:
+                if not upstream_failed(e):
+                    raise
+                UPSTREAM_FALLBACKS.inc('traffic', 'none')
+                sample_traffic = []
+            for (lat, lon), traffic in zip(sample_points, sample_traffic):
+                alert = traffic_alert(lat, lon, traffic)
+                if alert:
+                    traffic_alerts.append(alert)
+                    needs_rerouting = needs_rerouting or alert['severity'] == 'High'
             
             return {
                 'needs_rerouting': needs_rerouting,
@@ -225,38 +396,66 @@ class RouteOptimizer:
 
     async def calculate_alternative_route(self, current_route: Dict, 
                                        current_position: Dict,
-                                       destination: Dict) -> Dict:
+                                       destination: Dict,
+                                       traffic_alerts: Optional[List[Dict]] = None,
+                                       via: Optional[List[Dict]] = None) -> Dict:
         """Calculate alternative route avoiding congested areas"""
         try:
-            # Get congested coordinates from current route
-            congested_areas = [
-                alert['coordinates'] 
-                for alert in (await self.check_route_conditions(current_route))['traffic_alerts']
+            # Get congested coordinates from current route unless the caller just checked
+            if traffic_alerts is None:
+                traffic_alerts = (await self.check_route_conditions(current_route))['traffic_alerts']
+            congested_areas = [alert['coordinates'] for alert in traffic_alerts]
+            
+            # Ask for alternatives and rank them by how much they drive through congestion
+            from .geometry import RouteSpatialIndex
+            via = via or []
+            waypoints = [current_position] + via + [destination]
+            candidates = []
+            routes = await self.get_osm_routes(waypoints, alternatives=True)
+            with timed("rank"):
+                for route in routes:
+                    index = RouteSpatialIndex(route['geometry']['coordinates'])
+                    congested_distance = index.length_near(congested_areas, CONGESTION_RADIUS)
+                    candidates.append((congested_distance, route['duration'], route))
+            
+            acceptable = [
+                c for c in candidates
+                if c[0] <= MAX_CONGESTED_SHARE * max(c[2]['distance'], 1)
             ]
+            if acceptable:
+                # Fastest of the routes that mostly avoid congestion
+                congested_distance, _, best_route = min(acceptable, key=lambda c: c[1])
+            else:
+                # Nothing avoids it, so take the least congested
+                congested_distance, _, best_route = min(candidates, key=lambda c: (c[0], c[1]))
+            logger.info(
+                f"Picked alternative with {congested_distance:.0f}m near congestion "
+                f"out of {len(candidates)} candidates"
+            )
             
-            # Calculate new route avoiding congested areas
-            waypoints = [current_position, destination]
-            new_route = await self.get_osm_route(waypoints)
-            
-            # Verify new route doesn't pass through congested areas
-            for area in congested_areas:
-                # Add some buffer around congested areas
-                buffer_distance = 0.01  # roughly 1km
-                if any(
-                    abs(coord[1] - area['lat']) < buffer_distance and 
-                    abs(coord[0] - area['lon']) < buffer_distance 
-                    for coord in new_route['geometry']['coordinates']
-                ):
-                    continue  # Try another variation if needed
-            
-            return await self.optimize_route(current_position, [destination])
+            alternative = await self.optimize_route(current_position, via + [destination], route_data=best_route)
+            alternative['congested_distance'] = congested_distance
+            return alternative
             
         except Exception as e:
             logger.error(f"Alternative route calculation failed: {str(e)}")
             raise
 
-    async def optimize_multi_point_delivery(self, user_id: str, routes: List[Dict]) -> Dict:
-        """Optimize multiple deliveries for the same user using TSP"""
+    async def optimize_multi_point_delivery(self, user_id: str, routes: List[Dict],
+                                            time_budget: Optional[float] = None,
+                                            quality: str = 'balanced',
+                                            seed: Optional[int] = None,
+                                            departure_time: Optional[str] = None,
+                                            on_progress: Optional[ProgressCallback] = None,
+                                            cancelled: Optional[Callable[[], bool]] = None,
+                                            run_solver: SolverRunner = run_solver_inline) -> Dict:
+        """Optimize multiple deliveries for the same user using TSP.
+
+        on_progress receives each stage and every improved stop order; the
+        solve stops early with the best order so far once cancelled() is True.
+        Upstream calls happen here; only the solve itself goes to run_solver.
+        """
+        report = on_progress or (lambda stage, detail: None)
         try:
             logger.info(f"Starting multi-point optimization for user {user_id}")
             
@@ -285,32 +484,37 @@ class RouteOptimizer:
                     'stop_number': i
                 })
 
-            # Calculate distance matrix
-            n = len(all_points)
-            distance_matrix = np.zeros((n, n))
-            
-            for i in range(n):
-                for j in range(n):
-                    if i != j:
-                        route_data = await self.get_osm_route([all_points[i], all_points[j]])
-                        distance_matrix[i][j] = route_data['distance']
+            # Calculate distance matrix in as few table requests as possible; very
+            # large tours only get road distances between nearby points
+            sparse = len(all_points) >= self.sparse_threshold
+            report('matrix', {'points': len(all_points), 'sparse': sparse})
+            if sparse:
+                matrix = await self.get_sparse_matrix(all_points)
+            else:
+                matrix = await self.get_matrix(all_points)
+
+            def on_improvement(order: List[int], cost: float):
+                report('solve', {
+                    'objective': float(cost),
+                    'route_order': [all_points[i].get('route_id') for i in order[1:]]
+                })
 
             # Solve TSP
-            best_distance = float('inf')
-            best_order = None
-            
-            for perm in permutations(range(1, n)):
-                order = (0,) + perm  # Add depot (0) as first point
-                distance = sum(distance_matrix[order[i]][order[i+1]] for i in range(n-1))
-                distance += distance_matrix[order[-1]][0]  # Return to depot
-                
-                if distance < best_distance:
-                    best_distance = distance
-                    best_order = order
+            with timed("solve"):
+                if sparse:
+                    solve = partial(solve_candidate_tsp, matrix, 'distances',
+                                    time_budget=time_budget, quality=quality, seed=seed)
+                else:
+                    solve = partial(solve_tsp, matrix.distances, time_budget=time_budget, quality=quality, seed=seed)
+                solution = await run_solver(solve, on_improvement=on_improvement, cancelled=cancelled)
+            best_order = solution['order']
+            best_distance = solution['objective']
 
             # Get optimized route with traffic data
+            report('route', {'objective': best_distance})
             optimized_points = [all_points[i] for i in best_order]
-            optimized_route = await self.optimize_route(depot, optimized_points[1:])
+            optimized_route = await self.optimize_route(depot, optimized_points[1:],
+                                                        departure_time=departure_time)
             
             # Add stop information to the response
             optimized_route['stops'] = [
@@ -332,6 +536,15 @@ class RouteOptimizer:
             optimized_route['route_order'] = [
                 all_points[i].get('route_id') for i in best_order[1:]
             ]
+            optimized_route['solver'] = solution['solver']
+            optimized_route['objective'] = solution['objective']
+            optimized_route['solve_time'] = solution['solve_time']
+            if 'seed' in solution:
+                optimized_route['seed'] = solution['seed']
+            if sparse:
+                optimized_route['candidates'] = int(matrix.neighbors.shape[1])
+            if matrix.estimated:
+                optimized_route.setdefault('estimates', {})['matrix'] = 'haversine'
             
             logger.info(f"Multi-point optimization completed for user {user_id}")
             return optimized_route
@@ -340,32 +553,135 @@ class RouteOptimizer:
             logger.error(f"Multi-point delivery optimization failed: {str(e)}")
             raise
 
-    async def get_live_updates(self, route_id: str, current_position: Dict) -> Dict:
-        """Get live updates including traffic and rerouting suggestions"""
+    async def optimize_fleet(self, vehicles: List[Dict], orders: List[Dict],
+                             time_budget: Optional[float] = None,
+                             on_progress: Optional[ProgressCallback] = None,
+                             cancelled: Optional[Callable[[], bool]] = None,
+                             run_solver: SolverRunner = run_solver_inline) -> Dict:
+        """Split orders across vehicles with capacities, shifts and time windows"""
+        report = on_progress or (lambda stage, detail: None)
+        try:
+            logger.info(f"Starting fleet optimization for {len(vehicles)} vehicles and {len(orders)} orders")
+
+            # Build one shared matrix over every depot and order location
+            points = []
+            index = {}
+
+            def node_for(location: Dict) -> int:
+                key = (location['lat'], location['lon'])
+                if key not in index:
+                    index[key] = len(points)
+                    points.append(location)
+                return index[key]
+
+            solver_vehicles = [{
+                'start': node_for(vehicle['start_depot']),
+                'end': node_for(vehicle.get('end_depot') or vehicle['start_depot']),
+                'capacity': vehicle['capacity'],
+                'shift_start': vehicle['shift_start'],
+                'shift_end': vehicle['shift_end']
+            } for vehicle in vehicles]
+            solver_orders = [{
+                'node': node_for(order['location']),
+                'demand': order['demand'],
+                'service_time': order['service_time'],
+                'tw_start': order.get('time_window_start') if order.get('time_window_start') is not None else 0,
+                'tw_end': order.get('time_window_end') if order.get('time_window_end') is not None else float('inf')
+            } for order in orders]
+
+            report('matrix', {'points': len(points)})
+            matrix = await self.get_matrix(points)
+            report('solve', {})
+            with timed("solve"):
+                solution = await run_solver(partial(
+                    solve_vrp,
+                    matrix.durations, matrix.distances,
+                    solver_vehicles, solver_orders,
+                    time_budget=time_budget
+                ), cancelled=cancelled)
+            report('route', {'objective': solution['total_duration']})
+
+            routes = []
+            for vehicle, route in zip(vehicles, solution['routes']):
+                routes.append({
+                    'vehicle_id': vehicle['id'],
+                    'stops': [
+                        {
+                            'order_id': orders[k]['id'],
+                            'name': orders[k]['location'].get('name'),
+                            'coordinates': {
+                                'lat': orders[k]['location']['lat'],
+                                'lon': orders[k]['location']['lon']
+                            },
+                            'service_start': start
+                        }
+                        for k, start in zip(route['orders'], route['service_starts'])
+                    ],
+                    'load': route['load'],
+                    'duration': route['duration'],
+                    'distance': route['distance']
+                })
+
+            logger.info(f"Fleet optimization completed in {solution['solve_time']:.2f}s")
+            result = {
+                'routes': routes,
+                'unassigned_orders': [orders[k]['id'] for k in solution['unassigned']],
+                'total_duration': solution['total_duration'],
+                'total_distance': solution['total_distance'],
+                'solve_time': solution['solve_time']
+            }
+            if matrix.estimated:
+                result['estimates'] = {'matrix': 'haversine'}
+            return result
+
+        except Exception as e:
+            logger.error(f"Fleet optimization failed: {str(e)}")
+            raise
+
+    async def get_live_updates(self, route_id: str, current_position: Dict, route: Dict,
+                               progress=None) -> Dict:
+        """Get live updates including traffic and rerouting suggestions for an optimized route.
+
+        With a RouteProgress tracker only the part of the route still ahead of
+        the vehicle is checked, and rerouting keeps the stops not yet served.
+        """
         try:
             logger.info(f"Checking updates at {datetime.now().strftime('%H:%M:%S')} for route {route_id}")
             
-            # Get stored route data
-            route = routes_store[int(route_id)]
+            remaining_stops = route['stops']
+            sample_points = None
+            summary = None
+            if progress is not None:
+                summary = progress.update(current_position)
+                remaining_stops = progress.remaining_stops()
+                sample_points = progress.remaining_samples()
             
             # Get current route conditions
-            conditions = await self.check_route_conditions(route)
+            conditions = await self.check_route_conditions(route, sample_points)
             
             response = {
                 'route_id': route_id,
                 'current_position': current_position,
                 'traffic_alerts': conditions['traffic_alerts'],
-                'needs_rerouting': conditions['needs_rerouting'],
+                'needs_rerouting': conditions['needs_rerouting'] and bool(remaining_stops),
                 'timestamp': datetime.now().isoformat()
             }
+            if summary is not None:
+                response['progress'] = summary
+                response['eta'] = (datetime.now() + timedelta(seconds=summary['remaining_duration'])).isoformat()
             
             # Calculate alternative route if needed
-            if conditions['needs_rerouting']:
+            if response['needs_rerouting']:
                 logger.info(f"Rerouting needed for route {route_id}")
                 alternative_route = await self.calculate_alternative_route(
                     route,
                     current_position,
-                    route['destinations'][-1]
+                    remaining_stops[-1]['coordinates'],
+                    traffic_alerts=conditions['traffic_alerts'],
+                    via=[
+                        {**stop['coordinates'], 'name': stop.get('name')}
+                        for stop in remaining_stops[:-1]
+                    ]
                 )
                 response['alternative_route'] = alternative_route
             
@@ -0,0 +1,174 @@
+from typing import Any, Dict, List, Optional
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from .geometry import decode_polyline, encode_polyline, route_coordinates
+from .serialization import dumps, loads
+
+logger = logging.getLogger(__name__)
+
+# Geometries are stored as polyline6 strings: ~0.1m precision at a fraction of the JSON size
+GEOMETRY_PRECISION = 6
+
+def _pack_geometries(value: Any) -> Any:
+    """Replace GeoJSON LineString coordinates with polyline strings, recursively"""
+    if isinstance(value, dict):
+        packed = {}
+        for key, item in value.items():
+            if key == 'geometry' and isinstance(item, dict) and 'coordinates' in item:
+                packed[key] = {
+                    'type': item.get('type', 'LineString'),
+                    'polyline6': encode_polyline(item['coordinates'], GEOMETRY_PRECISION)
+                }
+            else:
+                packed[key] = _pack_geometries(item)
+        return packed
+    if isinstance(value, list):
+        return [_pack_geometries(item) for item in value]
+    return value
+
+def _unpack_geometries(value: Any) -> Any:
+    if isinstance(value, dict):
+        if 'polyline6' in value:
+            coordinates = decode_polyline(value['polyline6'], GEOMETRY_PRECISION)
+            return {'type': value['type'], 'coordinates': route_coordinates(coordinates)}
+        return {key: _unpack_geometries(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_unpack_geometries(item) for item in value]
+    return value
+
+def encode_record(value: Optional[Dict]) -> Optional[bytes]:
+    if value is None:
+        return None
+    return zlib.compress(dumps(_pack_geometries(value)))
+
+def decode_record(blob: Optional[bytes]) -> Optional[Dict]:
+    if blob is None:
+        return None
+    return _unpack_geometries(loads(zlib.decompress(blob)))
+
+class RouteStore:
+    """Routes and their optimized results in an SQLite database.
+
+    The database runs in WAL mode so several worker processes can share one
+    file: readers never block the writer and IDs are allocated atomically by
+    SQLite. Routes are indexed by ID, by user and by creation time.
+    """
+
+    def __init__(self, path: str = "routes.db"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS routes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                request BLOB,
+                result BLOB
+            );
+            CREATE INDEX IF NOT EXISTS routes_user_created ON routes (user_id, created_at);
+            CREATE INDEX IF NOT EXISTS routes_created ON routes (created_at);
+        """)
+        self._conn.commit()
+
+    def create(self, request: Optional[Dict] = None, result: Optional[Dict] = None,
+               user_id: Optional[str] = None) -> int:
+        """Store a route and return its newly allocated ID"""
+        now = time.time()
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "INSERT INTO routes (user_id, created_at, updated_at, request, result) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (user_id, now, now, encode_record(request), encode_record(result))
+            )
+        return cursor.lastrowid
+
+    def get(self, route_id: int) -> Optional[Dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, user_id, created_at, updated_at, request, result "
+                "FROM routes WHERE id = ?", (route_id,)
+            ).fetchone()
+        return self._to_record(row) if row else None
+
+    def updated_at(self, route_id: int) -> Optional[float]:
+        """When the route was last written, without loading its bodies"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT updated_at FROM routes WHERE id = ?", (route_id,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_result(self, route_id: int, result: Dict, expected_updated_at: Optional[float] = None) -> bool:
+        return self._update(route_id, {'result': result}, expected_updated_at)
+
+    def update(self, route_id: int, request: Dict, result: Dict,
+               expected_updated_at: Optional[float] = None) -> bool:
+        """Replace the request and result together, e.g. after editing a route's stops"""
+        return self._update(route_id, {'request': request, 'result': result}, expected_updated_at)
+
+    def _update(self, route_id: int, fields: Dict[str, Dict], expected_updated_at: Optional[float]) -> bool:
+        # With expected_updated_at the write only happens if nobody wrote the route
+        # since it was read; returns whether a row was written
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        params = [encode_record(value) for value in fields.values()] + [time.time(), route_id]
+        condition = ""
+        if expected_updated_at is not None:
+            condition = " AND updated_at = ?"
+            params.append(expected_updated_at)
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                f"UPDATE routes SET {assignments}, updated_at = ? WHERE id = ?{condition}", params
+            )
+        return cursor.rowcount > 0
+
+    def list_routes(self, user_id: Optional[str] = None,
+                    since: Optional[float] = None, until: Optional[float] = None,
+                    limit: int = 100) -> List[Dict]:
+        """Route summaries, newest first, without the stored request/result bodies"""
+        clauses, params = [], []
+        if user_id is not None:
+            clauses.append("user_id = ?")
+            params.append(user_id)
+        if since is not None:
+            clauses.append("created_at >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("created_at < ?")
+            params.append(until)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT id, user_id, created_at, updated_at, result IS NOT NULL FROM routes "
+                f"{where} ORDER BY created_at DESC LIMIT ?", (*params, limit)
+            ).fetchall()
+        return [
+            {'id': row[0], 'user_id': row[1], 'created_at': row[2],
+             'updated_at': row[3], 'optimized': bool(row[4])}
+            for row in rows
+        ]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    @staticmethod
+    def _to_record(row) -> Dict:
+        return {
+            'id': row[0],
+            'user_id': row[1],
+            'created_at': row[2],
+            'updated_at': row[3],
+            'request': decode_record(row[4]),
+            'result': decode_record(row[5])
+        }
+
+def open_route_store() -> RouteStore:
+    return RouteStore(os.getenv("ROUTE_STORE_PATH", "routes.db"))
@@ -0,0 +1,108 @@
+from typing import Dict, List, Optional
+import asyncio
+import logging
+import os
+from .distance_matrix import DETOUR_FACTOR, ESTIMATE_SPEED, MatrixBackend, OSRMMatrixBackend
+from .geometry import haversine, route_coordinates
+from .http_client import HTTPClient
+from .serialization import loads
+
+logger = logging.getLogger(__name__)
+
+class RoutingBackend(MatrixBackend):
+    """Interface for engines that route between waypoints and build duration/distance matrices.
+
+    Routes are dicts with a GeoJSON LineString 'geometry' in [lon, lat],
+    'distance' in metres, 'duration' in seconds and per-leg 'legs', as
+    returned by OSRM's route service.
+    """
+
+    name = "base"
+
+    async def get_routes(self, waypoints: List[Dict], alternatives: bool = False) -> List[Dict]:
+        """Best route through the waypoints in order, plus alternatives if asked for"""
+        raise NotImplementedError
+
+    async def warm_up(self, points: List[Dict]):
+        """Prepare for requests around these points; optional"""
+
+class OSRMRoutingBackend(OSRMMatrixBackend, RoutingBackend):
+    """Routes and tables from an OSRM server"""
+
+    name = "osrm"
+
+    def __init__(self, base_url: str = "http://router.project-osrm.org",
+                 profile: str = "driving",
+                 max_table_size: int = 100,
+                 http_client: Optional[HTTPClient] = None):
+        super().__init__(base_url, profile, max_table_size, http_client)
+        self.base_url = base_url
+        self.profile = profile
+        self.route_url = f"{base_url}/route/v1/{profile}"
+
+    async def get_routes(self, waypoints: List[Dict], alternatives: bool = False) -> List[Dict]:
+        try:
+            coordinates = ";".join([f"{point['lon']},{point['lat']}" for point in waypoints])
+            url = f"{self.route_url}/{coordinates}"
+            params = {
+                'overview': 'full',
+                'geometries': 'geojson',
+                'steps': 'true'
+            }
+            if alternatives:
+                params['alternatives'] = 'true'
+
+            logger.debug(f"Requesting route from OSRM with URL: {url}")
+            response = await self.http_client.get(url, params=params)
+            response.raise_for_status()
+
+            route_data = loads(response.content)
+            if 'routes' not in route_data or not route_data['routes']:
+                raise ValueError("No route found in OSRM response")
+            for route in route_data['routes']:
+                route['geometry']['coordinates'] = route_coordinates(route['geometry']['coordinates'])
+            return route_data['routes']
+
+        except Exception as e:
+            logger.error(f"OSRM route calculation failed: {str(e)}")
+            raise
+
+    async def warm_up(self, points: List[Dict]):
+        # Cheap requests that leave pooled connections open to the server
+        async def nearest(point: Dict):
+            url = f"{self.base_url}/nearest/v1/{self.profile}/{point['lon']},{point['lat']}"
+            response = await self.http_client.get(url)
+            response.raise_for_status()
+
+        await asyncio.gather(*[nearest(point) for point in points])
+
+def estimate_route(waypoints: List[Dict]) -> Dict:
+    """Straight lines between the waypoints, in the shape of a backend route.
+
+    Leg distances are haversine times DETOUR_FACTOR and durations assume
+    ESTIMATE_SPEED; 'estimate' marks the route as not coming from a router.
+    """
+    lat = [point['lat'] for point in waypoints]
+    lon = [point['lon'] for point in waypoints]
+    distances = haversine(lat[:-1], lon[:-1], lat[1:], lon[1:]) * DETOUR_FACTOR
+    legs = [{'distance': float(d), 'duration': float(d / ESTIMATE_SPEED), 'steps': []} for d in distances]
+    return {
+        'geometry': {'type': 'LineString', 'coordinates': route_coordinates(waypoints)},
+        'distance': sum(leg['distance'] for leg in legs),
+        'duration': sum(leg['duration'] for leg in legs),
+        'legs': legs,
+        'estimate': 'haversine'
+    }
+
+def create_routing_backend(http_client: Optional[HTTPClient] = None) -> RoutingBackend:
+    """Backend chosen by ROUTING_BACKEND: "osrm" (OSRM_URL) or "local" (LOCAL_GRAPH_PATH)"""
+    name = os.getenv("ROUTING_BACKEND", "osrm")
+    if name == "osrm":
+        return OSRMRoutingBackend(
+            os.getenv("OSRM_URL", "http://router.project-osrm.org"),
+            http_client=http_client
+        )
+    if name == "local":
+        from .local_router import LocalRoutingBackend, RoadGraph
+        return LocalRoutingBackend(RoadGraph.load(os.getenv("LOCAL_GRAPH_PATH", "graph")))
+    raise ValueError(f"Unknown routing backend: {name}")
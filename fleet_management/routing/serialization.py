@@ -0,0 +1,46 @@
+from typing import Any
+import json
+import logging
+from fastapi.responses import JSONResponse
+from .metrics import timed
+
+logger = logging.getLogger(__name__)
+
+# orjson encodes several times faster than json and writes NumPy arrays
+# directly; without it we fall back to json and convert arrays to lists
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def _to_builtin(value: Any) -> Any:
+    # NumPy arrays and scalars
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def dumps(value: Any) -> bytes:
+    """Compact UTF-8 JSON; NumPy arrays are written as nested lists"""
+    if orjson is not None:
+        return orjson.dumps(value, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(value, separators=(',', ':'), default=_to_builtin).encode()
+
+def dumps_text(value: Any) -> str:
+    """JSON as str, e.g. for WebSocket text frames"""
+    return dumps(value).decode()
+
+def loads(data) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+class FastJSONResponse(JSONResponse):
+    """JSON response encoded with dumps(), recording the time as the serialize stage.
+
+    Handlers that return one directly also skip FastAPI's jsonable_encoder
+    pass, which walks every coordinate of a route geometry in Python.
+    """
+
+    def render(self, content: Any) -> bytes:
+        with timed("serialize"):
+            return dumps(content)
@@ -0,0 +1,377 @@
+from datetime import timedelta
+from typing import Dict, List, Optional, Set, Tuple
+import asyncio
+import logging
+import numpy as np
+from .distance_matrix import estimate_od_matrix
+from .eta import parse_departure_time
+from .geometry import haversine
+from .metrics import UPSTREAM_FALLBACKS, timed
+from .resilience import upstream_failed
+from .route_optimizer import RouteOptimizer
+from .route_store import RouteStore
+from .tsp_solver import UNREACHABLE_COST, solve_tsp
+
+logger = logging.getLogger(__name__)
+
+# Stops closest to a new one in a straight line; the legs on either side of them are tried
+INSERTION_CANDIDATES = 8
+# Stops on either side of an edit that are re-ordered afterwards. With the two fixed
+# ends that is at most 11 points, which solve_tsp still solves exactly in milliseconds.
+REOPTIMIZE_WINDOW = 4
+# Tries at saving an edit before giving up on a route that keeps changing
+EDIT_ATTEMPTS = 3
+# Parts of a route that a full re-routing replaces; stop details and metadata are kept
+ROUTED_FIELDS = ('geometry', 'distance', 'duration', 'duration_in_traffic', 'legs', 'traffic_segments',
+                 'departure_time', 'eta', 'traffic_conditions')
+
+class StopNotFound(LookupError):
+    pass
+
+class EditConflict(Exception):
+    """The stored route changed between reading and saving an edit"""
+
+def point_key(point: Dict) -> str:
+    return f"{point['lon']:.5f},{point['lat']:.5f}"
+
+class MatrixRows:
+    """Road durations and distances between points, cached one origin row at a time.
+
+    Rows are kept in the route cache under the origin's coordinates, so legs
+    fetched for one edit are reused by later edits of any route. Missing
+    cells are fetched with a single origin-destination request and
+    estimated from straight lines when the upstream fails.
+    """
+
+    def __init__(self, optimizer: RouteOptimizer):
+        self.backend = optimizer.matrix_backend
+        self.cache = optimizer.route_cache
+        self.rows: Dict[str, Dict[str, List[float]]] = {}
+        self.estimated = False
+
+    def _cache_key(self, point: Dict) -> str:
+        return self.cache.make_key([point], {'matrix_row': self.backend.name})
+
+    def _row(self, point: Dict) -> Dict[str, List[float]]:
+        return self.rows.setdefault(point_key(point), {})
+
+    async def fetch(self, pairs: List[Tuple[Dict, Dict]]):
+        """Make sure the cost of every (origin, destination) pair is known"""
+        for origin, _ in pairs:
+            key = point_key(origin)
+            if key not in self.rows:
+                # Cached values are shared, so extend a copy
+                self.rows[key] = dict(await self.cache.get_async(self._cache_key(origin)) or {})
+
+        origins: Dict[str, Dict] = {}
+        destinations: Dict[str, Dict] = {}
+        for origin, destination in pairs:
+            if point_key(destination) not in self._row(origin):
+                origins.setdefault(point_key(origin), origin)
+                destinations.setdefault(point_key(destination), destination)
+        if not origins:
+            return
+
+        origins_list, destinations_list = list(origins.values()), list(destinations.values())
+        with timed("matrix"):
+            try:
+                matrix = await self.backend.get_od_matrix(origins_list, destinations_list)
+            except Exception as e:
+                if not upstream_failed(e):
+                    raise
+                logger.warning(f"Estimating {len(origins_list)}x{len(destinations_list)} legs: {str(e)}")
+                UPSTREAM_FALLBACKS.inc('matrix', 'haversine')
+                matrix = estimate_od_matrix(origins_list, destinations_list)
+        self.estimated = self.estimated or matrix.estimated
+        durations = np.minimum(matrix.durations, UNREACHABLE_COST)
+        distances = np.minimum(matrix.distances, UNREACHABLE_COST)
+        for i, origin in enumerate(origins_list):
+            row = self._row(origin)
+            for j, destination in enumerate(destinations_list):
+                row[point_key(destination)] = [float(durations[i, j]), float(distances[i, j])]
+            if not matrix.estimated:
+                self.cache.set(self._cache_key(origin), row)
+
+    def duration(self, origin: Dict, destination: Dict) -> float:
+        return self._row(origin)[point_key(destination)][0]
+
+    def distance(self, origin: Dict, destination: Dict) -> float:
+        return self._row(origin)[point_key(destination)][1]
+
+def stored_depot(request: Dict) -> Dict:
+    """Depot of a route stored by /set-route or /optimize-multi-point"""
+    if request.get('depot'):
+        return request['depot']
+    lat, lon = map(float, request['routes'][0]['startPoint'].split())
+    return {'lat': lat, 'lon': lon, 'name': 'Depot'}
+
+def edited_request(request: Dict, stops: List[Dict], depot: Dict) -> Dict:
+    """The stored request with the edited stops, so optimizing it again keeps the edits"""
+    if 'destinations' in request:
+        return {**request, 'destinations': [{**stop['coordinates'], 'name': stop.get('name')} for stop in stops]}
+    if 'routes' in request:
+        routes_by_id = {route['id']: route for route in request['routes']}
+        routes = []
+        for stop in stops:
+            route = routes_by_id.get(stop.get('route_id'))
+            if route is None:
+                route = {
+                    'id': stop.get('route_id') or f"stop-{stop['number']}",
+                    'name': stop.get('name'),
+                    'startPoint': f"{depot['lat']} {depot['lon']}",
+                    'endPoint': f"{stop['coordinates']['lat']} {stop['coordinates']['lon']}"
+                }
+            routes.append(route)
+        return {**request, 'routes': routes}
+    return request
+
+class StopEditor:
+    """Adds and removes stops on stored optimized routes without solving them again.
+
+    A new stop goes where it adds the least distance among the legs next to
+    its nearest stops, so only its costs to those stops are fetched. The
+    stops within `window` places of an edit are then re-ordered exactly.
+    Legs and ETAs are updated from the cached matrix rows at once, and the
+    route's geometry and traffic-aware ETAs are recomputed in the
+    background; until then the route is marked 'geometry_stale'.
+    """
+
+    def __init__(self, optimizer: RouteOptimizer, store: Optional[RouteStore], live_updates=None,
+                 candidates: int = INSERTION_CANDIDATES, window: int = REOPTIMIZE_WINDOW):
+        self.optimizer = optimizer
+        self.store = store
+        self.live_updates = live_updates
+        self.candidates = candidates
+        self.window = window
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._pending: Set[int] = set()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def insert(self, route: Dict, depot: Dict, stop: Dict, position: Optional[int] = None) -> Dict:
+        """The route with `stop` added at `position` in the stop order, or where it costs least.
+
+        Stops around a cheapest insertion are re-ordered; a given position is kept as asked.
+        """
+        stops = route['stops']
+        points = [depot] + [s['coordinates'] for s in stops]
+        point = {'lat': float(stop['lat']), 'lon': float(stop['lon'])}
+        rows = MatrixRows(self.optimizer)
+        legs = self._legs_by_pair(route, points)
+
+        if position is not None:
+            if not 0 <= position <= len(stops):
+                raise ValueError(f"Position must be between 0 and {len(stops)}")
+            after = position
+            await rows.fetch([(points[after], point)] + ([(point, points[after + 1])] if after < len(stops) else []))
+        else:
+            # Insert after one of these path indices: a nearby stop or the one before it
+            straight = haversine(point['lat'], point['lon'],
+                                 np.array([p['lat'] for p in points]), np.array([p['lon'] for p in points]))
+            nearest = np.argsort(straight)[:self.candidates]
+            positions = sorted({int(i) for index in nearest for i in (index - 1, index) if i >= 0})
+            await rows.fetch([(points[i], point) for i in positions]
+                             + [(point, points[i + 1]) for i in positions if i + 1 < len(points)])
+
+            def added(i: int) -> float:
+                if i + 1 == len(points):
+                    return rows.distance(points[i], point)
+                return (rows.distance(points[i], point) + rows.distance(point, points[i + 1])
+                        - legs[(point_key(points[i]), point_key(points[i + 1]))]['distance'])
+
+            after = min(positions, key=added)
+
+        number = max((s.get('number') or 0 for s in stops), default=0) + 1
+        new_stop = {
+            'number': number,
+            'name': stop.get('name') or f"Stop {number}",
+            'coordinates': point
+        }
+        if stop.get('route_id') is not None:
+            new_stop['route_id'] = stop['route_id']
+        new_stops = stops[:after] + [new_stop] + stops[after:]
+        if position is None:
+            new_stops = await self._reoptimize(rows, depot, new_stops, after + 1)
+        return await self._rebuild(route, depot, new_stops, rows, legs)
+
+    async def remove(self, route: Dict, depot: Dict, number: int) -> Dict:
+        """The route without the stop numbered `number`, with the stops around the gap re-ordered"""
+        stops = route['stops']
+        index = next((i for i, s in enumerate(stops) if s.get('number') == number), None)
+        if index is None:
+            raise StopNotFound(f"Route has no stop {number}")
+        if len(stops) == 1:
+            raise ValueError("Cannot remove the only stop of a route")
+        points = [depot] + [s['coordinates'] for s in stops]
+        rows = MatrixRows(self.optimizer)
+        new_stops = stops[:index] + stops[index + 1:]
+        new_stops = await self._reoptimize(rows, depot, new_stops, index + 1)
+        return await self._rebuild(route, depot, new_stops, rows, self._legs_by_pair(route, points))
+
+    def _legs_by_pair(self, route: Dict, points: List[Dict]) -> Dict[Tuple[str, str], Dict]:
+        legs = route.get('legs', [])
+        if len(legs) != len(points) - 1:
+            raise ValueError("Stored route has no leg per stop; optimize it again before editing")
+        return {(point_key(a), point_key(b)): leg for a, b, leg in zip(points[:-1], points[1:], legs)}
+
+    async def _reoptimize(self, rows: MatrixRows, depot: Dict, stops: List[Dict], center: int) -> List[Dict]:
+        """Stops with those within `window` places of path index `center` in their best order"""
+        points = [depot] + [s['coordinates'] for s in stops]
+        lo, hi = max(1, center - self.window), min(len(points) - 1, center + self.window)
+        if hi <= lo:
+            return stops
+        # The stop before the window and the one after it (if any) stay where they are
+        nodes = list(range(lo - 1, min(hi + 2, len(points))))
+        await rows.fetch([(points[a], points[b]) for a in nodes for b in nodes if a != b])
+
+        open_end = hi + 1 == len(points)
+        size = len(nodes) + open_end
+        end = size - 1
+        matrix = np.zeros((size, size))
+        for i, a in enumerate(nodes):
+            for j, b in enumerate(nodes):
+                if a != b:
+                    matrix[i, j] = rows.distance(points[a], points[b])
+        # As a closed tour: the only way back to the first fixed stop is from the last one,
+        # which is a free dummy when the window runs to the end of the route
+        matrix[:, 0] = UNREACHABLE_COST
+        matrix[end, :] = UNREACHABLE_COST
+        matrix[end, 0] = 0
+        matrix[0, end] = UNREACHABLE_COST
+        if open_end:
+            matrix[1:end, end] = 0
+        np.fill_diagonal(matrix, 0)
+
+        with timed("solve"):
+            solution = solve_tsp(matrix, quality='balanced')
+        order = solution['order'][1:]
+        if order[-1] != end:
+            return stops
+        current = float(sum(matrix[i, i + 1] for i in range(end)))
+        if solution['objective'] >= current - 1e-9:
+            return stops
+        window = [stops[nodes[i] - 1] for i in order[:-1]]
+        return stops[:lo - 1] + window + stops[hi:]
+
+    async def _rebuild(self, route: Dict, depot: Dict, stops: List[Dict], rows: MatrixRows,
+                       old_legs: Dict[Tuple[str, str], Dict]) -> Dict:
+        """Route fields for the new stop order: kept legs, new legs from the matrix rows, and ETAs"""
+        points = [depot] + [s['coordinates'] for s in stops]
+        pairs = list(zip(points[:-1], points[1:]))
+        await rows.fetch([(a, b) for a, b in pairs if (point_key(a), point_key(b)) not in old_legs])
+        legs = [
+            old_legs.get((point_key(a), point_key(b)))
+            or {'distance': rows.distance(a, b), 'duration': rows.duration(a, b)}
+            for a, b in pairs
+        ]
+
+        # Traffic on the old route stretches every leg alike until the route is refreshed
+        slowdown = route['duration_in_traffic'] / route['duration'] if route.get('duration') else 1.0
+        departure = parse_departure_time(route.get('departure_time'))
+        arrivals = np.cumsum([leg['duration'] for leg in legs]) * slowdown
+        distance = float(sum(leg['distance'] for leg in legs))
+        duration = float(sum(leg['duration'] for leg in legs))
+
+        updated = {
+            **route,
+            'distance': distance,
+            'duration': duration,
+            'duration_in_traffic': duration * slowdown,
+            'legs': legs,
+            'eta': (departure + timedelta(seconds=float(arrivals[-1]))).isoformat(),
+            'stops': [
+                {**stop, 'eta': (departure + timedelta(seconds=float(arrival))).isoformat()}
+                for stop, arrival in zip(stops, arrivals)
+            ],
+            'geometry_stale': True
+        }
+        if 'route_order' in route:
+            updated['route_order'] = [stop.get('route_id') for stop in stops]
+        if 'total_distance' in route:
+            updated['total_distance'] = route['total_distance'] + distance - route['distance']
+        if rows.estimated:
+            updated['estimates'] = {**route.get('estimates', {}), 'matrix': 'haversine'}
+        return updated
+
+    async def refresh(self, route: Dict, depot: Dict) -> Dict:
+        """Route an edited route again in its current stop order, keeping its stop details"""
+        fresh = await self.optimizer.optimize_route(
+            depot,
+            [{**stop['coordinates'], 'name': stop.get('name')} for stop in route['stops']],
+            departure_time=route.get('departure_time')
+        )
+        refreshed = {key: value for key, value in route.items() if key not in ('geometry_stale', 'estimates')}
+        refreshed.update({key: fresh[key] for key in ROUTED_FIELDS if key in fresh})
+        refreshed['stops'] = [{**stop, 'eta': routed['eta']} for stop, routed in zip(route['stops'], fresh['stops'])]
+        estimates = {**fresh.get('estimates', {}), **{
+            key: value for key, value in route.get('estimates', {}).items() if key == 'matrix'
+        }}
+        if estimates:
+            refreshed['estimates'] = estimates
+        return refreshed
+
+    async def insert_stop(self, route_id: int, stop: Dict, position: Optional[int] = None) -> Dict:
+        """Add a stop to a stored optimized route and save it"""
+        return await self._edit(route_id, lambda route, depot: self.insert(route, depot, stop, position))
+
+    async def remove_stop(self, route_id: int, number: int) -> Dict:
+        """Remove a stop from a stored optimized route and save it"""
+        return await self._edit(route_id, lambda route, depot: self.remove(route, depot, number))
+
+    async def _edit(self, route_id: int, edit) -> Dict:
+        # Saved only if the route is unchanged since it was read. A concurrent edit or a
+        # background refresh is picked up by editing again; the matrix rows are cached by then.
+        for _ in range(EDIT_ATTEMPTS):
+            record = self.store.get(route_id)
+            if record is None or record['result'] is None:
+                raise StopNotFound(f"Route {route_id} has no optimized result")
+            depot = stored_depot(record['request'])
+            updated = await edit(record['result'], depot)
+            request = edited_request(record['request'], updated['stops'], depot)
+            if self.store.update(route_id, request, updated, expected_updated_at=record['updated_at']):
+                self.schedule_refresh(route_id)
+                return updated
+        raise EditConflict(f"Route {route_id} kept changing while it was being edited")
+
+    def schedule_refresh(self, route_id: int):
+        # Several quick edits to one route share a single refresh
+        if route_id not in self._pending:
+            self._pending.add(route_id)
+            self._queue.put_nowait(route_id)
+
+    async def _refresh_loop(self):
+        while True:
+            route_id = await self._queue.get()
+            self._pending.discard(route_id)
+            try:
+                await self.refresh_stored(route_id)
+            except Exception as e:
+                logger.error(f"Refreshing edited route {route_id} failed: {str(e)}")
+
+    async def refresh_stored(self, route_id: int, stale_only: bool = True) -> Optional[Dict]:
+        """Route a stored route again in its stop order and save it; by default only after an edit"""
+        record = self.store.get(route_id)
+        if record is None or record['result'] is None:
+            return None
+        if stale_only and not record['result'].get('geometry_stale'):
+            return None
+        refreshed = await self.refresh(record['result'], stored_depot(record['request']))
+        # A newer edit has scheduled its own refresh
+        if not self.store.set_result(route_id, refreshed, expected_updated_at=record['updated_at']):
+            return refreshed
+        logger.info(f"Refreshed route {route_id}")
+        if self.live_updates is not None:
+            await self.live_updates.replace_route(route_id, refreshed)
+        return refreshed
@@ -1,28 +1,68 @@
-import requests
-from typing import Dict, List
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from urllib.parse import urlencode
+import asyncio
 import logging
+import math
+import os
+import time
+import numpy as np
+from .distance_matrix import DistanceMatrix, MatrixBackend, estimate_od_matrix, iter_blocks
+from .http_client import HTTPClient, get_http_client
+from .metrics import UPSTREAM_FALLBACKS
+from .resilience import UpstreamJobFailed, UpstreamTimeout, upstream_failed
 
-class TomTomService:
-    def __init__(self, api_key: str):
+# Batch Routing takes up to 100 routes per synchronous call and 700 per asynchronous batch
+BATCH_SYNC_ITEMS = 100
+BATCH_ASYNC_ITEMS = 700
+# Asynchronous jobs are polled after this many seconds, doubling up to POLL_MAX_INTERVAL
+POLL_INTERVAL = 0.5
+POLL_MAX_INTERVAL = 5.0
+
+class BatchRoutes(NamedTuple):
+    durations: np.ndarray  # seconds per request, inf where it could not be routed
+    distances: np.ndarray  # metres per request, inf where it could not be routed
+    routes: List[Optional[Dict]]  # TomTom route per request, None where it failed or was estimated
+    estimated: Optional[np.ndarray] = None  # True where the upstream failed and haversine stands in
+
+def format_locations(waypoints: List[Dict]) -> str:
+    return ":".join([f"{point['lat']},{point['lon']}" for point in waypoints])
+
+class TomTomService(MatrixBackend):
+    def __init__(self, api_key: str, http_client: Optional[HTTPClient] = None,
+                 vehicle: Optional[Dict] = None):
         self.api_key = api_key
-        self.search_url = "https://api.tomtom.com/search/2/search"
-        self.autocomplete_url = "https://api.tomtom.com/search/2/autocomplete"
-        self.routing_url = "https://api.tomtom.com/routing/1/calculateRoute"
+        self.http_client = http_client or get_http_client()
+        # Truck parameters such as vehicleWeight, vehicleHeight or vehicleCommercial,
+        # sent with every route and matrix request
+        self.vehicle = vehicle or {}
+        self.base_url = os.getenv("TOMTOM_API_URL", "https://api.tomtom.com")
+        self.search_url = f"{self.base_url}/search/2/search"
+        self.autocomplete_url = f"{self.base_url}/search/2/autocomplete"
+        self.routing_url = f"{self.base_url}/routing/1/calculateRoute"
+        self.batch_url = f"{self.base_url}/routing/1/batch"
+        self.matrix_url = f"{self.base_url}/routing/matrix/2"
+        # Synchronous Matrix Routing v2 requests are limited to 200 cells and
+        # asynchronous jobs to 2500
+        self.matrix_block_size = int(math.sqrt(int(os.getenv("TOMTOM_MATRIX_SYNC_CELLS", "200"))))
+        self.async_block_size = int(math.sqrt(int(os.getenv("TOMTOM_MATRIX_ASYNC_CELLS", "2500"))))
+        # Give up on an asynchronous matrix job or batch after this many seconds
+        self.poll_timeout = float(os.getenv("TOMTOM_POLL_TIMEOUT", "300"))
 
-    async def search_place(self, query: str, country: str = None) -> List[Dict]:
-        """Search for places using TomTom Search API"""
+    async def search_place(self, query: str, country: str = None, typeahead: bool = False) -> List[Dict]:
+        """Search for places using TomTom Search API; typeahead treats the query as partly typed"""
         try:
             params = {
                 'key': self.api_key,
                 'query': query,
                 'limit': 10,
                 'countrySet': country if country else None,
-                'idxSet': 'POI,PAD,Addr'
+                'idxSet': 'POI,PAD,Addr',
+                'typeahead': 'true' if typeahead else None
             }
 
-            response = requests.get(self.search_url, params=params)
+            response = await self.http_client.get(self.search_url, params=params)
             response.raise_for_status()
-            
+
             results = response.json().get('results', [])
             return [{
                 'id': result['id'],
@@ -36,40 +76,251 @@ class TomTomService:
             logging.error(f"Place search failed: {str(e)}")
             raise
 
-    async def get_route(self, 
+    def _route_params(self, departure_time: str = None) -> Dict:
+        return {
+            'traffic': 'true',
+            'travelMode': 'truck',
+            'routeType': 'fastest',
+            'departAt': departure_time,
+            **self.vehicle
+        }
+
+    async def get_route(self,
                        depot: Dict[str, float],
                        destinations: List[Dict[str, float]],
                        departure_time: str = None) -> Dict:
         """Calculate route using TomTom Routing API"""
         try:
             # Format waypoints
-            waypoints = [depot] + destinations
-            waypoints_param = ":".join([
-                f"{point['lat']},{point['lon']}"
-                for point in waypoints
-            ])
+            waypoints_param = format_locations([depot] + destinations)
 
-            params = {
-                'key': self.api_key,
-                'traffic': 'true',
-                'travelMode': 'truck',
-                'routeType': 'fastest',
-                'departAt': departure_time
-            }
+            params = {'key': self.api_key, **self._route_params(departure_time)}
 
-            response = requests.get(
+            response = await self.http_client.get(
                 f"{self.routing_url}/{waypoints_param}/json",
                 params=params
             )
             response.raise_for_status()
-            
+
             return response.json()
 
         except Exception as e:
             logging.error(f"Route calculation failed: {str(e)}")
             raise
 
+    async def get_routes_batch(self, waypoint_lists: List[List[Dict]],
+                               departure_time: str = None) -> BatchRoutes:
+        """Route many waypoint sequences with TomTom Batch Routing.
+
+        Up to BATCH_SYNC_ITEMS routes go in one synchronous call; more are
+        split into asynchronous batches of up to BATCH_ASYNC_ITEMS that run
+        concurrently and are polled until done. Results keep the order of
+        waypoint_lists. A batch the upstream fails to answer in time is
+        estimated from straight-line distances and flagged in `estimated`.
+        """
+        try:
+            n = len(waypoint_lists)
+            params = urlencode({k: v for k, v in self._route_params(departure_time).items() if v is not None})
+            queries = [f"/calculateRoute/{format_locations(waypoints)}/json?{params}"
+                       for waypoints in waypoint_lists]
+            if n <= BATCH_SYNC_ITEMS:
+                starts, size = [0] if queries else [], BATCH_SYNC_ITEMS
+                chunks = [self._post_batch_sync(queries)] if queries else []
+            else:
+                starts, size = range(0, n, BATCH_ASYNC_ITEMS), BATCH_ASYNC_ITEMS
+                chunks = [self._run_batch_async(queries[start:start + size]) for start in starts]
+            chunks = await asyncio.gather(*chunks, return_exceptions=True)
+
+            durations = np.full(n, np.inf)
+            distances = np.full(n, np.inf)
+            estimated = np.zeros(n, dtype=bool)
+            routes: List[Optional[Dict]] = [None] * n
+            for start, chunk in zip(starts, chunks):
+                if isinstance(chunk, BaseException):
+                    if not upstream_failed(chunk):
+                        raise chunk
+                    logging.warning(f"Estimating {min(size, n - start)} batch routes: {str(chunk)}")
+                    UPSTREAM_FALLBACKS.inc('batch', 'haversine')
+                    for i in range(start, min(start + size, n)):
+                        waypoints = waypoint_lists[i]
+                        # The diagonal holds the legs between consecutive waypoints
+                        legs = estimate_od_matrix(waypoints[:-1], waypoints[1:])
+                        durations[i] = np.trace(legs.durations)
+                        distances[i] = np.trace(legs.distances)
+                        estimated[i] = True
+                    continue
+                for i, item in enumerate(chunk[:min(size, n - start)], start):
+                    # Failed items carry an error response instead of routes
+                    found = (item.get('response') or {}).get('routes') if item.get('statusCode') == 200 else None
+                    if found:
+                        routes[i] = found[0]
+                        durations[i] = found[0]['summary']['travelTimeInSeconds']
+                        distances[i] = found[0]['summary']['lengthInMeters']
+
+            failed = sum(route is None for route in routes) - int(estimated.sum())
+            if failed:
+                logging.warning(f"Batch routing could not route {failed} of {n} requests")
+            return BatchRoutes(durations, distances, routes, estimated)
+
+        except Exception as e:
+            logging.error(f"Batch route calculation failed: {str(e)}")
+            raise
+
+    async def _post_batch_sync(self, queries: List[str]) -> List[Dict]:
+        response = await self.http_client.post(
+            f"{self.batch_url}/sync/json", params={'key': self.api_key},
+            json={'batchItems': [{'query': query} for query in queries]}
+        )
+        response.raise_for_status()
+        return response.json().get('batchItems', [])
+
+    async def _run_batch_async(self, queries: List[str]) -> List[Dict]:
+        """Submit an asynchronous batch and poll its status URL until the results are ready"""
+        # Manual redirects, so the download is fetched through our client with the key
+        response = await self.http_client.post(
+            f"{self.batch_url}/json", params={'key': self.api_key, 'redirectMode': 'manual'},
+            json={'batchItems': [{'query': query} for query in queries]}
+        )
+        response.raise_for_status()
+        if response.status_code == 200:
+            return response.json().get('batchItems', [])
+
+        location = response.headers['Location']
+        deadline = time.monotonic() + self.poll_timeout
+        interval = POLL_INTERVAL
+        while True:
+            if time.monotonic() > deadline:
+                raise UpstreamTimeout(f"Batch did not finish within {self.poll_timeout:g}s")
+            await asyncio.sleep(interval)
+            interval = min(interval * 2, POLL_MAX_INTERVAL)
+            # Location headers are relative to the API host
+            url = location if location.startswith("http") else f"{self.base_url}{location}"
+            response = await self.http_client.get(url, params={'key': self.api_key})
+            if response.status_code == 303:
+                location = response.headers['Location']
+                continue
+            response.raise_for_status()
+            if response.status_code == 200:
+                return response.json().get('batchItems', [])
+
+    async def get_matrix(self, points: List[Dict], departure_time: str = None) -> DistanceMatrix:
+        """Get durations and distances between all points using TomTom Matrix Routing"""
+        try:
+            if len(points) < 2:
+                return DistanceMatrix(np.zeros((len(points), len(points))), np.zeros((len(points), len(points))))
+            matrix = await self.get_od_matrix(points, points, departure_time)
+            np.fill_diagonal(matrix.durations, 0)
+            np.fill_diagonal(matrix.distances, 0)
+            return matrix
+
+        except Exception as e:
+            logging.error(f"Matrix calculation failed: {str(e)}")
+            raise
+
+    async def get_od_matrix(self, origins: List[Dict], destinations: List[Dict],
+                            departure_time: str = None) -> DistanceMatrix:
+        """Durations and distances from every origin to every destination.
+
+        Matrices that need no more synchronous blocks than the client sends
+        to one host at once are requested synchronously. Larger ones are
+        split into asynchronous jobs, which take over ten times as many
+        cells each and run concurrently. Blocks the upstream fails to answer
+        in time are estimated from straight-line distances.
+        """
+        n_rows, n_cols = len(origins), len(destinations)
+        durations = np.zeros((n_rows, n_cols))
+        distances = np.zeros((n_rows, n_cols))
+        if not n_rows or not n_cols:
+            return DistanceMatrix(durations, distances)
+
+        sync_blocks = math.ceil(n_rows / self.matrix_block_size) * math.ceil(n_cols / self.matrix_block_size)
+        use_async = sync_blocks > self.http_client.max_connections_per_host
+        blocks = list(iter_blocks(n_rows, self.async_block_size if use_async else self.matrix_block_size, n_cols))
+        results = await asyncio.gather(*[
+            self._get_matrix_block(origins, destinations, rows, cols, departure_time, use_async)
+            for rows, cols in blocks
+        ], return_exceptions=True)
+
+        estimated = False
+        for (rows, cols), result in zip(blocks, results):
+            if isinstance(result, BaseException):
+                if not upstream_failed(result):
+                    raise result
+                logging.warning(f"Estimating {len(rows)}x{len(cols)} matrix block: {str(result)}")
+                UPSTREAM_FALLBACKS.inc('matrix', 'haversine')
+                estimate = estimate_od_matrix([origins[i] for i in rows], [destinations[j] for j in cols])
+                result = estimate.durations, estimate.distances
+                estimated = True
+            durations[rows.start:rows.stop, cols.start:cols.stop] = result[0]
+            distances[rows.start:rows.stop, cols.start:cols.stop] = result[1]
+        return DistanceMatrix(durations, distances, estimated)
+
+    async def _get_matrix_block(self, origins: List[Dict], destinations: List[Dict],
+                                rows: range, cols: range, departure_time: str = None,
+                                use_async: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+        body = {
+            'origins': [
+                {'point': {'latitude': origins[i]['lat'], 'longitude': origins[i]['lon']}}
+                for i in rows
+            ],
+            'destinations': [
+                {'point': {'latitude': destinations[j]['lat'], 'longitude': destinations[j]['lon']}}
+                for j in cols
+            ],
+            'options': {
+                'departAt': departure_time or 'now',
+                'travelMode': 'truck',
+                'routeType': 'fastest',
+                'traffic': 'live',
+                **self.vehicle
+            }
+        }
+
+        if use_async:
+            result = await self._run_matrix_async(body)
+        else:
+            response = await self.http_client.post(self.matrix_url, params={'key': self.api_key}, json=body)
+            response.raise_for_status()
+            result = response.json()
+
+        # Cells that could not be routed carry a detailedError instead of a summary
+        block_durations = np.full((len(rows), len(cols)), np.inf)
+        block_distances = np.full((len(rows), len(cols)), np.inf)
+        for cell in result.get('data', []):
+            summary = cell.get('routeSummary')
+            if summary:
+                i, j = cell['originIndex'], cell['destinationIndex']
+                block_durations[i, j] = summary['travelTimeInSeconds']
+                block_distances[i, j] = summary['lengthInMeters']
+        return block_durations, block_distances
+
+    async def _run_matrix_async(self, body: Dict) -> Dict:
+        """Submit an asynchronous matrix job, poll its state and download the result"""
+        params = {'key': self.api_key}
+        response = await self.http_client.post(f"{self.matrix_url}/async", params=params, json=body)
+        response.raise_for_status()
+        job_id = response.json()['jobId']
+
+        deadline = time.monotonic() + self.poll_timeout
+        interval = POLL_INTERVAL
+        while True:
+            if time.monotonic() > deadline:
+                raise UpstreamTimeout(f"Matrix job {job_id} did not finish within {self.poll_timeout:g}s")
+            await asyncio.sleep(interval)
+            interval = min(interval * 2, POLL_MAX_INTERVAL)
+            response = await self.http_client.get(f"{self.matrix_url}/async/{job_id}", params=params)
+            response.raise_for_status()
+            state = response.json().get('state')
+            if state == 'Completed':
+                break
+            if state not in ('Submitted', 'InProgress'):
+                raise UpstreamJobFailed(f"Matrix job {job_id} ended as {state}")
+
+        response = await self.http_client.get(f"{self.matrix_url}/async/{job_id}/result", params=params)
+        response.raise_for_status()
+        return response.json()
+
     async def get_route_update(self, route_id: str) -> Dict:
         """Get real-time updates for a route"""
         # Implement real-time route updates logic here
-        pass 
\ No newline at end of file
+        pass
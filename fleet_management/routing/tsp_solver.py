@@ -0,0 +1,258 @@
+from typing import Callable, Dict, List, Optional
+import logging
+import secrets
+import time
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Cost used in place of unreachable (inf) matrix entries so deltas stay finite
+UNREACHABLE_COST = 1e12
+
+# Largest stop count (depot included) solved exactly, and the longest
+# segment Or-opt tries to move, for each quality setting. 'thorough' keeps
+# improving larger tours with iterated local search on every core until
+# the time budget runs out or it stops finding better tours.
+QUALITY_SETTINGS = {
+    'fast': {'exact_max_points': 9, 'or_opt_max_segment': 1},
+    'balanced': {'exact_max_points': 12, 'or_opt_max_segment': 3},
+    'quality': {'exact_max_points': 15, 'or_opt_max_segment': 3},
+    'thorough': {'exact_max_points': 15, 'or_opt_max_segment': 3, 'iterated': True},
+}
+# Iterated local search runs until it stalls, but never longer than this
+ITERATED_TIME_BUDGET = 30.0
+
+class Deadline:
+    """Time budget for a solve (None for no limit), which also ends early if `cancelled` returns True"""
+
+    def __init__(self, time_budget: Optional[float], cancelled: Optional[Callable[[], bool]] = None):
+        self.expires_at = time.perf_counter() + time_budget if time_budget is not None else None
+        self.cancelled = cancelled
+
+    def expired(self) -> bool:
+        if self.expires_at is not None and time.perf_counter() >= self.expires_at:
+            return True
+        return self.cancelled is not None and self.cancelled()
+
+    def remaining(self) -> Optional[float]:
+        """Seconds left, for handing the budget to another process"""
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.perf_counter())
+
+class DeadlineExceeded(Exception):
+    pass
+
+def tour_cost(distance_matrix: np.ndarray, order: List[int]) -> float:
+    """Cost of a closed tour that returns to its first point"""
+    order = np.asarray(order)
+    return float(distance_matrix[order, np.roll(order, -1)].sum())
+
+# Called with (order, cost) whenever a solver finds a better tour
+ImprovementCallback = Callable[[List[int], float], None]
+
+def held_karp(distance_matrix: np.ndarray, deadline: Deadline, settings: Dict,
+              on_improvement: Optional[ImprovementCallback] = None) -> List[int]:
+    """Exact Held-Karp dynamic program over subsets of stops, depot fixed at 0"""
+    n = len(distance_matrix)
+    m = n - 1
+    if m <= 1:
+        return list(range(n))
+
+    stops = distance_matrix[1:, 1:]
+    bits = 1 << np.arange(m)
+
+    # dp[mask, j]: cheapest path leaving the depot, visiting mask, ending at stop j
+    dp = np.full((1 << m, m), np.inf)
+    parent = np.full((1 << m, m), -1, dtype=np.int8)
+    dp[bits, np.arange(m)] = distance_matrix[0, 1:]
+
+    for mask in range(1, 1 << m):
+        if mask & (mask - 1) == 0:
+            continue
+        if mask & 1023 == 0 and deadline.expired():
+            raise DeadlineExceeded()
+
+        in_mask = (mask & bits) != 0
+        # candidates[j, k] = dp[mask without j, k] + cost(k -> j)
+        candidates = dp[mask ^ bits] + stops.T
+        best = candidates.argmin(axis=1)
+        costs = candidates[np.arange(m), best]
+        dp[mask] = np.where(in_mask, costs, np.inf)
+        parent[mask] = np.where(in_mask, best, -1)
+
+    full = (1 << m) - 1
+    last = int(np.argmin(dp[full] + distance_matrix[1:, 0]))
+
+    order = []
+    mask = full
+    while last >= 0:
+        order.append(last + 1)
+        previous = int(parent[mask, last])
+        mask ^= 1 << last
+        last = previous
+    return [0] + order[::-1]
+
+def nearest_neighbor(distance_matrix: np.ndarray) -> List[int]:
+    """Greedy tour that always drives to the closest unvisited stop"""
+    n = len(distance_matrix)
+    visited = np.zeros(n, dtype=bool)
+    visited[0] = True
+    order = [0]
+    for _ in range(n - 1):
+        costs = np.where(visited, np.inf, distance_matrix[order[-1]])
+        nxt = int(np.argmin(costs))
+        visited[nxt] = True
+        order.append(nxt)
+    return order
+
+def two_opt(distance_matrix: np.ndarray, order: List[int], deadline: Deadline) -> List[int]:
+    """Segment-reversal local search; handles asymmetric matrices"""
+    n = len(order)
+    tour = np.asarray(order)
+    improved = True
+    while improved and not deadline.expired():
+        improved = False
+        ext = np.append(tour, tour[0])
+        fwd = distance_matrix[ext[:-1], ext[1:]]
+        rev = distance_matrix[ext[1:], ext[:-1]]
+        # Reversing a segment also flips the direction of its inner edges
+        fwd_sum = np.concatenate(([0.0], np.cumsum(fwd)))
+        rev_sum = np.concatenate(([0.0], np.cumsum(rev)))
+
+        for i in range(n - 2):
+            j = np.arange(i + 2, n)
+            delta = (distance_matrix[ext[i], ext[j]]
+                     + distance_matrix[ext[i + 1], ext[j + 1]]
+                     - fwd[i] - fwd[j]
+                     + (rev_sum[j] - rev_sum[i + 1])
+                     - (fwd_sum[j] - fwd_sum[i + 1]))
+            best = int(np.argmin(delta))
+            if delta[best] < -1e-9:
+                j = int(j[best])
+                tour[i + 1:j + 1] = tour[i + 1:j + 1][::-1]
+                improved = True
+                break
+    return tour.tolist()
+
+def or_opt(distance_matrix: np.ndarray, order: List[int], deadline: Deadline,
+           max_segment: int = 3) -> List[int]:
+    """Move chains of 1..max_segment consecutive stops to their cheapest position"""
+    n = len(order)
+    tour = list(order)
+    improved = True
+    while improved and not deadline.expired():
+        improved = False
+        for length in range(1, max_segment + 1):
+            for i in range(1, n - length + 1):
+                ext = np.append(tour, tour[0])
+                first, last = ext[i], ext[i + length - 1]
+                prev, nxt = ext[i - 1], ext[i + length]
+                removal_gain = (distance_matrix[prev, first] + distance_matrix[last, nxt]
+                                - distance_matrix[prev, nxt])
+
+                p = np.arange(n)
+                p = p[(p < i - 1) | (p > i + length - 1)]
+                if len(p) == 0:
+                    continue
+                insertion_cost = (distance_matrix[ext[p], first]
+                                  + distance_matrix[last, ext[p + 1]]
+                                  - distance_matrix[ext[p], ext[p + 1]])
+                best = int(np.argmin(insertion_cost))
+                if insertion_cost[best] - removal_gain < -1e-9:
+                    position = int(p[best])
+                    segment = tour[i:i + length]
+                    rest = tour[:i] + tour[i + length:]
+                    # Positions after the removed segment shift left by its length
+                    insert_at = position + 1 if position < i else position + 1 - length
+                    tour = rest[:insert_at] + segment + rest[insert_at:]
+                    improved = True
+                    break
+            if improved or deadline.expired():
+                break
+    return tour
+
+def local_search(distance_matrix: np.ndarray, deadline: Deadline, settings: Dict,
+                 on_improvement: Optional[ImprovementCallback] = None) -> List[int]:
+    """Nearest-neighbour construction improved by 2-opt and Or-opt until no move helps"""
+    order = nearest_neighbor(distance_matrix)
+    best_cost = tour_cost(distance_matrix, order)
+    if on_improvement is not None:
+        on_improvement(order, best_cost)
+    while not deadline.expired():
+        order = two_opt(distance_matrix, order, deadline)
+        order = or_opt(distance_matrix, order, deadline, settings['or_opt_max_segment'])
+        cost = tour_cost(distance_matrix, order)
+        if cost >= best_cost - 1e-9:
+            break
+        best_cost = cost
+        if on_improvement is not None:
+            on_improvement(order, best_cost)
+    return order
+
+def iterated_local_search(distance_matrix: np.ndarray, deadline: Deadline, settings: Dict,
+                          on_improvement: Optional[ImprovementCallback] = None) -> List[int]:
+    # Imported here: the parallel solver builds on the functions above
+    from .parallel_solver import parallel_ils
+    return parallel_ils(distance_matrix, deadline, settings, on_improvement)
+
+SOLVERS: Dict[str, Callable] = {
+    'held_karp': held_karp,
+    'local_search': local_search,
+    'iterated_local_search': iterated_local_search,
+}
+
+def select_solver(n: int, quality: str = 'balanced') -> str:
+    """Pick a solver name for a tour with n points, depot included"""
+    settings = QUALITY_SETTINGS[quality]
+    if n <= settings['exact_max_points']:
+        return 'held_karp'
+    if settings.get('iterated'):
+        return 'iterated_local_search'
+    return 'local_search'
+
+def solve_tsp(distance_matrix: np.ndarray,
+              time_budget: Optional[float] = None,
+              quality: str = 'balanced',
+              on_improvement: Optional[ImprovementCallback] = None,
+              cancelled: Optional[Callable[[], bool]] = None,
+              seed: Optional[int] = None) -> Dict:
+    """Find a short closed tour starting and ending at point 0.
+
+    on_improvement sees each better tour as it is found; once cancelled()
+    returns True the solver stops and returns the best tour so far.
+    Randomised solvers draw from `seed` and report the seed they used, so
+    any run can be repeated.
+    """
+    if quality not in QUALITY_SETTINGS:
+        raise ValueError(f"Unknown quality setting: {quality}")
+
+    start = time.perf_counter()
+    matrix = np.where(np.isfinite(distance_matrix), distance_matrix, UNREACHABLE_COST)
+    solver = select_solver(len(matrix), quality)
+    settings = QUALITY_SETTINGS[quality]
+    if solver == 'iterated_local_search':
+        if seed is None:
+            seed = secrets.randbits(32)
+        settings = {**settings, 'seed': seed}
+        time_budget = ITERATED_TIME_BUDGET if time_budget is None else min(time_budget, ITERATED_TIME_BUDGET)
+    deadline = Deadline(time_budget, cancelled)
+
+    try:
+        order = SOLVERS[solver](matrix, deadline, settings, on_improvement)
+    except DeadlineExceeded:
+        logger.warning(f"{solver} ran out of time budget, falling back to local search")
+        solver = 'local_search'
+        order = SOLVERS[solver](matrix, deadline, settings, on_improvement)
+
+    solve_time = time.perf_counter() - start
+    logger.info(f"Solved {len(matrix)}-point tour with {solver} in {solve_time:.3f}s")
+    solution = {
+        'order': [int(i) for i in order],
+        'objective': tour_cost(distance_matrix, order),
+        'solver': solver,
+        'solve_time': solve_time
+    }
+    if 'seed' in settings:
+        solution['seed'] = seed
+    return solution
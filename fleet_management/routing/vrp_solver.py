@@ -0,0 +1,281 @@
+from typing import Callable, Dict, List, Optional, Tuple
+import logging
+import random
+import time
+import numpy as np
+from .tsp_solver import UNREACHABLE_COST, Deadline
+
+logger = logging.getLogger(__name__)
+
+# Used when the caller does not give a time budget
+DEFAULT_TIME_BUDGET = 10.0
+# How many nearby orders each order tries moves against during local search
+NEIGHBOR_COUNT = 12
+
+class VRPInstance:
+    """Vehicles and orders expressed as indices into a shared duration/distance matrix.
+
+    vehicles: dicts with start, end (matrix indices), capacity, shift_start, shift_end
+    orders: dicts with node (matrix index), demand, service_time, tw_start, tw_end
+    Times are seconds on the same clock as the shift bounds.
+    """
+
+    def __init__(self, durations: np.ndarray, distances: np.ndarray,
+                 vehicles: List[Dict], orders: List[Dict]):
+        self.durations = np.where(np.isfinite(durations), durations, UNREACHABLE_COST)
+        self.distances = distances
+        self.vehicles = vehicles
+        self.orders = orders
+
+        self.node = np.array([o['node'] for o in orders], dtype=int)
+        self.demand = np.array([o.get('demand', 0) for o in orders], dtype=float)
+        self.service = np.array([o.get('service_time', 0) for o in orders], dtype=float)
+        self.tw_start = np.array([o.get('tw_start', 0) for o in orders], dtype=float)
+        self.tw_end = np.array([o.get('tw_end', np.inf) for o in orders], dtype=float)
+
+        # Plain lists are much faster than NumPy for the scalar lookups in route evaluation
+        self.duration_rows = self.durations.tolist()
+        self.node_list = self.node.tolist()
+        self.demand_list = self.demand.tolist()
+        self.service_list = self.service.tolist()
+        self.tw_start_list = self.tw_start.tolist()
+        self.tw_end_list = self.tw_end.tolist()
+
+    def evaluate(self, r: int, route: List[int]) -> Optional[float]:
+        """Travel duration of a vehicle's route, or None if it breaks a constraint"""
+        vehicle = self.vehicles[r]
+        T = self.duration_rows
+        node = self.node_list
+        load = 0.0
+        for k in route:
+            load += self.demand_list[k]
+        if load > vehicle['capacity']:
+            return None
+
+        t = vehicle['shift_start']
+        prev = vehicle['start']
+        cost = 0.0
+        for k in route:
+            travel = T[prev][node[k]]
+            cost += travel
+            t = max(t + travel, self.tw_start_list[k])
+            if t > self.tw_end_list[k]:
+                return None
+            t += self.service_list[k]
+            prev = node[k]
+        travel = T[prev][vehicle['end']]
+        if t + travel > vehicle['shift_end']:
+            return None
+        return cost + travel
+
+    def schedule(self, r: int, route: List[int]) -> List[float]:
+        """Service start time at each order of a feasible route"""
+        vehicle = self.vehicles[r]
+        t = vehicle['shift_start']
+        prev = vehicle['start']
+        starts = []
+        for k in route:
+            t = max(t + self.duration_rows[prev][self.node_list[k]], self.tw_start_list[k])
+            starts.append(t)
+            t += self.service_list[k]
+            prev = self.node_list[k]
+        return starts
+
+def _insertion_costs(inst: VRPInstance, r: int, route: List[int],
+                     candidates: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Cheapest feasible insertion cost and position of each candidate order into route r"""
+    vehicle = inst.vehicles[r]
+    T = inst.durations
+    nodes = inst.node[route] if route else np.empty(0, dtype=int)
+    prev_nodes = np.concatenate(([vehicle['start']], nodes))
+    next_nodes = np.concatenate((nodes, [vehicle['end']]))
+
+    # Departure from each predecessor and latest service start at each successor
+    starts = inst.schedule(r, route)
+    depart_prev = np.array(
+        [vehicle['shift_start']] + [s + inst.service_list[k] for s, k in zip(starts, route)]
+    )
+    latest_next = np.empty(len(route) + 1)
+    latest_next[-1] = vehicle['shift_end']
+    for i in range(len(route) - 1, -1, -1):
+        k = route[i]
+        latest_next[i] = min(
+            inst.tw_end_list[k],
+            latest_next[i + 1] - inst.service_list[k] - T[nodes[i], next_nodes[i + 1]]
+        )
+
+    cand_nodes = inst.node[candidates]
+    to_cand = T[np.ix_(prev_nodes, cand_nodes)].T
+    from_cand = T[np.ix_(cand_nodes, next_nodes)]
+    begin = np.maximum(inst.tw_start[candidates][:, None], depart_prev[None, :] + to_cand)
+    feasible = (
+        (begin <= inst.tw_end[candidates][:, None])
+        & (begin + inst.service[candidates][:, None] + from_cand <= latest_next[None, :])
+    )
+    load = inst.demand[route].sum() if route else 0.0
+    feasible &= (load + inst.demand[candidates] <= vehicle['capacity'])[:, None]
+
+    delta = np.where(feasible, to_cand + from_cand - T[prev_nodes, next_nodes][None, :], np.inf)
+    positions = delta.argmin(axis=1)
+    return delta[np.arange(len(candidates)), positions], positions
+
+def regret_insertion(inst: VRPInstance, routes: List[List[int]], unassigned: List[int],
+                     deadline: Deadline) -> List[int]:
+    """Insert orders one at a time, most constrained (largest regret) first"""
+    n_routes = len(routes)
+    pending = np.array(sorted(unassigned), dtype=int)
+    if len(pending) == 0 or n_routes == 0:
+        return pending.tolist()
+
+    cost = np.full((len(inst.orders), n_routes), np.inf)
+    position = np.zeros((len(inst.orders), n_routes), dtype=int)
+    for r in range(n_routes):
+        cost[pending, r], position[pending, r] = _insertion_costs(inst, r, routes[r], pending)
+
+    while len(pending) and not deadline.expired():
+        rows = cost[pending]
+        best_route = rows.argmin(axis=1)
+        best = rows[np.arange(len(pending)), best_route]
+        if not np.isfinite(best).any():
+            break
+        if n_routes > 1:
+            second = np.partition(rows, 1, axis=1)[:, 1]
+            regret = np.where(np.isfinite(best), second - best, -np.inf)
+        else:
+            regret = np.where(np.isfinite(best), -best, -np.inf)
+        # Orders with a single feasible vehicle get infinite regret and go first
+        pick = int(np.argmax(regret))
+        order, r = int(pending[pick]), int(best_route[pick])
+        routes[r].insert(int(position[order, r]), order)
+        pending = np.delete(pending, pick)
+        if len(pending):
+            cost[pending, r], position[pending, r] = _insertion_costs(inst, r, routes[r], pending)
+
+    return pending.tolist()
+
+def _neighbors(inst: VRPInstance) -> np.ndarray:
+    T = inst.durations[np.ix_(inst.node, inst.node)]
+    T = T + T.T
+    np.fill_diagonal(T, np.inf)
+    k = min(NEIGHBOR_COUNT, len(inst.orders) - 1)
+    return np.argpartition(T, k - 1, axis=1)[:, :k] if k > 0 else np.empty((len(T), 0), dtype=int)
+
+def inter_route_search(inst: VRPInstance, routes: List[List[int]], deadline: Deadline,
+                       seed: int = 0) -> List[List[int]]:
+    """Relocate, exchange and 2-opt* moves between each order and its nearest neighbours"""
+    neighbors = _neighbors(inst)
+    costs = [inst.evaluate(r, route) for r, route in enumerate(routes)]
+    route_of = {}
+    for r, route in enumerate(routes):
+        for k in route:
+            route_of[k] = r
+
+    rng = random.Random(seed)
+    improved = True
+    while improved and not deadline.expired():
+        improved = False
+        order_ids = list(route_of)
+        rng.shuffle(order_ids)
+        for u in order_ids:
+            if deadline.expired():
+                break
+            moved = False
+            for v in neighbors[u]:
+                v = int(v)
+                if v not in route_of:
+                    continue
+                ru, rv = route_of[u], route_of[v]
+                for changed in _candidate_moves(routes, ru, rv, u, v):
+                    new_costs = {r: inst.evaluate(r, seq) for r, seq in changed.items()}
+                    if any(c is None for c in new_costs.values()):
+                        continue
+                    delta = sum(new_costs[r] - costs[r] for r in changed)
+                    if delta < -1e-6:
+                        for r, seq in changed.items():
+                            routes[r] = seq
+                            costs[r] = new_costs[r]
+                            for k in seq:
+                                route_of[k] = r
+                        moved = improved = True
+                        break
+                if moved:
+                    break
+    return routes
+
+def _candidate_moves(routes: List[List[int]], ru: int, rv: int, u: int, v: int):
+    """Yield {route: new sequence} dicts for moves that bring u next to v"""
+    a, b = routes[ru], routes[rv]
+    i, j = a.index(u), b.index(v)
+
+    if ru == rv:
+        # Relocate u directly after or before v within the same route
+        rest = a[:i] + a[i + 1:]
+        jj = rest.index(v)
+        yield {ru: rest[:jj + 1] + [u] + rest[jj + 1:]}
+        yield {ru: rest[:jj] + [u] + rest[jj:]}
+        return
+
+    # Relocate u next to v
+    rest = a[:i] + a[i + 1:]
+    yield {ru: rest, rv: b[:j + 1] + [u] + b[j + 1:]}
+    yield {ru: rest, rv: b[:j] + [u] + b[j:]}
+    # Exchange u and v
+    yield {ru: a[:i] + [v] + a[i + 1:], rv: b[:j] + [u] + b[j + 1:]}
+    # 2-opt*: swap route tails so u is followed by v's successor, or v by u
+    yield {ru: a[:i + 1] + b[j + 1:], rv: b[:j + 1] + a[i + 1:]}
+    yield {ru: a[:i] + b[j:], rv: b[:j] + a[i:]}
+
+def solve_vrp(durations: np.ndarray, distances: np.ndarray,
+              vehicles: List[Dict], orders: List[Dict],
+              time_budget: Optional[float] = None,
+              cancelled: Optional[Callable[[], bool]] = None) -> Dict:
+    """Assign orders to vehicles and sequence each route, minimising total travel time"""
+    if not vehicles:
+        raise ValueError("At least one vehicle is required")
+    start = time.perf_counter()
+    deadline = Deadline(DEFAULT_TIME_BUDGET if time_budget is None else time_budget, cancelled)
+    inst = VRPInstance(durations, distances, vehicles, orders)
+
+    # A vehicle that cannot even get from its start to its end depot within its shift takes no orders
+    usable = [v for v in range(len(vehicles)) if inst.evaluate(v, []) is not None]
+    if len(usable) < len(vehicles):
+        logger.warning(f"{len(vehicles) - len(usable)} vehicles cannot reach their end depot within their shift")
+        inst.vehicles = [vehicles[v] for v in usable]
+
+    routes: List[List[int]] = [[] for _ in usable]
+    unassigned = regret_insertion(inst, routes, list(range(len(orders))), deadline)
+    construction_cost = sum(inst.evaluate(r, route) for r, route in enumerate(routes))
+
+    routes = inter_route_search(inst, routes, deadline)
+    if unassigned:
+        unassigned = regret_insertion(inst, routes, unassigned, deadline)
+
+    results = [
+        {'orders': [], 'service_starts': [], 'load': 0.0, 'duration': 0.0, 'distance': 0.0}
+        for _ in vehicles
+    ]
+    for r, route in enumerate(routes):
+        v = usable[r]
+        nodes = [vehicles[v]['start']] + [inst.node_list[k] for k in route] + [vehicles[v]['end']]
+        results[v] = {
+            'orders': route,
+            'service_starts': inst.schedule(r, route),
+            'load': float(inst.demand[route].sum()) if route else 0.0,
+            'duration': inst.evaluate(r, route),
+            'distance': float(distances[nodes[:-1], nodes[1:]].sum())
+        }
+
+    total_duration = sum(route['duration'] for route in results)
+    solve_time = time.perf_counter() - start
+    logger.info(
+        f"Solved VRP with {len(orders)} orders and {len(vehicles)} vehicles in {solve_time:.2f}s "
+        f"(construction {construction_cost:.0f}s, final {total_duration:.0f}s, "
+        f"{len(unassigned)} unassigned)"
+    )
+    return {
+        'routes': results,
+        'unassigned': unassigned,
+        'total_duration': total_duration,
+        'total_distance': sum(route['distance'] for route in results),
+        'solve_time': solve_time
+    }
@@ -0,0 +1,42 @@
+import os
+import httpx
+import pytest
+from routing.benchmarks import fake_upstream
+from routing.benchmarks.routing_benchmark import fake_http_client
+from routing.http_client import set_http_client
+
+@pytest.fixture
+def anyio_backend():
+    return 'asyncio'
+
+@pytest.fixture
+def fake_upstream_app():
+    """The fake OSRM/TomTom upstream, reset to no latency or faults after each test"""
+    fake_upstream.configure()
+    yield fake_upstream
+    fake_upstream.configure()
+
+@pytest.fixture
+async def client(request, tmp_path, monkeypatch, fake_upstream_app):
+    """API client for the app, with every upstream call served by the fake.
+
+    Jobs run inline unless the test parametrizes the fixture (indirect=True)
+    with other environment settings, e.g. {"JOB_WORKERS": "1"}.
+    """
+    settings = {
+        "TOMTOM_API_KEY": "test",
+        "ROUTE_STORE_PATH": str(tmp_path / "routes.db"),
+        "JOB_WORKERS": "0",
+        "WARMUP_DEPOTS": "",
+        **getattr(request, "param", {})
+    }
+    for name, value in settings.items():
+        monkeypatch.setenv(name, value)
+    from routing.main import app
+    # Middlewares read their settings on the first request; rebuild them for this test's
+    app.middleware_stack = None
+    set_http_client(fake_http_client())
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test",
+                                     timeout=60) as api:
+            yield api
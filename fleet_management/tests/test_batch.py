@@ -0,0 +1,45 @@
+import asyncio
+import json
+import pytest
+from routing.route_optimizer import RouteOptimizer
+
+pytestmark = pytest.mark.anyio
+
+def route_request(lat: float) -> dict:
+    return {'depot': {'lat': 52.5, 'lon': 13.4}, 'destinations': [{'lat': lat, 'lon': 13.5}]}
+
+@pytest.fixture
+def optimized(monkeypatch):
+    """Stand-in for optimize_route that records the routes and how many ran at once"""
+    calls = {'routes': [], 'active': 0, 'peak': 0}
+
+    async def optimize_route(self, depot, destinations, **kwargs):
+        calls['routes'].append(destinations[0]['lat'])
+        calls['active'] += 1
+        calls['peak'] = max(calls['peak'], calls['active'])
+        await asyncio.sleep(0.01)
+        calls['active'] -= 1
+        if destinations[0]['lat'] < 0:
+            raise ValueError("No route found")
+        return {'distance': destinations[0]['lat']}
+
+    monkeypatch.setattr(RouteOptimizer, 'optimize_route', optimize_route)
+    return calls
+
+async def test_batches_stream_every_item_with_bounded_concurrency(optimized, client):
+    latitudes = [52.0 + i / 100 for i in range(10)]
+    routes = [route_request(lat) for lat in latitudes]
+    # A repeat of the first route and one that fails
+    routes += [route_request(latitudes[0]), route_request(-1)]
+    response = await client.post("/optimize-batch", json={'routes': routes, 'max_concurrency': 3})
+    assert response.status_code == 200
+    items = {item['index']: item for item in map(json.loads, response.text.splitlines())}
+
+    assert sorted(items) == list(range(12))
+    for index, lat in enumerate(latitudes):
+        assert items[index]['optimized_route'] == {'distance': lat}
+    assert items[10]['optimized_route'] == {'distance': latitudes[0]}
+    assert items[11]['error'] == "No route found"
+    # The repeated route is optimized once
+    assert sorted(optimized['routes']) == sorted([-1] + latitudes)
+    assert optimized['peak'] == 3
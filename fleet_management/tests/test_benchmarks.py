@@ -0,0 +1,47 @@
+import pytest
+from routing.benchmarks.instances import generate_multi_point_request, generate_route_request
+from routing.benchmarks.routing_benchmark import bench_matrix, compare, load_test
+
+def run(**metrics_by_size) -> dict:
+    return {'results': [{'benchmark': 'matrix', 'params': {'points': int(size)}, 'metrics': metrics}
+                        for size, metrics in metrics_by_size.items()]}
+
+def test_compare_flags_regressions_in_either_direction():
+    baseline = run(**{'10': {'time_ms': 100.0, 'throughput': 50.0, 'errors': 0}})
+    current = run(**{'10': {'time_ms': 130.0, 'throughput': 40.0, 'errors': 0},
+                     '20': {'time_ms': 1.0}})
+    changes = {c['metric']: c for c in compare(baseline, current, threshold=0.25)}
+
+    # Only metrics present in both runs are compared
+    assert set(changes) == {'time_ms', 'throughput', 'errors'}
+    assert changes['time_ms']['regression'] == pytest.approx(0.3)
+    assert changes['time_ms']['regressed']
+    # Lower throughput is worse, but 20% is within the threshold
+    assert changes['throughput']['regression'] == pytest.approx(0.2)
+    assert not changes['throughput']['regressed']
+    assert changes['errors']['regression'] == 0
+
+def test_metrics_appearing_from_zero_count_as_regressions():
+    changes = compare(run(**{'10': {'errors': 0}}), run(**{'10': {'errors': 2}}), threshold=0.1)
+    assert changes[0]['regressed']
+
+@pytest.mark.anyio
+async def test_matrix_benchmark_counts_upstream_requests(fake_upstream_app):
+    results = await bench_matrix([5, 120], range(1), repeat=1)
+    requests = {(r['params']['points'], r['params']['clustered']): r['metrics']['upstream_requests']
+                for r in results}
+    assert set(requests) == {(5, False), (5, True), (120, False), (120, True)}
+    assert requests[(5, False)] == 1
+    # 120 points no longer fit in one table request
+    assert requests[(120, False)] > 1
+
+@pytest.mark.anyio
+async def test_endpoints_answer_under_load_against_the_fake_upstream(client):
+    requests = [{'method': 'POST', 'url': f'/route-update/{seed}', 'body': generate_route_request(5, seed)}
+                for seed in range(4)]
+    requests.append({'method': 'POST', 'url': '/optimize-multi-point',
+                     'body': generate_multi_point_request(6, 0)})
+    metrics = await load_test(client, requests, concurrency=2)
+    assert metrics['errors'] == 0
+    assert metrics['throughput'] > 0
+    assert metrics['p50_ms'] <= metrics['p99_ms']
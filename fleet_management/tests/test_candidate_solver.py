@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+from routing import geometry
+from routing.benchmarks.instances import generate_points, synthetic_matrix
+from routing.candidate_solver import solve_candidate_tsp
+from routing.distance_matrix import DistanceMatrix, MatrixBackend, SparseDistanceMatrix, get_sparse_matrix
+from routing.geometry import haversine, nearest_neighbors, quadrant_neighbors
+from routing.tsp_solver import solve_tsp, tour_cost
+
+class SyntheticBackend(MatrixBackend):
+    """Straight-line matrices, recording the size of every block asked for"""
+
+    def __init__(self):
+        self.blocks = []
+
+    async def get_matrix(self, points):
+        return DistanceMatrix(*synthetic_matrix(points))
+
+    async def get_od_matrix(self, origins, destinations):
+        self.blocks.append((len(origins), len(destinations)))
+        return await super().get_od_matrix(origins, destinations)
+
+def coordinates(points):
+    return (np.array([p['lat'] for p in points]), np.array([p['lon'] for p in points]))
+
+def sparse_from_dense(points, k):
+    lat, lon = coordinates(points)
+    durations, distances = synthetic_matrix(points)
+    neighbors = quadrant_neighbors(lat, lon, k)
+    rows = np.arange(len(points))[:, None]
+    return SparseDistanceMatrix(lat, lon, neighbors, durations[rows, neighbors], distances[rows, neighbors]), distances
+
+@pytest.mark.parametrize('kdtree', [True, False])
+def test_nearest_neighbors_match_sorting_all_distances(monkeypatch, kdtree):
+    if not kdtree:
+        monkeypatch.setattr(geometry, 'cKDTree', None)
+    lat, lon = coordinates(generate_points(300, 0, clustered=True))
+    found = nearest_neighbors(lat, lon, 8)
+    distances = haversine(lat[:, None], lon[:, None], lat[None, :], lon[None, :])
+    np.fill_diagonal(distances, np.inf)
+    np.testing.assert_allclose(np.take_along_axis(distances, found, axis=1),
+                               np.sort(distances, axis=1)[:, :8])
+
+def test_lookup_reads_candidates_and_estimates_the_rest():
+    points = generate_points(200, 1)
+    matrix, dense = sparse_from_dense(points, 8)
+    rows = np.repeat(np.arange(200), 8)
+    cols = matrix.neighbors.ravel()
+    np.testing.assert_array_equal(matrix.lookup('distances', rows, cols), dense[rows, cols])
+
+    # Any other pair scales the straight line by the candidates' detour, which here is exact
+    rows, cols = np.meshgrid(np.arange(200), np.arange(200), indexing='ij')
+    np.testing.assert_allclose(matrix.lookup('distances', rows, cols), dense, rtol=1e-9)
+    assert matrix.lookup('durations', [[0, 1]], [[0, 0]]).shape == (1, 2)
+
+@pytest.mark.anyio
+async def test_sparse_matrices_only_fetch_neighbour_blocks():
+    points = generate_points(400, 2, clustered=True)
+    backend = SyntheticBackend()
+    sparse = await get_sparse_matrix(backend, points, 12)
+    _, dense = synthetic_matrix(points)
+    rows = np.arange(400)[:, None]
+    np.testing.assert_allclose(sparse.distances, dense[rows, sparse.neighbors])
+    assert not sparse.estimated
+    # Far fewer cells than the full 400 x 400
+    assert sum(r * c for r, c in backend.blocks) < 400 * 400 / 4
+
+@pytest.mark.parametrize('clustered', [False, True])
+def test_candidate_tours_are_close_to_dense_tours(clustered):
+    points = generate_points(300, 3, clustered)
+    matrix, dense = sparse_from_dense(points, 12)
+    solution = solve_candidate_tsp(matrix, seed=0)
+    assert solution['order'][0] == 0
+    assert sorted(solution['order']) == list(range(300))
+    assert solution['objective'] == pytest.approx(tour_cost(dense, solution['order']))
+
+    dense_cost = solve_tsp(dense, seed=0)['objective']
+    assert solution['objective'] < 1.05 * dense_cost
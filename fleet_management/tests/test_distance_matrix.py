@@ -0,0 +1,67 @@
+import httpx
+import numpy as np
+import pytest
+from routing.distance_matrix import OSRMMatrixBackend, iter_blocks
+from routing.http_client import HTTPClient
+
+def points(n: int) -> list:
+    return [{'lat': i * 0.01, 'lon': 13.0} for i in range(n)]
+
+def index_of(latitude: float) -> int:
+    return round(latitude / 0.01)
+
+class FakeTable:
+    """OSRM /table whose duration from point i to point j is 1000 * i + j"""
+
+    def __init__(self, unreachable=()):
+        self.unreachable = set(unreachable)
+        self.calls = []
+
+    def response(self, path: str, params: dict) -> dict:
+        coordinates = path.rsplit('/', 1)[1].split(';')
+        indices = [index_of(float(coordinate.split(',')[1])) for coordinate in coordinates]
+        sources = [indices[int(k)] for k in params['sources'].split(';')]
+        destinations = [indices[int(k)] for k in params['destinations'].split(';')]
+        self.calls.append(len(coordinates))
+        durations = [[None if (i, j) in self.unreachable else 1000.0 * i + j for j in destinations] for i in sources]
+        distances = [[None if d is None else 10 * d for d in row] for row in durations]
+        return {'code': 'Ok', 'durations': durations, 'distances': distances}
+
+@pytest.fixture
+def table() -> FakeTable:
+    return FakeTable()
+
+@pytest.fixture
+async def http_client(table):
+    client = HTTPClient(transport=httpx.MockTransport(
+        lambda request: httpx.Response(200, json=table.response(request.url.path, dict(request.url.params)))
+    ))
+    yield client
+    await client.aclose()
+
+def expected(n: int) -> np.ndarray:
+    durations = 1000.0 * np.arange(n)[:, None] + np.arange(n)[None, :]
+    np.fill_diagonal(durations, 0)
+    return durations
+
+def test_blocks_tile_the_matrix_once():
+    covered = np.zeros((7, 7), dtype=int)
+    for rows, cols in iter_blocks(7, 3):
+        covered[rows.start:rows.stop, cols.start:cols.stop] += 1
+    assert (covered == 1).all()
+
+@pytest.mark.anyio
+async def test_large_matrices_are_stitched_from_table_blocks(table, http_client):
+    matrix = await OSRMMatrixBackend(max_table_size=100, http_client=http_client).get_matrix(points(120))
+    np.testing.assert_array_equal(matrix.durations, expected(120))
+    np.testing.assert_array_equal(matrix.distances, 10 * expected(120))
+    # 50-point blocks: 3 diagonal blocks of 50 coordinates or fewer, 6 off-diagonal ones of up to 100
+    assert len(table.calls) == 9
+    assert max(table.calls) <= 100
+
+@pytest.mark.anyio
+async def test_unreachable_pairs_become_infinite(table, http_client):
+    table.unreachable = {(0, 2)}
+    matrix = await OSRMMatrixBackend(http_client=http_client).get_matrix(points(3))
+    assert np.isinf(matrix.durations[0, 2]) and np.isinf(matrix.distances[0, 2])
+    assert matrix.durations[2, 0] == 2000
@@ -0,0 +1,80 @@
+from datetime import datetime, timezone
+import numpy as np
+import pytest
+from routing.benchmarks.routing_benchmark import synthetic_route
+from routing.eta import SLOTS, RouteTimeline, SpeedProfiles, tour_arrival_times
+
+# A Monday at 03:00 and 08:00 UTC: free-flowing night and the morning rush
+NIGHT = datetime(2026, 10, 12, 3, tzinfo=timezone.utc).timestamp()
+RUSH = datetime(2026, 10, 12, 8, tzinfo=timezone.utc).timestamp()
+
+def flat_profiles(factor: float) -> SpeedProfiles:
+    return SpeedProfiles(default=np.full(SLOTS, factor))
+
+@pytest.fixture
+def route():
+    return synthetic_route(2000, 8, seed=0)
+
+def test_flat_profiles_reproduce_the_leg_durations(route):
+    expected = np.cumsum([leg['duration'] for leg in route['legs']])
+    timeline = RouteTimeline(route, flat_profiles(1.0))
+    assert timeline.free_flow_duration == pytest.approx(route['duration'])
+    np.testing.assert_allclose(timeline.stop_arrivals([NIGHT, RUSH]), [expected, expected])
+    np.testing.assert_allclose(RouteTimeline(route, flat_profiles(0.5)).stop_arrivals(NIGHT)[0], 2 * expected)
+
+def test_spans_stay_short_and_end_at_stops(route):
+    timeline = RouteTimeline(route, SpeedProfiles())
+    assert len(timeline.span_seconds) > route['duration'] / 300
+    assert set(timeline.stop_vertices) <= set(timeline.boundaries)
+    assert timeline.stop_vertices[-1] == len(route['geometry']['coordinates']) - 1
+
+def test_arrivals_match_stepping_through_the_profile(route):
+    profiles = SpeedProfiles()
+    timeline = RouteTimeline(route, profiles)
+    arrivals = timeline.stop_arrivals([NIGHT, RUSH])
+
+    for row, departure in enumerate([NIGHT, RUSH]):
+        # Drive each span in one-second steps at the factor of the moment
+        clock, elapsed = departure, [0.0]
+        for seconds, cell in zip(timeline.span_seconds, timeline.span_rows):
+            remaining = seconds
+            while remaining > 0:
+                factor = float(profiles.factors(cell, (clock + 3 * 86400) % (7 * 86400)))
+                step = min(1.0, remaining / factor)
+                remaining -= step * factor
+                clock += step
+            elapsed.append(clock - departure)
+        expected = np.asarray(elapsed)[timeline.stop_boundaries]
+        np.testing.assert_allclose(arrivals[row], expected, rtol=0.01)
+    # The rush hour costs time over the night
+    assert arrivals[1, -1] > 1.05 * arrivals[0, -1]
+
+def test_live_traffic_fades_into_the_profile(route):
+    timeline = RouteTimeline(route, flat_profiles(1.0))
+    live = np.full(len(timeline.span_seconds), 0.5)
+    now = timeline.stop_arrivals(NIGHT, live=live, now=NIGHT)[0, -1]
+    later = timeline.stop_arrivals(NIGHT + 6 * 3600, live=live, now=NIGHT)[0, -1]
+    assert now > 1.05 * route['duration']
+    assert later == pytest.approx(route['duration'], rel=1e-3)
+
+def test_profiles_learned_from_observations_round_trip(tmp_path):
+    # Four observations of half speed in one cell on Mondays at 08:xx
+    profiles = SpeedProfiles.from_observations([52.5] * 4, [13.4] * 4, [RUSH + 60 * i for i in range(4)], [0.5] * 4)
+    assert len(profiles) == 1
+    path = tmp_path / "profiles.npz"
+    profiles.save(str(path))
+    loaded = SpeedProfiles.load(str(path))
+
+    rows = loaded.rows([52.5, 48.1], [13.4, 11.6])
+    assert rows.tolist() == [1, 0]
+    slot_middle = 8.5 * 3600
+    assert loaded.factors(rows[0], slot_middle) == pytest.approx(0.5, abs=1 / 200)
+    assert loaded.factors(rows[1], slot_middle) == pytest.approx(profiles.default[8], abs=1e-6)
+
+def test_tour_arrivals_scale_each_leg_by_the_profile():
+    durations = np.array([[0, 600, 900], [600, 0, 300], [900, 300, 0]], dtype=float)
+    tours = [[0, 1, 2], [0, 2, 1]]
+    flat = tour_arrival_times(durations, tours, [NIGHT, RUSH], flat_profiles(1.0))
+    np.testing.assert_allclose(flat, [[[0, 600, 900], [0, 900, 1200]]] * 2)
+    slow = tour_arrival_times(durations, tours, [NIGHT], flat_profiles(0.5))
+    np.testing.assert_allclose(slow[0], 2 * flat[0])
@@ -0,0 +1,22 @@
+from routing.geocoding import MAX_CANDIDATES, PlaceIndex, own_place
+
+def learned_place(i: int) -> dict:
+    return {'id': f'upstream:{i}', 'name': f'Market Street {i}', 'address': f'Market Street {i}, Springfield'}
+
+def test_own_places_are_found_among_many_learned_ones():
+    index = PlaceIndex()
+    # Learned keys that sort before the depot's would fill the whole lookup window
+    for i in range(2 * MAX_CANDIDATES):
+        index.add(learned_place(i))
+    index.add_many([own_place({'lat': 1.0, 'lon': 2.0, 'name': 'Market Street Depot'})], own=True)
+    assert index.search('market street')[0]['name'] == 'Market Street Depot'
+
+def test_learned_places_are_capped_oldest_first():
+    index = PlaceIndex(max_learned=100)
+    index.add_many([own_place({'lat': 1.0, 'lon': 2.0, 'name': 'Market Hall'})], own=True)
+    for i in range(300):
+        index.add(learned_place(i))
+    assert len(index) == 101
+    assert index.search('market street 5 ') == []
+    assert [place['id'] for place in index.search('market street 299')] == ['upstream:299']
+    assert index.search('market hall')[0]['name'] == 'Market Hall'
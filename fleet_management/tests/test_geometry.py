@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+from routing.geometry import (EARTH_RADIUS, GeometryOptions, RouteSpatialIndex, decode_polyline,
+                              encode_polyline, format_routes, haversine, simplify, to_unit_vectors)
+
+def random_walk(n: int, seed: int) -> np.ndarray:
+    """[lon, lat] polyline wandering around Berlin in steps of up to ~100 m"""
+    steps = np.random.default_rng(seed).uniform(-1e-3, 1e-3, (n, 2))
+    return np.array([13.4, 52.5]) + np.cumsum(steps, axis=0)
+
+def brute_force_near(route: np.ndarray, points: np.ndarray, radius: float) -> np.ndarray:
+    """Exact point-to-segment distances from every point to every segment"""
+    xyz = to_unit_vectors(route) * EARTH_RADIUS
+    p = to_unit_vectors(points) * EARTH_RADIUS
+    a, b = xyz[:-1], xyz[1:]
+    ab, ap = b - a, p[:, None, :] - a[None, :, :]
+    t = np.clip(np.einsum('psk,sk->ps', ap, ab) / np.einsum('sk,sk->s', ab, ab), 0, 1)
+    distances = np.linalg.norm(ap - t[..., None] * ab, axis=2)
+    return (distances <= radius).any(axis=0)
+
+def test_haversine_between_berlin_and_paris():
+    assert haversine(52.52, 13.405, 48.8566, 2.3522) == pytest.approx(877_500, rel=1e-3)
+
+@pytest.mark.parametrize('radius', [50.0, 300.0, 1500.0])
+def test_segments_near_match_brute_force(radius):
+    route = random_walk(2000, 0)
+    points = random_walk(20, 1)
+    index = RouteSpatialIndex(route, cell_size=500.0)
+    expected = brute_force_near(route, points, radius)
+    np.testing.assert_array_equal(index.segments_near(points, radius), expected)
+    assert index.length_near(points, radius) == pytest.approx(index.segment_lengths[expected].sum())
+
+def test_points_far_from_the_route_touch_nothing():
+    index = RouteSpatialIndex(random_walk(100, 2))
+    assert not index.segments_near([{'lat': 48.1, 'lon': 11.6}], 1000).any()
+    assert index.length_near([], 1000) == 0.0
+
+def project(route: np.ndarray) -> np.ndarray:
+    scale = np.radians(1) * EARTH_RADIUS
+    return np.column_stack([route[:, 0] * scale * np.cos(np.radians(route[:, 1].mean())), route[:, 1] * scale])
+
+def douglas_peucker(xy: np.ndarray, first: int, last: int, tolerance: float) -> list:
+    """Textbook recursive Douglas-Peucker over projected points, kept indices in order"""
+    if last - first < 2:
+        return [first, last]
+    d, p = xy[last] - xy[first], xy[first + 1:last] - xy[first]
+    t = np.clip(p @ d / max(d @ d, 1e-12), 0, 1)
+    distances = np.linalg.norm(p - t[:, None] * d, axis=1)
+    farthest = first + 1 + int(np.argmax(distances))
+    if distances.max() <= tolerance:
+        return [first, last]
+    return douglas_peucker(xy, first, farthest, tolerance)[:-1] + douglas_peucker(xy, farthest, last, tolerance)
+
+def test_polyline_matches_the_reference_encoding():
+    # Example from Google's polyline documentation, as [lon, lat]
+    coordinates = [[-120.2, 38.5], [-120.95, 40.7], [-126.453, 43.252]]
+    assert encode_polyline(coordinates) == "_p~iF~ps|U_ulLnnqC_mqNvxq`@"
+    np.testing.assert_allclose(decode_polyline("_p~iF~ps|U_ulLnnqC_mqNvxq`@"), coordinates)
+    assert encode_polyline([]) == ""
+    assert decode_polyline("").shape == (0, 2)
+
+@pytest.mark.parametrize('precision', [5, 6])
+def test_polylines_round_trip_to_their_precision(precision):
+    route = random_walk(500, 3)
+    decoded = decode_polyline(encode_polyline(route, precision), precision)
+    np.testing.assert_allclose(decoded, route, atol=0.51 / 10 ** precision)
+
+@pytest.mark.parametrize('tolerance', [1.0, 10.0, 100.0])
+def test_simplify_matches_recursive_douglas_peucker(tolerance):
+    route = random_walk(1000, 4)
+    expected = douglas_peucker(project(route), 0, len(route) - 1, tolerance)
+    np.testing.assert_array_equal(simplify(route, tolerance), expected)
+
+def test_simplify_collapses_straight_lines():
+    line = np.column_stack([np.linspace(13.0, 13.5, 50), np.full(50, 52.5)])
+    np.testing.assert_array_equal(simplify(line, 1.0), [0, 49])
+    np.testing.assert_array_equal(simplify(line, 0), np.arange(50))
+
+def test_format_routes_encodes_every_nested_geometry():
+    route = random_walk(200, 5)
+    response = {'optimized_route': {'geometry': {'type': 'LineString', 'coordinates': route.tolist()},
+                                    'alternatives': [{'geometry': {'type': 'LineString', 'coordinates': route[:10]}}],
+                                    'stops': [{'lat': 52.5, 'lon': 13.4}]}}
+    assert format_routes(response, GeometryOptions()) is response
+
+    formatted = format_routes(response, GeometryOptions(format='polyline6', tolerance=5.0))['optimized_route']
+    assert formatted['geometry_format'] == 'polyline6'
+    np.testing.assert_allclose(decode_polyline(formatted['geometry'], 6), route[simplify(route, 5.0)], atol=1e-6)
+    assert formatted['alternatives'][0]['geometry_format'] == 'polyline6'
+    assert formatted['stops'] == [{'lat': 52.5, 'lon': 13.4}]
+    # The response itself is left as it was
+    assert isinstance(response['optimized_route']['geometry'], dict)
@@ -0,0 +1,32 @@
+import asyncio
+import httpx
+import pytest
+from routing.http_client import HTTPClient
+
+pytestmark = pytest.mark.anyio
+
+async def test_requests_per_host_are_capped():
+    active = {'a.example': 0, 'b.example': 0}
+    peak = dict(active)
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        host = request.url.host
+        active[host] += 1
+        peak[host] = max(peak[host], active[host])
+        await asyncio.sleep(0.01)
+        active[host] -= 1
+        return httpx.Response(200, json={'host': host})
+
+    client = HTTPClient(max_connections_per_host=3, transport=httpx.MockTransport(handler))
+    responses = await asyncio.gather(*(
+        client.get(f"http://{host}/route") for host in ('a.example', 'b.example') for _ in range(10)
+    ))
+    await client.aclose()
+    assert [response.json()['host'] for response in responses] == ['a.example'] * 10 + ['b.example'] * 10
+    assert peak == {'a.example': 3, 'b.example': 3}
+
+async def test_unset_query_parameters_are_dropped():
+    client = HTTPClient(transport=httpx.MockTransport(lambda request: httpx.Response(200, text=str(request.url))))
+    response = await client.get("http://a.example/search", params={'q': 'berlin', 'country': None})
+    await client.aclose()
+    assert response.text == "http://a.example/search?q=berlin"
@@ -0,0 +1,36 @@
+import pytest
+from routing.benchmarks.instances import generate_multi_point_request
+
+pytestmark = pytest.mark.anyio
+
+def metric_value(metrics: str, sample: str) -> float:
+    for line in metrics.splitlines():
+        if line.startswith(sample + " "):
+            return float(line.split()[-1])
+    return 0.0
+
+@pytest.mark.parametrize('client', [{"JOB_WORKERS": "1", "SERVER_TIMING": "true"}], indirect=True)
+async def test_worker_jobs_report_to_the_app_metrics(client, fake_upstream_app):
+    before = (await client.get("/metrics")).text
+    response = await client.post("/optimize-multi-point", json=generate_multi_point_request(20, 0))
+    assert response.status_code == 200
+    # Matrix and routing went through the app's client; the solve ran in the worker
+    assert fake_upstream_app.calls['table'] >= 1
+    timing = response.headers['server-timing']
+    assert 'matrix;' in timing and 'solve;' in timing and 'route;' in timing
+
+    after = (await client.get("/metrics")).text
+    for stage in ('matrix', 'solve', 'route'):
+        sample = f'routing_stage_duration_seconds_count{{stage="{stage}"}}'
+        assert metric_value(after, sample) == metric_value(before, sample) + 1
+
+async def test_finished_jobs_are_not_reused(client):
+    request = generate_multi_point_request(8, 1)
+    first = await client.post("/optimize-multi-point", json=request)
+    second = await client.post("/optimize-multi-point", json=request)
+    assert first.status_code == second.status_code == 200
+    # The second request is a new run with its own stored route, not the first one's result
+    assert first.json()['route_id'] != second.json()['route_id']
+
+    queued = await client.post("/jobs/multi-point", json=request)
+    assert queued.json()['deduplicated'] is False
@@ -0,0 +1,40 @@
+import json
+import pytest
+from routing.benchmarks.instances import generate_multi_point_request
+from routing.main import app, load_optimized_route
+
+pytestmark = pytest.mark.anyio
+
+async def test_failed_first_check_leaves_no_subscription(client, monkeypatch):
+    response = await client.post("/optimize-multi-point", json=generate_multi_point_request(5, 0))
+    route_id = response.json()['route_id']
+    route = await load_optimized_route(route_id, app.state.optimizer, app.state.route_store)
+    hub = app.state.live_updates
+
+    async def traffic_down(cells):
+        raise RuntimeError("traffic lookup failed")
+
+    monkeypatch.setattr(hub.optimizer, 'get_traffic_batch', traffic_down)
+    with pytest.raises(RuntimeError):
+        await hub.subscribe(route_id, route)
+    assert hub.stats() == {'routes': 0, 'subscribers': 0, 'cells': 0}
+
+async def test_traffic_outage_still_subscribes_without_alerts(client, monkeypatch):
+    from routing.metrics import UPSTREAM_FALLBACKS
+    from routing.resilience import CircuitOpen
+
+    response = await client.post("/optimize-multi-point", json=generate_multi_point_request(5, 0))
+    route_id = response.json()['route_id']
+    route = await load_optimized_route(route_id, app.state.optimizer, app.state.route_store)
+    hub = app.state.live_updates
+
+    async def traffic_down(cells):
+        raise CircuitOpen("traffic provider unavailable")
+
+    monkeypatch.setattr(hub.optimizer, 'get_traffic_batch', traffic_down)
+    fallbacks = UPSTREAM_FALLBACKS.state().get(('traffic', 'none'), 0)
+    subscription = await hub.subscribe(route_id, route)
+    message = json.loads(await subscription.next_message())
+    assert message['traffic_alerts'] == [] and not message['needs_rerouting']
+    assert UPSTREAM_FALLBACKS.state()[('traffic', 'none')] == fallbacks + 1
+    hub.unsubscribe(subscription)
@@ -0,0 +1,74 @@
+import heapq
+import numpy as np
+import pytest
+from routing import local_router
+from routing.local_router import LocalRoutingBackend, RoadGraph
+
+def grid_graph(size: int = 12, seed: int = 0) -> RoadGraph:
+    """Streets on a jittered grid with random travel times; a few are one-way"""
+    rng = np.random.default_rng(seed)
+    ids = np.arange(size * size).reshape(size, size)
+    lat = 52.5 + np.repeat(np.arange(size), size) * 0.002 + rng.uniform(0, 2e-4, size * size)
+    lon = 13.4 + np.tile(np.arange(size), size) * 0.003 + rng.uniform(0, 2e-4, size * size)
+    pairs = np.vstack([
+        np.column_stack((ids[:, :-1].ravel(), ids[:, 1:].ravel())),
+        np.column_stack((ids[:-1, :].ravel(), ids[1:, :].ravel())),
+    ])
+    two_way = rng.random(len(pairs)) > 0.1
+    sources = np.concatenate((pairs[:, 0], pairs[two_way, 1]))
+    targets = np.concatenate((pairs[:, 1], pairs[two_way, 0]))
+    duration = rng.uniform(10, 60, len(sources))
+    return RoadGraph.from_edges(lat, lon, sources, targets, duration, n_landmarks=4)
+
+def plain_dijkstra(graph: RoadGraph, source: int):
+    """Travel times from source, and the length along each fastest path"""
+    dist, length = {source: 0.0}, {source: 0.0}
+    heap = [(0.0, source)]
+    while heap:
+        d, u = heapq.heappop(heap)
+        if d > dist[u]:
+            continue
+        for e in range(graph.indptr[u], graph.indptr[u + 1]):
+            v, nd = int(graph.targets[e]), d + float(graph.duration[e])
+            if nd < dist.get(v, np.inf):
+                dist[v], length[v] = nd, length[u] + float(graph.length[e])
+                heapq.heappush(heap, (nd, v))
+    return dist, length
+
+@pytest.fixture(scope='module')
+def graph() -> RoadGraph:
+    return grid_graph()
+
+def test_shortest_paths_match_dijkstra(graph):
+    rng = np.random.default_rng(1)
+    for source, target in rng.integers(0, graph.n_nodes, (20, 2)).tolist():
+        dist, _ = plain_dijkstra(graph, source)
+        edges = graph.shortest_path(source, target)
+        nodes = graph.path_nodes(source, edges)
+        assert nodes[0] == source and nodes[-1] == target
+        # Consecutive edges join up
+        for e, tail in zip(edges, nodes):
+            assert graph.indptr[tail] <= e < graph.indptr[tail + 1]
+        assert float(graph.duration[edges].sum()) == pytest.approx(dist[target], rel=1e-5)
+
+@pytest.mark.parametrize('scipy', [True, False])
+def test_matrices_match_dijkstra(graph, monkeypatch, scipy):
+    if not scipy:
+        monkeypatch.setattr(local_router, 'csgraph_dijkstra', None)
+    nodes = [0, 17, 17, 60, graph.n_nodes - 1]
+    matrix = graph.many_to_many(nodes)
+    for i, source in enumerate(nodes):
+        dist, length = plain_dijkstra(graph, source)
+        np.testing.assert_allclose(matrix.durations[i], [dist[t] for t in nodes], rtol=1e-5)
+        np.testing.assert_allclose(matrix.distances[i], [length[t] for t in nodes], rtol=1e-5)
+
+@pytest.mark.anyio
+async def test_backend_routes_agree_with_its_matrix(graph):
+    backend = LocalRoutingBackend(graph)
+    points = [{'lat': float(graph.lat[n]), 'lon': float(graph.lon[n])} for n in (3, 80, 140)]
+    matrix = await backend.get_matrix(points)
+    routes = await backend.get_routes(points)
+    legs = routes[0]['legs']
+    assert [leg['duration'] for leg in legs] == pytest.approx([matrix.durations[0, 1], matrix.durations[1, 2]])
+    assert routes[0]['distance'] == pytest.approx(matrix.distances[0, 1] + matrix.distances[1, 2])
+    assert routes[0]['geometry']['coordinates'][0] == pytest.approx([points[0]['lon'], points[0]['lat']])
@@ -0,0 +1,54 @@
+import httpx
+import pytest
+from fastapi import FastAPI
+from routing.benchmarks.instances import generate_route_request
+from routing.metrics import Histogram, MetricsMiddleware, timed, upstream_endpoint
+
+def test_histograms_render_cumulative_buckets():
+    histogram = Histogram("latency_seconds", "Test latency", ["path"], buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 3):
+        histogram.observe(value, 'a"b')
+    lines = histogram.render().splitlines()
+    assert lines[:2] == ["# HELP latency_seconds Test latency", "# TYPE latency_seconds histogram"]
+    assert lines[2:] == [
+        'latency_seconds_bucket{path="a\\"b",le="0.1"} 2',
+        'latency_seconds_bucket{path="a\\"b",le="1"} 3',
+        'latency_seconds_bucket{path="a\\"b",le="+Inf"} 4',
+        'latency_seconds_sum{path="a\\"b"} 3.65',
+        'latency_seconds_count{path="a\\"b"} 4',
+    ]
+
+def test_upstream_endpoints_stop_before_coordinates():
+    assert upstream_endpoint("/route/v1/driving/13.4,52.5;13.5,52.6") == "route/v1/driving"
+    assert upstream_endpoint("/table/v1/driving/13.4,52.5") == "table/v1/driving"
+    assert upstream_endpoint("/traffic/services/4/flowSegmentData/absolute/10/json") == \
+        "traffic/services/4/flowSegmentData"
+
+@pytest.mark.anyio
+async def test_server_timing_lists_each_stage_and_the_total():
+    app = FastAPI()
+
+    @app.get("/work")
+    async def work():
+        with timed("solve"):
+            pass
+        with timed("solve"):
+            pass
+        return {}
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=MetricsMiddleware(app, server_timing=True)),
+                                 base_url="http://test") as client:
+        response = await client.get("/work")
+    stages = [part.split(";")[0] for part in response.headers["Server-Timing"].split(", ")]
+    assert stages == ["solve", "total"]
+
+@pytest.mark.anyio
+async def test_metrics_route_reports_stages_upstream_calls_and_caches(client):
+    response = await client.post("/route-update/metrics", json=generate_route_request(4, 0))
+    assert response.status_code == 200
+
+    body = (await client.get("/metrics")).text
+    assert 'routing_stage_duration_seconds_count{stage="route"}' in body
+    assert 'endpoint="route/v1/driving",status="200"}' in body
+    assert 'routing_http_request_duration_seconds_count{method="POST",route="/route-update/{route_id}",status="200"}' in body
+    assert 'routing_cache_misses_total{cache="route"}' in body
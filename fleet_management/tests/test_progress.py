@@ -0,0 +1,18 @@
+import pytest
+from routing.progress import RouteProgress
+
+def two_leg_route() -> dict:
+    """Two equally long legs along the equator; the second takes three times as long"""
+    return {
+        'geometry': {'coordinates': [[0.0, 0.0], [0.01, 0.0], [0.02, 0.0]]},
+        'distance': 2226, 'duration': 400,
+        'legs': [{'distance': 1113, 'duration': 100}, {'distance': 1113, 'duration': 300}],
+        'stops': [{'coordinates': {'lat': 0.0, 'lon': 0.01}}, {'coordinates': {'lat': 0.0, 'lon': 0.02}}]
+    }
+
+def test_remaining_duration_follows_each_legs_speed():
+    progress = RouteProgress(two_leg_route())
+    assert progress.summary()['remaining_duration'] == pytest.approx(400)
+    # Halfway by distance, but only the quick leg is done
+    assert progress.update({'lat': 0.0, 'lon': 0.01})['remaining_duration'] == pytest.approx(300)
+    assert progress.update({'lat': 0.0, 'lon': 0.015})['remaining_duration'] == pytest.approx(150)
@@ -0,0 +1,54 @@
+import json
+import time
+import pytest
+from routing.benchmarks.instances import generate_route_request
+
+pytestmark = pytest.mark.anyio
+
+async def test_batch_items_each_get_the_request_deadline(client, fake_upstream_app):
+    # Two at a time through a 100ms upstream takes well over the 1s deadline in total
+    fake_upstream_app.configure(latency_ms=100)
+    routes = [generate_route_request(3, seed) for seed in range(30)]
+    start = time.monotonic()
+    response = await client.post("/optimize-batch", json={"routes": routes, "max_concurrency": 2},
+                                 headers={"X-Request-Deadline": "1"})
+    elapsed = time.monotonic() - start
+
+    items = [json.loads(line) for line in response.text.splitlines()]
+    assert elapsed > 1
+    assert sorted(item['index'] for item in items) == list(range(len(routes)))
+    assert all('estimates' not in item['optimized_route'] for item in items)
+
+async def test_plain_requests_keep_the_deadline(client, fake_upstream_app):
+    fake_upstream_app.configure(latency_ms=300)
+    response = await client.post("/route-update/1", json=generate_route_request(3, 0),
+                                 headers={"X-Request-Deadline": "0.1"})
+    assert response.status_code == 200
+    assert response.json()['optimized_route']['estimates']['route'] == 'haversine'
+
+async def test_traffic_outage_falls_back_to_profile_etas(client, monkeypatch):
+    from routing.eta import RouteTimeline, parse_departure_time
+    from routing.main import app
+    from routing.resilience import CircuitOpen
+
+    optimizer = app.state.optimizer
+    request = generate_route_request(4, 0)
+
+    async def traffic_down(points):
+        raise CircuitOpen("traffic provider unavailable")
+
+    monkeypatch.setattr(optimizer.traffic, 'get_flows', traffic_down)
+    route_data = await optimizer.get_osm_route([request['depot']] + request['destinations'])
+    # Monday 08:00, departing now: only the rush-hour profile should slow the trip down
+    monday_rush = "2026-10-19T08:00:00+00:00"
+    monkeypatch.setattr(time, 'time', lambda: parse_departure_time(monday_rush).timestamp())
+    route = await optimizer.optimize_route(request['depot'], request['destinations'],
+                                           route_data=route_data, departure_time=monday_rush)
+
+    departure = parse_departure_time(monday_rush)
+    expected = RouteTimeline(route_data, optimizer.speed_profiles).stop_arrivals(
+        departure.timestamp(), departure.utcoffset().total_seconds()
+    )[0]
+    assert route['estimates']['traffic'] == 'profile'
+    assert route['duration_in_traffic'] == pytest.approx(float(expected[-1]))
+    assert route['duration_in_traffic'] > route['duration']
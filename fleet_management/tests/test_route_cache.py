@@ -0,0 +1,84 @@
+import asyncio
+import sqlite3
+import threading
+import time
+import pytest
+from routing import route_cache
+from routing.route_cache import RouteCache
+from routing.serialization import dumps
+
+def disk_keys(path) -> set:
+    with sqlite3.connect(path) as disk:
+        return {key for (key,) in disk.execute("SELECT key FROM route_cache")}
+
+def test_disk_entries_survive_a_restart(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = RouteCache(disk_path=path)
+    cache.set("a", {"distance": 1})
+    cache.close()
+
+    reopened = RouteCache(disk_path=path)
+    assert reopened.get("a") == {"distance": 1}
+    assert reopened.disk_hits == 1
+    reopened.close()
+
+def test_disk_table_drops_old_rows_and_stays_capped(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = RouteCache(ttl=0.01, stale_ttl=0, disk_path=path)
+    cache.set("expired", {"distance": 0})
+    time.sleep(0.05)
+    cache.ttl = 300
+    cache.max_disk_rows = 3
+    for i in range(5):
+        cache.set(f"route-{i}", {"distance": i})
+        time.sleep(0.001)
+    cache.close()
+    # The expired row is gone and only the three latest to expire remain
+    assert disk_keys(path) == {"route-2", "route-3", "route-4"}
+
+def route_like(n: int) -> list:
+    coordinates = [[13.4 + i * 1e-4, 52.5 + i * 1e-4] for i in range(n)]
+    return [{'distance': 1234.5, 'duration': 321.0, 'geometry': {'type': 'LineString', 'coordinates': coordinates},
+             'legs': [{'distance': 617.25, 'duration': 160.5, 'summary': 'Unter den Linden'}] * 2}]
+
+def test_sizes_are_estimated_without_encoding(monkeypatch):
+    value = route_like(2000)
+    actual = len(dumps(value))
+    monkeypatch.setattr(route_cache, 'dumps', None)
+    cache = RouteCache()
+    cache.set("a", value)
+    assert actual / 2 < cache.stats()['bytes'] < actual * 2
+
+@pytest.mark.anyio
+async def test_disk_reads_stay_off_the_event_loop(tmp_path, monkeypatch):
+    path = str(tmp_path / "cache.db")
+    cache = RouteCache(disk_path=path)
+    cache.set("a", route_like(10))
+    cache.close()
+
+    reopened = RouteCache(disk_path=path)
+    reader_threads = []
+    read_disk = reopened._read_disk
+    def recording_read(key):
+        reader_threads.append(threading.current_thread())
+        return read_disk(key)
+    monkeypatch.setattr(reopened, '_read_disk', recording_read)
+
+    fetches = 0
+    async def fetch():
+        nonlocal fetches
+        fetches += 1
+        await asyncio.sleep(0.01)
+        return route_like(1)
+
+    # Concurrent lookups of one key read the disk once; a missing key is fetched once
+    assert await asyncio.gather(*(reopened.get_or_fetch("a", fetch) for _ in range(3))) == [route_like(10)] * 3
+    # Sized from the bytes read rather than estimated
+    assert reopened.stats()['bytes'] == len(dumps(route_like(10)))
+    assert await asyncio.gather(*(reopened.get_or_fetch("b", fetch) for _ in range(3))) == [route_like(1)] * 3
+    assert fetches == 1
+    assert await reopened.get_stale("missing") is None
+    assert len(reader_threads) == 3
+    assert threading.current_thread() not in reader_threads
+    assert reopened.disk_hits == 1
+    reopened.close()
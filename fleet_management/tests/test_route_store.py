@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+from routing.benchmarks.instances import generate_multi_point_request, generate_route_request
+from routing.main import app
+from routing.route_store import RouteStore
+
+@pytest.fixture
+def store(tmp_path):
+    store = RouteStore(str(tmp_path / "routes.db"))
+    yield store
+    store.close()
+
+def test_records_round_trip_with_packed_geometry(store):
+    coordinates = [[13.4 + i * 1e-3, 52.5 + i * 1e-3] for i in range(50)]
+    result = {'distance': 1234.5, 'geometry': {'type': 'LineString', 'coordinates': coordinates},
+              'stops': [{'name': 'A'}]}
+    route_id = store.create(request={'depot': {'lat': 52.5, 'lon': 13.4}}, result=result, user_id='u1')
+
+    record = store.get(route_id)
+    assert record['user_id'] == 'u1'
+    assert record['request'] == {'depot': {'lat': 52.5, 'lon': 13.4}}
+    assert record['result']['stops'] == [{'name': 'A'}]
+    # polyline6 keeps coordinates to about 0.1m
+    assert np.allclose(record['result']['geometry']['coordinates'], coordinates, atol=1e-6, rtol=0)
+    assert store.get(route_id + 1) is None
+
+def test_conditional_writes_lose_to_newer_ones(store):
+    route_id = store.create(request={'depot': None})
+    read_at = store.updated_at(route_id)
+    assert store.set_result(route_id, {'n': 1}, expected_updated_at=read_at)
+    assert not store.set_result(route_id, {'n': 2}, expected_updated_at=read_at)
+    assert store.get(route_id)['result'] == {'n': 1}
+
+def test_list_routes_filters_by_user_and_time_newest_first(store):
+    ids = [store.create(request={}, user_id=user) for user in ('a', 'b', 'a')]
+    store.set_result(ids[2], {'done': True})
+
+    listed = store.list_routes(user_id='a')
+    assert [route['id'] for route in listed] == [ids[2], ids[0]]
+    assert [route['optimized'] for route in listed] == [True, False]
+    assert 'request' not in listed[0]
+
+    created = store.get(ids[1])['created_at']
+    assert [route['id'] for route in store.list_routes(since=created)] == [ids[2], ids[1]]
+    assert [route['id'] for route in store.list_routes(until=created)] == [ids[0]]
+    assert len(store.list_routes(limit=1)) == 1
+
+@pytest.mark.anyio
+async def test_stored_routes_are_served_without_optimizing_again(client):
+    multi_point = await client.post("/optimize-multi-point", json=generate_multi_point_request(5, 0))
+    route_ids = [multi_point.json()['route_id']]
+    set_route = await client.post("/set-route", json=generate_route_request(5, 1))
+    route_ids.append(set_route.json()['route_id'])
+
+    store = app.state.route_store
+    for route_id in route_ids:
+        first = await client.get(f"/optimized-route/{route_id}")
+        assert first.status_code == 200
+        written_at = store.updated_at(route_id)
+        again = (await client.get(f"/optimized-route/{route_id}")).json()['optimized_route']
+        assert again['eta'] == first.json()['optimized_route']['eta']
+        assert store.updated_at(route_id) == written_at
+
+        refreshed = await client.get(f"/optimized-route/{route_id}", params={'refresh': 'true'})
+        assert refreshed.status_code == 200
+        assert store.updated_at(route_id) > written_at
+        stops = refreshed.json()['optimized_route']['stops']
+        assert [stop['name'] for stop in stops] == [stop['name'] for stop in first.json()['optimized_route']['stops']]
+
+    assert (await client.get("/optimized-route/9999")).status_code == 404
@@ -0,0 +1,36 @@
+import httpx
+import pytest
+from routing.benchmarks import fake_upstream
+from routing.http_client import HTTPClient
+from routing.main import parse_depots
+from routing.route_cache import RouteCache
+from routing.route_optimizer import RouteOptimizer
+
+pytestmark = pytest.mark.anyio
+
+DEPOTS = "52.52,13.40;52.50,13.45;52.48,13.35"
+
+@pytest.fixture
+def optimizer(monkeypatch):
+    monkeypatch.setenv("TOMTOM_API_KEY", "test")
+    monkeypatch.setenv("OSRM_URL", "http://osrm.test")
+    http_client = HTTPClient(transport=httpx.ASGITransport(app=fake_upstream.app))
+    return RouteOptimizer(http_client=http_client, route_cache=RouteCache())
+
+def test_warmup_depots_are_parsed():
+    assert parse_depots(DEPOTS + ";") == [
+        {'lat': 52.52, 'lon': 13.40}, {'lat': 52.50, 'lon': 13.45}, {'lat': 52.48, 'lon': 13.35}
+    ]
+    assert parse_depots("") == []
+
+async def test_warm_up_caches_routes_between_depots(optimizer):
+    await optimizer.warm_up(parse_depots(DEPOTS))
+    # Every ordered pair of the three depots
+    assert optimizer.route_cache.stats()['entries'] == 6
+    await optimizer.http_client.aclose()
+
+async def test_warm_up_survives_an_unreachable_upstream(optimizer):
+    optimizer.http_client = HTTPClient(transport=httpx.MockTransport(lambda request: httpx.Response(503)))
+    await optimizer.warm_up(parse_depots(DEPOTS))
+    assert optimizer.route_cache.stats()['entries'] == 0
+    await optimizer.http_client.aclose()
@@ -0,0 +1,66 @@
+from datetime import datetime
+import pytest
+from routing.benchmarks.instances import generate_points, generate_route_request
+from routing.main import app
+
+pytestmark = pytest.mark.anyio
+
+def assert_consistent(route: dict):
+    """One leg per stop, totals matching the legs, and ETAs in stop order"""
+    assert len(route['legs']) == len(route['stops'])
+    assert route['distance'] == pytest.approx(sum(leg['distance'] for leg in route['legs']))
+    assert route['duration'] == pytest.approx(sum(leg['duration'] for leg in route['legs']))
+    etas = [datetime.fromisoformat(stop['eta']) for stop in route['stops']]
+    assert etas == sorted(etas)
+    assert datetime.fromisoformat(route['eta']) == etas[-1]
+
+async def stored_route(client) -> int:
+    response = await client.post("/set-route", json=generate_route_request(6, 0))
+    return response.json()['route_id']
+
+async def test_insert_then_remove_round_trip(client):
+    route_id = await stored_route(client)
+    original = (await client.get(f"/optimized-route/{route_id}")).json()['optimized_route']
+    numbers = {stop['number'] for stop in original['stops']}
+
+    new_stop = generate_points(1, 99)[0]
+    inserted = await client.post(f"/optimized-route/{route_id}/stops",
+                                 json={'lat': new_stop['lat'], 'lon': new_stop['lon'], 'name': 'Extra'})
+    assert inserted.status_code == 200
+    route = inserted.json()['optimized_route']
+    assert_consistent(route)
+    assert route['geometry_stale']
+    added = next(stop for stop in route['stops'] if stop['name'] == 'Extra')
+    assert added['number'] not in numbers
+
+    removed = await client.delete(f"/optimized-route/{route_id}/stops/{added['number']}")
+    assert removed.status_code == 200
+    route = removed.json()['optimized_route']
+    assert_consistent(route)
+    assert {stop['number'] for stop in route['stops']} == numbers
+
+    # The background refresh routes the edited order again and keeps the stops
+    editor = app.state.stop_editor
+    await editor.refresh_stored(route_id)
+    refreshed = app.state.route_store.get(route_id)['result']
+    assert 'geometry_stale' not in refreshed
+    assert [stop['number'] for stop in refreshed['stops']] == [stop['number'] for stop in route['stops']]
+    assert_consistent(refreshed)
+
+async def test_insert_at_a_given_position(client):
+    route_id = await stored_route(client)
+    response = await client.post(f"/optimized-route/{route_id}/stops",
+                                 json={'lat': 52.5, 'lon': 13.4, 'name': 'First', 'position': 0})
+    route = response.json()['optimized_route']
+    assert route['stops'][0]['name'] == 'First'
+    assert_consistent(route)
+
+    response = await client.post(f"/optimized-route/{route_id}/stops",
+                                 json={'lat': 52.5, 'lon': 13.4, 'position': 99})
+    assert response.status_code == 400
+
+async def test_missing_routes_and_stops_are_not_found(client):
+    route_id = await stored_route(client)
+    assert (await client.delete(f"/optimized-route/{route_id}/stops/999")).status_code == 404
+    assert (await client.delete("/optimized-route/424242/stops/1")).status_code == 404
+    assert (await client.post("/optimized-route/424242/stops", json={'lat': 52.5, 'lon': 13.4})).status_code == 404
@@ -0,0 +1,138 @@
+import json
+import re
+import httpx
+import numpy as np
+import pytest
+from routing import tomtom_service
+from routing.http_client import HTTPClient
+from routing.tomtom_service import TomTomService
+
+pytestmark = pytest.mark.anyio
+
+def points(n: int, offset: int = 0) -> list:
+    return [{'lat': (offset + i) * 0.01, 'lon': 13.0} for i in range(n)]
+
+def index_of(latitude: float) -> int:
+    return round(latitude / 0.01)
+
+def matrix_result(body: dict) -> dict:
+    """Cells whose duration encodes origin and destination: 1000 * origin + destination"""
+    origins = [index_of(o['point']['latitude']) for o in body['origins']]
+    destinations = [index_of(d['point']['latitude']) for d in body['destinations']]
+    return {'data': [
+        {'originIndex': i, 'destinationIndex': j,
+         'routeSummary': {'travelTimeInSeconds': 1000 * o + d, 'lengthInMeters': 10 * (1000 * o + d)}}
+        for i, o in enumerate(origins) for j, d in enumerate(destinations)
+    ]}
+
+def batch_result(body: dict) -> dict:
+    items = []
+    for item in body['batchItems']:
+        first = re.search(r"calculateRoute/([\d.]+),", item['query']).group(1)
+        seconds = index_of(float(first))
+        items.append({'statusCode': 200, 'response': {'routes': [
+            {'summary': {'travelTimeInSeconds': seconds, 'lengthInMeters': 10 * seconds}}
+        ]}})
+    return {'batchItems': items}
+
+class FakeTomTom:
+    """Matrix and batch endpoints; async jobs report InProgress `polls` times before finishing"""
+
+    def __init__(self, polls: int = 1, final_state: str = 'Completed'):
+        self.polls = polls
+        self.final_state = final_state
+        self.jobs = {}
+        self.requests = []
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        path = request.url.path
+        self.requests.append((request.method, path))
+        if path == '/routing/matrix/2':
+            return httpx.Response(200, json=matrix_result(json.loads(request.content)))
+        if path == '/routing/matrix/2/async':
+            job_id = str(len(self.jobs))
+            self.jobs[job_id] = [self.polls, matrix_result(json.loads(request.content))]
+            return httpx.Response(202, json={'jobId': job_id, 'state': 'Submitted'})
+        match = re.fullmatch(r"/routing/matrix/2/async/(\d+)(/result)?", path)
+        if match:
+            job = self.jobs[match.group(1)]
+            if match.group(2):
+                return httpx.Response(200, json=job[1])
+            job[0] -= 1
+            state = 'InProgress' if job[0] >= 0 else self.final_state
+            return httpx.Response(200, json={'jobId': match.group(1), 'state': state})
+        if path == '/routing/1/batch/sync/json':
+            return httpx.Response(200, json=batch_result(json.loads(request.content)))
+        if path == '/routing/1/batch/json':
+            batch_id = f"b{len(self.jobs)}"
+            self.jobs[batch_id] = [self.polls, batch_result(json.loads(request.content))]
+            return httpx.Response(202, headers={'Location': f"/routing/1/batch/{batch_id}"})
+        match = re.fullmatch(r"/routing/1/batch/(download/)?(b\d+)", path)
+        if match:
+            job = self.jobs[match.group(2)]
+            if match.group(1):
+                return httpx.Response(200, json=job[1])
+            job[0] -= 1
+            if job[0] >= 0:
+                return httpx.Response(202)
+            return httpx.Response(303, headers={'Location': f"/routing/1/batch/download/{match.group(2)}"})
+        return httpx.Response(404)
+
+@pytest.fixture
+def fake_tomtom(monkeypatch):
+    monkeypatch.setattr(tomtom_service, 'POLL_INTERVAL', 0.001)
+    monkeypatch.setattr(tomtom_service, 'POLL_MAX_INTERVAL', 0.001)
+    return FakeTomTom()
+
+@pytest.fixture
+async def service(fake_tomtom):
+    client = HTTPClient(max_connections_per_host=4, transport=httpx.MockTransport(fake_tomtom))
+    yield TomTomService("test", client)
+    await client.aclose()
+
+def expected_durations(origins: list, destinations: list) -> np.ndarray:
+    return np.array([[1000 * index_of(o['lat']) + index_of(d['lat']) for d in destinations] for o in origins],
+                    dtype=float)
+
+async def test_small_matrices_are_stitched_from_sync_blocks(service, fake_tomtom):
+    origins, destinations = points(20), points(25, offset=100)
+    matrix = await service.get_od_matrix(origins, destinations)
+    np.testing.assert_array_equal(matrix.durations, expected_durations(origins, destinations))
+    np.testing.assert_array_equal(matrix.distances, 10 * expected_durations(origins, destinations))
+    # 200-cell blocks are 14x14: 2 row blocks by 2 column blocks
+    assert fake_tomtom.requests.count(('POST', '/routing/matrix/2')) == 4
+    assert not matrix.estimated
+
+async def test_large_matrices_run_as_polled_async_jobs(service, fake_tomtom):
+    origins = points(60)
+    matrix = await service.get_matrix(origins)
+    expected = expected_durations(origins, origins)
+    np.fill_diagonal(expected, 0)
+    np.testing.assert_array_equal(matrix.durations, expected)
+    # 2500-cell jobs are 50x50: 2 by 2 jobs, each polled until Completed
+    assert fake_tomtom.requests.count(('POST', '/routing/matrix/2/async')) == 4
+    assert fake_tomtom.requests.count(('POST', '/routing/matrix/2')) == 0
+    assert all(job[0] < 0 for job in fake_tomtom.jobs.values())
+
+async def test_batches_over_the_sync_limit_are_polled(service, fake_tomtom):
+    routes = [points(2, offset=i) for i in range(150)]
+    result = await service.get_routes_batch(routes)
+    np.testing.assert_array_equal(result.durations, np.arange(150))
+    assert fake_tomtom.requests.count(('POST', '/routing/1/batch/json')) == 1
+    assert not result.estimated.any()
+
+@pytest.mark.parametrize("final_state", ['InProgress', 'Failed'])
+async def test_stuck_or_failed_matrix_jobs_fall_back_to_estimates(service, fake_tomtom, final_state):
+    fake_tomtom.final_state = final_state
+    service.poll_timeout = 0.05
+    matrix = await service.get_matrix(points(60))
+    assert matrix.estimated
+    assert np.isfinite(matrix.durations).all()
+    assert (matrix.durations[~np.eye(60, dtype=bool)] > 0).all()
+
+async def test_batch_poll_timeout_falls_back_to_estimates(service, fake_tomtom):
+    fake_tomtom.polls = 10 ** 6
+    service.poll_timeout = 0.05
+    result = await service.get_routes_batch([points(2, offset=i) for i in range(150)])
+    assert result.estimated.all()
+    assert np.isfinite(result.durations).all()
@@ -0,0 +1,53 @@
+import asyncio
+import pytest
+from routing.traffic import CachedTrafficProvider, TrafficProvider, flow
+
+pytestmark = pytest.mark.anyio
+
+# Two points a metre apart share a cell; the third is across town
+SAME_CELL = [(52.520000, 13.405000), (52.520008, 13.405008)]
+ELSEWHERE = (52.600000, 13.500000)
+
+class SlowProvider(TrafficProvider):
+    """Takes a while to answer and counts its calls; fails while `failing` is set"""
+
+    def __init__(self):
+        self.calls = 0
+        self.failing = False
+
+    async def get_flow(self, lat: float, lon: float):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        if self.failing:
+            raise RuntimeError("upstream down")
+        return flow(10 + lat)
+
+async def test_concurrent_lookups_in_one_cell_share_a_call():
+    provider = SlowProvider()
+    cached = CachedTrafficProvider(provider)
+    flows = await asyncio.gather(*(cached.get_flow(lat, lon) for lat, lon in SAME_CELL * 5))
+    assert provider.calls == 1
+    assert all(f is flows[0] for f in flows)
+    # Later lookups in the same bucket are served from the cache
+    await cached.get_flow(*SAME_CELL[1])
+    assert provider.calls == 1
+
+async def test_batches_make_one_call_per_cell():
+    provider = SlowProvider()
+    cached = CachedTrafficProvider(provider)
+    flows = await cached.get_flows(SAME_CELL + [ELSEWHERE] + SAME_CELL)
+    assert provider.calls == 2
+    assert flows[0] is flows[1] is flows[3]
+    assert flows[2]['current_speed'] == 10 + ELSEWHERE[0]
+
+async def test_failures_reach_every_waiter_and_are_not_cached():
+    provider = SlowProvider()
+    provider.failing = True
+    cached = CachedTrafficProvider(provider)
+    results = await asyncio.gather(*(cached.get_flow(*SAME_CELL[0]) for _ in range(3)), return_exceptions=True)
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert provider.calls == 1
+
+    provider.failing = False
+    assert (await cached.get_flow(*SAME_CELL[0]))['current_speed'] == 10 + SAME_CELL[0][0]
+    assert provider.calls == 2
@@ -0,0 +1,58 @@
+import itertools
+import numpy as np
+import pytest
+from routing.benchmarks.instances import generate_points, synthetic_matrix
+from routing.tsp_solver import (QUALITY_SETTINGS, Deadline, held_karp, local_search, nearest_neighbor,
+                                solve_tsp, tour_cost)
+
+pytestmark = pytest.mark.anyio
+
+def brute_force_cost(matrix: np.ndarray) -> float:
+    n = len(matrix)
+    return min(tour_cost(matrix, [0, *rest]) for rest in itertools.permutations(range(1, n)))
+
+def random_matrix(n: int, seed: int, symmetric: bool) -> np.ndarray:
+    matrix = np.random.default_rng(seed).uniform(1, 100, (n, n))
+    if symmetric:
+        matrix = (matrix + matrix.T) / 2
+    np.fill_diagonal(matrix, 0)
+    return matrix
+
+@pytest.mark.parametrize('n', [2, 3, 5, 8])
+@pytest.mark.parametrize('symmetric', [True, False])
+def test_held_karp_matches_brute_force(n, symmetric):
+    for seed in range(3):
+        matrix = random_matrix(n, seed, symmetric)
+        order = held_karp(matrix, Deadline(None), QUALITY_SETTINGS['balanced'])
+        assert order[0] == 0 and sorted(order) == list(range(n))
+        assert tour_cost(matrix, order) == pytest.approx(brute_force_cost(matrix))
+
+@pytest.mark.parametrize('symmetric', [True, False])
+def test_local_search_improves_on_nearest_neighbour(symmetric):
+    for seed in range(5):
+        matrix = random_matrix(8, seed, symmetric)
+        order = local_search(matrix, Deadline(None), QUALITY_SETTINGS['balanced'])
+        assert order[0] == 0 and sorted(order) == list(range(8))
+        cost = tour_cost(matrix, order)
+        assert brute_force_cost(matrix) - 1e-9 <= cost <= tour_cost(matrix, nearest_neighbor(matrix)) + 1e-9
+
+def test_thorough_solves_repeat_with_their_seed(monkeypatch):
+    monkeypatch.setenv("TSP_WORKERS", "1")
+    _, distances = synthetic_matrix(generate_points(20, 1))
+    first = solve_tsp(distances, quality='thorough', seed=7)
+    again = solve_tsp(distances, quality='thorough', seed=first['seed'])
+    assert first['order'] == again['order']
+
+def test_zero_time_budget_is_a_limit_not_unlimited():
+    assert Deadline(0).expired()
+    assert not Deadline(None).expired()
+    _, distances = synthetic_matrix(generate_points(60, 0))
+    solution = solve_tsp(distances, time_budget=0, quality='thorough')
+    assert sorted(solution['order']) == list(range(60))
+    assert solution['solve_time'] < 1
+
+async def test_requests_reject_non_positive_time_budgets(client):
+    response = await client.post("/optimize-multi-point", json={
+        "user_id": "u1", "routes": [], "time_budget": 0
+    })
+    assert response.status_code == 422
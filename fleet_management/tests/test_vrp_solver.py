@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+from pydantic import ValidationError
+from routing.benchmarks.instances import generate_vrp_instance
+from routing.main import FleetRequest
+from routing.vrp_solver import solve_vrp
+
+def assert_feasible(durations: np.ndarray, vehicles: list, orders: list, solution: dict):
+    """Check the plan against the raw inputs rather than the solver's own evaluation"""
+    assigned = [k for route in solution['routes'] for k in route['orders']]
+    assert len(assigned) == len(set(assigned))
+    assert sorted(assigned + solution['unassigned']) == list(range(len(orders)))
+
+    for vehicle, route in zip(vehicles, solution['routes']):
+        if not route['orders']:
+            # Unused vehicles stay at the depot
+            continue
+        assert sum(orders[k]['demand'] for k in route['orders']) <= vehicle['capacity']
+        t = vehicle['shift_start']
+        previous = vehicle['start']
+        for k, service_start in zip(route['orders'], route['service_starts']):
+            order = orders[k]
+            arrival = t + durations[previous, order['node']]
+            assert service_start == pytest.approx(max(arrival, order.get('tw_start', 0)))
+            assert service_start <= order.get('tw_end', np.inf) + 1e-6
+            t = service_start + order.get('service_time', 0)
+            previous = order['node']
+        assert t + durations[previous, vehicle['end']] <= vehicle['shift_end'] + 1e-6
+
+def line_instance(n_orders: int) -> tuple:
+    """Depot at 0 and orders at 1..n along a line, one minute apart"""
+    positions = np.arange(n_orders + 1, dtype=float)
+    durations = 60 * np.abs(positions[:, None] - positions[None, :])
+    return durations, durations * 10
+
+@pytest.mark.parametrize('clustered', [False, True])
+def test_generated_fleet_plans_are_feasible(clustered):
+    instance = generate_vrp_instance(60, 8, seed=3, clustered=clustered)
+    solution = solve_vrp(instance['durations'], instance['distances'],
+                         instance['vehicles'], instance['orders'], time_budget=2)
+    assert_feasible(instance['durations'], instance['vehicles'], instance['orders'], solution)
+    assert not solution['unassigned']
+
+def test_orders_beyond_capacity_stay_unassigned():
+    durations, distances = line_instance(10)
+    vehicles = [{'start': 0, 'end': 0, 'capacity': 3, 'shift_start': 0, 'shift_end': 86400}] * 2
+    orders = [{'node': k + 1, 'demand': 1} for k in range(10)]
+    solution = solve_vrp(durations, distances, vehicles, orders, time_budget=1)
+    assert_feasible(durations, vehicles, orders, solution)
+    assert len(solution['unassigned']) == 4
+
+def test_time_windows_decide_the_visit_order():
+    durations, distances = line_instance(2)
+    vehicles = [{'start': 0, 'end': 0, 'capacity': 10, 'shift_start': 0, 'shift_end': 86400}]
+    # The far order has to be served first, although the near one is on the way
+    orders = [
+        {'node': 1, 'demand': 1, 'tw_start': 3600, 'tw_end': 7200},
+        {'node': 2, 'demand': 1, 'tw_start': 0, 'tw_end': 600},
+    ]
+    solution = solve_vrp(durations, distances, vehicles, orders, time_budget=1)
+    assert_feasible(durations, vehicles, orders, solution)
+    assert solution['routes'][0]['orders'] == [1, 0]
+    assert solution['routes'][0]['service_starts'] == [120, 3600]
+
+def test_vehicles_that_cannot_return_in_their_shift_stay_empty():
+    durations, distances = line_instance(3)
+    vehicles = [
+        # Ends at the far end of the line, 3 minutes away, with a 2 minute shift
+        {'start': 0, 'end': 3, 'capacity': 10, 'shift_start': 0, 'shift_end': 120},
+        {'start': 0, 'end': 0, 'capacity': 10, 'shift_start': 0, 'shift_end': 86400},
+    ]
+    orders = [{'node': k + 1, 'demand': 1} for k in range(3)]
+    solution = solve_vrp(durations, distances, vehicles, orders, time_budget=1)
+    assert_feasible(durations, vehicles, orders, solution)
+    assert solution['routes'][0] == {'orders': [], 'service_starts': [], 'load': 0.0,
+                                     'duration': 0.0, 'distance': 0.0}
+    assert sorted(solution['routes'][1]['orders']) == [0, 1, 2]
+    assert solution['total_duration'] == 360
+
+def test_orders_stay_unassigned_when_no_vehicle_is_usable():
+    durations, distances = line_instance(2)
+    vehicles = [{'start': 0, 'end': 2, 'capacity': 10, 'shift_start': 0, 'shift_end': 60}]
+    solution = solve_vrp(durations, distances, vehicles, [{'node': 1, 'demand': 1}], time_budget=1)
+    assert solution['unassigned'] == [0]
+    assert solution['total_duration'] == 0
+
+def test_fleet_requests_need_vehicles_with_valid_shifts():
+    depot = {'lat': 52.52, 'lon': 13.40}
+    order = {'id': 'o1', 'location': depot}
+    vehicle = {'id': 'v1', 'capacity': 5, 'start_depot': depot}
+    FleetRequest(vehicles=[vehicle], orders=[order])
+    for invalid in ([], [{**vehicle, 'shift_start': 3600, 'shift_end': 3600}], [{**vehicle, 'capacity': -1}]):
+        with pytest.raises(ValidationError):
+            FleetRequest(vehicles=invalid, orders=[order])